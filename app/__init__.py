@@ -88,7 +88,7 @@ def create_app(config_name=None):
         return User.query.get(int(user_id))
     
     # Registrar blueprints
-    from app.routes import auth, main, folders, listar_dropbox, users, usuarios, web_register, admin, tutoriales
+    from app.routes import auth, main, folders, listar_dropbox, users, usuarios, web_register, admin, tutoriales, metrics, trabajos
     app.register_blueprint(auth.bp)
     app.register_blueprint(main.bp)
     app.register_blueprint(folders.bp)
@@ -98,11 +98,21 @@ def create_app(config_name=None):
     app.register_blueprint(web_register.bp)
     app.register_blueprint(admin.admin_bp)
     app.register_blueprint(tutoriales.bp)
+    app.register_blueprint(metrics.bp)
+    app.register_blueprint(trabajos.bp)
     
     # Configurar eventos de SQLAlchemy
     from app.events import setup_events
     setup_events()
 
+    # Perfilado por petición (opcional)
+    from app import request_profiler
+    request_profiler.init_app(app)
+
+    # Respuesta 503 + Retry-After cuando Dropbox sigue limitando
+    from app import dropbox_rate_limit
+    dropbox_rate_limit.init_app(app)
+
     # Inicializar el gestor de tokens de Dropbox una vez cargada la config
     try:
         from app.dropbox_token_manager import get_token_manager
@@ -182,19 +192,12 @@ def create_app(config_name=None):
         """Inyecta las últimas 5 notificaciones del usuario autenticado para el header."""
         try:
             from flask_login import current_user as cu
-            from app.models import Notification
             if cu.is_authenticated:
-                try:
-                    from app.utils.notification_utils import marcar_notificaciones_archivos_fuera_de_revision_como_leidas
-                    marcar_notificaciones_archivos_fuera_de_revision_como_leidas(cu.id)
-                except Exception:
-                    # Si falla el auto-marcado, no bloquea el render del header
-                    pass
-                ultimas = Notification.query \
-                    .filter_by(user_id=cu.id) \
-                    .order_by(Notification.fecha_creacion.desc()) \
-                    .limit(5).all()
-                unread_count = Notification.query.filter_by(user_id=cu.id, leida=False).count()
+                from app.utils.notification_feed import contar_difundidas_no_leidas, lector, obtener_feed
+                usuario = lector(cu.id)
+                ultimas = obtener_feed(usuario, 5)
+                # Contador desnormalizado (User.notificaciones_no_leidas) más las difundidas a su rol
+                unread_count = (usuario.notificaciones_no_leidas or 0) + contar_difundidas_no_leidas(usuario)
             else:
                 ultimas = []
                 unread_count = 0
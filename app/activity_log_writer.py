@@ -0,0 +1,246 @@
+"""
+Escritura en lote del registro de actividad (``UserActivityLog``).
+
+``User.registrar_actividad``, ``activity_logger.log_user_activity`` y el
+login hacían ``db.session.add`` + ``commit`` dentro de la petición por cada
+entrada (algunas rutas registran dos veces), y ``registrar_actividad`` además
+actualizaba ``ultimo_acceso``: cada vista pagaba uno o dos commits con fsync
+solo para auditoría.
+
+Ahora ``registrar`` deja la entrada en una cola del proceso y responde. Un
+hilo la vacía con un INSERT multi-fila (y un UPDATE por lote de
+``ultimo_acceso``, conservando el valor más reciente) cuando se juntan
+``ACTIVITY_LOG_BATCH_SIZE`` entradas o pasan ``ACTIVITY_LOG_FLUSH_SECONDS``.
+Al terminar el proceso (atexit y el hook ``worker_exit`` de gunicorn.conf.py)
+se vacía lo pendiente. Si la cola llega a ``ACTIVITY_LOG_MAX_QUEUE`` el
+llamador vacía la cola él mismo en lugar de descartar entradas. Si el lote
+falla se reintenta fila por fila: las filas que siguen fallando se registran
+en el log y se descartan, y si la BD no está disponible se reencolan.
+
+Con ``ACTIVITY_LOG_MODE = 'sync'`` (pruebas) cada entrada se escribe y se
+confirma en la sesión de la petición, como antes.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import bindparam, insert, or_, update
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+FLUSH_SECONDS = 2.0
+MAX_QUEUE = 10000
+
+
+def _entrada(user_id, accion, descripcion, ip_address, user_agent):
+    if has_request_context():
+        if ip_address is None:
+            ip_address = request.remote_addr
+        if user_agent is None:
+            user_agent = request.headers.get('User-Agent', '')
+    return {
+        'user_id': user_id,
+        'accion': (accion or '')[:100],
+        'descripcion': descripcion[:255] if descripcion else descripcion,
+        'ip_address': ip_address[:45] if ip_address else ip_address,
+        'user_agent': user_agent[:255] if user_agent else user_agent,
+        'fecha': datetime.utcnow(),
+    }
+
+
+def escribir(connection, entradas, accesos):
+    """INSERT multi-fila de ``entradas`` y UPDATE por lote de ``accesos`` ({user_id: fecha})."""
+    from app.models import User, UserActivityLog
+
+    if entradas:
+        connection.execute(insert(UserActivityLog.__table__), entradas)
+    if accesos:
+        tabla = User.__table__
+        connection.execute(
+            update(tabla)
+            .where(
+                tabla.c.id == bindparam('b_id'),
+                or_(tabla.c.ultimo_acceso.is_(None), tabla.c.ultimo_acceso < bindparam('b_fecha')),
+            )
+            .values(ultimo_acceso=bindparam('b_fecha')),
+            [{'b_id': user_id, 'b_fecha': fecha} for user_id, fecha in accesos.items()],
+        )
+
+
+class ActivityLogWriter:
+    """Cola en memoria del proceso con un hilo que la escribe por lotes."""
+
+    def __init__(self, app, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, max_queue=MAX_QUEUE):
+        self.app = app
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.max_queue = max(self.batch_size, max_queue)
+        self._entradas = []
+        self._accesos = {}
+        self._lock = threading.Lock()
+        # Serializa las escrituras (hilo de fondo, backpressure y cierre)
+        self._flush_lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+        self._hilo.start()
+        return self
+
+    def pendientes(self):
+        with self._lock:
+            return len(self._entradas)
+
+    def agregar(self, entrada, tocar_acceso=False):
+        with self._lock:
+            self._entradas.append(entrada)
+            if tocar_acceso:
+                anterior = self._accesos.get(entrada['user_id'])
+                if anterior is None or anterior < entrada['fecha']:
+                    self._accesos[entrada['user_id']] = entrada['fecha']
+            total = len(self._entradas)
+        if total >= self.max_queue:
+            # La BD no da abasto: escribir aquí antes que perder entradas
+            self.flush()
+        elif total >= self.batch_size:
+            self._despertar.set()
+
+    def _transaccion(self, entradas, accesos):
+        with self.app.app_context():
+            try:
+                escribir(db.session.connection(), entradas, accesos)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _reencolar(self, entradas, accesos):
+        with self._lock:
+            # Reintentar en la próxima vuelta sin superar el máximo de la cola
+            espacio = max(0, self.max_queue - len(self._entradas))
+            if espacio < len(entradas):
+                logger.error(f"Registro de actividad: se descartan {len(entradas) - espacio} entradas")
+            self._entradas[:0] = entradas[:espacio]
+            for user_id, fecha in accesos.items():
+                if self._accesos.get(user_id) is None or self._accesos[user_id] < fecha:
+                    self._accesos[user_id] = fecha
+
+    def _escribir_por_fila(self, entradas, accesos):
+        """
+        Tras fallar el lote, escribe cada entrada en su propia transacción para
+        que una fila inválida no bloquee al resto: las que vuelven a fallar se
+        registran en el log y se descartan. Si la BD no está disponible
+        (``OperationalError``/``InterfaceError``) se reencola lo que falta.
+        """
+        escritas = 0
+        for i, entrada in enumerate(entradas):
+            try:
+                self._transaccion([entrada], {})
+                escritas += 1
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f"Registro de actividad: BD no disponible, se reencolan {len(entradas) - i} entradas: {e}")
+                self._reencolar(entradas[i:], accesos)
+                return escritas
+            except Exception as e:
+                logger.error(f"Registro de actividad: se descarta la entrada {entrada!r}: {e}")
+        if accesos:
+            try:
+                self._transaccion([], accesos)
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f"Registro de actividad: no se pudo actualizar ultimo_acceso, se reencola: {e}")
+                self._reencolar([], accesos)
+            except Exception as e:
+                logger.error(f"Registro de actividad: se descarta la actualización de ultimo_acceso {accesos!r}: {e}")
+        return escritas
+
+    def flush(self):
+        """Escribe todo lo pendiente. Retorna cuántas entradas escribió."""
+        with self._flush_lock:
+            with self._lock:
+                entradas, self._entradas = self._entradas, []
+                accesos, self._accesos = self._accesos, {}
+            if not entradas and not accesos:
+                return 0
+            try:
+                self._transaccion(entradas, accesos)
+                return len(entradas)
+            except Exception as e:
+                logger.error(f"No se pudo escribir el registro de actividad en lote ({len(entradas)} entradas): {e}")
+                return self._escribir_por_fila(entradas, accesos)
+
+    def _run(self):
+        while not self._detener.is_set():
+            self._despertar.wait(self.flush_seconds)
+            self._despertar.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Error en el escritor del registro de actividad: {e}")
+
+    def cerrar(self, timeout=10):
+        """Detiene el hilo y escribe lo pendiente (al terminar el proceso)."""
+        self._detener.set()
+        self._despertar.set()
+        if self._hilo is not None and self._hilo is not threading.current_thread():
+            self._hilo.join(timeout)
+        inicio = time.monotonic()
+        while self.pendientes() and time.monotonic() - inicio < timeout:
+            if not self.flush():
+                break
+
+
+# Escritor del proceso (se recrea tras el fork de gunicorn)
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_activity_writer():
+    global _writer, _writer_pid
+
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            app = current_app._get_current_object()
+            cfg = app.config
+            _writer = ActivityLogWriter(
+                app,
+                batch_size=int(cfg.get('ACTIVITY_LOG_BATCH_SIZE') or BATCH_SIZE),
+                flush_seconds=float(cfg.get('ACTIVITY_LOG_FLUSH_SECONDS') or FLUSH_SECONDS),
+                max_queue=int(cfg.get('ACTIVITY_LOG_MAX_QUEUE') or MAX_QUEUE),
+            ).iniciar()
+            _writer_pid = os.getpid()
+            atexit.register(_writer.cerrar)
+    return _writer
+
+
+def cerrar_writer():
+    """Vacía el escritor de este proceso si existe (hook ``worker_exit`` de gunicorn)."""
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.cerrar()
+
+
+def registrar(user_id, accion, descripcion=None, ip_address=None, user_agent=None, tocar_acceso=False):
+    """
+    Registra una actividad de ``user_id``. ``tocar_acceso`` actualiza también
+    ``User.ultimo_acceso``. En modo ``buffered`` no toca la sesión de la
+    petición ni hace commit.
+    """
+    entrada = _entrada(user_id, accion, descripcion, ip_address, user_agent)
+    if current_app.config.get('ACTIVITY_LOG_MODE', 'buffered') == 'sync':
+        escribir(db.session.connection(), [entrada], {user_id: entrada['fecha']} if tocar_acceso else {})
+        db.session.commit()
+        return entrada
+    get_activity_writer().agregar(entrada, tocar_acceso)
+    return entrada
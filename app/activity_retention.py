@@ -0,0 +1,311 @@
+"""
+Retención del registro de actividad (``UserActivityLog``).
+
+La tabla crecía sin límite (una fila por login, vista de dashboard, búsqueda
+o subida) y la leen ``get_recent_activity``, los "usuarios más activos" del
+dashboard y cuatro endpoints de historial.
+
+Aquí la tabla solo guarda la ventana caliente (``ACTIVITY_LOG_HOT_DAYS``).
+``archivar`` mueve lo anterior, por lotes y en orden de id, a segmentos
+JSON Lines comprimidos con gzip por mes (UTC) y cubeta de usuarios
+(``user_id % CUBETAS``) en ``ACTIVITY_ARCHIVE_DIR``:
+
+- Cada segmento se escribe completo (archivo temporal + rename) antes de
+  borrar sus filas; el borrado, el registro del segmento en
+  ``actividad_archivada`` y los totales por usuario y mes en
+  ``resumen_actividad`` van en la misma transacción. Si el proceso muere a
+  mitad, el segmento huérfano no está en el catálogo y se ignora.
+- ``compactar`` une los segmentos de los meses ya cerrados en un archivo por
+  cubeta (y reparte por cubetas los segmentos antiguos que no tenían).
+- ``historial_actividad`` completa el historial de un usuario con los
+  segmentos de su cubeta en los meses en que tuvo actividad (según
+  ``resumen_actividad``) cuando la ventana caliente no alcanza: no abre los
+  segmentos del resto de usuarios.
+
+Se ejecuta de forma incremental con ``python manage.py activity_retention``
+(p. ej. desde cron); un lock de archivo evita dos ejecuciones a la vez.
+"""
+import gzip
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+HOT_DAYS = 90
+LOTE = 5000
+# Usuarios por archivo de segmento: user_id % CUBETAS. Cambiarlo obliga a
+# reescribir los segmentos existentes (su cubeta queda en el catálogo).
+CUBETAS = 16
+COLUMNAS = ('id', 'user_id', 'accion', 'descripcion', 'ip_address', 'user_agent', 'fecha')
+
+
+class RegistroArchivado:
+    """Actividad leída de un segmento, con los atributos de ``UserActivityLog``."""
+
+    __slots__ = COLUMNAS
+
+    def __init__(self, datos):
+        for columna in COLUMNAS:
+            setattr(self, columna, datos.get(columna))
+        if self.fecha:
+            self.fecha = datetime.fromisoformat(self.fecha)
+
+
+def directorio_archivo():
+    return current_app.config.get('ACTIVITY_ARCHIVE_DIR') or os.path.join(
+        current_app.instance_path, 'activity_archive'
+    )
+
+
+def _mes(fecha):
+    return fecha.strftime('%Y-%m')
+
+
+def _fecha(valor):
+    # Los registros leídos de un segmento traen la fecha en ISO
+    return datetime.fromisoformat(valor) if isinstance(valor, str) else valor
+
+
+def cubeta(user_id):
+    return (user_id or 0) % CUBETAS
+
+
+@contextmanager
+def _lock(directorio):
+    os.makedirs(directorio, exist_ok=True)
+    with open(os.path.join(directorio, '.lock'), 'w') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError("Otra ejecución de la retención de actividad está en curso")
+        yield
+
+
+def _escribir_segmento(directorio, relativa, registros):
+    """Escribe ``registros`` (dicts) como JSON Lines + gzip de forma atómica."""
+    destino = os.path.join(directorio, relativa)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporal = f"{destino}.tmp"
+    with gzip.open(temporal, 'wt', encoding='utf-8') as f:
+        for registro in registros:
+            f.write(json.dumps(registro, ensure_ascii=False, default=str))
+            f.write('\n')
+    with open(temporal, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temporal, destino)
+
+
+def leer_segmento(relativa, directorio=None):
+    """Itera los registros (dicts) de un segmento."""
+    with gzip.open(os.path.join(directorio or directorio_archivo(), relativa), 'rt', encoding='utf-8') as f:
+        for linea in f:
+            if linea.strip():
+                yield json.loads(linea)
+
+
+def _sumar_resumen(connection, totales):
+    from app.models import ResumenActividad
+
+    tabla = ResumenActividad.__table__
+    dialecto = connection.dialect.name
+    for (user_id, mes), total in totales.items():
+        if dialecto in ('postgresql', 'sqlite'):
+            modulo = postgresql if dialecto == 'postgresql' else sqlite
+            connection.execute(
+                modulo.insert(tabla)
+                .values(user_id=user_id, mes=mes, total=total)
+                .on_conflict_do_update(index_elements=['user_id', 'mes'], set_={'total': tabla.c.total + total})
+            )
+            continue
+        res = connection.execute(
+            update(tabla)
+            .where(tabla.c.user_id == user_id, tabla.c.mes == mes)
+            .values(total=tabla.c.total + total)
+        )
+        if res.rowcount == 0:
+            connection.execute(insert(tabla).values(user_id=user_id, mes=mes, total=total))
+
+
+def _segmento(directorio, mes, cubeta_, registros, prefijo):
+    """Escribe ``registros`` (en orden de id) y retorna su fila de ``actividad_archivada``."""
+    desde, hasta = registros[0]['id'], registros[-1]['id']
+    relativa = os.path.join(mes, f"{prefijo}-{desde}-{hasta}-c{cubeta_}.jsonl.gz")
+    _escribir_segmento(directorio, relativa, registros)
+    return {
+        'mes': mes, 'cubeta': cubeta_, 'ruta': relativa, 'id_desde': desde, 'id_hasta': hasta,
+        'filas': len(registros),
+        'fecha_desde': min(_fecha(r['fecha']) for r in registros),
+        'fecha_hasta': max(_fecha(r['fecha']) for r in registros),
+        'fecha_creacion': datetime.utcnow(),
+    }
+
+
+def _archivar_lote(directorio, limite, lote):
+    from app.models import ActividadArchivada, UserActivityLog
+
+    tabla = UserActivityLog.__table__
+    filas = db.session.execute(
+        select(*(tabla.c[c] for c in COLUMNAS))
+        .where(tabla.c.fecha < limite)
+        .order_by(tabla.c.id)
+        .limit(lote)
+    ).mappings().all()
+    if not filas:
+        return 0
+
+    por_segmento = defaultdict(list)
+    for fila in filas:
+        por_segmento[(_mes(fila['fecha']), cubeta(fila['user_id']))].append(dict(fila))
+
+    connection = db.session.connection()
+    segmentos = []
+    totales = Counter()
+    for (mes, cubeta_), registros in sorted(por_segmento.items()):
+        segmentos.append(_segmento(directorio, mes, cubeta_, registros, "segmento"))
+        for registro in registros:
+            totales[(registro['user_id'], mes)] += 1
+
+    ids = [fila['id'] for fila in filas]
+    for i in range(0, len(ids), 500):
+        connection.execute(delete(tabla).where(tabla.c.id.in_(ids[i:i + 500])))
+    connection.execute(insert(ActividadArchivada.__table__), segmentos)
+    _sumar_resumen(connection, totales)
+    db.session.commit()
+    return len(filas)
+
+
+def archivar(hot_days=None, lote=LOTE, max_lotes=None):
+    """
+    Mueve a segmentos comprimidos las actividades más antiguas que la ventana
+    caliente. Retorna ``{'filas': n, 'lotes': n, 'limite': fecha}``.
+    """
+    if hot_days is None:
+        hot_days = int(current_app.config.get('ACTIVITY_LOG_HOT_DAYS') or HOT_DAYS)
+    limite = datetime.utcnow() - timedelta(days=hot_days)
+    directorio = directorio_archivo()
+    resumen = {'filas': 0, 'lotes': 0, 'limite': limite}
+    with _lock(directorio):
+        while max_lotes is None or resumen['lotes'] < max_lotes:
+            try:
+                movidas = _archivar_lote(directorio, limite, lote)
+            except Exception:
+                db.session.rollback()
+                raise
+            if not movidas:
+                break
+            resumen['filas'] += movidas
+            resumen['lotes'] += 1
+            logger.info(f"Actividad archivada: {movidas} filas (total {resumen['filas']})")
+    return resumen
+
+
+def compactar(hot_days=None):
+    """
+    Une los segmentos de cada mes ya cerrado (anterior al mes del límite de la
+    ventana caliente) en un archivo por cubeta. Retorna los meses compactados.
+    """
+    from app.models import ActividadArchivada
+
+    if hot_days is None:
+        hot_days = int(current_app.config.get('ACTIVITY_LOG_HOT_DAYS') or HOT_DAYS)
+    mes_limite = _mes(datetime.utcnow() - timedelta(days=hot_days))
+    directorio = directorio_archivo()
+    compactados = []
+    with _lock(directorio):
+        # Meses con más de un segmento en alguna cubeta o con segmentos sin cubeta
+        meses = db.session.execute(
+            select(ActividadArchivada.mes)
+            .where(ActividadArchivada.mes < mes_limite)
+            .group_by(ActividadArchivada.mes)
+            .having(db.or_(
+                db.func.count(ActividadArchivada.id) > db.func.count(db.distinct(ActividadArchivada.cubeta)),
+                db.func.count(ActividadArchivada.id) > db.func.count(ActividadArchivada.cubeta),
+            ))
+            .order_by(ActividadArchivada.mes)
+        ).scalars().all()
+        for mes in meses:
+            segmentos = ActividadArchivada.query.filter_by(mes=mes).order_by(ActividadArchivada.id_desde).all()
+            por_cubeta = defaultdict(list)
+            for segmento in segmentos:
+                for registro in leer_segmento(segmento.ruta, directorio):
+                    por_cubeta[cubeta(registro.get('user_id'))].append(registro)
+            nuevos = []
+            for cubeta_, registros in sorted(por_cubeta.items()):
+                registros.sort(key=lambda r: r['id'])
+                nuevos.append(_segmento(directorio, mes, cubeta_, registros, mes))
+            rutas_nuevas = {n['ruta'] for n in nuevos}
+            anteriores = [s.ruta for s in segmentos]
+            try:
+                for segmento in segmentos:
+                    db.session.delete(segmento)
+                db.session.flush()
+                db.session.execute(insert(ActividadArchivada.__table__), nuevos)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            for ruta in anteriores:
+                if ruta not in rutas_nuevas:
+                    try:
+                        os.remove(os.path.join(directorio, ruta))
+                    except OSError as e:
+                        logger.warning(f"No se pudo borrar el segmento compactado {ruta}: {e}")
+            compactados.append(mes)
+            logger.info(f"Actividad de {mes} compactada: {len(segmentos)} segmentos -> {len(nuevos)} cubetas")
+    return compactados
+
+
+def historial_actividad(user_id, limit=50):
+    """
+    Actividades de ``user_id`` (más recientes primero): la tabla caliente y,
+    si no alcanza ``limit``, los segmentos archivados.
+    """
+    from app.models import ActividadArchivada, ResumenActividad, UserActivityLog
+
+    actividades = UserActivityLog.query.filter_by(user_id=user_id) \
+        .order_by(UserActivityLog.fecha.desc()) \
+        .limit(limit) \
+        .all()
+    if len(actividades) >= limit:
+        return actividades
+
+    meses = db.session.execute(
+        select(ResumenActividad.mes)
+        .where(ResumenActividad.user_id == user_id, ResumenActividad.total > 0)
+        .order_by(ResumenActividad.mes.desc())
+    ).scalars().all()
+    for mes in meses:
+        # Solo los segmentos de su cubeta (y los antiguos sin cubeta)
+        rutas = db.session.execute(
+            select(ActividadArchivada.ruta).where(
+                ActividadArchivada.mes == mes,
+                db.or_(ActividadArchivada.cubeta == cubeta(user_id), ActividadArchivada.cubeta.is_(None)),
+            )
+        ).scalars().all()
+        del_mes = []
+        for ruta in rutas:
+            try:
+                del_mes.extend(RegistroArchivado(r) for r in leer_segmento(ruta) if r.get('user_id') == user_id)
+            except OSError as e:
+                logger.error(f"No se pudo leer el segmento de actividad {ruta}: {e}")
+        del_mes.sort(key=lambda r: (r.fecha or datetime.min, r.id), reverse=True)
+        actividades.extend(del_mes[:limit - len(actividades)])
+        if len(actividades) >= limit:
+            break
+    return actividades
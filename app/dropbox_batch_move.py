@@ -0,0 +1,365 @@
+"""
+Movimiento masivo de archivos entre carpetas de Dropbox en segundo plano.
+
+``exportar_archivos_carpeta`` recorría los ``Archivo`` de la carpeta origen
+uno a uno: ``files_create_folder_v2`` de su carpeta, ``files_move_v2`` y
+``commit`` por archivo. Con miles de archivos eran 3N llamadas síncronas
+dentro de una petición limitada por el timeout de gunicorn (300 s).
+
+Aquí la ruta solo crea un ``MovimientoLote`` y lo encola en la cola de
+trabajos (``app/job_runner.py``, tarea ``exportar_carpeta``):
+
+1. Se calculan una vez las rutas destino y las carpetas que necesitan; se
+   crean con ``files_create_folder_batch`` (solo las más profundas: Dropbox
+   crea las intermedias).
+2. Los archivos se mueven en bloques de ``files_move_batch_v2`` (hasta 1000
+   por llamada), consultando el trabajo asíncrono con
+   ``files_move_batch_check_v2`` y espera creciente.
+3. Las rutas de cada bloque se actualizan en la BD con un UPDATE por lote
+   (por clave primaria), junto con el progreso del trabajo.
+
+El progreso se lee de la fila (``progreso``), así que cualquier worker de
+gunicorn puede responder la consulta. Si el proceso muere a mitad, el
+movimiento deja de dar ``latido`` y se informa como interrumpido hasta que la
+cola lo reintenta: ejecutarlo de nuevo mueve los archivos que siguen en la
+carpeta origen.
+"""
+import itertools
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from dropbox.files import RelocationPath
+from sqlalchemy import update
+
+from app import db, job_runner
+from app.dropbox_utils import _normalize_dropbox_path, get_dbx, with_base_folder, without_base_folder
+from app.utils.query_utils import filtro_prefijo_ruta
+
+logger = logging.getLogger(__name__)
+
+PENDIENTE = "pendiente"
+EJECUTANDO = "ejecutando"
+COMPLETADO = "completado"
+FALLIDO = "fallido"
+CANCELADO = "cancelado"
+INTERRUMPIDO = "interrumpido"  # solo informado: el worker dejó de dar latido
+
+# Límites de la API de Dropbox por llamada
+LOTE_MOVIMIENTO = 1000
+LOTE_CARPETAS = 1000
+ESPERA_INICIAL = 0.5
+ESPERA_MAXIMA = 5.0
+# Sin latido durante este tiempo, el trabajo se considera interrumpido
+LATIDO_VENCIDO = timedelta(minutes=5)
+MAX_ERRORES_GUARDADOS = 50
+# Variantes ``nombre (n).ext`` revisadas al verificar un archivo ya movido
+MAX_RENOMBRADOS = 5
+
+
+def _bloques(lista, tamano):
+    for i in range(0, len(lista), tamano):
+        yield lista[i:i + tamano]
+
+
+def planificar(origen, destino, archivos):
+    """
+    Rutas destino de ``archivos`` (``[(id, ruta)]``) conservando las
+    subcarpetas bajo ``origen``.
+
+    Retorna ``(movimientos [(id, ruta, nueva_ruta)], carpetas a crear)``.
+    """
+    origen = _normalize_dropbox_path(origen).rstrip('/')
+    destino = _normalize_dropbox_path(destino).rstrip('/')
+    movimientos = []
+    carpetas = {destino}
+    for archivo_id, ruta in archivos:
+        relativa = ruta[len(origen):].lstrip('/')
+        nueva = _normalize_dropbox_path(f"{destino}/{relativa}")
+        movimientos.append((archivo_id, ruta, nueva))
+        carpetas.add(nueva.rsplit('/', 1)[0] or '/')
+    # Basta con crear las más profundas: las intermedias se crean solas
+    con_subcarpetas = set()
+    for carpeta in carpetas:
+        partes = carpeta.strip('/').split('/')
+        con_subcarpetas.update('/' + '/'.join(partes[:i]) for i in range(1, len(partes)))
+    return movimientos, sorted(carpetas - con_subcarpetas)
+
+
+def _esperar(consultar, async_job_id):
+    """Consulta un trabajo asíncrono de Dropbox hasta que deje de estar en curso."""
+    espera = ESPERA_INICIAL
+    while True:
+        estado = consultar(async_job_id)
+        if not estado.is_in_progress():
+            return estado
+        time.sleep(espera)
+        espera = min(espera * 2, ESPERA_MAXIMA)
+
+
+def crear_carpetas(dbx, carpetas):
+    """Crea ``carpetas`` con ``files_create_folder_batch``; las que ya existen se ignoran."""
+    for bloque in _bloques(carpetas, LOTE_CARPETAS):
+        lanzamiento = dbx.files_create_folder_batch([with_base_folder(c) for c in bloque], autorename=False)
+        if lanzamiento.is_async_job_id():
+            estado = _esperar(dbx.files_create_folder_batch_check, lanzamiento.get_async_job_id())
+            if not estado.is_complete():
+                raise RuntimeError(f"Dropbox no pudo crear las carpetas destino: {estado}")
+            resultado = estado.get_complete()
+        elif lanzamiento.is_complete():
+            resultado = lanzamiento.get_complete()
+        else:
+            raise RuntimeError(f"Respuesta inesperada de files_create_folder_batch: {lanzamiento}")
+        for carpeta, entrada in zip(bloque, resultado.entries):
+            if entrada.is_failure() and 'conflict' not in str(entrada.get_failure()).lower():
+                logger.warning(f"No se pudo crear la carpeta {carpeta}: {entrada.get_failure()}")
+
+
+def _origen_no_encontrado(entrada):
+    error = entrada.get_failure()
+    if not (error.is_relocation_error() and error.get_relocation_error().is_from_lookup()):
+        return False
+    return error.get_relocation_error().get_from_lookup().is_not_found()
+
+
+def _renombrados(nueva):
+    """Rutas que ``autorename`` daría a ``nueva`` en conflicto (``nombre (1).ext``, ...)."""
+    carpeta, _, nombre = nueva.rpartition('/')
+    base, punto, ext = nombre.rpartition('.')
+    if not base:
+        base, punto, ext = nombre, '', ''
+    for n in range(1, MAX_RENOMBRADOS + 1):
+        yield f"{carpeta}/{base} ({n}){punto}{ext}"
+
+
+def _ya_movido(dbx, nueva, tamano):
+    """
+    Ruta (sin carpeta base) del archivo si un intento anterior ya lo movió
+    pero murió antes de actualizar la BD.
+
+    Con ``autorename`` el archivo en ``nueva`` puede ser otro que ya estaba
+    ahí (el nuestro quedó como ``nombre (1).ext``), así que se revisan
+    ``nueva`` y sus variantes renombradas y solo se acepta una coincidencia
+    única con el ``tamano`` registrado en la fila. Sin tamaño registrado
+    solo se acepta ``nueva`` si no hay variantes renombradas (no hubo
+    conflicto). En cualquier otro caso retorna ``None`` y queda como error.
+    """
+    from dropbox.exceptions import ApiError
+    from dropbox.files import FileMetadata
+
+    candidatos = []
+    for ruta in itertools.chain([nueva], _renombrados(nueva)):
+        try:
+            metadata = dbx.files_get_metadata(with_base_folder(ruta))
+        except ApiError:
+            if ruta != nueva:
+                break  # autorename usa el primer nombre libre
+            continue
+        if isinstance(metadata, FileMetadata):
+            candidatos.append(metadata)
+    if tamano is None:
+        if len(candidatos) != 1:
+            return None
+        coincidencias = [m for m in candidatos if m.path_lower == with_base_folder(nueva).lower()]
+    else:
+        coincidencias = [m for m in candidatos if m.size == tamano]
+    if len(coincidencias) != 1:
+        return None
+    metadata = coincidencias[0]
+    return without_base_folder(metadata.path_display or metadata.path_lower)
+
+
+def mover_bloque(dbx, bloque, tamanos=None):
+    """
+    Mueve ``bloque`` (``[(id, ruta, nueva_ruta)]``) con una llamada por lotes.
+    Retorna ``(cambios [{'id', 'dropbox_path'}], errores [str])``.
+
+    La ruta guardada es la que Dropbox informa en el resultado (``autorename``
+    puede cambiarla). Un archivo que ya no está en el origen pero sí en su
+    destino (movido por un intento anterior) cuenta como movido si se puede
+    verificar con ``tamanos`` (``{id: tamano}``), ver ``_ya_movido``.
+    """
+    tamanos = tamanos or {}
+    entradas = [RelocationPath(with_base_folder(ruta), with_base_folder(nueva)) for _, ruta, nueva in bloque]
+    lanzamiento = dbx.files_move_batch_v2(entradas, autorename=True)
+    if lanzamiento.is_async_job_id():
+        estado = _esperar(dbx.files_move_batch_check_v2, lanzamiento.get_async_job_id())
+        if not estado.is_complete():
+            raise RuntimeError(f"Dropbox no completó el movimiento del bloque: {estado}")
+        resultado = estado.get_complete()
+    elif lanzamiento.is_complete():
+        resultado = lanzamiento.get_complete()
+    else:
+        raise RuntimeError(f"Respuesta inesperada de files_move_batch_v2: {lanzamiento}")
+
+    cambios, errores = [], []
+    for (archivo_id, ruta, nueva), entrada in zip(bloque, resultado.entries):
+        if entrada.is_success():
+            metadata = entrada.get_success()
+            cambios.append({
+                'id': archivo_id,
+                'dropbox_path': without_base_folder(metadata.path_display or metadata.path_lower),
+            })
+            continue
+        if _origen_no_encontrado(entrada):
+            movido = _ya_movido(dbx, nueva, tamanos.get(archivo_id))
+            if movido:
+                cambios.append({'id': archivo_id, 'dropbox_path': movido})
+                continue
+            errores.append(f"{ruta}: no está en el origen y no se pudo verificar en el destino {nueva}")
+            continue
+        errores.append(f"{ruta}: {entrada.get_failure()}")
+    return cambios, errores
+
+
+def _guardar_progreso(trabajo, cambios, errores):
+    from app.models import Archivo
+
+    if cambios:
+        db.session.execute(update(Archivo), cambios)
+    trabajo.movidos += len(cambios)
+    trabajo.fallidos += len(errores)
+    if errores:
+        guardados = json.loads(trabajo.errores or '[]')
+        guardados.extend(errores[:max(0, MAX_ERRORES_GUARDADOS - len(guardados))])
+        trabajo.errores = json.dumps(guardados, ensure_ascii=False)
+    trabajo.latido = datetime.utcnow()
+    db.session.commit()
+
+
+def ejecutar(trabajo_id, avanzar=None):
+    """
+    Ejecuta el movimiento ``trabajo_id`` (dentro de un contexto de aplicación).
+
+    Un movimiento fallido o interrumpido se retoma con los archivos que siguen
+    en el origen. ``avanzar(hechos, total, mensaje)`` se llama tras cada bloque;
+    si lanza ``TrabajoCancelado`` el movimiento queda cancelado.
+    """
+    from app.activity_log_writer import registrar
+    from app.models import Archivo, MovimientoLote
+    from app.structure_cache import invalidar_estructuras
+
+    trabajo = db.session.get(MovimientoLote, trabajo_id)
+    if trabajo is None or trabajo.estado in (COMPLETADO, CANCELADO):
+        return trabajo
+    trabajo.estado = EJECUTANDO
+    # En un reintento, los fallidos siguen en el origen y se vuelven a intentar
+    trabajo.fallidos = 0
+    trabajo.fecha_inicio = trabajo.latido = datetime.utcnow()
+    db.session.commit()
+
+    try:
+        dbx = get_dbx()
+        if not dbx:
+            raise RuntimeError("No se pudo conectar con Dropbox")
+        archivos = db.session.execute(
+            db.select(Archivo.id, Archivo.dropbox_path, Archivo.tamano)
+            .where(filtro_prefijo_ruta(Archivo.dropbox_path, trabajo.origen))
+            .order_by(Archivo.id)
+        ).all()
+        tamanos = {archivo_id: tamano for archivo_id, _, tamano in archivos}
+        movimientos, carpetas = planificar(
+            trabajo.origen, trabajo.destino, [(archivo_id, ruta) for archivo_id, ruta, _ in archivos])
+        trabajo.total = trabajo.movidos + len(movimientos)
+        db.session.commit()
+
+        crear_carpetas(dbx, carpetas)
+        for bloque in _bloques(movimientos, LOTE_MOVIMIENTO):
+            cambios, errores = mover_bloque(dbx, bloque, tamanos)
+            _guardar_progreso(trabajo, cambios, errores)
+            logger.info(f"Movimiento #{trabajo.id}: {trabajo.movidos}/{trabajo.total} archivos")
+            if avanzar is not None:
+                avanzar(trabajo.movidos + trabajo.fallidos, trabajo.total,
+                        f"{trabajo.movidos} de {trabajo.total} archivos movidos")
+
+        trabajo.estado = COMPLETADO
+    except job_runner.TrabajoCancelado:
+        db.session.rollback()
+        logger.info(f"Movimiento #{trabajo_id} cancelado")
+        trabajo = db.session.get(MovimientoLote, trabajo_id)
+        trabajo.estado = CANCELADO
+    except Exception as e:
+        db.session.rollback()
+        logger.exception(f"Movimiento #{trabajo_id} falló: {e}")
+        trabajo = db.session.get(MovimientoLote, trabajo_id)
+        trabajo.estado = FALLIDO
+        guardados = json.loads(trabajo.errores or '[]')
+        guardados.append(str(e))
+        trabajo.errores = json.dumps(guardados[-MAX_ERRORES_GUARDADOS:], ensure_ascii=False)
+    trabajo.fecha_fin = trabajo.latido = datetime.utcnow()
+    db.session.commit()
+
+    invalidar_estructuras(rutas=[trabajo.origen, trabajo.destino])
+    if trabajo.usuario_id:
+        registrar(trabajo.usuario_id, 'bulk_export',
+                  f'Exportados {trabajo.movidos} archivos de "{trabajo.origen}" a "{trabajo.destino}"')
+    return trabajo
+
+
+def cancelar(movimiento_id):
+    """Marca cancelado un movimiento que no terminó (la cola hace commit)."""
+    from app.models import MovimientoLote
+
+    trabajo = db.session.get(MovimientoLote, movimiento_id)
+    if trabajo is not None and trabajo.estado in (PENDIENTE, EJECUTANDO):
+        trabajo.estado = CANCELADO
+        trabajo.fecha_fin = trabajo.latido = datetime.utcnow()
+
+
+def _clave(origen):
+    return f"exportar_carpeta:{origen}"
+
+
+def en_curso(origen):
+    """Trabajo de exportación pendiente o en ejecución desde ``origen``, si lo hay."""
+    return job_runner.activo(_clave(_normalize_dropbox_path(origen).rstrip('/')))
+
+
+def lanzar(origen, destino, usuario_id=None):
+    """
+    Crea el movimiento y lo encola en la cola de trabajos.
+    Retorna ``(MovimientoLote, Trabajo)``; ``(None, Trabajo)`` si ya había
+    una exportación activa desde ``origen``.
+    """
+    from app.models import MovimientoLote
+
+    trabajo = MovimientoLote(
+        usuario_id=usuario_id,
+        origen=_normalize_dropbox_path(origen).rstrip('/'),
+        destino=_normalize_dropbox_path(destino).rstrip('/'),
+        estado=PENDIENTE,
+        latido=datetime.utcnow(),
+    )
+    db.session.add(trabajo)
+    db.session.flush()
+    encolado, nuevo = job_runner.encolar(
+        'exportar_carpeta', {'movimiento_id': trabajo.id},
+        usuario_id=usuario_id, clave=_clave(trabajo.origen),
+    )
+    if not nuevo:
+        # Otra exportación desde el mismo origen se encoló entretanto
+        db.session.rollback()
+        return None, encolado
+    return trabajo, encolado
+
+
+def progreso(trabajo):
+    """Estado del movimiento para la API."""
+    estado = trabajo.estado
+    # Los pendientes esperan turno en la cola; solo caduca el que está corriendo
+    if estado == EJECUTANDO and trabajo.latido < datetime.utcnow() - LATIDO_VENCIDO:
+        estado = INTERRUMPIDO
+    return {
+        'id': trabajo.id,
+        'estado': estado,
+        'origen': trabajo.origen,
+        'destino': trabajo.destino,
+        'total': trabajo.total,
+        'movidos': trabajo.movidos,
+        'fallidos': trabajo.fallidos,
+        'porcentaje': round(100 * (trabajo.movidos + trabajo.fallidos) / trabajo.total, 1) if trabajo.total else None,
+        'errores': json.loads(trabajo.errores or '[]')[:10],
+        'fecha_inicio': trabajo.fecha_inicio.isoformat() if trabajo.fecha_inicio else None,
+        'fecha_fin': trabajo.fecha_fin.isoformat() if trabajo.fecha_fin else None,
+    }
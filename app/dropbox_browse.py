@@ -0,0 +1,205 @@
+"""
+Navegación perezosa de carpetas de Dropbox: un nivel a la vez.
+
+``carpetas_dropbox`` construía el árbol completo (hasta 5000 entradas) de cada
+usuario visible, lo aplanaba en una lista de Python para cortar 10 archivos y
+embebía el árbol en el HTML. Para los administradores eso crecía con el total
+de clientes y archivos.
+
+Aquí la vista general solo necesita:
+
+- ``pagina_usuarios``: una página de usuarios por keyset (``User.id``) con un
+  resumen agregado en BD (archivos, carpetas, última subida), sin Dropbox.
+- ``listar_nivel``: un único ``files_list_folder`` no recursivo de la carpeta
+  que se expande, paginado con el cursor de Dropbox.
+
+Los cursores que recibe el navegador van firmados (``itsdangerous``) junto con
+el usuario y la ruta, así que no pueden reutilizarse para otra carpeta.
+"""
+import logging
+
+import dropbox
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import func
+
+from app import db
+from app.dropbox_utils import with_base_folder
+from app.utils.query_utils import filtro_prefijo_ruta
+
+logger = logging.getLogger(__name__)
+
+NIVEL_LIMITE_DEFECTO = 100
+NIVEL_LIMITE_MAXIMO = 500
+USUARIOS_LIMITE_DEFECTO = 20
+USUARIOS_LIMITE_MAXIMO = 100
+# Los cursores de Dropbox duran más, pero una página vieja no tiene sentido
+CURSOR_MAX_AGE_SECONDS = 3600
+_CURSOR_SALT = "navegacion-dropbox"
+
+
+class CursorInvalido(Exception):
+    """El cursor está alterado, expiró o pertenece a otra carpeta/usuario."""
+
+
+def acotar(valor, defecto, maximo):
+    """Normaliza el parámetro ``limit`` de la API."""
+    try:
+        valor = int(valor)
+    except (TypeError, ValueError):
+        return defecto
+    return max(1, min(valor, maximo))
+
+
+def firmar_cursor(secret_key, datos):
+    return URLSafeTimedSerializer(secret_key, salt=_CURSOR_SALT).dumps(datos)
+
+
+def leer_cursor(secret_key, token, max_age=CURSOR_MAX_AGE_SECONDS):
+    try:
+        return URLSafeTimedSerializer(secret_key, salt=_CURSOR_SALT).loads(token, max_age=max_age)
+    except BadSignature as e:  # incluye SignatureExpired
+        raise CursorInvalido(str(e)) from e
+
+
+def normalizar_ruta(path):
+    """
+    Ruta absoluta sin barras repetidas ni final. Retorna None si contiene
+    segmentos ``.``/``..`` (no se permite salir de la carpeta del usuario).
+    """
+    partes = [p for p in (path or "").split("/") if p]
+    if any(p in (".", "..") for p in partes):
+        return None
+    return "/" + "/".join(partes)
+
+
+def listar_nivel(dbx, path, cursor_dropbox=None, limite=NIVEL_LIMITE_DEFECTO):
+    """
+    Lista un solo nivel de ``path`` (ruta sin carpeta base).
+
+    Retorna ``(carpetas, archivos, siguiente_cursor)``; ``archivos`` es una
+    lista de dicts con nombre, tamaño y fecha de modificación y
+    ``siguiente_cursor`` es el cursor de Dropbox si quedan más entradas.
+    """
+    if cursor_dropbox:
+        res = dbx.files_list_folder_continue(cursor_dropbox)
+    else:
+        res = dbx.files_list_folder(with_base_folder(path), recursive=False, limit=limite)
+
+    carpetas, archivos = [], []
+    for entry in res.entries:
+        if isinstance(entry, dropbox.files.FolderMetadata):
+            carpetas.append(entry.name)
+        elif isinstance(entry, dropbox.files.FileMetadata):
+            modificado = getattr(entry, "server_modified", None)
+            archivos.append({
+                "nombre": entry.name,
+                "tamano": getattr(entry, "size", None),
+                "modificado": modificado.isoformat(timespec="seconds") if modificado else None,
+            })
+    return carpetas, archivos, (res.cursor if res.has_more else None)
+
+
+def _siguiente_segmento(columna, padre, dialecto):
+    """``(segmento, barra)``: nombre del hijo de ``padre`` en la ruta y posición de la barra que le sigue."""
+    resto = func.substr(columna, len(padre) + 2)
+    barra = (func.strpos if dialecto == 'postgresql' else func.instr)(resto, '/')
+    return func.substr(resto, 1, barra - 1), barra
+
+
+def carpetas_con_contenido(rutas):
+    """
+    De las subcarpetas no registradas en BD, las que tienen archivos o
+    carpetas registrados debajo.
+
+    Una sola consulta por carpeta padre (en la práctica, una por nivel): las
+    rutas bajo el padre se agrupan por su siguiente segmento, en lugar de dos
+    consultas por subcarpeta.
+    """
+    from app.models import Archivo, Folder
+
+    por_padre = {}
+    for ruta in rutas:
+        padre, _, nombre = ruta.rpartition('/')
+        por_padre.setdefault(padre, {})[nombre] = ruta
+
+    dialecto = db.engine.dialect.name
+    con_contenido = set()
+    for padre, nombres in por_padre.items():
+        consultas = []
+        for columna in (Archivo.dropbox_path, Folder.dropbox_path):
+            segmento, barra = _siguiente_segmento(columna, padre, dialecto)
+            consultas.append(
+                db.select(segmento.label('nombre'))
+                .where(filtro_prefijo_ruta(columna, padre, dialecto), barra > 0, segmento.in_(list(nombres)))
+                .group_by(segmento)
+            )
+        for nombre in db.session.execute(db.union(*consultas)).scalars():
+            con_contenido.add(nombres[nombre])
+    return con_contenido
+
+
+def estados_archivos(rutas):
+    """Mapa ruta -> estado de los archivos del nivel registrados en BD."""
+    from app.models import Archivo
+
+    if not rutas:
+        return {}
+    filas = db.session.query(Archivo.dropbox_path, Archivo.estado).filter(Archivo.dropbox_path.in_(rutas))
+    return {path: estado for path, estado in filas}
+
+
+def pagina_usuarios(consulta, despues_de_id=None, limite=USUARIOS_LIMITE_DEFECTO):
+    """
+    Página de ``consulta`` (sobre ``User``) ordenada por id con keyset.
+
+    Retorna ``(usuarios, siguiente_id)``; ``siguiente_id`` es None en la
+    última página.
+    """
+    from app.models import User
+
+    if despues_de_id:
+        consulta = consulta.filter(User.id > despues_de_id)
+    usuarios = consulta.order_by(User.id).limit(limite + 1).all()
+    if len(usuarios) > limite:
+        usuarios = usuarios[:limite]
+        return usuarios, usuarios[-1].id
+    return usuarios, None
+
+
+def resumen_usuarios(usuarios):
+    """
+    Resumen por usuario para la vista general, con dos consultas agregadas
+    para toda la página (sin listar Dropbox).
+    """
+    from app.models import Archivo, Folder
+
+    ids = [u.id for u in usuarios]
+    archivos, carpetas = {}, {}
+    if ids:
+        filas = (
+            db.session.query(Archivo.usuario_id, func.count(Archivo.id), func.max(Archivo.fecha_subida))
+            .filter(Archivo.usuario_id.in_(ids))
+            .group_by(Archivo.usuario_id)
+        )
+        archivos = {uid: (total, ultima) for uid, total, ultima in filas}
+        carpetas = dict(
+            db.session.query(Folder.user_id, func.count(Folder.id))
+            .filter(Folder.user_id.in_(ids))
+            .group_by(Folder.user_id)
+        )
+
+    resumen = []
+    for u in usuarios:
+        total, ultima = archivos.get(u.id, (0, None))
+        resumen.append({
+            "id": u.id,
+            "email": u.email,
+            "nombre": u.nombre,
+            "apellido": u.apellido,
+            "rol": u.rol,
+            "dropbox_folder_path": u.dropbox_folder_path or f"/{u.email}",
+            "archivos": total,
+            "carpetas": carpetas.get(u.id, 0),
+            "ultima_subida": ultima.isoformat(timespec="seconds") if ultima else None,
+        })
+    return resumen
@@ -0,0 +1,225 @@
+"""
+Pool de clientes de Dropbox compartido por proceso.
+
+Evita reconstruir y re-verificar un ``dropbox.Dropbox`` en cada llamada a
+``get_dbx()``: el cliente verificado se guarda por (access token, modo de
+path_root) y se reutiliza hasta que el token rota o se invalida.
+"""
+import os
+import threading
+import time
+import logging
+
+import dropbox
+
+from app.dropbox_metrics import instrumentar
+from app.dropbox_rate_limit import get_planificador
+
+logger = logging.getLogger(__name__)
+
+# Un access token de Dropbox de corta duración vive ~4h; no reutilizamos
+# una verificación más allá de ese plazo aunque el token no haya rotado.
+DEFAULT_VERIFY_TTL_SECONDS = 4 * 60 * 60
+
+
+class _PoolEntry:
+    __slots__ = ('client', 'account', 'verified_at')
+
+    def __init__(self, client, account, verified_at):
+        self.client = client
+        self.account = account
+        self.verified_at = verified_at
+
+
+class DropboxClientPool:
+    """
+    Cache de clientes verificados de Dropbox, seguro entre hilos.
+
+    - La clave es (access_token, path_root_mode).
+    - Cada clave se verifica (``users_get_current_account``) una sola vez
+      por vida del token; la verificación se hace fuera del lock global
+      con un lock por clave para no serializar a todos los hilos.
+    - Al insertar un token nuevo se descartan los clientes de tokens
+      anteriores (rotación).
+    - Tras un ``fork`` (workers de gunicorn con preload_app) el pool se
+      vacía en el hijo para no compartir sesiones HTTP entre procesos.
+    """
+
+    def __init__(self, verify_ttl_seconds=DEFAULT_VERIFY_TTL_SECONDS):
+        self.verify_ttl_seconds = verify_ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._key_locks = {}
+        self._pid = os.getpid()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'verifications': 0,
+            'verify_failures': 0,
+            'rotations': 0,
+            'invalidations': 0,
+            'verify_time_total_ms': 0.0,
+            'verify_time_max_ms': 0.0,
+            'verify_time_last_ms': 0.0,
+        }
+
+    def _check_fork(self):
+        """Vacía el pool si estamos en un proceso distinto al que lo creó."""
+        pid = os.getpid()
+        if pid != self._pid:
+            self._lock = threading.Lock()
+            self._entries = {}
+            self._key_locks = {}
+            self._pid = pid
+            self._reset_stats()
+
+    def _get_fresh_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if (time.monotonic() - entry.verified_at) > self.verify_ttl_seconds:
+            self._entries.pop(key, None)
+            return None
+        return entry
+
+    def get_client(self, access_token, path_root_mode=''):
+        """
+        Devuelve un cliente verificado para el token dado.
+
+        Lanza las excepciones de Dropbox de la verificación (p.ej.
+        ``AuthError``) para que el llamador decida si refrescar el token.
+        """
+        if not access_token:
+            return None
+        mode = (path_root_mode or '').strip().lower()
+        key = (access_token, mode)
+
+        self._check_fork()
+        with self._lock:
+            entry = self._get_fresh_entry(key)
+            if entry is not None:
+                self._stats['hits'] += 1
+                return entry.client
+            self._stats['misses'] += 1
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Otro hilo pudo haber verificado mientras esperábamos
+            with self._lock:
+                entry = self._get_fresh_entry(key)
+                if entry is not None:
+                    return entry.client
+
+            entry = self._build_and_verify(access_token, mode)
+
+            with self._lock:
+                stale = [k for k in self._entries if k[0] != access_token]
+                for k in stale:
+                    self._entries.pop(k, None)
+                    self._key_locks.pop(k, None)
+                if stale:
+                    self._stats['rotations'] += 1
+                self._entries[key] = entry
+            return entry.client
+
+    def _build_and_verify(self, access_token, mode):
+        # Con el planificador activo los 429 le llegan a él en vez de dormir en el SDK
+        reintentos_429 = 0 if get_planificador() else None
+        client = dropbox.Dropbox(access_token, max_retries_on_rate_limit=reintentos_429)
+        started = time.perf_counter()
+        try:
+            acct = instrumentar(client).users_get_current_account()
+        except Exception:
+            with self._lock:
+                self._stats['verify_failures'] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000.0
+            with self._lock:
+                self._stats['verifications'] += 1
+                self._stats['verify_time_total_ms'] += elapsed_ms
+                self._stats['verify_time_last_ms'] = elapsed_ms
+                if elapsed_ms > self._stats['verify_time_max_ms']:
+                    self._stats['verify_time_max_ms'] = elapsed_ms
+
+        client = _apply_path_root(client, acct, mode)
+        return _PoolEntry(client, acct, time.monotonic())
+
+    def get_account(self, access_token, path_root_mode=''):
+        """Cuenta asociada al cliente cacheado (sin llamadas de red)."""
+        mode = (path_root_mode or '').strip().lower()
+        with self._lock:
+            entry = self._get_fresh_entry((access_token, mode))
+            return entry.account if entry else None
+
+    def invalidate(self, access_token=None):
+        """Descarta clientes de un token concreto o de todos si no se indica."""
+        self._check_fork()
+        with self._lock:
+            if access_token is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k in self._entries if k[0] == access_token]
+            for k in keys:
+                self._entries.pop(k, None)
+                self._key_locks.pop(k, None)
+            if keys:
+                self._stats['invalidations'] += 1
+
+    def stats(self):
+        """Contadores de uso del pool para diagnóstico."""
+        self._check_fork()
+        with self._lock:
+            data = dict(self._stats)
+            data['size'] = len(self._entries)
+        verifications = data['verifications']
+        data['verify_time_avg_ms'] = (
+            data['verify_time_total_ms'] / verifications if verifications else 0.0
+        )
+        lookups = data['hits'] + data['misses']
+        data['hit_ratio'] = (data['hits'] / lookups) if lookups else 0.0
+        data['pid'] = self._pid
+        return data
+
+
+def _apply_path_root(client, acct, mode):
+    """Aplica path_root para cuentas Business/Team cuando se solicita.
+
+    En Dropbox Business es común que la UI muestre el 'Team space' mientras que
+    la API por defecto opera en el 'home namespace'. Con path_root=root, la API
+    ve el mismo árbol que la UI (por ejemplo, /IOK alfa/Casos App IOK).
+
+    Configuración: DROPBOX_PATH_ROOT_MODE=root
+    """
+    if mode != 'root':
+        return client
+    try:
+        root_info = getattr(acct, 'root_info', None)
+        root_ns = getattr(root_info, 'root_namespace_id', None)
+        if not root_ns:
+            logger.warning("DROPBOX_PATH_ROOT_MODE=root pero no hay root_namespace_id disponible")
+            return client
+        return client.with_path_root(dropbox.common.PathRoot.root(root_ns))
+    except Exception as e:
+        logger.warning(f"No se pudo aplicar path_root=root: {e}")
+        return client
+
+
+# Instancia global del pool (una por proceso)
+client_pool = None
+
+
+def get_client_pool():
+    """Obtiene la instancia global del pool de clientes"""
+    global client_pool
+    if client_pool is None:
+        client_pool = DropboxClientPool()
+    return client_pool
+
+
+def get_client_pool_stats():
+    """Contadores hit/miss/latencia de verificación del pool"""
+    return get_client_pool().stats()
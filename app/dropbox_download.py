@@ -0,0 +1,437 @@
+"""
+Descargas y previsualizaciones de Dropbox en streaming.
+
+``descargar_desde_dropbox`` devuelve ``res.content`` (el archivo completo en
+memoria) y las rutas lo envolvían en ``BytesIO``/``Response``: un PDF o un
+escaneo grande ocupaba RAM del worker y el navegador no recibía el primer byte
+hasta terminar la descarga completa desde Dropbox.
+
+``respuesta_archivo`` en cambio:
+
+- Obtiene un enlace temporal (``files_get_temporary_link``) que se guarda en
+  caché hasta poco antes de expirar (duran 4 horas), junto con la metadata del
+  archivo (tamaño, ``content_hash``/``rev``, fecha). Con
+  ``STRUCTURE_CACHE_BACKEND=sqlite`` la caché vive en el mismo archivo SQLite
+  que la caché de estructuras y la comparten todos los workers; si no, es un
+  LRU por proceso. Las rutas que modifican Dropbox la descartan con
+  ``invalidar_enlaces`` (vía ``invalidar_estructuras``), así que ningún worker
+  sigue sirviendo el enlace, el ETag o el tamaño anteriores.
+- Responde 304 a peticiones condicionales (``If-None-Match`` /
+  ``If-Modified-Since``) sin tocar el contenido.
+- Reenvía el contenido en bloques de ``CHUNK_SIZE`` con un generador, pidiendo
+  a Dropbox solo el rango solicitado (HTTP ``Range`` -> 206).
+- En modo ``redirect`` (``DROPBOX_DOWNLOAD_MODE``) responde 302 al enlace
+  temporal y el servidor no transfiere el contenido.
+
+Si no se puede obtener el enlace temporal se usa ``files_download`` iterando la
+respuesta por bloques (sin soporte de rangos).
+"""
+import json
+import logging
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote
+
+import dropbox
+import requests
+from flask import Response, current_app, redirect, request, stream_with_context
+from werkzeug.http import http_date, is_resource_modified
+
+from app.dropbox_utils import get_dropbox_client, with_base_folder
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# Los enlaces temporales duran 4 horas; se renuevan con margen
+LINK_TTL_SECONDS = 4 * 3600 - 15 * 60
+LINK_CACHE_MAX_ENTRIES = 2048
+# (conexión, lectura) hacia el servidor de contenido de Dropbox
+UPSTREAM_TIMEOUT = (10, 60)
+# Respuestas del enlace que indican que expiró o ya no es válido
+_ENLACE_VENCIDO = (401, 403, 404, 410)
+
+
+class EnlaceTemporal:
+    """Enlace temporal de Dropbox y la metadata del archivo al generarlo."""
+
+    __slots__ = ("link", "etag", "tamano", "modificado", "expira")
+
+    def __init__(self, link, etag, tamano, modificado, expira):
+        self.link = link
+        self.etag = etag
+        self.tamano = tamano
+        self.modificado = modificado
+        self.expira = expira
+
+    @classmethod
+    def desde_metadata(cls, link, metadata, expira):
+        return cls(
+            link,
+            getattr(metadata, "content_hash", None) or getattr(metadata, "rev", None),
+            getattr(metadata, "size", None),
+            getattr(metadata, "server_modified", None),
+            expira,
+        )
+
+    def serializar(self):
+        return json.dumps({
+            "link": self.link,
+            "etag": self.etag,
+            "tamano": self.tamano,
+            "modificado": self.modificado.isoformat() if self.modificado else None,
+        })
+
+    @classmethod
+    def deserializar(cls, datos, expira):
+        d = json.loads(datos)
+        modificado = datetime.fromisoformat(d["modificado"]) if d.get("modificado") else None
+        return cls(d["link"], d.get("etag"), d.get("tamano"), modificado, expira)
+
+
+def _bajo_prefijo(path_lower, prefijos):
+    return any(path_lower == p or path_lower.startswith(p + "/") for p in prefijos)
+
+
+class MemoriaEnlaces:
+    """LRU de enlaces en el proceso (sin caché compartida)."""
+
+    def __init__(self, max_entries=LINK_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._enlaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            enlace = self._enlaces.get(path)
+            if enlace is None or enlace.expira <= time.time():
+                return None
+            self._enlaces.move_to_end(path)
+            return enlace
+
+    def put(self, path, enlace):
+        with self._lock:
+            self._enlaces[path] = enlace
+            self._enlaces.move_to_end(path)
+            while len(self._enlaces) > self.max_entries:
+                self._enlaces.popitem(last=False)
+
+    def pop(self, path):
+        with self._lock:
+            self._enlaces.pop(path, None)
+
+    def invalidar(self, prefijos):
+        with self._lock:
+            viejos = [path for path in self._enlaces if _bajo_prefijo(path.lower(), prefijos)]
+            for path in viejos:
+                self._enlaces.pop(path, None)
+        return len(viejos)
+
+
+class SQLiteEnlaces:
+    """Enlaces compartidos entre procesos, en el archivo SQLite de la caché de estructuras."""
+
+    def __init__(self, path, max_entries=LINK_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS enlaces_temporales ("
+            " path TEXT PRIMARY KEY, path_lower TEXT NOT NULL, datos TEXT NOT NULL, expira REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_enlaces_temporales_path_lower ON enlaces_temporales (path_lower)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_enlaces_temporales_expira ON enlaces_temporales (expira)")
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se comparten tras un fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, path):
+        fila = self._conn().execute(
+            "SELECT datos, expira FROM enlaces_temporales WHERE path = ? AND expira > ?", (path, time.time())
+        ).fetchone()
+        return EnlaceTemporal.deserializar(*fila) if fila else None
+
+    def put(self, path, enlace):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO enlaces_temporales (path, path_lower, datos, expira) VALUES (?, ?, ?, ?)",
+            (path, path.lower(), enlace.serializar(), enlace.expira),
+        )
+        conn.execute("DELETE FROM enlaces_temporales WHERE expira <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM enlaces_temporales WHERE path IN ("
+            " SELECT path FROM enlaces_temporales ORDER BY expira DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def pop(self, path):
+        self._conn().execute("DELETE FROM enlaces_temporales WHERE path = ?", (path,))
+
+    def invalidar(self, prefijos):
+        borrados = 0
+        conn = self._conn()
+        for p in prefijos:
+            # '0' es el carácter siguiente a '/': el rango cubre todo lo que está debajo
+            borrados += conn.execute(
+                "DELETE FROM enlaces_temporales"
+                " WHERE path_lower = ? OR (path_lower >= ? AND path_lower < ?)",
+                (p, p + "/", p + "0"),
+            ).rowcount
+        return borrados
+
+
+# Instancia global (una por proceso; el archivo SQLite une a los workers)
+_enlaces = None
+_enlaces_lock = threading.Lock()
+
+
+def get_link_store():
+    global _enlaces
+    if _enlaces is None:
+        with _enlaces_lock:
+            if _enlaces is None:
+                _enlaces = _build_link_store()
+    return _enlaces
+
+
+def _build_link_store():
+    try:
+        cfg, instance_path = current_app.config, current_app.instance_path
+    except RuntimeError:
+        cfg, instance_path = {}, os.getcwd()
+    if (cfg.get("STRUCTURE_CACHE_BACKEND") or "memory").strip().lower() == "sqlite":
+        path = cfg.get("STRUCTURE_CACHE_SQLITE_PATH") or os.path.join(instance_path, "structure_cache.sqlite3")
+        try:
+            return SQLiteEnlaces(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"No se pudo abrir la caché compartida de enlaces en {path}, usando solo memoria: {e}")
+    return MemoriaEnlaces()
+
+
+def obtener_enlace(dbx, path, renovar=False):
+    """
+    Enlace temporal de ``path`` (ruta sin carpeta base), desde la caché si no
+    ha expirado. Propaga ``ApiError`` (p. ej. not_found).
+    """
+    store = get_link_store()
+    if not renovar:
+        try:
+            enlace = store.get(path)
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo leer el enlace cacheado de {path}: {e}")
+            enlace = None
+        if enlace is not None:
+            return enlace
+
+    res = dbx.files_get_temporary_link(with_base_folder(path))
+    enlace = EnlaceTemporal.desde_metadata(res.link, res.metadata, time.time() + LINK_TTL_SECONDS)
+    try:
+        store.put(path, enlace)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo cachear el enlace de {path}: {e}")
+    return enlace
+
+
+def invalidar_enlace(path):
+    try:
+        get_link_store().pop(path)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo descartar el enlace cacheado de {path}: {e}")
+
+
+def invalidar_enlaces(*rutas):
+    """
+    Descarta los enlaces cacheados de ``rutas`` y de todo lo que está debajo
+    (archivos subidos, renombrados, movidos, borrados o sincronizados) en
+    todos los workers: el enlace y su metadata (ETag, tamaño) ya no
+    corresponden al contenido.
+    """
+    prefijos = [r.rstrip("/").lower() for r in rutas if r]
+    if not prefijos:
+        return 0
+    try:
+        return get_link_store().invalidar(prefijos)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudieron descartar los enlaces cacheados: {e}")
+        return 0
+
+
+def enlace_temporal(path):
+    """URL temporal de ``path`` (cacheada) o None si no se pudo generar."""
+    dbx = get_dropbox_client()
+    if dbx is None:
+        return None
+    try:
+        return obtener_enlace(dbx, path).link
+    except Exception as e:
+        logger.error(f"Error obteniendo enlace temporal para {path}: {e}")
+        return None
+
+
+def mimetype_para(nombre):
+    return mimetypes.guess_type(nombre or "")[0] or "application/octet-stream"
+
+
+def _content_disposition(nombre, adjunto):
+    tipo = "attachment" if adjunto else "inline"
+    ascii_nombre = nombre.encode("ascii", "ignore").decode("ascii").replace('"', "") or "archivo"
+    return f"{tipo}; filename=\"{ascii_nombre}\"; filename*=UTF-8''{quote(nombre)}"
+
+
+def _iterar(upstream):
+    try:
+        for bloque in upstream.iter_content(CHUNK_SIZE):
+            if bloque:
+                yield bloque
+    finally:
+        upstream.close()
+
+
+def _cabeceras_base(nombre, adjunto, etag=None, modificado=None):
+    cabeceras = {
+        "Content-Disposition": _content_disposition(nombre, adjunto),
+        "Cache-Control": "private, max-age=0, must-revalidate",
+    }
+    if etag:
+        cabeceras["ETag"] = f'"{etag}"'
+    if modificado:
+        cabeceras["Last-Modified"] = http_date(modificado)
+    return cabeceras
+
+
+def _rango_solicitado(tamano, etag, modificado):
+    """
+    ``(inicio, fin)`` del rango pedido, None para enviar el archivo completo o
+    ``False`` si el rango no se puede satisfacer (416).
+    """
+    rango = request.range
+    if rango is None or tamano is None:
+        return None
+    if_range = request.if_range
+    if if_range and (if_range.etag or if_range.date):
+        # If-Range: el rango solo aplica si el archivo no cambió
+        if if_range.etag and if_range.etag != etag:
+            return None
+        if if_range.date and (modificado is None or modificado.replace(microsecond=0) > if_range.date.replace(tzinfo=None)):
+            return None
+    if rango.units != "bytes" or len(rango.ranges) != 1:
+        return None  # multipart/byteranges no soportado: se envía completo
+    return rango.range_for_length(tamano) or False
+
+
+def _abrir_upstream(dbx, path, enlace, inicio_fin):
+    """GET al enlace temporal (con reintento si expiró)."""
+    cabeceras = {}
+    if inicio_fin:
+        cabeceras["Range"] = f"bytes={inicio_fin[0]}-{inicio_fin[1] - 1}"
+    for intento in range(2):
+        upstream = requests.get(enlace.link, headers=cabeceras, stream=True, timeout=UPSTREAM_TIMEOUT)
+        if upstream.status_code not in _ENLACE_VENCIDO or intento:
+            return upstream, enlace
+        upstream.close()
+        invalidar_enlace(path)
+        enlace = obtener_enlace(dbx, path, renovar=True)
+    return upstream, enlace
+
+
+def _respuesta_files_download(dbx, path, nombre, adjunto, mimetype):
+    """Alternativa sin enlace temporal: ``files_download`` iterado por bloques."""
+    metadata, res = dbx.files_download(with_base_folder(path))
+    etag = getattr(metadata, "content_hash", None) or getattr(metadata, "rev", None)
+    modificado = getattr(metadata, "server_modified", None)
+    cabeceras = _cabeceras_base(nombre, adjunto, etag, modificado)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modificado):
+        res.close()
+        return Response(status=304, headers=cabeceras)
+    cabeceras["Accept-Ranges"] = "none"
+    if getattr(metadata, "size", None) is not None:
+        cabeceras["Content-Length"] = str(metadata.size)
+    return Response(stream_with_context(_iterar(res)), status=200, mimetype=mimetype,
+                    headers=cabeceras, direct_passthrough=True)
+
+
+def respuesta_archivo(path, nombre=None, adjunto=False, mimetype=None, modo=None):
+    """
+    Respuesta HTTP con el archivo ``path`` (ruta sin carpeta base) sin
+    cargarlo completo en memoria.
+
+    ``modo``: ``stream`` (por defecto, ``DROPBOX_DOWNLOAD_MODE``) o
+    ``redirect`` (302 al enlace temporal cacheado).
+    """
+    nombre = nombre or (path or "").rsplit("/", 1)[-1] or "archivo"
+    mimetype = mimetype or mimetype_para(nombre)
+    modo = modo or current_app.config.get("DROPBOX_DOWNLOAD_MODE", "stream")
+
+    dbx = get_dropbox_client()
+    if dbx is None:
+        return Response("Dropbox no está disponible", status=503, mimetype="text/plain")
+
+    try:
+        enlace = obtener_enlace(dbx, path)
+    except dropbox.exceptions.ApiError as e:
+        if "not_found" in str(e):
+            return Response("Archivo no encontrado en Dropbox", status=404, mimetype="text/plain")
+        logger.warning(f"No se pudo obtener enlace temporal para {path}, usando files_download: {e}")
+        enlace = None
+
+    try:
+        if enlace is None:
+            return _respuesta_files_download(dbx, path, nombre, adjunto, mimetype)
+
+        if modo == "redirect":
+            return redirect(enlace.link, code=302)
+
+        tamano = enlace.tamano
+        modificado = enlace.modificado
+        cabeceras = _cabeceras_base(nombre, adjunto, enlace.etag, modificado)
+        cabeceras["Accept-Ranges"] = "bytes"
+
+        if not is_resource_modified(request.environ, etag=enlace.etag, last_modified=modificado):
+            return Response(status=304, headers=cabeceras)
+
+        inicio_fin = _rango_solicitado(tamano, enlace.etag, modificado)
+        if inicio_fin is False:
+            cabeceras["Content-Range"] = f"bytes */{tamano}"
+            return Response(status=416, headers=cabeceras)
+
+        upstream, enlace = _abrir_upstream(dbx, path, enlace, inicio_fin)
+        if upstream.status_code == 206 and inicio_fin:
+            inicio, fin = inicio_fin
+            cabeceras["Content-Range"] = f"bytes {inicio}-{fin - 1}/{tamano}"
+            cabeceras["Content-Length"] = str(fin - inicio)
+            estado = 206
+        elif upstream.status_code == 200:
+            # Sin rango (o el servidor lo ignoró): archivo completo
+            if tamano is not None:
+                cabeceras["Content-Length"] = str(tamano)
+            estado = 200
+        else:
+            logger.error(f"Dropbox respondió {upstream.status_code} descargando {path}")
+            upstream.close()
+            invalidar_enlace(path)
+            return Response("Error descargando el archivo desde Dropbox", status=502, mimetype="text/plain")
+
+        return Response(stream_with_context(_iterar(upstream)), status=estado, mimetype=mimetype,
+                        headers=cabeceras, direct_passthrough=True)
+    except dropbox.exceptions.ApiError as e:
+        if "not_found" in str(e):
+            return Response("Archivo no encontrado en Dropbox", status=404, mimetype="text/plain")
+        logger.error(f"APIError descargando {path}: {e}")
+        return Response("Error descargando el archivo desde Dropbox", status=502, mimetype="text/plain")
+    except requests.RequestException as e:
+        logger.error(f"Error de red descargando {path}: {e}")
+        return Response("Error descargando el archivo desde Dropbox", status=502, mimetype="text/plain")
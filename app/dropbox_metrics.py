@@ -0,0 +1,227 @@
+"""
+Métricas de uso de la API de Dropbox en formato Prometheus.
+
+Todas las llamadas pasan por ``DropboxInstrumentado``, el proxy que
+``get_dropbox_client()`` / ``get_dbx()`` devuelven alrededor del cliente del
+pool; el proxy también pide turno al planificador de ``app/dropbox_rate_limit.py``.
+Por cada método de la API se registra:
+
+- ``dropbox_api_requests_total{method, outcome}``: llamadas por resultado
+  (``ok``, ``rate_limit``, ``auth_error``, ``api_error``, ``http_error``,
+  ``error``). ``rate_limit`` y ``auth_error`` son ``RateLimitError`` y
+  ``AuthError`` del SDK.
+- ``dropbox_api_request_duration_seconds{method}``: histograma de latencia.
+- ``dropbox_api_bytes_total{method, direction}``: bytes subidos (cuerpo de
+  ``files_upload*``) y descargados (``Content-Length`` de ``files_download``
+  y similares). Las descargas por enlace temporal no pasan por el servidor y
+  no se cuentan.
+- ``dropbox_scheduler_wait_seconds{priority}``: espera por turno en el
+  límite de tasa compartido.
+
+Con varios workers de gunicorn, ``PROMETHEUS_MULTIPROC_DIR`` (lo define
+``gunicorn.conf.py``) hace que cada proceso escriba sus valores en ficheros
+mapeados en memoria de ese directorio; ``/metrics`` los suma al exponerlos.
+Sin la variable, las métricas son las del proceso actual.
+
+``prometheus_client`` es opcional: si no está instalado, el proxy solo
+alimenta el perfilado por petición (``app/request_profiler.py``).
+"""
+import logging
+import os
+import time
+
+import dropbox
+
+from app.dropbox_rate_limit import INTERACTIVA, get_planificador, prioridad_actual
+from app.request_profiler import perfil_actual
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover - depende del entorno
+    Counter = None
+    logger.warning("⚠️ prometheus_client no está instalado; /metrics no estará disponible. "
+                   "Instala con: pip install prometheus_client")
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Latencias típicas de la API: de decenas de ms (metadata) a decenas de s (lotes, subidas)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Métodos cuyo primer argumento (o ``f``) es el cuerpo que se sube
+_SUBIDAS = (
+    'files_upload',
+    'files_upload_session_start',
+    'files_upload_session_append',
+    'files_upload_session_append_v2',
+    'files_upload_session_finish',
+)
+# Métodos del cliente que no llaman a la API
+_LOCALES = frozenset((
+    'with_path_root', 'clone', 'as_user', 'as_admin', 'close',
+))
+
+if Counter is not None:
+    if MULTIPROC_DIR:
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    LLAMADAS = Counter(
+        'dropbox_api_requests_total', 'Llamadas a la API de Dropbox', ('method', 'outcome'),
+    )
+    LATENCIA = Histogram(
+        'dropbox_api_request_duration_seconds', 'Latencia de las llamadas a la API de Dropbox',
+        ('method',), buckets=BUCKETS,
+    )
+    BYTES = Counter(
+        'dropbox_api_bytes_total', 'Bytes transferidos con la API de Dropbox', ('method', 'direction'),
+    )
+    ESPERA = Histogram(
+        'dropbox_scheduler_wait_seconds', 'Espera por turno en el límite de tasa de Dropbox',
+        ('priority',), buckets=(0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+    )
+else:
+    LLAMADAS = LATENCIA = BYTES = ESPERA = None
+
+
+def habilitadas():
+    return LLAMADAS is not None
+
+
+def resultado_de(error):
+    """Etiqueta ``outcome`` para la excepción ``error`` (``None``: ok)."""
+    if error is None:
+        return 'ok'
+    if isinstance(error, dropbox.exceptions.RateLimitError):
+        return 'rate_limit'
+    if isinstance(error, dropbox.exceptions.AuthError):
+        return 'auth_error'
+    if isinstance(error, dropbox.exceptions.ApiError):
+        return 'api_error'
+    if isinstance(error, dropbox.exceptions.HttpError):
+        return 'http_error'
+    return 'error'
+
+
+def _bytes_subidos(metodo, args, kwargs):
+    if metodo not in _SUBIDAS:
+        return 0
+    cuerpo = args[0] if args else kwargs.get('f')
+    return len(cuerpo) if isinstance(cuerpo, (bytes, bytearray, memoryview)) else 0
+
+
+def _bytes_descargados(resultado):
+    # files_download, files_get_thumbnail, sharing_get_shared_link_file...: (metadata, requests.Response)
+    if isinstance(resultado, tuple) and len(resultado) == 2 and hasattr(resultado[1], 'headers'):
+        try:
+            return int(resultado[1].headers.get('Content-Length') or 0)
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+
+def registrar_llamada(metodo, segundos, error=None, subidos=0, descargados=0):
+    """Anota una llamada a la API (también usado por el pool al verificar la cuenta)."""
+    if LLAMADAS is None:
+        return
+    LLAMADAS.labels(metodo, resultado_de(error)).inc()
+    LATENCIA.labels(metodo).observe(segundos)
+    if subidos:
+        BYTES.labels(metodo, 'upload').inc(subidos)
+    if descargados:
+        BYTES.labels(metodo, 'download').inc(descargados)
+
+
+def registrar_espera(prioridad, segundos):
+    """Anota la espera de una llamada en el planificador (``app/dropbox_rate_limit.py``)."""
+    if ESPERA is not None:
+        ESPERA.labels(prioridad).observe(segundos)
+
+
+class DropboxInstrumentado:
+    """
+    Proxy de ``dropbox.Dropbox`` que mide cada llamada a la API.
+
+    Los métodos públicos se envuelven al accederse; el resto de atributos se
+    delegan sin cambios. ``perfil`` es el perfil de la petición que obtuvo el
+    cliente: se guarda (no se busca en ``g``) para que las llamadas hechas
+    desde hilos de la vista (p. ej. subidas en paralelo) también se cuenten.
+    """
+
+    def __init__(self, cliente, perfil=None, prioridad=INTERACTIVA):
+        self._cliente = cliente
+        self._perfil = perfil
+        self._prioridad = prioridad
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._cliente, nombre)
+        if nombre.startswith('_') or not callable(atributo):
+            return atributo
+        perfil = self._perfil
+        prioridad = self._prioridad
+        if nombre in _LOCALES:
+            def local(*args, **kwargs):
+                resultado = atributo(*args, **kwargs)
+                # with_path_root / clone devuelven otro cliente: seguir midiéndolo
+                if isinstance(resultado, dropbox.Dropbox):
+                    return DropboxInstrumentado(resultado, perfil, prioridad)
+                return resultado
+            return local
+
+        def medir(args, kwargs):
+            inicio = time.perf_counter()
+            error = None
+            resultado = None
+            try:
+                resultado = atributo(*args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                segundos = time.perf_counter() - inicio
+                try:
+                    registrar_llamada(
+                        nombre, segundos, error,
+                        subidos=_bytes_subidos(nombre, args, kwargs),
+                        descargados=_bytes_descargados(resultado),
+                    )
+                except Exception as e:
+                    logger.debug(f"No se pudo registrar la métrica de {nombre}: {e}")
+                if perfil is not None:
+                    perfil.dropbox(nombre, segundos * 1000.0, error is not None)
+            return resultado
+
+        def llamada(*args, **kwargs):
+            planificador = get_planificador()
+            if planificador is None:
+                return medir(args, kwargs)
+            return planificador.ejecutar(lambda: medir(args, kwargs), prioridad, nombre)
+
+        return llamada
+
+
+def instrumentar(cliente):
+    """
+    Envuelve ``cliente`` para medirlo y pasarlo por el planificador con la
+    prioridad del contexto actual (y perfilarlo si la petición se está perfilando).
+    """
+    if cliente is None or isinstance(cliente, DropboxInstrumentado):
+        return cliente
+    return DropboxInstrumentado(cliente, perfil_actual(), prioridad_actual())
+
+
+def exponer():
+    """``(cuerpo, content_type)`` con las métricas en formato de texto de Prometheus."""
+    if MULTIPROC_DIR:
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro, path=MULTIPROC_DIR)
+    else:
+        registro = REGISTRY
+    return generate_latest(registro), CONTENT_TYPE_LATEST
+
+
+def proceso_terminado(pid):
+    """Hook ``child_exit`` de gunicorn: libera los ficheros del worker ``pid``."""
+    if MULTIPROC_DIR and LLAMADAS is not None:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
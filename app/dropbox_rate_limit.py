@@ -0,0 +1,337 @@
+"""
+Planificador de llamadas a la API de Dropbox con límite de tasa compartido.
+
+El SDK reintenta un ``too_many_requests`` durmiendo el hilo que lo recibió,
+sin que los demás hilos ni los otros workers de gunicorn se enteren: siguen
+llamando y alargan la penalización. Aquí todas las llamadas que pasan por el
+proxy de ``get_dbx()`` (``app/dropbox_metrics.py``) piden turno antes:
+
+- Cubeta de tokens en un archivo SQLite compartido por todos los workers:
+  ``tasa`` llamadas por segundo con ráfagas de hasta ``capacidad``, y como
+  mucho ``concurrencia`` llamadas en curso a la vez entre todos los procesos.
+- Prioridades: las llamadas hechas dentro de una petición web son
+  interactivas; las de hilos en segundo plano, scripts y comandos (exportación
+  masiva, sincronización) son de segundo plano y no pueden usar los últimos
+  ``reserva`` tokens ni los últimos ``reserva_concurrencia`` turnos.
+- Ante un ``RateLimitError`` se bloquea la cubeta para todos los workers
+  durante ``RateLimitError.backoff`` (o una espera creciente si Dropbox no la
+  indica) y la llamada se reintenta. Si el turno no llega dentro de la espera
+  máxima de su prioridad se lanza ``RateLimitError`` con el tiempo restante,
+  que la app responde como 503 con ``Retry-After``.
+
+Los clientes del pool se crean con ``max_retries_on_rate_limit=0`` para que
+los 429 lleguen al planificador en lugar de dormir dentro del SDK.
+
+Configuración (config.py): DROPBOX_RATE_LIMIT_ENABLED,
+DROPBOX_RATE_LIMIT_SQLITE_PATH, DROPBOX_RATE_LIMIT_PER_SECOND,
+DROPBOX_RATE_LIMIT_BURST, DROPBOX_RATE_LIMIT_INTERACTIVE_RESERVE,
+DROPBOX_MAX_CONCURRENCY, DROPBOX_INTERACTIVE_CONCURRENCY_RESERVE,
+DROPBOX_INTERACTIVE_MAX_WAIT, DROPBOX_BACKGROUND_MAX_WAIT.
+"""
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import dropbox
+from flask import jsonify, request
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVA = 'interactive'
+SEGUNDO_PLANO = 'background'
+
+DEFAULT_TASA = 10.0
+DEFAULT_CAPACIDAD = 20.0
+DEFAULT_RESERVA = 5.0
+DEFAULT_CONCURRENCIA = 8
+DEFAULT_RESERVA_CONCURRENCIA = 2
+DEFAULT_ESPERA_INTERACTIVA = 10.0
+DEFAULT_ESPERA_SEGUNDO_PLANO = 300.0
+REINTENTOS = 5
+# Espera ante un 429 sin Retry-After (se duplica en cada reintento)
+BACKOFF_POR_DEFECTO = 2.0
+# Cada cuánto se vuelve a consultar la cubeta mientras se espera
+SONDEO_MAXIMO = 1.0
+# Turnos de procesos vivos que llevan más que esto se consideran perdidos
+TURNO_MAXIMO = 600.0
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SQLiteBucket:
+    """Cubeta de tokens y turnos en curso sobre un archivo SQLite (modo WAL)."""
+
+    def __init__(self, path, tasa=DEFAULT_TASA, capacidad=DEFAULT_CAPACIDAD, reserva=DEFAULT_RESERVA,
+                 concurrencia=DEFAULT_CONCURRENCIA, reserva_concurrencia=DEFAULT_RESERVA_CONCURRENCIA):
+        self.path = path
+        self.tasa = tasa
+        self.capacidad = max(capacidad, 1.0)
+        self.reserva = min(reserva, self.capacidad - 1.0)
+        self.concurrencia = concurrencia
+        self.reserva_concurrencia = min(reserva_concurrencia, max(concurrencia - 1, 0))
+        self._local = threading.local()
+        directorio = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directorio, exist_ok=True)
+        with self._tx() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cubeta ("
+                " id INTEGER PRIMARY KEY CHECK (id = 1), tokens REAL NOT NULL,"
+                " actualizado REAL NOT NULL, bloqueado_hasta REAL NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO cubeta (id, tokens, actualizado, bloqueado_hasta) VALUES (1, ?, ?, 0)",
+                (self.capacidad, time.time()),
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS en_curso ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL,"
+                " prioridad TEXT NOT NULL, desde REAL NOT NULL)"
+            )
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se comparten tras un fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _purgar(self, conn, ahora):
+        """Libera turnos de procesos muertos o demasiado antiguos. Retorna cuántos."""
+        perdidos = [
+            turno for turno, pid, desde in conn.execute("SELECT id, pid, desde FROM en_curso")
+            if ahora - desde > TURNO_MAXIMO or not _proceso_vivo(pid)
+        ]
+        conn.executemany("DELETE FROM en_curso WHERE id = ?", [(turno,) for turno in perdidos])
+        return len(perdidos)
+
+    def intentar(self, prioridad):
+        """
+        Toma un token y un turno si hay. Retorna ``(turno, 0)`` o
+        ``(None, segundos a esperar antes de volver a intentar)``.
+        """
+        ahora = time.time()
+        segundo_plano = prioridad == SEGUNDO_PLANO
+        with self._tx() as conn:
+            tokens, actualizado, bloqueado_hasta = conn.execute(
+                "SELECT tokens, actualizado, bloqueado_hasta FROM cubeta WHERE id = 1"
+            ).fetchone()
+            if bloqueado_hasta > ahora:
+                return None, bloqueado_hasta - ahora
+            tokens = min(self.capacidad, tokens + max(0.0, ahora - actualizado) * self.tasa)
+            minimo = 1.0 + (self.reserva if segundo_plano else 0.0)
+            if tokens < minimo:
+                conn.execute("UPDATE cubeta SET tokens = ?, actualizado = ? WHERE id = 1", (tokens, ahora))
+                return None, (minimo - tokens) / self.tasa
+            if self.concurrencia:
+                limite = self.concurrencia - (self.reserva_concurrencia if segundo_plano else 0)
+                en_curso = conn.execute("SELECT COUNT(*) FROM en_curso").fetchone()[0]
+                if en_curso >= limite:
+                    en_curso -= self._purgar(conn, ahora)
+                if en_curso >= limite:
+                    conn.execute("UPDATE cubeta SET tokens = ?, actualizado = ? WHERE id = 1", (tokens, ahora))
+                    return None, min(1.0 / self.tasa, SONDEO_MAXIMO)
+            conn.execute("UPDATE cubeta SET tokens = ?, actualizado = ? WHERE id = 1", (tokens - 1.0, ahora))
+            turno = conn.execute(
+                "INSERT INTO en_curso (pid, prioridad, desde) VALUES (?, ?, ?)", (os.getpid(), prioridad, ahora)
+            ).lastrowid
+        return turno, 0.0
+
+    def liberar(self, turno):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM en_curso WHERE id = ?", (turno,))
+
+    def penalizar(self, segundos):
+        """Bloquea la cubeta para todos los workers durante ``segundos`` (respuesta 429)."""
+        ahora = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE cubeta SET tokens = 0, actualizado = ?, bloqueado_hasta = MAX(bloqueado_hasta, ?) WHERE id = 1",
+                (ahora + segundos, ahora + segundos),
+            )
+
+    def estado(self):
+        conn = self._conn()
+        tokens, actualizado, bloqueado_hasta = conn.execute(
+            "SELECT tokens, actualizado, bloqueado_hasta FROM cubeta WHERE id = 1"
+        ).fetchone()
+        en_curso = dict(conn.execute("SELECT prioridad, COUNT(*) FROM en_curso GROUP BY prioridad").fetchall())
+        ahora = time.time()
+        return {
+            'tokens': round(min(self.capacidad, tokens + max(0.0, ahora - actualizado) * self.tasa), 2),
+            'bloqueado_segundos': round(max(0.0, bloqueado_hasta - ahora), 2),
+            'en_curso': en_curso,
+            'tasa': self.tasa,
+            'capacidad': self.capacidad,
+            'concurrencia': self.concurrencia,
+        }
+
+
+class Planificador:
+    """Ejecuta llamadas a Dropbox cuando la cubeta compartida lo permite."""
+
+    def __init__(self, cubeta, espera_interactiva=DEFAULT_ESPERA_INTERACTIVA,
+                 espera_segundo_plano=DEFAULT_ESPERA_SEGUNDO_PLANO, reintentos=REINTENTOS):
+        self.cubeta = cubeta
+        self.espera_maxima = {INTERACTIVA: espera_interactiva, SEGUNDO_PLANO: espera_segundo_plano}
+        self.reintentos = reintentos
+
+    def _esperar_turno(self, prioridad, limite):
+        from app.dropbox_metrics import registrar_espera
+
+        inicio = time.monotonic()
+        while True:
+            try:
+                turno, espera = self.cubeta.intentar(prioridad)
+            except sqlite3.Error as e:
+                # Sin la cubeta compartida no se bloquean las llamadas
+                logger.warning(f"No se pudo consultar el límite de tasa de Dropbox: {e}")
+                return None
+            if turno is not None:
+                registrar_espera(prioridad, time.monotonic() - inicio)
+                return turno
+            restante = limite - time.monotonic()
+            if espera > restante:
+                registrar_espera(prioridad, time.monotonic() - inicio)
+                raise dropbox.exceptions.RateLimitError(None, backoff=max(espera, 1.0))
+            time.sleep(min(espera, SONDEO_MAXIMO))
+
+    def _liberar(self, turno):
+        if turno is None:
+            return
+        try:
+            self.cubeta.liberar(turno)
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo liberar el turno {turno} de Dropbox: {e}")
+
+    def ejecutar(self, funcion, prioridad=INTERACTIVA, nombre=''):
+        """Llama a ``funcion()`` con turno, reintentando los 429 tras su ``backoff``."""
+        limite = time.monotonic() + self.espera_maxima.get(prioridad, DEFAULT_ESPERA_INTERACTIVA)
+        intento = 0
+        while True:
+            turno = self._esperar_turno(prioridad, limite)
+            try:
+                return funcion()
+            except dropbox.exceptions.RateLimitError as e:
+                backoff = e.backoff if e.backoff is not None else BACKOFF_POR_DEFECTO * (2 ** intento)
+                try:
+                    self.cubeta.penalizar(backoff)
+                except sqlite3.Error as error:
+                    logger.warning(f"No se pudo registrar la penalización de Dropbox: {error}")
+                intento += 1
+                if intento > self.reintentos or time.monotonic() + backoff > limite:
+                    raise
+                logger.info(f"Dropbox limitó {nombre or 'la llamada'}; reintento {intento} en {backoff:.1f} s")
+                if turno is None:
+                    time.sleep(backoff)
+            finally:
+                self._liberar(turno)
+
+    def estado(self):
+        return self.cubeta.estado()
+
+
+def prioridad_actual():
+    """Interactiva dentro de una petición web; segundo plano en hilos, scripts y comandos."""
+    from flask import has_request_context
+
+    return INTERACTIVA if has_request_context() else SEGUNDO_PLANO
+
+
+# Instancia global (una por proceso; la cubeta compartida une a los workers)
+planificador = None
+_planificador_lock = threading.Lock()
+_DESACTIVADO = object()
+
+
+def get_planificador():
+    """Planificador configurado o ``None`` si el límite de tasa está desactivado."""
+    global planificador
+    if planificador is None:
+        with _planificador_lock:
+            if planificador is None:
+                planificador = _build_from_config() or _DESACTIVADO
+    return None if planificador is _DESACTIVADO else planificador
+
+
+def _config():
+    try:
+        from flask import current_app
+        return current_app.config, current_app.instance_path
+    except RuntimeError:
+        return {}, os.getcwd()
+
+
+def habilitado():
+    cfg, _ = _config()
+    valor = cfg.get('DROPBOX_RATE_LIMIT_ENABLED')
+    if valor is None:
+        valor = os.environ.get('DROPBOX_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    return bool(valor)
+
+
+def _build_from_config():
+    if not habilitado():
+        return None
+    cfg, instance_path = _config()
+    path = cfg.get('DROPBOX_RATE_LIMIT_SQLITE_PATH') or os.path.join(instance_path, 'dropbox_rate_limit.sqlite3')
+    try:
+        cubeta = SQLiteBucket(
+            path,
+            tasa=float(cfg.get('DROPBOX_RATE_LIMIT_PER_SECOND') or DEFAULT_TASA),
+            capacidad=float(cfg.get('DROPBOX_RATE_LIMIT_BURST') or DEFAULT_CAPACIDAD),
+            reserva=float(cfg.get('DROPBOX_RATE_LIMIT_INTERACTIVE_RESERVE') or DEFAULT_RESERVA),
+            concurrencia=int(cfg.get('DROPBOX_MAX_CONCURRENCY') or DEFAULT_CONCURRENCIA),
+            reserva_concurrencia=int(
+                cfg.get('DROPBOX_INTERACTIVE_CONCURRENCY_RESERVE') or DEFAULT_RESERVA_CONCURRENCIA
+            ),
+        )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"No se pudo abrir la cubeta de Dropbox en {path}, sin límite de tasa: {e}")
+        return None
+    return Planificador(
+        cubeta,
+        espera_interactiva=float(cfg.get('DROPBOX_INTERACTIVE_MAX_WAIT') or DEFAULT_ESPERA_INTERACTIVA),
+        espera_segundo_plano=float(cfg.get('DROPBOX_BACKGROUND_MAX_WAIT') or DEFAULT_ESPERA_SEGUNDO_PLANO),
+    )
+
+
+def init_app(app):
+    """Responde con 503 y ``Retry-After`` cuando Dropbox sigue limitando tras los reintentos."""
+
+    @app.errorhandler(dropbox.exceptions.RateLimitError)
+    def dropbox_limitado(error):
+        segundos = max(1, int(round(error.backoff or BACKOFF_POR_DEFECTO)))
+        mensaje = 'Dropbox está recibiendo demasiadas solicitudes. Intenta de nuevo en unos segundos.'
+        if request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            respuesta = jsonify({'success': False, 'error': mensaje, 'retry_after': segundos})
+        else:
+            respuesta = app.response_class(mensaje, mimetype='text/plain')
+        respuesta.status_code = 503
+        respuesta.headers['Retry-After'] = str(segundos)
+        return respuesta
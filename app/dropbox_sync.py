@@ -0,0 +1,530 @@
+"""
+Sincronización incremental Dropbox → BD basada en cursores de list_folder.
+
+Cada usuario guarda en ``User.dropbox_cursor`` el cursor de su carpeta raíz.
+La primera sincronización pagina el listado recursivo completo; las
+siguientes solo piden los cambios con ``files_list_folder_continue``, así el
+costo es proporcional a lo que cambió y no al tamaño del árbol.
+
+Los cambios de cada página se reducen primero al estado final de cada ruta
+(en el orden en que Dropbox los informa) y luego se aplican en bloque: una
+consulta ``IN`` para saber qué existe, un INSERT multi-fila para lo nuevo y
+DELETE/UPDATE por lote para bajas y movimientos.
+"""
+import logging
+import queue
+import threading
+from datetime import datetime
+
+import dropbox
+from sqlalchemy import bindparam
+
+from app import db
+from app.models import Archivo, Folder, User, extension_de_nombre
+from app.utils.notification_utils import desvincular_archivos
+from app.utils.query_utils import filtro_prefijo_ruta
+from app.utils.rollups import sumar_fechas
+from app.structure_cache import invalidar_estructuras
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de página pedido a Dropbox y tamaño de lote para cláusulas IN
+LIST_FOLDER_PAGE_SIZE = 2000
+_IN_CHUNK = 500
+
+# Un lock por usuario evita que el webhook y una sincronización manual
+# apliquen la misma página a la vez (duplicarían inserts).
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+
+
+def _user_lock(user_id):
+    with _user_locks_guard:
+        return _user_locks.setdefault(user_id, threading.Lock())
+
+
+def _chunks(items, size=_IN_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _categoria_subcategoria(canonical_path, user_root):
+    """Deriva categoría/subcategoría de los segmentos bajo la raíz del usuario."""
+    rel = canonical_path[len(user_root):].strip('/') if canonical_path.startswith(user_root) else canonical_path.strip('/')
+    partes = rel.split('/')[:-1]  # sin el nombre de archivo
+    categoria = partes[0] if len(partes) > 0 else ''
+    subcategoria = partes[1] if len(partes) > 1 else ''
+    return categoria, subcategoria
+
+
+class SyncStats(dict):
+    """Contadores de una sincronización (serializable a JSON)."""
+
+    def __init__(self):
+        super().__init__(
+            pages=0, archivos_nuevos=0, archivos_actualizados=0, archivos_movidos=0,
+            archivos_eliminados=0, carpetas_nuevas=0, carpetas_eliminadas=0, full=False,
+        )
+
+
+def _is_reset_error(e):
+    err = getattr(e, 'error', None)
+    try:
+        return isinstance(err, dropbox.files.ListFolderContinueError) and err.is_reset()
+    except Exception:
+        return False
+
+
+def _reducir_pagina(entries, user_root):
+    """
+    Reduce una página al estado final de cada ruta, respetando el orden.
+
+    Dropbox informa los cambios en orden: una baja anula lo que la página
+    listó antes en esa ruta o bajo ella, y lo que llega después (un archivo
+    vuelto a subir en la misma ruta, el contenido de una carpeta recreada)
+    prevalece sobre la baja. Las rutas se comparan sin mayúsculas, como en
+    Dropbox.
+
+    Retorna ``(archivos {ruta: entry}, carpetas {ruta: entry}, bajas [ruta])``.
+    """
+    from app.dropbox_utils import without_base_folder
+
+    final = {}
+    bajas = {}
+    for entry in entries:
+        path_display = getattr(entry, 'path_display', None)
+        if not path_display:
+            continue
+        canonical = without_base_folder(path_display)
+        clave = canonical.lower()
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            prefijo = clave.rstrip('/') + '/'
+            for k in [k for k in final if k == clave or k.startswith(prefijo)]:
+                del final[k]
+            for k in [k for k in bajas if k.startswith(prefijo)]:
+                del bajas[k]
+            bajas[clave] = canonical
+        elif isinstance(entry, (dropbox.files.FileMetadata, dropbox.files.FolderMetadata)):
+            final[clave] = (canonical, entry)
+    files = {c: e for c, e in final.values() if isinstance(e, dropbox.files.FileMetadata)}
+    folders = {
+        c: e for c, e in final.values()
+        if isinstance(e, dropbox.files.FolderMetadata) and c != user_root
+    }
+    return files, folders, list(bajas.values())
+
+
+def _destino_de_carpeta(origen, filas, nuevos_por_nombre):
+    """
+    Carpeta a la que se movió ``origen``: la ruta Q para la que más archivos
+    de ``filas`` (bajo ``origen``) reaparecen como ``Q + ruta relativa`` con
+    el mismo tamaño. ``None`` si ninguno coincide.
+    """
+    votos = {}
+    for row in filas:
+        relativa = row.dropbox_path[len(origen):]
+        for candidato, entry in nuevos_por_nombre.get(relativa.rsplit('/', 1)[-1].lower(), ()):
+            if candidato.lower().endswith(relativa.lower()) and entry.size == row.tamano:
+                destino = candidato[:len(candidato) - len(relativa)]
+                if destino.lower() != origen.lower():
+                    votos[destino] = votos.get(destino, 0) + 1
+    if not votos:
+        return None
+    return max(votos.items(), key=lambda item: item[1])[0]
+
+
+def _apply_page(user, entries, stats):
+    """Aplica una página de entradas de list_folder sobre Archivo/Folder."""
+    from app.dropbox_utils import _normalize_dropbox_path
+
+    user_root = _normalize_dropbox_path(user.dropbox_folder_path)
+    files, folders, deleted = _reducir_pagina(entries, user_root)
+    # Rutas que existen al final de la página: sus filas no se borran
+    vivos = {p.lower() for p in files} | {p.lower() for p in folders}
+
+    archivos = Archivo.__table__
+    carpetas = Folder.__table__
+
+    # --- Archivos existentes entre los agregados/modificados
+    existentes = {}
+    for chunk in _chunks(files):
+        for row in db.session.query(Archivo.id, Archivo.dropbox_path, Archivo.tamano).filter(
+            Archivo.dropbox_path.in_(chunk)
+        ):
+            existentes[row.dropbox_path] = row
+
+    # --- Filas afectadas por bajas (archivo o carpeta; DeletedMetadata no distingue).
+    # La baja de una carpeta es solo la raíz del subárbol: se borra todo lo de debajo.
+    columnas = (Archivo.id, Archivo.dropbox_path, Archivo.nombre, Archivo.tamano)
+    borrados_archivo = {}
+    for chunk in _chunks(deleted):
+        for row in db.session.query(*columnas).filter(Archivo.dropbox_path.in_(chunk)):
+            borrados_archivo[row.dropbox_path] = row
+    carpetas_borradas = set()
+    for chunk in _chunks(deleted):
+        for (path,) in db.session.query(Folder.dropbox_path).filter(Folder.dropbox_path.in_(chunk)):
+            carpetas_borradas.add(path)
+    bajo_carpeta = {}
+    for path in carpetas_borradas:
+        bajo_carpeta[path] = db.session.query(*columnas).filter(filtro_prefijo_ruta(Archivo.dropbox_path, path)).all()
+        for row in bajo_carpeta[path]:
+            borrados_archivo[row.dropbox_path] = row
+    borrados_archivo = {p: row for p, row in borrados_archivo.items() if p.lower() not in vivos}
+
+    # --- Movimientos: Dropbox los reporta como baja + alta. Se conservan
+    # estado y visibilidad moviendo el registro en lugar de recrearlo.
+    nuevos = {p: e for p, e in files.items() if p not in existentes}
+    nuevos_por_nombre = {}
+    for path, entry in nuevos.items():
+        nuevos_por_nombre.setdefault(entry.name.lower(), []).append((path, entry))
+    nuevos_lower = {p.lower(): p for p in nuevos}
+    movimientos = []
+    movimientos_carpeta = []
+
+    # Carpetas movidas o renombradas: baja de la carpeta + altas de su contenido
+    for origen in carpetas_borradas:
+        filas = [row for row in bajo_carpeta[origen] if row.dropbox_path in borrados_archivo]
+        destino = _destino_de_carpeta(origen, filas, nuevos_por_nombre)
+        if destino is None:
+            continue
+        for row in filas:
+            nueva = nuevos_lower.get((destino + row.dropbox_path[len(origen):]).lower())
+            if nueva is not None and nueva in nuevos:
+                movimientos.append((row, nueva))
+                borrados_archivo.pop(row.dropbox_path, None)
+                nuevos.pop(nueva)
+        movimientos_carpeta.append((origen, destino))
+
+    # Archivos sueltos: se emparejan por (nombre, tamaño) cuando el par es único en la página
+    altas_por_firma = {}
+    for path, entry in nuevos.items():
+        altas_por_firma.setdefault((entry.name, entry.size), []).append(path)
+    bajas_por_firma = {}
+    for row in borrados_archivo.values():
+        bajas_por_firma.setdefault((row.nombre, row.tamano), []).append(row)
+    for firma, rows in bajas_por_firma.items():
+        destinos = altas_por_firma.get(firma, [])
+        if len(rows) == 1 and len(destinos) == 1:
+            movimientos.append((rows[0], destinos[0]))
+            borrados_archivo.pop(rows[0].dropbox_path, None)
+            nuevos.pop(destinos[0], None)
+
+    if movimientos:
+        db.session.execute(
+            archivos.update()
+            .where(archivos.c.id == bindparam('b_id'))
+            .values(dropbox_path=bindparam('b_path'), categoria=bindparam('b_cat'), subcategoria=bindparam('b_sub')),
+            [
+                dict(zip(('b_id', 'b_path', 'b_cat', 'b_sub'),
+                         (row.id, destino) + _categoria_subcategoria(destino, user_root)))
+                for row, destino in movimientos
+            ],
+        )
+        stats['archivos_movidos'] += len(movimientos)
+
+    # Las filas Folder de una carpeta movida conservan su visibilidad
+    folders_lower = {p.lower(): p for p in folders}
+    for origen, destino in movimientos_carpeta:
+        cambios_carpeta = []
+        for folder_id, path in db.session.query(Folder.id, Folder.dropbox_path).filter(
+            (Folder.dropbox_path == origen) | filtro_prefijo_ruta(Folder.dropbox_path, origen)
+        ):
+            nueva = folders_lower.get((destino + path[len(origen):]).lower())
+            if nueva is not None:
+                cambios_carpeta.append({'b_id': folder_id, 'b_path': nueva, 'b_name': nueva.rsplit('/', 1)[-1]})
+        if cambios_carpeta:
+            db.session.execute(
+                carpetas.update().where(carpetas.c.id == bindparam('b_id'))
+                .values(dropbox_path=bindparam('b_path'), name=bindparam('b_name')),
+                cambios_carpeta,
+            )
+
+    # --- Bajas de archivos
+    if borrados_archivo:
+        ids = [row.id for row in borrados_archivo.values()]
+        for chunk in _chunks(ids):
+            desvincular_archivos(db.session.connection(), chunk, db.session)
+            db.session.query(Archivo).filter(Archivo.id.in_(chunk)).delete(synchronize_session=False)
+        stats['archivos_eliminados'] += len(ids)
+
+    # --- Bajas de carpetas (salvo las recreadas más adelante en la página)
+    for path in carpetas_borradas:
+        ids = [
+            folder_id for folder_id, folder_path in db.session.query(Folder.id, Folder.dropbox_path).filter(
+                (Folder.dropbox_path == path) | filtro_prefijo_ruta(Folder.dropbox_path, path)
+            )
+            if folder_path.lower() not in vivos
+        ]
+        for chunk in _chunks(ids):
+            stats['carpetas_eliminadas'] += db.session.query(Folder).filter(
+                Folder.id.in_(chunk)
+            ).delete(synchronize_session=False)
+
+    # --- Altas de archivos (INSERT multi-fila)
+    if nuevos:
+        filas = []
+        for path, entry in nuevos.items():
+            categoria, subcategoria = _categoria_subcategoria(path, user_root)
+            filas.append({
+                'nombre': entry.name,
+                'categoria': categoria,
+                'subcategoria': subcategoria,
+                'dropbox_path': path,
+                'tamano': entry.size,
+                'extension': extension_de_nombre(entry.name),
+                'usuario_id': user.id,
+                'estado': 'en_revision',
+            })
+        db.session.execute(archivos.insert(), filas)
+        sumar_fechas('archivos', [datetime.utcnow()] * len(filas))
+        stats['archivos_nuevos'] += len(filas)
+
+    # --- Modificaciones de archivos existentes (solo cambia el tamaño)
+    cambios = [
+        {'b_id': row.id, 'b_tamano': files[path].size}
+        for path, row in existentes.items()
+        if row.tamano != files[path].size
+    ]
+    if cambios:
+        db.session.execute(
+            archivos.update().where(archivos.c.id == bindparam('b_id')).values(tamano=bindparam('b_tamano')),
+            cambios,
+        )
+        stats['archivos_actualizados'] += len(cambios)
+
+    # --- Altas de carpetas
+    if folders:
+        ya = set()
+        for chunk in _chunks(folders):
+            ya.update(p for (p,) in db.session.query(Folder.dropbox_path).filter(Folder.dropbox_path.in_(chunk)))
+        filas = [
+            {'name': entry.name, 'user_id': user.id, 'dropbox_path': path, 'es_publica': True}
+            for path, entry in folders.items() if path not in ya
+        ]
+        if filas:
+            db.session.execute(carpetas.insert(), filas)
+            stats['carpetas_nuevas'] += len(filas)
+
+
+def sync_user(user, dbx=None, full=False):
+    """
+    Sincroniza la carpeta de un usuario con la BD.
+
+    - Con cursor guardado: solo aplica los cambios desde la última vez.
+    - Sin cursor, con ``full=True`` o si Dropbox invalida el cursor (reset):
+      recorre el árbol completo página por página.
+
+    Cada página se confirma junto con el cursor que la sigue, de modo que una
+    interrupción retoma desde la última página aplicada.
+
+    Returns:
+        SyncStats: contadores de la sincronización
+    """
+    from app.dropbox_utils import get_dbx, with_base_folder
+
+    stats = SyncStats()
+    if not getattr(user, 'dropbox_folder_path', None):
+        return stats
+    if dbx is None:
+        dbx = get_dbx()
+    if dbx is None:
+        raise RuntimeError("Cliente de Dropbox no disponible para sincronizar")
+
+    with _user_lock(user.id):
+        cursor = None if full else user.dropbox_cursor
+        result = None
+        if cursor:
+            try:
+                result = dbx.files_list_folder_continue(cursor)
+            except dropbox.exceptions.ApiError as e:
+                if not _is_reset_error(e):
+                    raise
+                logger.warning(f"Cursor de Dropbox reiniciado para usuario {user.id}; resincronizando completo")
+        if result is None:
+            stats['full'] = True
+            result = dbx.files_list_folder(
+                with_base_folder(user.dropbox_folder_path),
+                recursive=True,
+                limit=LIST_FOLDER_PAGE_SIZE,
+            )
+
+        while True:
+            try:
+                _apply_page(user, result.entries, stats)
+                user.dropbox_cursor = result.cursor
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            stats['pages'] += 1
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+
+    cambios = sum(v for k, v in stats.items() if k not in ('pages', 'full'))
+    if cambios:
+        # El árbol cacheado ya no refleja Dropbox (en ningún worker)
+        invalidar_estructuras(usuarios=[user.id], rutas=[user.dropbox_folder_path])
+
+    logger.info(f"Sincronización Dropbox usuario {user.id}: {dict(stats)}")
+    return stats
+
+
+def seed_user_cursor(user, dbx=None):
+    """Marca la carpeta del usuario como sincronizada sin listarla.
+
+    Útil para carpetas recién creadas (vacías) o cuando la BD ya está al día:
+    ``files_list_folder_get_latest_cursor`` devuelve un cursor sin entradas.
+    """
+    from app.dropbox_utils import get_dbx, with_base_folder
+
+    if not getattr(user, 'dropbox_folder_path', None):
+        return None
+    if dbx is None:
+        dbx = get_dbx()
+    if dbx is None:
+        return None
+    res = dbx.files_list_folder_get_latest_cursor(
+        with_base_folder(user.dropbox_folder_path), recursive=True
+    )
+    user.dropbox_cursor = res.cursor
+    db.session.commit()
+    return res.cursor
+
+
+def sync_all_users(full=False, dbx=None, progreso=None, solo_con_cursor=False):
+    """Sincroniza todos los usuarios con carpeta de Dropbox; devuelve totales.
+
+    ``progreso(hechos, total, user)`` se llama tras cada usuario (la cola de
+    trabajos lo usa para informar el avance y detenerse si se cancela).
+    Con ``solo_con_cursor`` se omiten los usuarios que nunca se sincronizaron
+    (su primera sincronización recorre el árbol completo).
+    """
+    from app.dropbox_utils import get_dbx
+
+    if dbx is None:
+        dbx = get_dbx()
+    totales = SyncStats()
+    errores = []
+    consulta = User.query.filter(User.dropbox_folder_path.isnot(None))
+    if solo_con_cursor:
+        consulta = consulta.filter(User.dropbox_cursor.isnot(None))
+    usuarios = consulta.all()
+    for hechos, user in enumerate(usuarios, 1):
+        try:
+            stats = sync_user(user, dbx=dbx, full=full)
+        except Exception as e:
+            logger.error(f"Error sincronizando usuario {user.email}: {e}")
+            errores.append(user.email)
+            stats = {}
+        for k, v in stats.items():
+            if isinstance(v, bool):
+                totales[k] = totales[k] or v
+            else:
+                totales[k] += v
+        if progreso is not None:
+            progreso(hechos, len(usuarios), user)
+    totales['errores'] = errores
+    return totales
+
+
+# ---------------------------------------------------------------------------
+# Cola alimentada por el webhook
+# ---------------------------------------------------------------------------
+
+_pending = queue.Queue()
+_pending_ids = set()
+_pending_guard = threading.Lock()
+_worker = None
+
+
+def _users_for_accounts(accounts):
+    """Usuarios afectados por las cuentas notificadas en el webhook.
+
+    Si la cuenta notificada es la cuenta de la app (la que contiene todas las
+    carpetas de clientes), no hay usuarios con ese ``dropbox_account_id`` y se
+    encolan los usuarios que ya tienen cursor: su ``continue`` es barato cuando
+    no hubo cambios.
+    """
+    accounts = [a for a in (accounts or []) if a]
+    ids = []
+    if accounts:
+        ids = [u.id for u in User.query.filter(User.dropbox_account_id.in_(accounts)).all()]
+    if not ids:
+        ids = [
+            u.id for u in User.query.filter(
+                User.dropbox_cursor.isnot(None), User.dropbox_folder_path.isnot(None)
+            ).all()
+        ]
+    return ids
+
+
+def enqueue_accounts(accounts, app=None):
+    """Encola los usuarios afectados y retorna cuántos se agregaron."""
+    from flask import current_app
+
+    if app is None:
+        app = current_app._get_current_object()
+    nuevos = 0
+    for user_id in _users_for_accounts(accounts):
+        with _pending_guard:
+            if user_id in _pending_ids:
+                continue
+            _pending_ids.add(user_id)
+        _pending.put(user_id)
+        nuevos += 1
+    _ensure_worker(app)
+    return nuevos
+
+
+def _ensure_worker(app):
+    global _worker
+    with _pending_guard:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_worker_loop, args=(app,), daemon=True, name='dropbox-sync')
+        _worker.start()
+
+
+def _worker_loop(app):
+    while True:
+        user_id = _pending.get()
+        with _pending_guard:
+            _pending_ids.discard(user_id)
+        try:
+            with app.app_context():
+                try:
+                    user = db.session.get(User, user_id)
+                    if user is not None:
+                        sync_user(user)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error en sincronización encolada del usuario {user_id}: {e}")
+                finally:
+                    db.session.remove()
+        finally:
+            _pending.task_done()
+
+
+def ponerse_al_dia(app):
+    """
+    Encola (en app/job_runner.py) una sincronización incremental de los
+    usuarios con cursor. La cola del webhook vive en memoria: los avisos que
+    un worker tenía pendientes se pierden si se recicla, se despliega o se
+    cae, y esto los recupera al arrancar el siguiente. La clave evita que los
+    workers que arrancan a la vez la encolen más de una vez.
+    """
+    from app import job_runner
+
+    with app.app_context():
+        try:
+            if db.session.query(User.id).filter(User.dropbox_cursor.isnot(None)).first() is None:
+                return None
+            trabajo, _ = job_runner.encolar(
+                'sincronizar_dropbox', {'full': False, 'solo_con_cursor': True},
+                clave='sincronizar_dropbox_pendientes',
+            )
+            return trabajo
+        finally:
+            db.session.remove()
@@ -33,7 +33,13 @@ class DropboxTokenManager:
         
         self.token_file = Path('.dropbox_tokens.json')
         self.last_refresh = None
-        self.refresh_lock = threading.Lock()
+        # Reentrante: get_valid_access_token lo toma y llama a refresh_access_token
+        self.refresh_lock = threading.RLock()
+        # Valores del entorno ya aplicados (ver refresh_env_view)
+        self._entorno_visto = self._leer_entorno()
+        # Último access token verificado contra Dropbox en este proceso.
+        # Mientras no rote, get_valid_access_token no vuelve a la red.
+        self._verified_access_token = None
         
         # Cargar tokens guardados si existen
         self._load_saved_tokens()
@@ -75,24 +81,26 @@ class DropboxTokenManager:
         except Exception as e:
             logger.error(f"Error guardando tokens: {e}")
     
+    @staticmethod
+    def _leer_entorno():
+        return {
+            'app_key': os.environ.get('DROPBOX_APP_KEY'),
+            'app_secret': os.environ.get('DROPBOX_APP_SECRET'),
+            'access_token': os.environ.get('DROPBOX_ACCESS_TOKEN') or os.environ.get('DROPBOX_API_KEY'),
+            'refresh_token': os.environ.get('DROPBOX_REFRESH_TOKEN'),
+        }
+
     def refresh_env_view(self):
         """Refresca credenciales desde variables de entorno si están disponibles.
-        No borra valores existentes; solo actualiza cuando hay un valor nuevo en el entorno.
+        No borra valores existentes; solo aplica los valores del entorno que cambiaron
+        desde la última lectura. Comparar con el valor actual revertiría un token que
+        otro hilo acaba de renovar y aún no ha escrito en el entorno.
         """
         try:
-            app_key_env = os.environ.get('DROPBOX_APP_KEY')
-            app_secret_env = os.environ.get('DROPBOX_APP_SECRET')
-            access_env = os.environ.get('DROPBOX_ACCESS_TOKEN') or os.environ.get('DROPBOX_API_KEY')
-            refresh_env = os.environ.get('DROPBOX_REFRESH_TOKEN')
-            
-            if app_key_env and app_key_env != self.app_key:
-                self.app_key = app_key_env
-            if app_secret_env and app_secret_env != self.app_secret:
-                self.app_secret = app_secret_env
-            if access_env and access_env != self.access_token:
-                self.access_token = access_env
-            if refresh_env and refresh_env != self.refresh_token:
-                self.refresh_token = refresh_env
+            for atributo, valor in self._leer_entorno().items():
+                if valor and valor != self._entorno_visto.get(atributo):
+                    self._entorno_visto[atributo] = valor
+                    setattr(self, atributo, valor)
         except Exception as e:
             logger.warning(f"No se pudo refrescar credenciales desde entorno: {e}")
     
@@ -206,12 +214,23 @@ class DropboxTokenManager:
                     token_data = response.json()
                     
                     # Actualizar tokens
+                    old_access_token = self.access_token
                     self.access_token = token_data.get('access_token')
                     self.refresh_token = token_data.get('refresh_token', self.refresh_token)
                     self.last_refresh = datetime.now()
+                    # Recién emitido por Dropbox: no requiere verificación adicional
+                    self._verified_access_token = self.access_token
                     
                     # Guardar tokens actualizados
                     self._save_tokens()
+
+                    # Descartar clientes cacheados del token anterior
+                    if old_access_token and old_access_token != self.access_token:
+                        try:
+                            from app.dropbox_client_pool import get_client_pool
+                            get_client_pool().invalidate(old_access_token)
+                        except Exception as e:
+                            logger.warning(f"No se pudo invalidar el pool de clientes: {e}")
                     
                     # Actualizar variables de entorno
                     self._update_environment_variables()
@@ -287,9 +306,23 @@ class DropboxTokenManager:
         
         return status
 
-    def get_valid_access_token(self):
+    def mark_access_token_verified(self, token):
+        """Registra que el token fue verificado (p.ej. por el pool de clientes)."""
+        if token and token == self.access_token:
+            self._verified_access_token = token
+
+    def mark_access_token_invalid(self, token=None):
+        """Olvida la verificación del token actual (p.ej. tras un AuthError)."""
+        if token is None or token == self._verified_access_token:
+            self._verified_access_token = None
+
+    def get_valid_access_token(self, verify=True):
         """
-        Obtiene un token de acceso válido, renovándolo si es necesario
+        Obtiene un token de acceso válido, renovándolo si es necesario.
+
+        Un token ya verificado en este proceso se devuelve sin llamadas de red
+        hasta que toque renovarlo. Con ``verify=False`` tampoco se verifica un
+        token nuevo: el llamador (el pool de clientes) se encarga de hacerlo.
         
         Returns:
             str|None: Token de acceso válido o None si no se puede obtener
@@ -302,23 +335,6 @@ class DropboxTokenManager:
             logger.warning("No hay refresh token configurado, usando access token actual")
             return self.access_token
         
-        # Primero validar que el refresh token no esté revocado
-        validation = self.validate_refresh_token()
-        if not validation["valid"]:
-            logger.error(f"Refresh token inválido: {validation['error']}")
-            # Permitir fallback opcional al access token cuando el refresh token está revocado
-            allow_fallback_env = os.environ.get('DROPBOX_ALLOW_ACCESS_TOKEN_FALLBACK', 'true')
-            allow_fallback = str(allow_fallback_env).strip().lower() in ("1", "true", "yes", "y")
-            if validation["status_code"] == 400:
-                logger.error("CRÍTICO: El refresh token está revocado. Se requiere reautenticación manual.")
-                if allow_fallback and self.access_token:
-                    logger.warning("Usando access token actual como fallback temporal (DROPBOX_ALLOW_ACCESS_TOKEN_FALLBACK habilitado)")
-                    return self.access_token
-                return None  # No usar token potencialmente inválido sin fallback
-            # Para otros errores, intentar usar el token actual
-            logger.warning("Error validando refresh token, usando access token actual")
-            return self.access_token
-        
         def _is_access_token_valid(token: str) -> bool:
             try:
                 import dropbox
@@ -333,23 +349,49 @@ class DropboxTokenManager:
             datetime.now() - self.last_refresh > timedelta(minutes=50)
         )
 
-        # Si no "toca" refrescar por tiempo, igual validamos el token.
+        # Si no "toca" refrescar por tiempo, validamos el token una sola vez por vida del token.
         # Esto cubre el caso típico en local: access token viejo en .env pero refresh token válido.
         if not needs_refresh and self.access_token:
+            if self._verified_access_token == self.access_token or not verify:
+                return self.access_token
             if _is_access_token_valid(self.access_token):
+                self._verified_access_token = self.access_token
                 return self.access_token
             logger.warning("Access token inválido detectado; forzando refresh...")
             needs_refresh = True
 
-        if needs_refresh:
+        # Un solo hilo renueva; los demás esperan y usan el token que obtuvo
+        with self.refresh_lock:
+            if (
+                self.access_token and self.last_refresh is not None and
+                datetime.now() - self.last_refresh <= timedelta(minutes=50) and
+                self._verified_access_token == self.access_token
+            ):
+                return self.access_token
+
+            # Antes de renovar, validar que el refresh token no esté revocado
+            validation = self.validate_refresh_token()
+            if not validation["valid"]:
+                logger.error(f"Refresh token inválido: {validation['error']}")
+                # Permitir fallback opcional al access token cuando el refresh token está revocado
+                allow_fallback_env = os.environ.get('DROPBOX_ALLOW_ACCESS_TOKEN_FALLBACK', 'true')
+                allow_fallback = str(allow_fallback_env).strip().lower() in ("1", "true", "yes", "y")
+                if validation["status_code"] == 400:
+                    logger.error("CRÍTICO: El refresh token está revocado. Se requiere reautenticación manual.")
+                    if allow_fallback and self.access_token:
+                        logger.warning("Usando access token actual como fallback temporal (DROPBOX_ALLOW_ACCESS_TOKEN_FALLBACK habilitado)")
+                        return self.access_token
+                    return None  # No usar token potencialmente inválido sin fallback
+                # Para otros errores, intentar usar el token actual
+                logger.warning("Error validando refresh token, usando access token actual")
+                return self.access_token
+
             logger.info("Renovando token de acceso...")
             if self.refresh_access_token():
                 logger.info("Token renovado exitosamente")
                 return self.access_token
             logger.error("No se pudo renovar el token")
             return None
-
-        return self.access_token
     
     def _start_auto_refresh_thread(self):
         """Inicia thread para renovación automática cada 45 minutos"""
@@ -420,18 +462,29 @@ class DropboxTokenManager:
 
 # Instancia global del gestor de tokens
 token_manager = None
+token_manager_pid = None
+_token_manager_lock = threading.Lock()
 
 def get_token_manager():
-    """Obtiene la instancia global del gestor de tokens"""
-    global token_manager
-    if token_manager is None:
-        token_manager = DropboxTokenManager()
+    """Obtiene la instancia global del gestor de tokens.
+
+    Se recrea tras el fork de gunicorn: el hilo de renovación automática del
+    proceso padre no existe en el worker.
+    """
+    global token_manager, token_manager_pid
+    if token_manager is None or token_manager_pid != os.getpid():
+        with _token_manager_lock:
+            if token_manager is None or token_manager_pid != os.getpid():
+                token_manager = DropboxTokenManager()
+                token_manager_pid = os.getpid()
     return token_manager
 
 def reset_token_manager():
     """Resetea la instancia global del gestor de tokens para releer entorno/archivo."""
-    global token_manager
-    token_manager = DropboxTokenManager()
+    global token_manager, token_manager_pid
+    with _token_manager_lock:
+        token_manager = DropboxTokenManager()
+        token_manager_pid = os.getpid()
     return token_manager
 
 def refresh_dropbox_token():
@@ -439,10 +492,10 @@ def refresh_dropbox_token():
     manager = get_token_manager()
     return manager.refresh_access_token()
 
-def get_valid_dropbox_token():
+def get_valid_dropbox_token(verify=True):
     """Obtiene un token válido de Dropbox"""
     manager = get_token_manager()
-    return manager.get_valid_access_token()
+    return manager.get_valid_access_token(verify=verify)
 
 def validate_dropbox_tokens():
     """Valida el estado completo de los tokens de Dropbox"""
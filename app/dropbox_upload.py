@@ -0,0 +1,596 @@
+"""
+Subidas a Dropbox por bloques (upload sessions) con memoria acotada.
+
+En lugar de ``archivo.read()`` + ``files_upload`` (que carga el archivo completo
+en RAM y falla por encima del límite de una sola llamada), el stream del
+``FileStorage`` se envía en bloques de ``CHUNK_SIZE`` con
+``files_upload_session_start/append_v2/finish``. Un archivo que cabe en un
+solo bloque se sube con ``files_upload`` como antes.
+
+Una sesión interrumpida puede retomarse desde el último offset confirmado:
+los reintentos internos lo hacen automáticamente y, si se agotan, la
+excepción ``ChunkedUploadError`` lleva el ``UploadSessionState`` para que el
+llamador reintente más tarde con ``upload_stream(..., session=estado)``.
+
+Para subidas de varios archivos, ``upload_batch`` sube las sesiones en
+paralelo (pool de hilos acotado) y las cierra todas juntas con
+``files_upload_session_finish_batch``; los nombres libres se resuelven antes
+de subir con un único listado de la carpeta (``ReservaNombres``).
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dropbox
+from dropbox.files import CommitInfo, UploadSessionCursor, UploadSessionFinishArg, WriteMode
+
+logger = logging.getLogger(__name__)
+
+# Dropbox recomienda múltiplos de 4 MB; cada bloque es lo único que se
+# mantiene en memoria durante la subida.
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1.0
+# Intentos de nombre con sufijo _N ante conflicto (mismo límite que antes)
+MAX_NAME_ATTEMPTS = 50
+# Subidas simultáneas por petición en upload_batch
+MAX_PARALLEL_UPLOADS = int(os.environ.get('DROPBOX_UPLOAD_WORKERS', '4'))
+# Límite de entradas por llamada a upload_session/finish_batch
+FINISH_BATCH_MAX_ENTRIES = 1000
+FINISH_BATCH_POLL_SECONDS = 0.5
+
+
+class UploadSessionState:
+    """Estado retomable de una sesión de subida."""
+
+    __slots__ = ('session_id', 'offset')
+
+    def __init__(self, session_id, offset=0):
+        self.session_id = session_id
+        self.offset = offset
+
+    def to_dict(self):
+        return {'session_id': self.session_id, 'offset': self.offset}
+
+
+class ChunkedUploadError(Exception):
+    """Falla de una subida por bloques; ``session`` permite retomarla."""
+
+    def __init__(self, message, session=None):
+        super().__init__(message)
+        self.session = session
+
+
+def _stream_size(stream):
+    """Tamaño del stream sin leerlo (None si no es posible)."""
+    try:
+        pos = stream.tell()
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(pos)
+        return size
+    except Exception:
+        return None
+
+
+def _is_conflict(e):
+    return isinstance(e, dropbox.exceptions.ApiError) and 'conflict' in str(e).lower()
+
+
+def _incorrect_offset(e):
+    """Offset correcto reportado por Dropbox ante un append desfasado."""
+    err = getattr(e, 'error', None)
+    try:
+        if err.is_incorrect_offset():
+            return err.get_incorrect_offset().correct_offset
+    except Exception:
+        pass
+    return None
+
+
+def _with_retries(fn, what):
+    """Ejecuta ``fn`` reintentando errores transitorios de red.
+
+    El bloque a reenviar ya está en memoria, así que no hace falta releer el
+    stream. Los errores de API (conflicto, offset desfasado) se propagan.
+    """
+    for intento in range(MAX_CHUNK_RETRIES + 1):
+        try:
+            return fn()
+        except (dropbox.exceptions.AuthError, dropbox.exceptions.ApiError):
+            raise
+        except Exception as e:
+            if intento >= MAX_CHUNK_RETRIES:
+                raise
+            logger.warning(f"Error transitorio en {what} (intento {intento + 1}): {e}")
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** intento))
+
+
+def upload_stream(dbx, stream, destinos, size=None, chunk_size=CHUNK_SIZE,
+                  progress=None, session=None, mode=None):
+    """
+    Sube ``stream`` a Dropbox por bloques y retorna ``(metadata, ruta_usada)``.
+
+    - destinos: ruta completa (con carpeta base) o iterable de rutas
+      candidatas; ante conflicto de nombre se prueba la siguiente sin volver
+      a subir los datos.
+    - progress: callback ``progress(bytes_enviados, total)``.
+    - session: ``UploadSessionState`` de un intento previo para retomarlo.
+    """
+    if isinstance(destinos, str):
+        destinos = [destinos]
+    destinos = iter(destinos)
+    mode = mode or WriteMode.add
+    if size is None:
+        size = _stream_size(stream)
+
+    def _report(sent):
+        if progress is not None:
+            try:
+                progress(sent, size)
+            except Exception:
+                pass
+
+    # Archivo pequeño: una sola llamada (el bloque ya está acotado)
+    if session is None and size is not None and size <= chunk_size:
+        stream.seek(0)
+        data = stream.read()
+        for destino in destinos:
+            try:
+                md = dbx.files_upload(data, destino, mode=mode)
+                _report(len(data))
+                return md, destino
+            except dropbox.exceptions.ApiError as e:
+                if _is_conflict(e):
+                    continue
+                raise
+        raise ChunkedUploadError("No hay nombre disponible para el archivo en Dropbox")
+
+    state = session
+    destino = next(destinos, None)
+    try:
+        if state is None:
+            stream.seek(0)
+            first = stream.read(chunk_size)
+            res = _with_retries(lambda: dbx.files_upload_session_start(first), 'upload_session_start')
+            state = UploadSessionState(res.session_id, len(first))
+            del first
+        _report(state.offset)
+
+        while destino is not None:
+            # Releer siempre desde el último offset confirmado: permite retomar
+            # tras un offset desfasado o una sesión de un intento anterior.
+            stream.seek(state.offset)
+            chunk = stream.read(chunk_size)
+            cursor = UploadSessionCursor(session_id=state.session_id, offset=state.offset)
+            try:
+                if len(chunk) == chunk_size:
+                    _with_retries(
+                        lambda: dbx.files_upload_session_append_v2(chunk, cursor), 'upload_session_append'
+                    )
+                    state.offset += len(chunk)
+                    _report(state.offset)
+                    continue
+                # Bloque final (posiblemente vacío): cerrar la sesión en la ruta destino
+                commit = CommitInfo(path=destino, mode=mode, autorename=False)
+                md = _with_retries(
+                    lambda: dbx.files_upload_session_finish(chunk, cursor, commit), 'upload_session_finish'
+                )
+                state.offset += len(chunk)
+                _report(state.offset)
+                return md, destino
+            except dropbox.exceptions.ApiError as e:
+                correct = _incorrect_offset(e)
+                if correct is not None:
+                    logger.warning(f"Offset desfasado en sesión {state.session_id}: {state.offset} -> {correct}")
+                    state.offset = correct
+                    continue
+                if _is_conflict(e):
+                    destino = next(destinos, None)
+                    continue
+                raise
+        raise ChunkedUploadError("No hay nombre disponible para el archivo en Dropbox", session=state)
+    except ChunkedUploadError:
+        raise
+    except dropbox.exceptions.AuthError:
+        raise
+    except Exception as e:
+        raise ChunkedUploadError(f"Subida interrumpida: {e}", session=state) from e
+
+
+def nombres_con_sufijo(carpeta, base, ext, max_intentos=MAX_NAME_ATTEMPTS):
+    """Genera ``carpeta/base.ext``, ``carpeta/base_1.ext``, ... (rutas lógicas)."""
+    carpeta = carpeta.rstrip('/')
+    for i in range(max_intentos):
+        nombre = f"{base}{ext}" if i == 0 else f"{base}_{i}{ext}"
+        yield f"{carpeta}/{nombre}".replace('//', '/')
+
+
+class ReservaNombres:
+    """
+    Resuelve nombres libres ``base_N.ext`` en una carpeta de Dropbox a partir
+    de un único listado, en lugar de probar ``files_upload`` hasta 50 veces.
+
+    Los nombres entregados quedan reservados, así que varios archivos con el
+    mismo nombre en una subida reciben sufijos distintos. Dropbox no distingue
+    mayúsculas, por lo que la comparación es en minúsculas.
+    """
+
+    def __init__(self, dbx, carpeta):
+        self.carpeta = carpeta.rstrip('/')
+        self._ocupados = _nombres_en_carpeta(dbx, self.carpeta)
+
+    def reservar(self, base, ext):
+        """Ruta libre para ``base``+``ext`` (o None si se agotan los sufijos)."""
+        for ruta in nombres_con_sufijo(self.carpeta, base, ext):
+            nombre = ruta.rsplit('/', 1)[-1].lower()
+            if nombre not in self._ocupados:
+                self._ocupados.add(nombre)
+                return ruta
+        return None
+
+    def alternativas(self, base, ext):
+        """Rutas libres adicionales (para reintentar si otra subida ganó el nombre)."""
+        while True:
+            ruta = self.reservar(base, ext)
+            if ruta is None:
+                return
+            yield ruta
+
+
+def _nombres_en_carpeta(dbx, carpeta):
+    """Nombres (en minúsculas) presentes en ``carpeta``; vacío si no existe."""
+    nombres = set()
+    try:
+        res = dbx.files_list_folder(carpeta or '', recursive=False, limit=2000)
+    except dropbox.exceptions.ApiError as e:
+        if 'not_found' in str(e).lower():
+            return nombres
+        raise
+    while True:
+        for entry in res.entries:
+            nombres.add(entry.name.lower())
+        if not res.has_more:
+            return nombres
+        res = dbx.files_list_folder_continue(res.cursor)
+
+
+class UploadJob:
+    """Un archivo de una subida en lote y su resultado."""
+
+    __slots__ = ('indice', 'nombre_original', 'stream', 'destino', 'alternativas',
+                 'progress', 'state', 'metadata', 'error')
+
+    def __init__(self, indice, nombre_original, stream, destino, alternativas=(), progress=None):
+        self.indice = indice
+        self.nombre_original = nombre_original
+        self.stream = stream
+        self.destino = destino
+        self.alternativas = alternativas
+        self.progress = progress
+        self.state = None
+        self.metadata = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.metadata is not None
+
+
+def _upload_closed_session(dbx, stream, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Sube todo ``stream`` a una sesión y la deja cerrada (requisito de
+    finish_batch). Retorna el ``UploadSessionState`` con el offset final.
+    """
+    size = _stream_size(stream)
+    if size is None:
+        raise ChunkedUploadError("No se pudo determinar el tamaño del archivo")
+
+    def _report(sent):
+        if progress is not None:
+            try:
+                progress(sent, size)
+            except Exception:
+                pass
+
+    stream.seek(0)
+    first = stream.read(chunk_size)
+    res = _with_retries(
+        lambda: dbx.files_upload_session_start(first, close=len(first) >= size), 'upload_session_start'
+    )
+    state = UploadSessionState(res.session_id, len(first))
+    del first
+    _report(state.offset)
+
+    try:
+        while state.offset < size:
+            stream.seek(state.offset)
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise ChunkedUploadError("El archivo terminó antes de lo esperado", session=state)
+            close = state.offset + len(chunk) >= size
+            cursor = UploadSessionCursor(session_id=state.session_id, offset=state.offset)
+            try:
+                _with_retries(
+                    lambda: dbx.files_upload_session_append_v2(chunk, cursor, close=close), 'upload_session_append'
+                )
+            except dropbox.exceptions.ApiError as e:
+                correct = _incorrect_offset(e)
+                if correct is None:
+                    raise
+                logger.warning(f"Offset desfasado en sesión {state.session_id}: {state.offset} -> {correct}")
+                state.offset = correct
+                continue
+            state.offset += len(chunk)
+            _report(state.offset)
+    except (ChunkedUploadError, dropbox.exceptions.AuthError):
+        raise
+    except Exception as e:
+        raise ChunkedUploadError(f"Subida interrumpida: {e}", session=state) from e
+    return state
+
+
+def _finish_batch(dbx, entries):
+    """Cierra sesiones en lote; retorna las entradas de resultado en orden."""
+    if hasattr(dbx, 'files_upload_session_finish_batch_v2'):
+        return dbx.files_upload_session_finish_batch_v2(entries).entries
+    # SDK antiguo: la versión asíncrona requiere consultar el job
+    launch = dbx.files_upload_session_finish_batch(entries)
+    if launch.is_complete():
+        return launch.get_complete().entries
+    job_id = launch.get_async_job_id()
+    while True:
+        time.sleep(FINISH_BATCH_POLL_SECONDS)
+        status = dbx.files_upload_session_finish_batch_check(job_id)
+        if status.is_complete():
+            return status.get_complete().entries
+
+
+def upload_batch(dbx, jobs, mode=None, max_workers=MAX_PARALLEL_UPLOADS, chunk_size=CHUNK_SIZE):
+    """
+    Sube varios archivos en paralelo y los confirma con una sola llamada a
+    finish_batch por cada ``FINISH_BATCH_MAX_ENTRIES`` archivos.
+
+    Cada ``UploadJob`` termina con ``metadata`` (éxito, ``destino`` es la ruta
+    usada) o ``error``. Si otro proceso ocupó el nombre reservado entre el
+    listado y el commit, se reintenta el cierre de esa sesión con
+    ``job.alternativas`` sin volver a subir los datos.
+    """
+    mode = mode or WriteMode.add
+    jobs = list(jobs)
+    if not jobs:
+        return jobs
+
+    def _subir(job):
+        job.state = _upload_closed_session(dbx, job.stream, chunk_size=chunk_size, progress=job.progress)
+
+    workers = max(1, min(max_workers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dropbox-upload') as pool:
+        futures = [(job, pool.submit(_subir, job)) for job in jobs]
+        for job, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                job.error = e
+                logger.warning(f"Error subiendo {job.nombre_original}: {e}")
+
+    listos = [job for job in jobs if job.state is not None and job.error is None]
+    for i in range(0, len(listos), FINISH_BATCH_MAX_ENTRIES):
+        lote = listos[i:i + FINISH_BATCH_MAX_ENTRIES]
+        entries = [
+            UploadSessionFinishArg(
+                cursor=UploadSessionCursor(session_id=job.state.session_id, offset=job.state.offset),
+                commit=CommitInfo(path=job.destino, mode=mode, autorename=False),
+            )
+            for job in lote
+        ]
+        try:
+            resultados = _finish_batch(dbx, entries)
+        except dropbox.exceptions.AuthError:
+            raise
+        except Exception as e:
+            for job in lote:
+                job.error = e
+            continue
+
+        for job, resultado in zip(lote, resultados):
+            if resultado.is_success():
+                job.metadata = resultado.get_success()
+                continue
+            fallo = resultado.get_failure()
+            if 'conflict' not in str(fallo).lower():
+                job.error = ChunkedUploadError(f"Dropbox rechazó el archivo: {fallo}", session=job.state)
+                continue
+            # El nombre se ocupó después del listado: cerrar la sesión en otra ruta
+            try:
+                job.metadata, job.destino = upload_stream(
+                    dbx, job.stream, job.alternativas, session=job.state, mode=mode
+                )
+            except Exception as e:
+                job.error = e
+    return jobs
+
+
+def insertar_archivos(filas):
+    """
+    Registra filas de ``Archivo`` con un único INSERT multi-fila y retorna
+    los objetos resultantes (en el orden de ``filas``) para usar sus ids.
+    No hace commit.
+    """
+    from app import db
+    from app.models import Archivo, extension_de_nombre
+    from app.utils.rollups import sumar_fechas
+
+    if not filas:
+        return []
+    # El INSERT de Core no pasa por los eventos del ORM (app/events.py)
+    for fila in filas:
+        fila['extension'] = fila.get('extension') or extension_de_nombre(fila['nombre'])
+    db.session.execute(Archivo.__table__.insert(), filas)
+    paths = [f['dropbox_path'] for f in filas]
+    por_path = {}
+    # Si la ruta ya tenía una fila antigua, la recién insertada es la de mayor id
+    for archivo in Archivo.query.filter(Archivo.dropbox_path.in_(paths)).order_by(Archivo.id).all():
+        por_path[archivo.dropbox_path] = archivo
+    insertados = [por_path[p] for p in paths if p in por_path]
+    sumar_fechas('archivos', [a.fecha_subida for a in insertados])
+    return insertados
+
+
+# ---------------------------------------------------------------------------
+# Progreso por archivo (consultado desde el navegador mientras sube)
+#
+# La subida corre en un worker de gunicorn y la consulta de progreso puede
+# llegar a otro, así que el progreso se guarda en un SQLite compartido
+# (UPLOAD_PROGRESS_SQLITE_PATH, como la caché de estructuras) con el id del
+# usuario que sube: solo ese usuario puede consultarlo.
+# ---------------------------------------------------------------------------
+
+_PROGRESS_TTL_SECONDS = 3600
+
+
+class MemoriaProgreso:
+    """Progreso en el propio proceso (STRUCTURE_CACHE_BACKEND=memory)."""
+
+    def __init__(self):
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def guardar(self, upload_id, usuario_id, indice, datos):
+        now = time.time()
+        with self._lock:
+            expirados = [k for k, v in self._datos.items() if now - v['updated'] > _PROGRESS_TTL_SECONDS]
+            for k in expirados:
+                self._datos.pop(k, None)
+            entry = self._datos.setdefault((usuario_id, upload_id), {'files': {}, 'updated': now})
+            entry['files'][indice] = datos
+            entry['updated'] = now
+
+    def leer(self, upload_id, usuario_id):
+        with self._lock:
+            entry = self._datos.get((usuario_id, upload_id))
+            if not entry or time.time() - entry['updated'] > _PROGRESS_TTL_SECONDS:
+                return None
+            return [dict(v, indice=k) for k, v in sorted(entry['files'].items())]
+
+
+class SQLiteProgreso:
+    """Progreso compartido entre procesos sobre un archivo SQLite (modo WAL)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS progreso_subida ("
+            " upload_id TEXT NOT NULL, usuario_id INTEGER NOT NULL, indice INTEGER NOT NULL,"
+            " datos TEXT NOT NULL, updated REAL NOT NULL,"
+            " PRIMARY KEY (upload_id, usuario_id, indice))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_progreso_subida_updated ON progreso_subida (updated)")
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (los callbacks corren en el pool de upload_batch)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def guardar(self, upload_id, usuario_id, indice, datos):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO progreso_subida (upload_id, usuario_id, indice, datos, updated)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (upload_id, usuario_id, indice, json.dumps(datos), now),
+        )
+        conn.execute("DELETE FROM progreso_subida WHERE updated < ?", (now - _PROGRESS_TTL_SECONDS,))
+
+    def leer(self, upload_id, usuario_id):
+        filas = self._conn().execute(
+            "SELECT indice, datos FROM progreso_subida"
+            " WHERE upload_id = ? AND usuario_id = ? AND updated >= ? ORDER BY indice",
+            (upload_id, usuario_id, time.time() - _PROGRESS_TTL_SECONDS),
+        ).fetchall()
+        if not filas:
+            return None
+        return [dict(json.loads(datos), indice=indice) for indice, datos in filas]
+
+
+# Instancia global (una por proceso; el archivo SQLite une a los workers)
+_progress_store = None
+_progress_store_lock = threading.Lock()
+
+
+def get_progress_store():
+    global _progress_store
+    if _progress_store is None:
+        with _progress_store_lock:
+            if _progress_store is None:
+                _progress_store = _build_progress_store()
+    return _progress_store
+
+
+def _build_progress_store():
+    from flask import current_app
+
+    cfg = current_app.config
+    if (cfg.get('STRUCTURE_CACHE_BACKEND') or 'memory').strip().lower() == 'sqlite':
+        path = cfg.get('UPLOAD_PROGRESS_SQLITE_PATH') or os.path.join(
+            current_app.instance_path, 'upload_progress.sqlite3'
+        )
+        try:
+            return SQLiteProgreso(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"No se pudo abrir el progreso compartido en {path}, usando solo memoria: {e}")
+    return MemoriaProgreso()
+
+
+def _publicar(store, upload_id, usuario_id, indice, datos):
+    # El progreso es informativo: un fallo al guardarlo no debe cortar la subida
+    try:
+        store.guardar(upload_id, usuario_id, indice, datos)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo guardar el progreso de la subida {upload_id}: {e}")
+
+
+def progress_tracker(upload_id, usuario_id, indice, nombre):
+    """Callback de progreso que publica el avance de un archivo de una subida."""
+    if not upload_id:
+        return None
+    # Se resuelve aquí (con contexto de app): el callback corre en el pool de hilos
+    store = get_progress_store()
+
+    def _cb(enviados, total):
+        _publicar(store, upload_id, usuario_id, indice, {
+            'nombre': nombre,
+            'enviados': enviados,
+            'total': total,
+            'porcentaje': round(100.0 * enviados / total, 1) if total else None,
+        })
+
+    return _cb
+
+
+def mark_progress_failed(upload_id, usuario_id, indice, nombre, error):
+    if not upload_id:
+        return
+    _publicar(get_progress_store(), upload_id, usuario_id, indice, {'nombre': nombre, 'error': str(error)})
+
+
+def get_progress(upload_id, usuario_id):
+    """Progreso de la subida ``upload_id`` de ``usuario_id`` (None si no existe o es de otro)."""
+    try:
+        return get_progress_store().leer(upload_id, usuario_id)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudo leer el progreso de la subida {upload_id}: {e}")
+        return None
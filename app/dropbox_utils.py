@@ -7,8 +7,11 @@ import logging
 from datetime import datetime
 import os
 from app.dropbox_token_manager import get_valid_dropbox_token, get_token_manager
+from app.dropbox_client_pool import get_client_pool
+from app.dropbox_metrics import instrumentar
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import re
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -17,13 +20,17 @@ logger = logging.getLogger(__name__)
 # con files_* dentro de esa carpeta. Marcamos un estado inválido para evitar fallbacks silenciosos.
 _UNRESOLVED_SHARED_LINK_SENTINEL = '::UNRESOLVED_SHARED_LINK::'
 
-# Cache simple en memoria para la carpeta base resuelta
+# Cache simple en memoria para la carpeta base resuelta. La resolución puede
+# llamar a Dropbox (enlace compartido): con workers de varios hilos la hace uno
+# solo mientras los demás esperan el resultado.
 _cached_base_folder = None
+_base_folder_lock = threading.RLock()
 
 def clear_base_folder_cache():
     """Limpia el cache de la carpeta base para forzar nueva resolución"""
     global _cached_base_folder
-    _cached_base_folder = None
+    with _base_folder_lock:
+        _cached_base_folder = None
 
 def _normalize_dropbox_path(path: str) -> str:
     """Normaliza rutas a formato Dropbox '/a/b' sin dobles barras."""
@@ -80,9 +87,16 @@ def sanitize_dropbox_segment(name: str) -> str:
 
 def get_dropbox_base_folder():
     """Obtiene la carpeta base configurada en Dropbox"""
+    carpeta = _cached_base_folder
+    if carpeta is not None:
+        return carpeta
+    with _base_folder_lock:
+        if _cached_base_folder is not None:
+            return _cached_base_folder
+        return _resolve_dropbox_base_folder()
+
+def _resolve_dropbox_base_folder():
     global _cached_base_folder
-    if _cached_base_folder is not None:
-        return _cached_base_folder
 
     def _join_under_base(base: str, segment: str | None) -> str:
         seg = (segment or '').strip()
@@ -199,10 +213,13 @@ def get_dropbox_client():
     """Obtiene el cliente de Dropbox con validaciones estrictas.
     - Nunca devuelve un cliente inválido.
     - Si no hay token válido, retorna None y loguea la causa.
+    - Reutiliza el cliente verificado del pool mientras el token no rote,
+      así que la verificación de la cuenta se hace una vez por token.
     """
     try:
         manager = get_token_manager()
-        token = get_valid_dropbox_token()
+        # El pool verifica el token al construir el cliente; evitar doble verificación
+        token = get_valid_dropbox_token(verify=False)
 
         # Si no hay access token pero sí refresh token, intentar refrescar on-demand
         if not token and manager and getattr(manager, 'refresh_token', None):
@@ -223,44 +240,27 @@ def get_dropbox_client():
             except Exception:
                 return ''
 
-        def _apply_path_root(client: dropbox.Dropbox, acct) -> dropbox.Dropbox:
-            """Aplica path_root para cuentas Business/Team cuando se solicita.
-
-            En Dropbox Business es común que la UI muestre el 'Team space' mientras que
-            la API por defecto opera en el 'home namespace'. Con path_root=root, la API
-            ve el mismo árbol que la UI (por ejemplo, /IOK alfa/Casos App IOK).
-
-            Configuración: DROPBOX_PATH_ROOT_MODE=root
-            """
-            mode = _get_path_root_mode()
-            if mode != 'root':
-                return client
-            try:
-                root_info = getattr(acct, 'root_info', None)
-                root_ns = getattr(root_info, 'root_namespace_id', None)
-                if not root_ns:
-                    logger.warning("DROPBOX_PATH_ROOT_MODE=root pero no hay root_namespace_id disponible")
-                    return client
-                return client.with_path_root(dropbox.common.PathRoot.root(root_ns))
-            except Exception as e:
-                logger.warning(f"No se pudo aplicar path_root=root: {e}")
-                return client
+        pool = get_client_pool()
+        mode = _get_path_root_mode()
 
-        def _build_and_verify(access_token: str):
-            client = dropbox.Dropbox(access_token)
-            acct = client.users_get_current_account()
-            client = _apply_path_root(client, acct)
-            return client
+        def _get_verified(access_token: str):
+            client = pool.get_client(access_token, mode)
+            if manager:
+                manager.mark_access_token_verified(access_token)
+            return instrumentar(client)
 
         try:
-            return _build_and_verify(token)
+            return _get_verified(token)
         except dropbox.exceptions.AuthError as e:
             # Si el token expiró/revocó, intentar una renovación inmediata y reintentar 1 vez.
             logger.warning(f"Token de Dropbox inválido o expirado, intentando refresh: {e}")
+            pool.invalidate(token)
+            if manager:
+                manager.mark_access_token_invalid(token)
             if manager and getattr(manager, 'refresh_token', None):
                 if manager.refresh_access_token() and manager.access_token:
                     try:
-                        return _build_and_verify(manager.access_token)
+                        return _get_verified(manager.access_token)
                     except Exception as e2:
                         logger.error(f"No se pudo verificar la cuenta de Dropbox tras refresh: {e2}")
                         return None
@@ -384,7 +384,9 @@ def get_file_download_link(*args, **kwargs):
 def descargar_desde_dropbox(*args, **kwargs):
     """Descarga archivo desde Dropbox.
 
-    Retorna bytes del contenido o None en caso de error.
+    Retorna bytes del contenido o None en caso de error. Carga el archivo
+    completo en memoria: para responder a peticiones HTTP usar
+    ``app.dropbox_download.respuesta_archivo`` (streaming).
     Acepta 'path' como argumento nombrado o primer posicional.
     """
     try:
@@ -446,10 +448,18 @@ def generar_enlace_dropbox_temporal(*args, **kwargs):
         return None
 
 def process_dropbox_webhook(*args, **kwargs):
-    """Procesa webhook de Dropbox"""
+    """Procesa webhook de Dropbox.
+
+    Dropbox solo notifica qué cuentas cambiaron; los cambios se obtienen con
+    los cursores guardados. Aquí solo se encolan los usuarios afectados para
+    que el hilo de sincronización los procese fuera del request.
+    """
     try:
-        # Función placeholder
-        return {'status': 'ok', 'message': 'Webhook procesado'}
+        data = kwargs.get('data') or (args[0] if args else None) or {}
+        accounts = (data.get('list_folder') or {}).get('accounts') or []
+        from app.dropbox_sync import enqueue_accounts
+        encolados = enqueue_accounts(accounts)
+        return {'status': 'ok', 'message': 'Webhook procesado', 'encolados': encolados}
     except Exception as e:
         logger.error(f"Error procesando webhook: {e}")
         return {'status': 'error', 'message': str(e)}
@@ -2,13 +2,50 @@
 Eventos de SQLAlchemy para hooks automáticos
 """
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
 from app import db
 
 def setup_events():
     """Configura todos los eventos de SQLAlchemy"""
     
     # Importar el modelo después de que db esté inicializado
-    from app.models import Beneficiario
-    
+    from app.models import Archivo, Beneficiario, extension_de_nombre
+    from app.utils.rollups import registrar_cambios
+    from app.utils import dashboard_snapshot
+    from app.utils.notification_utils import actualizar_contadores, aplicar_regla_auto_leida
+    from app.utils.file_search import crear_indice_busqueda, eliminar_indice_busqueda
+
+    # Archivo.extension siempre derivada del nombre (estadísticas por tipo)
+    def completar_extension(mapper, connection, target):
+        renombrado = db.inspect(target).attrs.nombre.history.has_changes()
+        if renombrado or not target.extension:
+            target.extension = extension_de_nombre(target.nombre)
+
+    if not event.contains(Archivo, 'before_insert', completar_extension):
+        event.listen(Archivo, 'before_insert', completar_extension)
+        event.listen(Archivo, 'before_update', completar_extension)
+
+    # Conteos por hora/día de archivos y usuarios (dashboard)
+    if not event.contains(Session, 'after_flush', registrar_cambios):
+        event.listen(Session, 'after_flush', registrar_cambios)
+
+    # Snapshot del dashboard de administración: se invalida al hacer commit
+    if not event.contains(Session, 'after_commit', dashboard_snapshot.invalidar_tras_commit):
+        event.listen(Session, 'after_flush', dashboard_snapshot.marcar_tras_flush)
+        event.listen(Session, 'do_orm_execute', dashboard_snapshot.marcar_tras_execute)
+        event.listen(Session, 'after_commit', dashboard_snapshot.invalidar_tras_commit)
+        event.listen(Session, 'after_rollback', dashboard_snapshot.limpiar_tras_rollback)
+
+    # Contador de notificaciones no leídas y auto-lectura al salir de revisión
+    if not event.contains(Session, 'before_flush', aplicar_regla_auto_leida):
+        event.listen(Session, 'before_flush', aplicar_regla_auto_leida)
+        event.listen(Session, 'after_flush', actualizar_contadores)
+
+    # Índice de búsqueda de archivos (FTS5 / tsvector) junto con db.create_all()/drop_all()
+    if not event.contains(Archivo.__table__, 'after_create', crear_indice_busqueda):
+        event.listen(Archivo.__table__, 'after_create', crear_indice_busqueda)
+        event.listen(Archivo.__table__, 'before_drop', eliminar_indice_busqueda)
     
     print("✅ Eventos de SQLAlchemy configurados") 
\ No newline at end of file
@@ -0,0 +1,540 @@
+"""
+Cola de trabajos en segundo plano guardada en la BD (sin broker externo).
+
+``sincronizar_dropbox``, ``sincronizar_dropbox_completo``, ``eliminar_usuario``
+(borrado recursivo en Dropbox y miles de filas en cascada) y la reparación de
+carpetas de beneficiarios corrían dentro de la petición: el navegador esperaba
+minutos, gunicorn la cortaba a los 300 s y el trabajo quedaba a medias sin
+forma de retomarlo.
+
+Ahora la ruta llama a ``encolar()``, que guarda una fila ``Trabajo`` y
+responde de inmediato; el estado se consulta en ``/trabajos/<id>``.
+
+- Las tareas se registran por ``tipo`` con ``@tarea`` (app/job_tasks.py).
+  Reciben un ``Contexto`` con el que guardan el progreso (``avanzar``), que
+  además detiene la tarea si se pidió cancelarla.
+- El worker reclama cada trabajo con un ``UPDATE`` condicional (estado +
+  lease), como el outbox de notificaciones, así que varios procesos pueden
+  tener workers sin ejecutar dos veces el mismo trabajo. Mientras corre, un
+  hilo renueva el lease; si el proceso muere, el trabajo vuelve a estar
+  disponible al vencer y se retoma.
+- Los errores se reintentan con backoff hasta ``max_intentos``. Las tareas
+  están escritas para que repetirlas sea seguro: retoman lo que falte.
+- ``clave`` evita duplicados: mientras haya un trabajo activo con la misma
+  clave, ``encolar`` devuelve ese en lugar de crear otro. Un índice único
+  parcial (``ux_trabajo_clave_activo``) lo garantiza también entre procesos.
+- La cancelación es cooperativa: los pendientes se cancelan al momento; los
+  que están corriendo se detienen en su siguiente ``avanzar()``.
+
+Configuración (config.py): JOB_RUNNER_WORKER (thread | external),
+JOB_RUNNER_CONCURRENCY, JOB_RUNNER_MAX_ATTEMPTS, JOB_RUNNER_BACKOFF_SECONDS,
+JOB_RUNNER_DRAIN_SECONDS. Con ``thread`` cada worker de gunicorn arranca su
+hilo al iniciar (``post_worker_init``) y lo drena al salir (``worker_exit``,
+también cuando se recicla por ``max_requests``). Con ``external`` el worker
+corre aparte: ``python manage.py job_worker``.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.notification_outbox import backoff
+
+logger = logging.getLogger(__name__)
+
+PENDIENTE = "pendiente"
+EJECUTANDO = "ejecutando"
+COMPLETADO = "completado"
+FALLIDO = "fallido"
+CANCELADO = "cancelado"
+ACTIVOS = (PENDIENTE, EJECUTANDO)
+
+# El hilo de latido renueva el lease cada LATIDO_SECONDS; si el proceso muere,
+# el trabajo se puede reclamar de nuevo LEASE_SECONDS después del último latido
+LEASE_SECONDS = 120
+LATIDO_SECONDS = 30
+# Cada cuánto revisa el worker si hay reintentos vencidos (si nadie lo despierta)
+POLL_SECONDS = 5
+LARGO_MENSAJE = 500
+
+
+class TrabajoCancelado(Exception):
+    """La tarea se detuvo porque se pidió cancelar su trabajo."""
+
+
+# --- Registro de tareas ---
+
+TAREAS = {}
+
+
+def tarea(tipo, al_cancelar=None):
+    """
+    Registra ``funcion(contexto, **parametros)`` como la tarea de ``tipo``.
+
+    ``al_cancelar(**parametros)`` se llama cuando el trabajo termina
+    cancelado (también si nunca llegó a empezar).
+    """
+    def registrar(funcion):
+        TAREAS[tipo] = (funcion, al_cancelar)
+        return funcion
+    return registrar
+
+
+def _tarea(tipo):
+    from app import job_tasks  # noqa: F401  (registra las tareas)
+
+    return TAREAS.get(tipo, (None, None))
+
+
+class Contexto:
+    """Lo que recibe la tarea para informar su progreso."""
+
+    def __init__(self, trabajo_id, intento):
+        self.trabajo_id = trabajo_id
+        self.intento = intento
+
+    def cancelado(self):
+        from app.models import Trabajo
+
+        return bool(db.session.execute(
+            select(Trabajo.cancelar).where(Trabajo.id == self.trabajo_id)
+        ).scalar())
+
+    def avanzar(self, progreso=None, total=None, mensaje=None, comprobar=True):
+        """
+        Guarda el progreso (hace commit de la sesión) y lanza
+        ``TrabajoCancelado`` si se pidió cancelar. Con ``comprobar=False``
+        solo guarda: para tramos que no conviene dejar a medias.
+        """
+        from app.models import Trabajo
+
+        valores = {'latido': datetime.utcnow()}
+        if progreso is not None:
+            valores['progreso'] = progreso
+        if total is not None:
+            valores['total'] = total
+        if mensaje is not None:
+            valores['mensaje'] = mensaje[:LARGO_MENSAJE]
+        db.session.execute(update(Trabajo).where(Trabajo.id == self.trabajo_id).values(**valores))
+        db.session.commit()
+        if comprobar and self.cancelado():
+            raise TrabajoCancelado()
+
+
+# --- Encolar, consultar, cancelar ---
+
+def activo(clave):
+    """Trabajo pendiente o en ejecución con ``clave``, si lo hay."""
+    from app.models import Trabajo
+
+    return (
+        Trabajo.query
+        .filter(Trabajo.clave == clave, Trabajo.estado.in_(ACTIVOS))
+        .order_by(Trabajo.id)
+        .first()
+    )
+
+
+def encolar(tipo, parametros=None, usuario_id=None, clave=None, max_intentos=None):
+    """
+    Guarda un trabajo pendiente y avisa al worker. Hace commit de la sesión
+    (junto con lo que el llamador haya agregado antes).
+
+    Si ya hay un trabajo activo con ``clave`` no se crea otro (tampoco si
+    otro proceso lo encola a la vez: lo impide ``ux_trabajo_clave_activo``).
+    Retorna ``(trabajo, nuevo)``.
+    """
+    from app.models import Trabajo
+
+    if _tarea(tipo)[0] is None:
+        raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+    if clave:
+        existente = activo(clave)
+        if existente is not None:
+            logger.info(f"Trabajo {tipo} ya encolado con clave {clave} (#{existente.id})")
+            return existente, False
+
+    ahora = datetime.utcnow()
+    trabajo = Trabajo(
+        tipo=tipo,
+        parametros=json.dumps(parametros or {}, default=str),
+        clave=clave,
+        estado=PENDIENTE,
+        usuario_id=usuario_id,
+        progreso=0,
+        intentos=0,
+        max_intentos=max_intentos or current_app.config.get("JOB_RUNNER_MAX_ATTEMPTS", 3),
+        cancelar=False,
+        proximo_intento=ahora,
+        fecha_creacion=ahora,
+    )
+    try:
+        # Savepoint: si choca con el índice único no se pierde lo que agregó el llamador
+        with db.session.begin_nested():
+            db.session.add(trabajo)
+    except IntegrityError:
+        existente = activo(clave) if clave else None
+        if existente is None:
+            raise
+        db.session.commit()
+        logger.info(f"Trabajo {tipo} encolado a la vez en otro proceso con clave {clave} (#{existente.id})")
+        return existente, False
+    db.session.commit()
+    despertar_worker()
+    return trabajo, True
+
+
+def cancelar(trabajo):
+    """
+    Pide cancelar ``trabajo``. Un pendiente se cancela ya; uno en ejecución
+    se detiene en su siguiente avance. Retorna False si ya había terminado.
+    """
+    from app.models import Trabajo
+
+    ahora = datetime.utcnow()
+    res = db.session.execute(
+        update(Trabajo)
+        .where(Trabajo.id == trabajo.id, Trabajo.estado == PENDIENTE)
+        .values(estado=CANCELADO, cancelar=True, mensaje="Cancelado", fecha_fin=ahora)
+    )
+    if res.rowcount:
+        db.session.commit()
+        _al_cancelar(trabajo.tipo, trabajo.parametros)
+        db.session.refresh(trabajo)
+        return True
+    res = db.session.execute(
+        update(Trabajo)
+        .where(Trabajo.id == trabajo.id, Trabajo.estado == EJECUTANDO)
+        .values(cancelar=True)
+    )
+    db.session.commit()
+    db.session.refresh(trabajo)
+    return res.rowcount == 1
+
+
+def _al_cancelar(tipo, parametros):
+    al_cancelar = _tarea(tipo)[1]
+    if al_cancelar is None:
+        return
+    try:
+        al_cancelar(**json.loads(parametros or '{}'))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.exception(f"Error al cancelar un trabajo {tipo}: {e}")
+
+
+def progreso(trabajo):
+    """Estado del trabajo para la API."""
+    return {
+        'id': trabajo.id,
+        'tipo': trabajo.tipo,
+        'estado': trabajo.estado,
+        'progreso': trabajo.progreso,
+        'total': trabajo.total,
+        'porcentaje': round(100 * trabajo.progreso / trabajo.total, 1) if trabajo.total else None,
+        'mensaje': trabajo.mensaje,
+        'resultado': json.loads(trabajo.resultado) if trabajo.resultado else None,
+        'error': trabajo.ultimo_error,
+        'intentos': trabajo.intentos,
+        'max_intentos': trabajo.max_intentos,
+        'cancelacion_solicitada': bool(trabajo.cancelar),
+        'fecha_creacion': trabajo.fecha_creacion.isoformat() if trabajo.fecha_creacion else None,
+        'fecha_inicio': trabajo.fecha_inicio.isoformat() if trabajo.fecha_inicio else None,
+        'fecha_fin': trabajo.fecha_fin.isoformat() if trabajo.fecha_fin else None,
+    }
+
+
+# --- Ejecución ---
+
+def _disponible(ahora):
+    from app.models import Trabajo as T
+
+    return or_(
+        and_(T.estado == PENDIENTE, T.proximo_intento <= ahora),
+        and_(T.estado == EJECUTANDO, T.bloqueado_hasta < ahora),
+    )
+
+
+def reclamar(trabajo_id):
+    """
+    Reserva el trabajo para este worker. Retorna False si otro worker lo
+    tomó primero o ya no está disponible.
+    """
+    from app.models import Trabajo as T
+
+    ahora = datetime.utcnow()
+    res = db.session.execute(
+        update(T)
+        .where(T.id == trabajo_id, _disponible(ahora))
+        .values(estado=EJECUTANDO, bloqueado_hasta=ahora + timedelta(seconds=LEASE_SECONDS),
+                latido=ahora, intentos=T.intentos + 1, fecha_inicio=func.coalesce(T.fecha_inicio, ahora))
+    )
+    db.session.commit()
+    return res.rowcount == 1
+
+
+def _renovar_lease(app, trabajo_id, detener):
+    from app.models import Trabajo as T
+
+    while not detener.wait(LATIDO_SECONDS):
+        with app.app_context():
+            try:
+                ahora = datetime.utcnow()
+                db.session.execute(
+                    update(T)
+                    .where(T.id == trabajo_id, T.estado == EJECUTANDO)
+                    .values(bloqueado_hasta=ahora + timedelta(seconds=LEASE_SECONDS), latido=ahora)
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"No se pudo renovar el lease del trabajo #{trabajo_id}: {e}")
+            finally:
+                db.session.remove()
+
+
+def _terminar(trabajo_id, estado, resultado=None, error=None, mensaje=None):
+    from app.models import Trabajo
+
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    trabajo.estado = estado
+    trabajo.bloqueado_hasta = None
+    trabajo.fecha_fin = trabajo.latido = datetime.utcnow()
+    if resultado is not None:
+        trabajo.resultado = json.dumps(resultado, default=str, ensure_ascii=False)
+    if error is not None:
+        trabajo.ultimo_error = error
+    if mensaje is not None:
+        trabajo.mensaje = mensaje
+    if estado == COMPLETADO and trabajo.total:
+        trabajo.progreso = trabajo.total
+    db.session.commit()
+    if estado == CANCELADO:
+        _al_cancelar(trabajo.tipo, trabajo.parametros)
+    return estado
+
+
+def _fallo(trabajo_id, error):
+    from app.models import Trabajo
+
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    if trabajo.cancelar:
+        return _terminar(trabajo_id, CANCELADO, error=error, mensaje="Cancelado")
+    if trabajo.intentos >= trabajo.max_intentos:
+        logger.error(f"Trabajo #{trabajo.id} ({trabajo.tipo}) falló tras {trabajo.intentos} intentos: {error}")
+        return _terminar(trabajo_id, FALLIDO, error=error)
+    base = current_app.config.get("JOB_RUNNER_BACKOFF_SECONDS", 60)
+    trabajo.estado = PENDIENTE
+    trabajo.ultimo_error = error
+    trabajo.bloqueado_hasta = None
+    trabajo.proximo_intento = datetime.utcnow() + timedelta(seconds=backoff(trabajo.intentos, base))
+    db.session.commit()
+    logger.warning(f"Trabajo #{trabajo.id} ({trabajo.tipo}) falló (intento {trabajo.intentos}), "
+                   f"reintento a las {trabajo.proximo_intento:%H:%M:%S}: {error}")
+    return trabajo.estado
+
+
+def procesar(trabajo_id):
+    """Ejecuta un trabajo ya reclamado y registra el resultado. Retorna el estado en que queda."""
+    from app.models import Trabajo
+
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    if trabajo is None or trabajo.estado != EJECUTANDO:
+        return None
+    funcion = _tarea(trabajo.tipo)[0]
+    if trabajo.cancelar:
+        # Se pidió cancelar y el proceso que lo ejecutaba murió antes de verlo
+        return _terminar(trabajo_id, CANCELADO, mensaje="Cancelado")
+    if funcion is None:
+        return _terminar(trabajo_id, FALLIDO, error=f"Tipo de trabajo desconocido: {trabajo.tipo}")
+    if trabajo.intentos > trabajo.max_intentos:
+        # Reclamado otra vez tras vencer el lease: el proceso se detuvo en cada intento
+        return _terminar(trabajo_id, FALLIDO,
+                         error=trabajo.ultimo_error or "El proceso que lo ejecutaba se detuvo")
+
+    parametros = json.loads(trabajo.parametros or '{}')
+    contexto = Contexto(trabajo.id, trabajo.intentos)
+    detener = threading.Event()
+    threading.Thread(
+        target=_renovar_lease, args=(current_app._get_current_object(), trabajo_id, detener),
+        name=f"trabajo-{trabajo_id}-lease", daemon=True,
+    ).start()
+    try:
+        resultado = funcion(contexto, **parametros)
+    except TrabajoCancelado:
+        db.session.rollback()
+        logger.info(f"Trabajo #{trabajo_id} cancelado")
+        return _terminar(trabajo_id, CANCELADO, mensaje="Cancelado")
+    except Exception as e:
+        db.session.rollback()
+        logger.exception(f"Trabajo #{trabajo_id} falló: {e}")
+        return _fallo(trabajo_id, f"{type(e).__name__}: {e}")
+    finally:
+        detener.set()
+    return _terminar(trabajo_id, COMPLETADO, resultado=resultado)
+
+
+class TrabajoWorker:
+    """Ejecuta trabajos con un pool de hilos (hasta ``concurrencia`` a la vez en este proceso)."""
+
+    def __init__(self, app, concurrencia=None, poll_seconds=POLL_SECONDS):
+        self.app = app
+        self.concurrencia = max(1, int(concurrencia or app.config.get("JOB_RUNNER_CONCURRENCY", 2)))
+        self.poll_seconds = poll_seconds
+        self._en_vuelo = 0
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrencia, thread_name_prefix="trabajo")
+
+    def en_vuelo(self):
+        with self._lock:
+            return self._en_vuelo
+
+    def despertar(self):
+        self._despertar.set()
+
+    def detener(self, espera=None):
+        """
+        Deja de reclamar trabajos y espera a los que están en curso (como mucho
+        ``espera`` segundos si se indica). Retorna cuántos siguen en curso.
+        """
+        self._detener.set()
+        self._despertar.set()
+        if espera is None:
+            self._pool.shutdown(wait=True)
+            return 0
+        self._pool.shutdown(wait=False)
+        limite = time.monotonic() + espera
+        while self.en_vuelo() and time.monotonic() < limite:
+            time.sleep(0.1)
+        return self.en_vuelo()
+
+    def _ejecutar(self, trabajo_id):
+        try:
+            with self.app.app_context():
+                try:
+                    procesar(trabajo_id)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.exception(f"Error procesando el trabajo #{trabajo_id}: {e}")
+                finally:
+                    db.session.remove()
+        finally:
+            with self._lock:
+                self._en_vuelo -= 1
+            self._despertar.set()
+
+    def ejecutar_una_vez(self):
+        """Reclama y lanza los trabajos disponibles que caben en el pool. Retorna cuántos lanzó."""
+        from app.models import Trabajo as T
+
+        libres = self.concurrencia - self.en_vuelo()
+        if libres <= 0:
+            return 0
+        lanzados = 0
+        with self.app.app_context():
+            try:
+                candidatos = db.session.execute(
+                    select(T.id)
+                    .where(_disponible(datetime.utcnow()))
+                    .order_by(T.proximo_intento, T.id)
+                    .limit(libres)
+                ).scalars().all()
+                for trabajo_id in candidatos:
+                    if self._detener.is_set() or not reclamar(trabajo_id):
+                        continue
+                    with self._lock:
+                        self._en_vuelo += 1
+                    self._pool.submit(self._ejecutar, trabajo_id)
+                    lanzados += 1
+            finally:
+                db.session.remove()
+        return lanzados
+
+    def drenar(self):
+        """Procesa hasta que no queden trabajos disponibles ni en curso."""
+        total = 0
+        while True:
+            self._despertar.clear()
+            lanzados = self.ejecutar_una_vez()
+            total += lanzados
+            if not lanzados and not self.en_vuelo():
+                return total
+            self._despertar.wait(self.poll_seconds)
+
+    def run_forever(self):
+        while not self._detener.is_set():
+            self._despertar.clear()
+            try:
+                self.ejecutar_una_vez()
+            except Exception as e:
+                logger.exception(f"Error en el worker de trabajos: {e}")
+            self._despertar.wait(self.poll_seconds)
+
+
+# Worker en hilo del propio proceso web (JOB_RUNNER_WORKER=thread)
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def iniciar_worker(app=None):
+    """
+    Arranca el worker en un hilo de este proceso si aún no corre. Lo llaman
+    ``post_worker_init`` de gunicorn y ``manage.py run`` al arrancar, para que
+    los trabajos pendientes (o abandonados por un worker reciclado) se retomen
+    sin esperar a que alguien encole otro. Retorna el worker, o ``None`` con
+    ``external`` (lo procesa manage.py).
+    """
+    global _worker, _worker_pid
+
+    app = app or current_app._get_current_object()
+    if app.config.get("JOB_RUNNER_WORKER", "thread") != "thread":
+        return None
+    with _worker_lock:
+        # Tras el fork de gunicorn el hilo del padre no existe en el hijo
+        if _worker is None or _worker_pid != os.getpid():
+            _worker = TrabajoWorker(app)
+            _worker_pid = os.getpid()
+            threading.Thread(target=_worker.run_forever, name="trabajo-worker", daemon=True).start()
+        return _worker
+
+
+def despertar_worker():
+    """Avisa al worker de que hay trabajos nuevos, arrancándolo en este proceso si hace falta."""
+    worker = iniciar_worker()
+    if worker is not None:
+        worker.despertar()
+
+
+def detener_worker(espera=None):
+    """
+    Hook ``worker_exit`` de gunicorn: deja de reclamar trabajos y espera a los
+    que están en curso como mucho ``espera`` segundos (JOB_RUNNER_DRAIN_SECONDS).
+    Los que no terminen se retoman en otro proceso al vencer su lease.
+    Retorna cuántos quedaron en curso.
+    """
+    global _worker, _worker_pid
+
+    with _worker_lock:
+        worker = _worker if _worker_pid == os.getpid() else None
+        _worker = _worker_pid = None
+    if worker is None:
+        return 0
+    if espera is None:
+        espera = worker.app.config.get("JOB_RUNNER_DRAIN_SECONDS", 25)
+    en_curso = worker.detener(espera)
+    if en_curso:
+        logger.warning(f"{en_curso} trabajo(s) seguían en curso al detener el worker; "
+                       f"se retomarán al vencer su lease ({LEASE_SECONDS} s)")
+    return en_curso
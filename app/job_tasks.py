@@ -0,0 +1,177 @@
+"""
+Tareas de la cola de trabajos (app/job_runner.py).
+
+Cada tarea se puede repetir sin riesgo: si un intento falla o el proceso
+muere a mitad, el siguiente retoma lo que falte.
+"""
+from app import db
+from app.job_runner import TrabajoCancelado, tarea
+
+# Filas por DELETE (y por commit) al eliminar el contenido de un usuario
+LOTE_BORRADO = 500
+MAX_ERRORES_GUARDADOS = 50
+
+
+@tarea('sincronizar_dropbox')
+def sincronizar_dropbox(contexto, full=False, solo_con_cursor=False):
+    """Sincronización Dropbox -> BD de todos los usuarios (incremental o completa)."""
+    from app.dropbox_sync import sync_all_users
+
+    contexto.avanzar(mensaje="Sincronizando carpetas de usuarios")
+    totales = sync_all_users(
+        full=full,
+        solo_con_cursor=solo_con_cursor,
+        progreso=lambda hechos, total, usuario: contexto.avanzar(hechos, total, f"Sincronizado {usuario.email}"),
+    )
+    return dict(totales)
+
+
+def _cancelar_movimiento(movimiento_id):
+    from app.dropbox_batch_move import cancelar
+
+    cancelar(movimiento_id)
+
+
+@tarea('exportar_carpeta', al_cancelar=_cancelar_movimiento)
+def exportar_carpeta(contexto, movimiento_id):
+    """Movimiento masivo de ``exportar_archivos_carpeta`` (app/dropbox_batch_move.py)."""
+    from app import dropbox_batch_move
+
+    movimiento = dropbox_batch_move.ejecutar(movimiento_id, avanzar=contexto.avanzar)
+    if movimiento is None:
+        return None
+    if movimiento.estado == dropbox_batch_move.CANCELADO:
+        raise TrabajoCancelado()
+    resultado = dropbox_batch_move.progreso(movimiento)
+    if movimiento.estado == dropbox_batch_move.FALLIDO:
+        raise RuntimeError(resultado['errores'][-1] if resultado['errores'] else "El movimiento falló")
+    return resultado
+
+
+def _borrar_por_lotes(contexto, etiqueta, modelo, *filtros, antes=None):
+    """
+    Borra las filas de ``modelo`` que cumplen ``filtros`` en lotes de
+    ``LOTE_BORRADO`` (un commit por lote). ``antes(ids)`` se llama antes de
+    borrar cada lote. Retorna cuántas filas borró.
+    """
+    borradas = 0
+    while True:
+        ids = db.session.execute(
+            db.select(modelo.id).where(*filtros).limit(LOTE_BORRADO)
+        ).scalars().all()
+        if not ids:
+            return borradas
+        if antes is not None:
+            antes(ids)
+        db.session.execute(db.delete(modelo).where(modelo.id.in_(ids)))
+        db.session.commit()
+        borradas += len(ids)
+        contexto.avanzar(mensaje=f"{borradas} {etiqueta} eliminados", comprobar=False)
+
+
+def _carpeta_no_encontrada(error):
+    ruta = getattr(error, 'error', None)
+    return bool(
+        ruta is not None
+        and hasattr(ruta, 'is_path_lookup')
+        and ruta.is_path_lookup()
+        and ruta.get_path_lookup().is_not_found()
+    )
+
+
+@tarea('eliminar_usuario')
+def eliminar_usuario(contexto, usuario_id, solicitante_id=None):
+    """
+    Elimina la carpeta de Dropbox del usuario y todo su contenido en la BD.
+
+    Solo se puede cancelar antes de borrar en Dropbox: después, dejar el
+    borrado a medias dejaría filas apuntando a archivos que ya no existen.
+    """
+    from dropbox.exceptions import ApiError
+
+    from app.dropbox_utils import get_dbx, with_base_folder
+    from app.models import (
+        Archivo, Beneficiario, Folder, FolderPermiso, Notification, NotificacionDifundida,
+        NotificacionDifundidaLeida, NotificacionSaliente, ResumenActividad, User, UserActivityLog,
+    )
+    from app.structure_cache import invalidar_estructuras
+    from app.utils.notification_utils import desvincular_archivos
+
+    usuario = db.session.get(User, usuario_id)
+    if usuario is None:
+        # Ya se eliminó en un intento anterior
+        return {'usuario_id': usuario_id, 'eliminado': True}
+    email = usuario.email
+    pasos = 4
+
+    contexto.avanzar(0, pasos, "Eliminando la carpeta de Dropbox")
+    if usuario.dropbox_folder_path:
+        dbx = get_dbx()
+        if dbx is None:
+            raise RuntimeError("No se pudo conectar a Dropbox (token inválido o no configurado)")
+        try:
+            dbx.files_delete_v2(with_base_folder(usuario.dropbox_folder_path))
+        except ApiError as e:
+            # La carpeta ya no existe (o se borró en un intento anterior)
+            if not _carpeta_no_encontrada(e):
+                raise
+        invalidar_estructuras(usuarios=[usuario_id], rutas=[usuario.dropbox_folder_path])
+
+    contexto.avanzar(1, pasos, "Eliminando archivos y carpetas", comprobar=False)
+    carpetas_usuario = db.select(Folder.id).where(Folder.user_id == usuario_id)
+    _borrar_por_lotes(contexto, "permisos", FolderPermiso, FolderPermiso.folder_id.in_(carpetas_usuario))
+    # Las notificaciones de otros usuarios sobre estos archivos dejan de estar pendientes
+    archivos = _borrar_por_lotes(
+        contexto, "archivos", Archivo, Archivo.usuario_id == usuario_id,
+        antes=lambda ids: desvincular_archivos(db.session.connection(), ids, db.session),
+    )
+    carpetas = _borrar_por_lotes(contexto, "carpetas", Folder, Folder.user_id == usuario_id)
+
+    contexto.avanzar(2, pasos, "Eliminando beneficiarios, actividad y notificaciones", comprobar=False)
+    _borrar_por_lotes(contexto, "beneficiarios", Beneficiario, Beneficiario.titular_id == usuario_id)
+    _borrar_por_lotes(contexto, "registros de actividad", UserActivityLog, UserActivityLog.user_id == usuario_id)
+    _borrar_por_lotes(contexto, "notificaciones", Notification, Notification.user_id == usuario_id)
+    ResumenActividad.query.filter_by(user_id=usuario_id).delete(synchronize_session=False)
+    NotificacionDifundidaLeida.query.filter_by(user_id=usuario_id).delete(synchronize_session=False)
+    NotificacionDifundida.query.filter_by(autor_id=usuario_id).update({'autor_id': None}, synchronize_session=False)
+    NotificacionSaliente.query.filter_by(usuario_id=usuario_id).update({'usuario_id': None}, synchronize_session=False)
+    db.session.commit()
+
+    contexto.avanzar(3, pasos, "Eliminando el usuario", comprobar=False)
+    db.session.delete(db.session.get(User, usuario_id))
+    if solicitante_id:
+        db.session.add(UserActivityLog(
+            user_id=solicitante_id,
+            accion="eliminar_usuario",
+            descripcion=f"Eliminó usuario {email} y todo su contenido (PRODUCCION)"
+        ))
+    db.session.commit()
+    return {'usuario_id': usuario_id, 'email': email, 'archivos': archivos, 'carpetas': carpetas, 'eliminado': True}
+
+
+@tarea('reparar_carpetas_beneficiarios')
+def reparar_carpetas_beneficiarios(contexto):
+    """Versión en segundo plano de ``fix_all_beneficiarios`` (mismo resumen)."""
+    from app.models import Beneficiario
+    from app.utils.beneficiario_utils import ensure_beneficiario_folder
+
+    beneficiarios = db.session.execute(
+        db.select(Beneficiario.id, Beneficiario.nombre, Beneficiario.email).order_by(Beneficiario.id)
+    ).all()
+    total = len(beneficiarios)
+    reparados = 0
+    errores = []
+    for hechos, (beneficiario_id, nombre, email) in enumerate(beneficiarios):
+        contexto.avanzar(hechos, total, f"Revisando {nombre} ({email})")
+        resultado = ensure_beneficiario_folder(beneficiario_id)
+        if resultado['success']:
+            reparados += 1
+        else:
+            errores.append({'beneficiario': f"{nombre} ({email})", 'error': resultado['error']})
+    return {
+        'success': True,
+        'total': total,
+        'fixed': reparados,
+        'errors': len(errores),
+        'error_details': errores[:MAX_ERRORES_GUARDADOS],
+    }
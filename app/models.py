@@ -20,7 +20,11 @@ class User(UserMixin, db.Model):
     activo = db.Column(db.Boolean, default=True)
     dropbox_folder_path = db.Column(db.String, nullable=True)
     dropbox_account_id = db.Column(db.String(100), nullable=True)  # ID de la cuenta de Dropbox
-    dropbox_cursor = db.Column(db.String(500), nullable=True)  # Cursor para sincronización incremental
+    dropbox_cursor = db.Column(db.Text, nullable=True)  # Cursor para sincronización incremental (app.dropbox_sync)
+    # Notificaciones no leídas (lo mantienen los eventos de app/events.py)
+    notificaciones_no_leidas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Notificaciones difundidas a su rol creadas hasta esta fecha se consideran leídas
+    difundidas_leidas_hasta = db.Column(db.DateTime, nullable=True)
     es_beneficiario = db.Column(db.Boolean, default=False)
     titular_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     rol = db.Column(db.String(20), nullable=False, default='cliente')
@@ -165,21 +169,13 @@ class User(UserMixin, db.Model):
                 self.puede_eliminar_archivos())
         
     def registrar_actividad(self, accion, descripcion=None):
-        """Registra una actividad del usuario"""
-        from flask import request
-        
-        actividad = UserActivityLog(
-            user_id=self.id,
-            accion=accion,
-            descripcion=descripcion,
-            ip_address=request.remote_addr if request else None,
-            user_agent=request.headers.get('User-Agent') if request else None
-        )
-        db.session.add(actividad)
-        
-        # Actualizar último acceso
-        self.ultimo_acceso = datetime.utcnow()
-        db.session.commit()
+        """Registra una actividad del usuario y su último acceso (en lote, ver app/activity_log_writer.py)"""
+        from sqlalchemy.orm.attributes import set_committed_value
+        from app.activity_log_writer import registrar
+
+        entrada = registrar(self.id, accion, descripcion, tocar_acceso=True)
+        # Reflejar el último acceso sin marcar la instancia como modificada
+        set_committed_value(self, 'ultimo_acceso', entrada['fecha'])
 
 class Beneficiario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -221,6 +217,15 @@ class Folder(db.Model):
     # Relación con usuario
     usuario = db.relationship('User', backref=db.backref('folders', lazy=True))
 
+    # Índices (ver migración d2e3f4a5b6c7)
+    __table_args__ = (
+        db.Index('ix_folder_dropbox_path', 'dropbox_path'),
+        db.Index('ix_folder_user_id', 'user_id'),
+        # Búsquedas por prefijo sin distinguir mayúsculas (filtro_prefijo_ruta, migración d3e4f5a6b7c9)
+        db.Index('ix_folder_dropbox_path_lower', db.func.lower(dropbox_path).label('dropbox_path_lower'),
+                 postgresql_ops={'dropbox_path_lower': 'varchar_pattern_ops'}),
+    )
+
 class FolderPermiso(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False)
@@ -232,6 +237,12 @@ class FolderPermiso(db.Model):
     folder = db.relationship('Folder', backref=db.backref('permisos', lazy=True))
     usuario = db.relationship('User', backref=db.backref('permisos_carpetas', lazy=True))
 
+def extension_de_nombre(nombre):
+    """Extensión de ``nombre`` en minúsculas y sin punto (ej: pdf), o None."""
+    if nombre and '.' in nombre:
+        return nombre.rsplit('.', 1)[1].strip().lower()[:20] or None
+    return None
+
 class Archivo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(255), nullable=False)  # nombre del archivo (ej: documento.pdf)
@@ -240,7 +251,7 @@ class Archivo(db.Model):
     dropbox_path = db.Column(db.String(500), nullable=False)  # ruta completa en Dropbox
     fecha_subida = db.Column(db.DateTime, default=datetime.utcnow)  # fecha/hora en que se subió el archivo
     tamano = db.Column(db.Integer, nullable=True)  # tamaño del archivo en bytes (opcional)
-    extension = db.Column(db.String(20), nullable=True)  # extensión (ej: pdf, jpg)
+    extension = db.Column(db.String(20), nullable=True)  # extensión (ej: pdf, jpg); se completa desde nombre (app/events.py)
     descripcion = db.Column(db.String(255), nullable=True)  # descripción opcional del archivo
     estado = db.Column(db.String(20), nullable=True, default='en_revision')
     es_publica = db.Column(db.Boolean, default=True)
@@ -249,6 +260,18 @@ class Archivo(db.Model):
     usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     usuario = db.relationship('User', backref=db.backref('archivos', lazy=True))
 
+    # Índices (ver migración d2e3f4a5b6c7)
+    __table_args__ = (
+        db.Index('ix_archivo_dropbox_path', 'dropbox_path'),
+        db.Index('ix_archivo_usuario_id_fecha_subida', 'usuario_id', 'fecha_subida'),
+        db.Index('ix_archivo_estado_fecha_subida', 'estado', 'fecha_subida'),
+        db.Index('ix_archivo_fecha_subida', 'fecha_subida'),
+        db.Index('ix_archivo_extension', 'extension'),
+        # Búsquedas por prefijo sin distinguir mayúsculas (filtro_prefijo_ruta, migración d3e4f5a6b7c9)
+        db.Index('ix_archivo_dropbox_path_lower', db.func.lower(dropbox_path).label('dropbox_path_lower'),
+                 postgresql_ops={'dropbox_path_lower': 'varchar_pattern_ops'}),
+    )
+
     def __repr__(self):
         return f"<Archivo {self.nombre} en {self.dropbox_path}>"
 
@@ -264,10 +287,50 @@ class UserActivityLog(db.Model):
     
     # Relación con usuario
     usuario = db.relationship('User', backref=db.backref('actividades', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_user_activity_log_user_id_fecha', 'user_id', 'fecha'),
+        db.Index('ix_user_activity_log_fecha', 'fecha'),
+    )
     
     def __repr__(self):
         return f"<ActivityLog {self.accion} by user {self.user_id} at {self.fecha}>"
 
+class ActividadArchivada(db.Model):
+    """Segmento comprimido de UserActivityLog archivado fuera de la tabla; ver app/activity_retention.py"""
+    __tablename__ = 'actividad_archivada'
+
+    id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.String(7), nullable=False)  # YYYY-MM (UTC)
+    ruta = db.Column(db.String(255), nullable=False)  # relativa a ACTIVITY_ARCHIVE_DIR
+    id_desde = db.Column(db.Integer, nullable=False)
+    id_hasta = db.Column(db.Integer, nullable=False)
+    filas = db.Column(db.Integer, nullable=False)
+    fecha_desde = db.Column(db.DateTime, nullable=True)
+    fecha_hasta = db.Column(db.DateTime, nullable=True)
+    # user_id % activity_retention.CUBETAS; None: segmento antiguo con todos los usuarios
+    cubeta = db.Column(db.Integer, nullable=True)
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_actividad_archivada_mes', 'mes'),
+        db.Index('ix_actividad_archivada_mes_cubeta', 'mes', 'cubeta'),
+    )
+
+    def __repr__(self):
+        return f"<ActividadArchivada {self.mes} {self.id_desde}-{self.id_hasta}>"
+
+class ResumenActividad(db.Model):
+    """Actividades archivadas por usuario y mes (sin FK: sobrevive al usuario, como el archivo)"""
+    __tablename__ = 'resumen_actividad'
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.String(7), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ResumenActividad user {self.user_id} {self.mes}: {self.total}>"
+
 class Notification(db.Model):
     """Modelo para notificaciones de usuarios"""
     id = db.Column(db.Integer, primary_key=True)
@@ -276,13 +339,18 @@ class Notification(db.Model):
     titulo = db.Column(db.String(200), nullable=False)
     mensaje = db.Column(db.Text, nullable=False)
     tipo = db.Column(db.String(50), nullable=False, default='info')  # info, success, warning, error
-    leida = db.Column(db.Boolean, default=False)
+    # active_history: el contador de no leídas necesita el valor anterior aunque la instancia esté expirada
+    leida = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     fecha_leida = db.Column(db.DateTime, nullable=True)
     
     # Relaciones
     usuario = db.relationship('User', backref=db.backref('notificaciones', lazy=True))
     archivo = db.relationship('Archivo', backref=db.backref('notificaciones', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_notification_user_id_leida_fecha_creacion', 'user_id', 'leida', 'fecha_creacion'),
+    )
     
     def marcar_como_leida(self):
         """Marca la notificación como leída"""
@@ -293,6 +361,150 @@ class Notification(db.Model):
     def __repr__(self):
         return f"<Notification {self.titulo} for user {self.user_id}>"
 
+class NotificacionDifundida(db.Model):
+    """Notificación de un evento para todos los usuarios de una audiencia (una fila por evento);
+    ver app/utils/notification_feed.py"""
+    __tablename__ = 'notificacion_difundida'
+
+    id = db.Column(db.Integer, primary_key=True)
+    audiencia = db.Column(db.String(20), nullable=False, default='staff')  # staff: admin, superadmin, lector
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivo.id'), nullable=True)
+    autor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # quien generó el evento
+    titulo = db.Column(db.String(200), nullable=False)
+    mensaje = db.Column(db.Text, nullable=False)
+    # Variante que ve el autor (p. ej. "Archivo subido exitosamente")
+    titulo_autor = db.Column(db.String(200), nullable=True)
+    mensaje_autor = db.Column(db.Text, nullable=True)
+    tipo = db.Column(db.String(50), nullable=False, default='info')
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    archivo = db.relationship('Archivo', backref=db.backref('notificaciones_difundidas', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_notificacion_difundida_audiencia_fecha_creacion', 'audiencia', 'fecha_creacion'),
+        db.Index('ix_notificacion_difundida_archivo_id', 'archivo_id'),
+    )
+
+    def __repr__(self):
+        return f"<NotificacionDifundida {self.titulo} for {self.audiencia}>"
+
+class NotificacionDifundidaLeida(db.Model):
+    """Marca de lectura de una notificación difundida por usuario"""
+    __tablename__ = 'notificacion_difundida_leida'
+
+    notificacion_id = db.Column(db.Integer, db.ForeignKey('notificacion_difundida.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    fecha_leida = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<NotificacionDifundidaLeida {self.notificacion_id} by user {self.user_id}>"
+
+class NotificacionSaliente(db.Model):
+    """Outbox de notificaciones externas (email, SMS, WhatsApp); ver app/notification_outbox.py"""
+    __tablename__ = 'notificacion_saliente'
+
+    id = db.Column(db.Integer, primary_key=True)
+    canal = db.Column(db.String(20), nullable=False)  # email, sms, whatsapp
+    proveedor = db.Column(db.String(20), nullable=False)  # smtp, sendgrid, twilio
+    funcion = db.Column(db.String(50), nullable=False)  # clave de external_notifications.ENVIADORES
+    destinatario = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON con los argumentos del envío
+    dedup_key = db.Column(db.String(64), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, enviando, enviada, fallida, duplicada
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=6)
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    bloqueado_hasta = db.Column(db.DateTime, nullable=True)  # lease del worker que la está enviando
+    ultimo_error = db.Column(db.Text, nullable=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    archivo_id = db.Column(db.Integer, db.ForeignKey('archivo.id'), nullable=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_envio = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_notificacion_saliente_estado_proximo_intento', 'estado', 'proximo_intento'),
+        db.Index('ix_notificacion_saliente_dedup_key', 'dedup_key'),
+    )
+
+    def __repr__(self):
+        return f"<NotificacionSaliente {self.id} {self.canal} {self.estado}>"
+
+class ConteoPeriodo(db.Model):
+    """
+    Conteos pre-agregados por hora y por día (hora local de Colombia) de
+    archivos subidos y usuarios registrados; ver app/utils/rollups.py
+    """
+    __tablename__ = 'conteo_periodo'
+
+    metrica = db.Column(db.String(20), primary_key=True)  # archivos, usuarios
+    granularidad = db.Column(db.String(10), primary_key=True)  # hora, dia
+    inicio = db.Column(db.DateTime, primary_key=True)  # inicio del bucket en hora local
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ConteoPeriodo {self.metrica} {self.granularidad} {self.inicio}: {self.total}>"
+
+class MovimientoLote(db.Model):
+    """Movimiento masivo de archivos entre carpetas en segundo plano; ver app/dropbox_batch_move.py"""
+    __tablename__ = 'movimiento_lote'
+
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    origen = db.Column(db.String(500), nullable=False)
+    destino = db.Column(db.String(500), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, ejecutando, completado, fallido
+    total = db.Column(db.Integer, nullable=False, default=0)
+    movidos = db.Column(db.Integer, nullable=False, default=0)
+    fallidos = db.Column(db.Integer, nullable=False, default=0)
+    errores = db.Column(db.Text, nullable=True)  # JSON con los primeros errores
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_inicio = db.Column(db.DateTime, nullable=True)
+    fecha_fin = db.Column(db.DateTime, nullable=True)
+    latido = db.Column(db.DateTime, nullable=True)  # última señal del hilo que lo ejecuta
+
+    __table_args__ = (
+        db.Index('ix_movimiento_lote_estado', 'estado'),
+    )
+
+    def __repr__(self):
+        return f"<MovimientoLote {self.id} {self.origen} -> {self.destino} {self.estado}>"
+
+class Trabajo(db.Model):
+    """Trabajo en segundo plano (sincronizaciones, exportaciones, borrados masivos); ver app/job_runner.py"""
+    __tablename__ = 'trabajo'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)  # clave del registro de app/job_tasks.py
+    parametros = db.Column(db.Text, nullable=False, default='{}')  # JSON con los argumentos
+    clave = db.Column(db.String(255), nullable=True)  # idempotencia: un solo trabajo activo por clave
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, ejecutando, completado, fallido, cancelado
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    progreso = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    mensaje = db.Column(db.String(500), nullable=True)
+    resultado = db.Column(db.Text, nullable=True)  # JSON devuelto por la tarea
+    ultimo_error = db.Column(db.Text, nullable=True)
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=3)
+    cancelar = db.Column(db.Boolean, nullable=False, default=False)  # cancelación solicitada
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    bloqueado_hasta = db.Column(db.DateTime, nullable=True)  # lease del worker que lo ejecuta
+    latido = db.Column(db.DateTime, nullable=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_inicio = db.Column(db.DateTime, nullable=True)
+    fecha_fin = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_trabajo_estado_proximo_intento', 'estado', 'proximo_intento'),
+        # Un solo trabajo activo por clave, también entre procesos (ver migración c2d3e4f5a6b8)
+        db.Index('ux_trabajo_clave_activo', 'clave', unique=True,
+                 postgresql_where=db.text("estado IN ('pendiente', 'ejecutando')"),
+                 sqlite_where=db.text("estado IN ('pendiente', 'ejecutando')")),
+    )
+
+    def __repr__(self):
+        return f"<Trabajo {self.id} {self.tipo} {self.estado}>"
+
 class Comentario(db.Model):
     """Comentarios asociados a archivos o carpetas por ruta de Dropbox."""
     id = db.Column(db.Integer, primary_key=True)
@@ -304,6 +516,10 @@ class Comentario(db.Model):
 
     usuario = db.relationship('User', backref=db.backref('comentarios', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_comentario_dropbox_path', 'dropbox_path'),
+    )
+
     def __repr__(self):
         return f"<Comentario {self.id} by {self.user_id} on {self.dropbox_path}>"
 
@@ -0,0 +1,394 @@
+"""
+Outbox de notificaciones externas (email, SMS, WhatsApp).
+
+``actualizar_estado_archivo`` enviaba los emails/SMS/WhatsApp dentro de la
+petición: la respuesta esperaba a SMTP, SendGrid y Twilio (segundos cada uno)
+y si un proveedor fallaba la notificación se perdía sin reintento.
+
+Ahora la ruta solo guarda una fila ``NotificacionSaliente`` por envío en la
+misma BD (``encolar_notificaciones_documento``) y responde. Un worker las
+procesa en segundo plano:
+
+- Reclama cada fila con un ``UPDATE`` condicional (estado + lease), así varios
+  workers/procesos no envían la misma fila dos veces. Si un worker muere a
+  mitad de un envío, la fila vuelve a estar disponible al vencer el lease.
+- Reintenta con backoff exponencial con jitter hasta ``max_intentos``.
+- Limita los envíos simultáneos por proveedor (smtp, sendgrid, twilio).
+- Deduplica: un mismo envío (función, destinatario, archivo y contenido) no se
+  encola de nuevo dentro de ``NOTIFICATION_OUTBOX_DEDUP_SECONDS`` y no se
+  envía si otra fila con la misma clave, encolada dentro de esa ventana, ya
+  se envió.
+
+Configuración (config.py): NOTIFICATION_OUTBOX_WORKER (thread | external),
+NOTIFICATION_OUTBOX_CONCURRENCY, NOTIFICATION_OUTBOX_MAX_ATTEMPTS,
+NOTIFICATION_OUTBOX_BACKOFF_SECONDS, NOTIFICATION_OUTBOX_DEDUP_SECONDS,
+NOTIFICATION_OUTBOX_DRAIN_SECONDS. Con ``thread`` cada worker de gunicorn
+arranca su hilo al iniciar (``post_worker_init``), así las filas pendientes o
+a la espera de su reintento no dependen de que se encole otra, y lo drena al
+salir (``worker_exit``). Con ``external`` el worker corre aparte:
+``python manage.py notification_worker``.
+``scripts/check_notification_outbox.py`` ejercita el reclamo, los reintentos y
+la deduplicación con proveedores locales.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_, update
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+PENDIENTE = "pendiente"
+ENVIANDO = "enviando"
+ENVIADA = "enviada"
+FALLIDA = "fallida"
+DUPLICADA = "duplicada"
+
+# Tiempo que una fila queda reservada para el worker que la reclamó
+LEASE_SECONDS = 300
+BACKOFF_MAX_SECONDS = 3600
+# Cada cuánto revisa el worker si hay reintentos vencidos (si nadie lo despierta)
+POLL_SECONDS = 5
+LOTE_RECLAMO = 50
+CONCURRENCIA_DEFECTO = "smtp=2,sendgrid=4,twilio=2"
+
+
+def clave_dedup(trabajo, archivo_id):
+    """Hash del envío: misma función, destinatario, archivo y contenido."""
+    base = json.dumps(
+        [trabajo["funcion"], trabajo["destinatario"], archivo_id, trabajo["kwargs"]],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+def parsear_concurrencia(valor):
+    """``"smtp=2,twilio=1"`` -> ``{'smtp': 2, 'twilio': 1}``."""
+    limites = {}
+    for parte in (valor or "").split(","):
+        nombre, _, limite = parte.partition("=")
+        try:
+            limites[nombre.strip()] = max(1, int(limite))
+        except ValueError:
+            continue
+    return limites
+
+
+def backoff(intentos, base):
+    """Espera antes del siguiente intento: base * 2^(n-1) con jitter, acotada."""
+    espera = min(BACKOFF_MAX_SECONDS, base * (2 ** max(0, intentos - 1)))
+    return espera * random.uniform(0.8, 1.2)
+
+
+def encolar_notificaciones_documento(usuario, archivo, estado, comentario=None):
+    """
+    Agrega a la sesión las notificaciones externas del cambio de estado de
+    ``archivo``; el llamador hace commit junto con el resto de cambios.
+    Retorna las filas nuevas (sin las duplicadas).
+    """
+    from app.models import NotificacionSaliente
+    from app.utils.external_notifications import proveedor_canal, trabajos_notificacion_documento
+
+    cfg = current_app.config
+    ahora = datetime.utcnow()
+    desde = ahora - timedelta(seconds=cfg.get("NOTIFICATION_OUTBOX_DEDUP_SECONDS", 600))
+    nuevas = []
+    for trabajo in trabajos_notificacion_documento(usuario, archivo, estado, comentario):
+        clave = clave_dedup(trabajo, archivo.id)
+        repetida = (
+            NotificacionSaliente.query
+            .filter(
+                NotificacionSaliente.dedup_key == clave,
+                NotificacionSaliente.estado.in_((PENDIENTE, ENVIANDO, ENVIADA)),
+                NotificacionSaliente.fecha_creacion >= desde,
+            )
+            .first()
+        )
+        if repetida:
+            logger.info(f"Notificación {trabajo['funcion']} a {trabajo['destinatario']} ya encolada (#{repetida.id})")
+            continue
+        fila = NotificacionSaliente(
+            canal=trabajo["canal"],
+            proveedor=proveedor_canal(trabajo["canal"]),
+            funcion=trabajo["funcion"],
+            destinatario=trabajo["destinatario"],
+            payload=json.dumps(trabajo["kwargs"], default=str),
+            dedup_key=clave,
+            estado=PENDIENTE,
+            intentos=0,
+            max_intentos=cfg.get("NOTIFICATION_OUTBOX_MAX_ATTEMPTS", 6),
+            proximo_intento=ahora,
+            usuario_id=usuario.id,
+            archivo_id=archivo.id,
+            fecha_creacion=ahora,
+        )
+        db.session.add(fila)
+        nuevas.append(fila)
+    return nuevas
+
+
+def _disponible(ahora):
+    from app.models import NotificacionSaliente as N
+
+    return or_(
+        and_(N.estado == PENDIENTE, N.proximo_intento <= ahora),
+        and_(N.estado == ENVIANDO, N.bloqueado_hasta < ahora),
+    )
+
+
+def reclamar(fila_id):
+    """
+    Reserva la fila para este worker. Retorna False si otro worker la tomó
+    primero o ya no está disponible.
+    """
+    from app.models import NotificacionSaliente as N
+
+    ahora = datetime.utcnow()
+    res = db.session.execute(
+        update(N)
+        .where(N.id == fila_id, _disponible(ahora))
+        .values(estado=ENVIANDO, bloqueado_hasta=ahora + timedelta(seconds=LEASE_SECONDS),
+                intentos=N.intentos + 1)
+    )
+    db.session.commit()
+    return res.rowcount == 1
+
+
+def procesar(fila_id):
+    """Envía una fila ya reclamada y registra el resultado."""
+    from app.models import NotificacionSaliente as N
+    from app.utils.external_notifications import canal_configurado, ejecutar_trabajo
+
+    fila = db.session.get(N, fila_id)
+    if fila is None or fila.estado != ENVIANDO:
+        return None
+
+    # Solo cuenta como duplicado un envío igual encolado dentro de la misma
+    # ventana: repetir la notificación días después es un envío legítimo.
+    ventana = timedelta(seconds=current_app.config.get("NOTIFICATION_OUTBOX_DEDUP_SECONDS", 600))
+    creada = fila.fecha_creacion or datetime.utcnow()
+    ya_enviada = (
+        db.session.query(N.id)
+        .filter(
+            N.dedup_key == fila.dedup_key,
+            N.estado == ENVIADA,
+            N.id != fila.id,
+            N.fecha_creacion.between(creada - ventana, creada + ventana),
+        )
+        .first()
+    )
+    if ya_enviada:
+        fila.estado = DUPLICADA
+        fila.bloqueado_hasta = None
+        db.session.commit()
+        return fila.estado
+    if not canal_configurado(fila.canal):
+        # Sin configuración los reintentos fallarían igual
+        fila.estado = FALLIDA
+        fila.ultimo_error = f"Canal {fila.canal} ({fila.proveedor}) no configurado"
+        fila.bloqueado_hasta = None
+        db.session.commit()
+        return fila.estado
+
+    try:
+        ok = ejecutar_trabajo(fila.funcion, json.loads(fila.payload))
+        error = None if ok else "El proveedor no aceptó el envío"
+    except Exception as e:
+        ok, error = False, f"{type(e).__name__}: {e}"
+
+    ahora = datetime.utcnow()
+    fila.bloqueado_hasta = None
+    if ok:
+        fila.estado = ENVIADA
+        fila.fecha_envio = ahora
+        fila.ultimo_error = None
+    elif fila.intentos >= fila.max_intentos:
+        fila.estado = FALLIDA
+        fila.ultimo_error = error
+        logger.error(f"Notificación #{fila.id} ({fila.funcion}) descartada tras {fila.intentos} intentos: {error}")
+    else:
+        base = current_app.config.get("NOTIFICATION_OUTBOX_BACKOFF_SECONDS", 30)
+        fila.estado = PENDIENTE
+        fila.ultimo_error = error
+        fila.proximo_intento = ahora + timedelta(seconds=backoff(fila.intentos, base))
+        logger.warning(f"Notificación #{fila.id} ({fila.funcion}) falló (intento {fila.intentos}), "
+                       f"reintento a las {fila.proximo_intento:%H:%M:%S}: {error}")
+    db.session.commit()
+    return fila.estado
+
+
+class OutboxWorker:
+    """
+    Procesa el outbox con un pool de hilos, respetando el límite de envíos
+    simultáneos por proveedor (por proceso).
+    """
+
+    def __init__(self, app, limites=None, poll_seconds=POLL_SECONDS):
+        self.app = app
+        self.limites = limites or parsear_concurrencia(
+            app.config.get("NOTIFICATION_OUTBOX_CONCURRENCY", CONCURRENCIA_DEFECTO)
+        )
+        self.poll_seconds = poll_seconds
+        self._en_vuelo = Counter()
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, sum(self.limites.values())),
+                                        thread_name_prefix="outbox")
+
+    def _limite(self, proveedor):
+        return self.limites.get(proveedor, 1)
+
+    def en_vuelo(self):
+        with self._lock:
+            return sum(self._en_vuelo.values())
+
+    def despertar(self):
+        self._despertar.set()
+
+    def detener(self, espera=None):
+        """
+        Deja de reclamar filas y espera a los envíos en curso (como mucho
+        ``espera`` segundos si se indica). Retorna cuántos siguen en curso.
+        """
+        self._detener.set()
+        self._despertar.set()
+        if espera is None:
+            self._pool.shutdown(wait=True)
+            return 0
+        self._pool.shutdown(wait=False)
+        limite = time.monotonic() + espera
+        while self.en_vuelo() and time.monotonic() < limite:
+            time.sleep(0.1)
+        return self.en_vuelo()
+
+    def _enviar(self, fila_id, proveedor):
+        try:
+            with self.app.app_context():
+                try:
+                    procesar(fila_id)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.exception(f"Error procesando notificación #{fila_id}: {e}")
+                finally:
+                    db.session.remove()
+        finally:
+            with self._lock:
+                self._en_vuelo[proveedor] -= 1
+            self._despertar.set()
+
+    def ejecutar_una_vez(self):
+        """Reclama y lanza las filas disponibles que caben en los límites. Retorna cuántas lanzó."""
+        from app.models import NotificacionSaliente as N
+
+        lanzadas = 0
+        with self.app.app_context():
+            try:
+                candidatas = (
+                    db.session.query(N.id, N.proveedor)
+                    .filter(_disponible(datetime.utcnow()))
+                    .order_by(N.proximo_intento, N.id)
+                    .limit(LOTE_RECLAMO)
+                    .all()
+                )
+                for fila_id, proveedor in candidatas:
+                    with self._lock:
+                        if self._en_vuelo[proveedor] >= self._limite(proveedor):
+                            continue
+                    if self._detener.is_set() or not reclamar(fila_id):
+                        continue
+                    with self._lock:
+                        self._en_vuelo[proveedor] += 1
+                    self._pool.submit(self._enviar, fila_id, proveedor)
+                    lanzadas += 1
+            finally:
+                db.session.remove()
+        return lanzadas
+
+    def drenar(self):
+        """Procesa hasta que no queden filas disponibles ni envíos en curso."""
+        total = 0
+        while True:
+            self._despertar.clear()
+            lanzadas = self.ejecutar_una_vez()
+            total += lanzadas
+            if not lanzadas and not self.en_vuelo():
+                return total
+            self._despertar.wait(self.poll_seconds)
+
+    def run_forever(self):
+        while not self._detener.is_set():
+            self._despertar.clear()
+            try:
+                self.ejecutar_una_vez()
+            except Exception as e:
+                logger.exception(f"Error en el worker de notificaciones: {e}")
+            self._despertar.wait(self.poll_seconds)
+
+
+# Worker en hilo del propio proceso web (NOTIFICATION_OUTBOX_WORKER=thread)
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def iniciar_worker(app=None):
+    """
+    Arranca el worker en un hilo de este proceso si aún no corre. Lo llaman
+    ``post_worker_init`` de gunicorn y ``manage.py run`` al arrancar, para que
+    las filas pendientes (o abandonadas por un worker reciclado) se envíen sin
+    esperar a que alguien encole otra. Retorna el worker, o ``None`` con
+    ``external`` (lo procesa manage.py).
+    """
+    global _worker, _worker_pid
+
+    app = app or current_app._get_current_object()
+    if app.config.get("NOTIFICATION_OUTBOX_WORKER", "thread") != "thread":
+        return None
+    with _worker_lock:
+        # Tras el fork de gunicorn el hilo del padre no existe en el hijo
+        if _worker is None or _worker_pid != os.getpid():
+            _worker = OutboxWorker(app)
+            _worker_pid = os.getpid()
+            threading.Thread(target=_worker.run_forever, name="outbox-worker", daemon=True).start()
+        return _worker
+
+
+def despertar_worker():
+    """Avisa al worker de que hay filas nuevas, arrancándolo en este proceso si hace falta."""
+    worker = iniciar_worker()
+    if worker is not None:
+        worker.despertar()
+
+
+def detener_worker(espera=None):
+    """
+    Hook ``worker_exit`` de gunicorn: deja de reclamar filas y espera a los
+    envíos en curso como mucho ``espera`` segundos
+    (NOTIFICATION_OUTBOX_DRAIN_SECONDS). Los que no terminen se retoman en otro
+    proceso al vencer su lease. Retorna cuántos quedaron en curso.
+    """
+    global _worker, _worker_pid
+
+    with _worker_lock:
+        worker = _worker if _worker_pid == os.getpid() else None
+        _worker = _worker_pid = None
+    if worker is None:
+        return 0
+    if espera is None:
+        espera = worker.app.config.get("NOTIFICATION_OUTBOX_DRAIN_SECONDS", 10)
+    en_curso = worker.detener(espera)
+    if en_curso:
+        logger.warning(f"{en_curso} notificación(es) seguían enviándose al detener el worker; "
+                       f"se retomarán al vencer su lease ({LEASE_SECONDS} s)")
+    return en_curso
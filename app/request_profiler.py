@@ -0,0 +1,367 @@
+"""
+Perfilado por petición: SQL, llamadas a Dropbox y render de plantillas.
+
+Se activa con ``REQUEST_PROFILER_ENABLED``. Para cada petición se cuenta:
+
+- Sentencias SQL y su tiempo (eventos ``before/after_cursor_execute`` del
+  ``Engine``), con las sentencias que más tiempo acumularon.
+- Llamadas a la API de Dropbox por método: el proxy de ``get_dropbox_client()``
+  (``app/dropbox_metrics.py``) las anota en el perfil activo.
+- Tiempo de render de ``render_template`` (señales de Flask).
+
+El resumen va en la cabecera ``Server-Timing`` (visible en las DevTools del
+navegador) y en los perfiles recientes que lista ``/admin/perf``: con
+``STRUCTURE_CACHE_BACKEND = 'sqlite'`` se guardan en el archivo SQLite
+compartido y la vista muestra todos los workers; con ``memory`` es un buffer
+circular del proceso y solo se ve el worker que atiende la vista.
+Las peticiones más lentas que ``REQUEST_PROFILER_SLOW_MS`` se registran en el
+log con su desglose.
+
+En respuestas por streaming el total cubre hasta que la vista devuelve la
+respuesta, no el envío del cuerpo.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+BUFFER = 200
+SENTENCIAS_TOP = 5
+# Límite de sentencias distintas agregadas por petición
+MAX_SENTENCIAS = 200
+LARGO_SENTENCIA = 300
+# Rutas que no se perfilan
+EXCLUIDAS = ('static', 'admin.perf')
+
+
+class Perfil:
+    """Mediciones de una petición. Puede recibir llamadas de hilos lanzados por la vista."""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.fecha = datetime.utcnow()
+        self._lock = threading.Lock()
+        self.sql_n = 0
+        self.sql_ms = 0.0
+        self.sentencias = {}
+        self.dropbox_n = 0
+        self.dropbox_ms = 0.0
+        self.dropbox_errores = 0
+        self.metodos = {}
+        self.render_ms = 0.0
+        self.plantillas = []
+
+    def sql(self, sentencia, ms):
+        with self._lock:
+            self.sql_n += 1
+            self.sql_ms += ms
+            agregado = self.sentencias.get(sentencia)
+            if agregado is None:
+                if len(self.sentencias) >= MAX_SENTENCIAS:
+                    return
+                agregado = self.sentencias[sentencia] = [0, 0.0]
+            agregado[0] += 1
+            agregado[1] += ms
+
+    def dropbox(self, metodo, ms, error=False):
+        with self._lock:
+            self.dropbox_n += 1
+            self.dropbox_ms += ms
+            agregado = self.metodos.setdefault(metodo, {'n': 0, 'ms': 0.0, 'errores': 0})
+            agregado['n'] += 1
+            agregado['ms'] += ms
+            if error:
+                self.dropbox_errores += 1
+                agregado['errores'] += 1
+
+    def plantilla(self, nombre, ms):
+        with self._lock:
+            self.render_ms += ms
+            self.plantillas.append(nombre)
+
+    def resumen(self, estado):
+        total_ms = (time.perf_counter() - self.inicio) * 1000.0
+        with self._lock:
+            top = sorted(self.sentencias.items(), key=lambda item: item[1][1], reverse=True)[:SENTENCIAS_TOP]
+            metodos = {
+                nombre: {'n': datos['n'], 'ms': round(datos['ms'], 1), 'errores': datos['errores']}
+                for nombre, datos in sorted(self.metodos.items(), key=lambda item: item[1]['ms'], reverse=True)
+            }
+            return {
+                'fecha': self.fecha,
+                'metodo': request.method,
+                'ruta': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'estado': estado,
+                'usuario_id': _usuario_id(),
+                'pid': os.getpid(),
+                'total_ms': round(total_ms, 1),
+                'sql': {
+                    'n': self.sql_n,
+                    'ms': round(self.sql_ms, 1),
+                    'top': [
+                        {'sentencia': sentencia[:LARGO_SENTENCIA], 'n': n, 'ms': round(ms, 1)}
+                        for sentencia, (n, ms) in top
+                    ],
+                },
+                'dropbox': {
+                    'n': self.dropbox_n,
+                    'ms': round(self.dropbox_ms, 1),
+                    'errores': self.dropbox_errores,
+                    'metodos': metodos,
+                },
+                'render': {'ms': round(self.render_ms, 1), 'plantillas': list(self.plantillas)},
+            }
+
+
+def _usuario_id():
+    try:
+        return current_user.id if current_user.is_authenticated else None
+    except Exception:
+        return None
+
+
+def perfil_actual():
+    """``Perfil`` de la petición en curso, o ``None`` si no se está perfilando."""
+    if not has_request_context():
+        return None
+    return g.get('_perfil')
+
+
+# --- Perfiles recientes ---
+
+class MemoriaPerfiles:
+    """Buffer circular del proceso: ``/admin/perf`` solo ve el worker que responde."""
+
+    compartido = False
+
+    def __init__(self, tamano=BUFFER):
+        self._buffer = deque(maxlen=tamano)
+        self._lock = threading.Lock()
+
+    def agregar(self, resumen):
+        with self._lock:
+            self._buffer.append(resumen)
+
+    def recientes(self):
+        with self._lock:
+            return list(reversed(self._buffer))
+
+    def total(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def mas_lentas(self, limite):
+        return sorted(self.recientes(), key=lambda perfil: perfil['total_ms'], reverse=True)[:limite]
+
+
+class SQLitePerfiles:
+    """
+    Los últimos ``tamano`` perfiles de todos los workers, en el archivo SQLite
+    de la caché de estructuras.
+    """
+
+    compartido = True
+
+    def __init__(self, path, tamano=BUFFER):
+        self.path = path
+        self.tamano = tamano
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS perfiles_peticion ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, total_ms REAL NOT NULL, datos TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_perfiles_peticion_total_ms ON perfiles_peticion (total_ms)")
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se comparten tras un fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _leer(filas):
+        perfiles = []
+        for (datos,) in filas:
+            perfil = json.loads(datos)
+            perfil['fecha'] = datetime.fromisoformat(perfil['fecha'])
+            perfiles.append(perfil)
+        return perfiles
+
+    def agregar(self, resumen):
+        datos = json.dumps(dict(resumen, fecha=resumen['fecha'].isoformat()), ensure_ascii=False)
+        conn = self._conn()
+        cursor = conn.execute(
+            "INSERT INTO perfiles_peticion (total_ms, datos) VALUES (?, ?)", (resumen['total_ms'], datos)
+        )
+        # Conservar solo los últimos ``tamano`` (el id crece con cada inserción)
+        conn.execute("DELETE FROM perfiles_peticion WHERE id <= ?", (cursor.lastrowid - self.tamano,))
+
+    def recientes(self):
+        return self._leer(self._conn().execute(
+            "SELECT datos FROM perfiles_peticion ORDER BY id DESC LIMIT ?", (self.tamano,)
+        ))
+
+    def total(self):
+        return self._conn().execute("SELECT COUNT(*) FROM perfiles_peticion").fetchone()[0]
+
+    def mas_lentas(self, limite):
+        return self._leer(self._conn().execute(
+            "SELECT datos FROM perfiles_peticion ORDER BY total_ms DESC LIMIT ?", (limite,)
+        ))
+
+
+# Instancia global (una por proceso; el archivo SQLite une a los workers)
+_perfiles = None
+_perfiles_lock = threading.Lock()
+
+
+def get_store():
+    global _perfiles
+    if _perfiles is None:
+        with _perfiles_lock:
+            if _perfiles is None:
+                _perfiles = _build_store()
+    return _perfiles
+
+
+def _build_store():
+    try:
+        cfg, instance_path = current_app.config, current_app.instance_path
+    except RuntimeError:
+        cfg, instance_path = {}, os.getcwd()
+    tamano = int(cfg.get('REQUEST_PROFILER_BUFFER') or BUFFER)
+    if (cfg.get('STRUCTURE_CACHE_BACKEND') or 'memory').strip().lower() == 'sqlite':
+        path = cfg.get('STRUCTURE_CACHE_SQLITE_PATH') or os.path.join(instance_path, 'structure_cache.sqlite3')
+        try:
+            return SQLitePerfiles(path, tamano)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"No se pudo abrir el almacén compartido de perfiles en {path}, usando solo memoria: {e}")
+    return MemoriaPerfiles(tamano)
+
+
+def recientes():
+    """Perfiles guardados (más reciente primero)."""
+    try:
+        return get_store().recientes()
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudieron leer los perfiles de peticiones: {e}")
+        return []
+
+
+def registradas():
+    try:
+        return get_store().total()
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudieron contar los perfiles de peticiones: {e}")
+        return 0
+
+
+def mas_lentas(limite=50):
+    try:
+        return get_store().mas_lentas(limite)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudieron leer los perfiles de peticiones: {e}")
+        return []
+
+
+# --- Hooks ---
+
+def _antes_de_cursor(conn, cursor, statement, parameters, context, executemany):
+    if perfil_actual() is not None:
+        conn.info.setdefault('_perfil_inicio', []).append(time.perf_counter())
+
+
+def _despues_de_cursor(conn, cursor, statement, parameters, context, executemany):
+    perfil = perfil_actual()
+    inicios = conn.info.get('_perfil_inicio')
+    if perfil is None or not inicios:
+        return
+    perfil.sql(statement, (time.perf_counter() - inicios.pop()) * 1000.0)
+
+
+def _error_de_cursor(contexto_error):
+    # Sin after_cursor_execute: descartar el inicio pendiente
+    conexion = contexto_error.connection
+    inicios = conexion.info.get('_perfil_inicio') if conexion is not None else None
+    if inicios:
+        inicios.pop()
+
+
+def _antes_de_render(sender, template, context, **extra):
+    if perfil_actual() is not None:
+        g._perfil_render = time.perf_counter()
+
+
+def _despues_de_render(sender, template, context, **extra):
+    perfil = perfil_actual()
+    inicio = g.pop('_perfil_render', None)
+    if perfil is not None and inicio is not None:
+        perfil.plantilla(template.name or '<string>', (time.perf_counter() - inicio) * 1000.0)
+
+
+def _server_timing(resumen):
+    sql, dropbox, render = resumen['sql'], resumen['dropbox'], resumen['render']
+    return ', '.join((
+        f'sql;dur={sql["ms"]};desc="{sql["n"]} consultas"',
+        f'dropbox;dur={dropbox["ms"]};desc="{dropbox["n"]} llamadas"',
+        f'render;dur={render["ms"]}',
+        f'total;dur={resumen["total_ms"]}',
+    ))
+
+
+def init_app(app):
+    """Registra el perfilado si ``REQUEST_PROFILER_ENABLED`` está activo."""
+    if not app.config.get('REQUEST_PROFILER_ENABLED'):
+        return
+    lentas_ms = float(app.config.get('REQUEST_PROFILER_SLOW_MS') or 0)
+
+    if not event.contains(Engine, 'before_cursor_execute', _antes_de_cursor):
+        event.listen(Engine, 'before_cursor_execute', _antes_de_cursor)
+        event.listen(Engine, 'after_cursor_execute', _despues_de_cursor)
+        event.listen(Engine, 'handle_error', _error_de_cursor)
+    before_render_template.connect(_antes_de_render, app)
+    template_rendered.connect(_despues_de_render, app)
+
+    @app.before_request
+    def iniciar_perfil():
+        if request.endpoint not in EXCLUIDAS:
+            g._perfil = Perfil()
+
+    @app.after_request
+    def cerrar_perfil(response):
+        perfil = g.pop('_perfil', None)
+        if perfil is None:
+            return response
+        resumen = perfil.resumen(response.status_code)
+        response.headers['Server-Timing'] = _server_timing(resumen)
+        try:
+            get_store().agregar(resumen)
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo guardar el perfil de {resumen['ruta']}: {e}")
+        if lentas_ms and resumen['total_ms'] >= lentas_ms:
+            logger.warning(
+                f"Petición lenta {resumen['metodo']} {resumen['ruta']}: {resumen['total_ms']} ms "
+                f"(SQL {resumen['sql']['n']}/{resumen['sql']['ms']} ms, "
+                f"Dropbox {resumen['dropbox']['n']}/{resumen['dropbox']['ms']} ms, "
+                f"render {resumen['render']['ms']} ms)"
+            )
+        return response
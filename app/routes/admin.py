@@ -1,10 +1,12 @@
-from flask import Blueprint, request, jsonify, Response, current_app
+from flask import Blueprint, request, jsonify, Response, current_app, render_template, url_for
 from flask_login import login_required, current_user
 from app.models import Archivo
-from app.dropbox_utils import descargar_desde_dropbox, generar_enlace_dropbox_temporal
+from app.dropbox_download import respuesta_archivo, enlace_temporal
 from app import db
-from app.routes.auth import role_required
+from app.routes.auth import role_required, roles_required
+from app import request_profiler
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -21,30 +23,23 @@ def preview_file_logic(file_id):
         if not current_user.puede_administrar() and archivo.usuario_id != current_user.id:
             return jsonify({"error": "No tienes permisos para ver este archivo"}), 403
         
-        # Si el archivo tiene ruta de Dropbox, descargarlo
-        if archivo.dropbox_path:
-            try:
-                contenido = descargar_desde_dropbox(archivo.dropbox_path)
-            except Exception as e:
-                logger.error(f"Error descargando archivo {archivo.dropbox_path}: {e}")
-                return jsonify({"error": f"No se pudo descargar el archivo: {str(e)}"}), 500
-        else:
+        if not archivo.dropbox_path:
             return jsonify({"error": "Archivo no disponible en Dropbox"}), 404
         
         # Determinar el tipo MIME basado en la extensión
         extension = archivo.nombre.split('.')[-1].lower() if '.' in archivo.nombre else ''
         
         if extension == "pdf":
-            # Para PDF, devolver el contenido directamente
-            return Response(contenido, mimetype="application/pdf")
+            # Para PDF, enviar el contenido en streaming (soporta Range)
+            return respuesta_archivo(archivo.dropbox_path, archivo.nombre, mimetype="application/pdf")
         elif extension in ["jpg", "jpeg", "png", "gif"]:
-            # Para imágenes, devolver el contenido directamente
+            # Para imágenes, enviar el contenido en streaming
             mimetype = f"image/{extension}" if extension != "jpg" else "image/jpeg"
-            return Response(contenido, mimetype=mimetype)
+            return respuesta_archivo(archivo.dropbox_path, archivo.nombre, mimetype=mimetype)
         elif extension in ["doc", "docx"]:
             # Para documentos Word, intentar generar enlace temporal
             try:
-                link_temporal = generar_enlace_dropbox_temporal(archivo.dropbox_path)
+                link_temporal = enlace_temporal(archivo.dropbox_path)
                 iframe_html = f"""
                 <!DOCTYPE html>
                 <html>
@@ -111,24 +106,18 @@ def admin_preview_file_dropbox():
             # Esta verificación puede ser más compleja dependiendo de tu lógica de permisos
             pass
 
-        # Descargar contenido para visualización
-        try:
-            contenido = descargar_desde_dropbox(path)
-        except Exception as e:
-            logger.error(f"Error descargando archivo {path}: {e}")
-            return jsonify({"error": f"No se pudo descargar el archivo: {str(e)}"}), 500
-
+        nombre = path.split('/')[-1]
         if extension == "pdf":
-            # Para PDF, devolver el contenido directamente
-            return Response(contenido, mimetype="application/pdf")
+            # Para PDF, enviar el contenido en streaming
+            return respuesta_archivo(path, nombre, mimetype="application/pdf", modo="stream")
         elif extension in ["jpg", "jpeg", "png", "gif"]:
-            # Para imágenes, devolver el contenido directamente
+            # Para imágenes, enviar el contenido en streaming
             mimetype = f"image/{extension}" if extension != "jpg" else "image/jpeg"
-            return Response(contenido, mimetype=mimetype)
+            return respuesta_archivo(path, nombre, mimetype=mimetype, modo="stream")
         elif extension in ["doc", "docx"]:
             # Para documentos Word, generar enlace temporal si es posible
             try:
-                link_temporal = generar_enlace_dropbox_temporal(path)
+                link_temporal = enlace_temporal(path)
                 iframe_html = f"""
                 <!DOCTYPE html>
                 <html>
@@ -170,8 +159,10 @@ def admin_preview_file_dropbox():
 @admin_bp.route("/descargar_archivo", methods=["GET"])
 @login_required
 def descargar_archivo():
-    from flask import send_file
-    import io
+    """
+    Descarga en streaming (o 302 al enlace temporal si
+    DROPBOX_DOWNLOAD_MODE=redirect); ver app/dropbox_download.py.
+    """
     archivo_id = request.args.get("archivo_id")
     dropbox_path = request.args.get("path")
     nombre_archivo = request.args.get("nombre", "documento.pdf")
@@ -184,24 +175,10 @@ def descargar_archivo():
             if not archivo.dropbox_path:
                 return "Archivo sin ruta Dropbox", 400
 
-            contenido = descargar_desde_dropbox(archivo.dropbox_path)
-            extension = archivo.nombre.split('.')[-1].lower()
-            mimetype = "application/octet-stream"
-            if extension in ["pdf", "jpg", "jpeg", "png"]:
-                mimetype = f"image/{extension}" if extension != "jpg" else "image/jpeg"
-            elif extension == "pdf":
-                mimetype = "application/pdf"
-
-            return send_file(io.BytesIO(contenido),
-                            mimetype=mimetype,
-                            as_attachment=True,
-                            download_name=archivo.nombre)
+            return respuesta_archivo(archivo.dropbox_path, archivo.nombre, adjunto=True)
         elif dropbox_path:
-            contenido = descargar_desde_dropbox(dropbox_path)
-            return send_file(io.BytesIO(contenido),
-                            mimetype="application/octet-stream",
-                            as_attachment=True,
-                            download_name=nombre_archivo)
+            return respuesta_archivo(dropbox_path, nombre_archivo, adjunto=True,
+                                     mimetype="application/octet-stream")
         else:
             return "Falta archivo_id o path", 400
     except Exception as e:
@@ -228,3 +205,44 @@ def fix_archivos_estado_en_revision():
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@admin_bp.route('/fix/beneficiarios/carpetas', methods=['POST'])
+@login_required
+@role_required('admin')
+def fix_beneficiarios_carpetas():
+    """Encola la creación de las carpetas de Dropbox que les falten a los beneficiarios
+    (``fix_all_beneficiarios`` en segundo plano). Solo para administradores.
+    """
+    from app import job_runner
+    from app.routes.trabajos import responder_encolado
+
+    trabajo, nuevo = job_runner.encolar(
+        'reparar_carpetas_beneficiarios', usuario_id=current_user.id, clave='reparar_carpetas_beneficiarios'
+    )
+    return responder_encolado(trabajo, nuevo, "Reparación de carpetas de beneficiarios iniciada.",
+                              request.referrer or url_for('main.dashboard'))
+
+
+@admin_bp.route('/perf')
+@login_required
+@roles_required('admin', 'superadmin')
+def perf():
+    """Peticiones más lentas con su desglose (ver app/request_profiler.py)."""
+    limite = min(request.args.get('limite', 50, type=int) or 50, 200)
+    lentas = request_profiler.mas_lentas(limite)
+    if request.args.get('formato') == 'json':
+        return jsonify({
+            'habilitado': bool(current_app.config.get('REQUEST_PROFILER_ENABLED')),
+            'pid': os.getpid(),
+            'compartido': request_profiler.get_store().compartido,
+            'peticiones': lentas,
+        })
+    return render_template(
+        'admin/perf.html',
+        habilitado=current_app.config.get('REQUEST_PROFILER_ENABLED'),
+        pid=os.getpid(),
+        compartido=request_profiler.get_store().compartido,
+        registradas=request_profiler.registradas(),
+        peticiones=lentas,
+    )
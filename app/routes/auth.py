@@ -3,7 +3,7 @@ from flask import Blueprint, abort, redirect, render_template, request, jsonify,
 from flask_login import current_user, login_required, login_user, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from app import db
+from app import activity_log_writer, db
 from app.models import Beneficiario, User, UserActivityLog
 from forms import LoginForm, BeneficiarioForm
 import logging
@@ -36,16 +36,8 @@ def roles_required(*roles):
     return wrapper
 
 def registrar_actividad(user, accion, descripcion=None):
-    """Helper para registrar actividad de usuario"""
-    actividad = UserActivityLog(
-        user_id=user.id,
-        accion=accion,
-        descripcion=descripcion,
-        ip_address=request.remote_addr,
-        user_agent=request.headers.get('User-Agent', '')[:255]
-    )
-    db.session.add(actividad)
-    db.session.commit()
+    """Helper para registrar actividad de usuario (en lote, ver app/activity_log_writer.py)"""
+    activity_log_writer.registrar(user.id, accion, descripcion)
 
 @bp.route('/', methods=['GET', 'POST'])
 def login():
@@ -66,21 +58,13 @@ def login():
             if not user.activo:
                 error = "Tu cuenta está desactivada. Contacta al administrador."
             else:
-                # Actualizar último acceso
-                user.ultimo_acceso = datetime.utcnow()
-                db.session.commit()
-                
                 # Login exitoso
                 login_user(user, remember=True)
                 
-                # Log de actividad
-                activity_log = UserActivityLog(
-                    user_id=user.id,
-                    accion='login',
-                    ip_address=request.remote_addr
+                # Log de actividad y último acceso (en lote, sin commit en la petición)
+                activity_log_writer.registrar(
+                    user.id, 'login', ip_address=request.remote_addr, tocar_acceso=True
                 )
-                db.session.add(activity_log)
-                db.session.commit()
                 
                 # Verificar si hay una URL de destino (next parameter)
                 next_page = request.args.get('next')
@@ -225,6 +209,13 @@ def register():
                     print(f"INFO | Carpeta raíz creada en BD para cliente registrado {user.id}: {path}")
                     user.dropbox_folder_path = path
                     db.session.commit()
+
+                    # Carpeta recién creada: fijar el cursor de sincronización sin listarla
+                    try:
+                        from app.dropbox_sync import seed_user_cursor
+                        seed_user_cursor(user)
+                    except Exception as e:
+                        print(f"No se pudo inicializar cursor de sincronización: {e}")
                 except Exception as e:
                     # Si falla la creación de carpeta, no es crítico
                     print(f"Error creando carpeta Dropbox: {e}")
@@ -3,12 +3,23 @@ import json
 from flask_login import current_user, login_required
 from app.categorias import CATEGORIAS
 import dropbox
-from app.models import Archivo, Beneficiario, Folder, User, Notification, Comentario
+from app.models import Archivo, Beneficiario, Folder, User, Notification, Comentario, extension_de_nombre
 from app import db
 import unicodedata
 from datetime import datetime
 from app.dropbox_utils import get_dbx, get_valid_dropbox_token, with_base_folder, without_base_folder, sanitize_dropbox_segment, _normalize_dropbox_path
 from app.utils.notification_utils import notificar_archivo_subido
+from app.utils.query_utils import filtro_prefijo_ruta
+from app.structure_cache import get_structure_cache, invalidar_estructuras
+from app.dropbox_upload import (
+    upload_batch, UploadJob, ReservaNombres, insertar_archivos,
+    progress_tracker, mark_progress_failed, get_progress,
+)
+from app.dropbox_browse import (
+    CursorInvalido, acotar, firmar_cursor, leer_cursor, normalizar_ruta,
+    listar_nivel, carpetas_con_contenido, estados_archivos, pagina_usuarios, resumen_usuarios,
+    NIVEL_LIMITE_DEFECTO, NIVEL_LIMITE_MAXIMO, USUARIOS_LIMITE_DEFECTO, USUARIOS_LIMITE_MAXIMO,
+)
 import time
 
 bp = Blueprint("listar_dropbox", __name__)
@@ -41,23 +52,6 @@ def _strip_archivos_from_tree(tree):
             out["_subcarpetas"][name] = _strip_archivos_from_tree(sub)
     return out
 
-# Caché simple en memoria para estructuras por usuario (TTL en segundos)
-_estructuras_cache = {}
-_CACHE_TTL_SECONDS = 300
-
-def _get_cached_estructura(user_id):
-    entry = _estructuras_cache.get(user_id)
-    if not entry:
-        return None
-    ts, data = entry
-    if (time.time() - ts) > _CACHE_TTL_SECONDS:
-        # Expirado
-        _estructuras_cache.pop(user_id, None)
-        return None
-    return data
-
-def _set_cached_estructura(user_id, estructura):
-    _estructuras_cache[user_id] = (time.time(), estructura)
 @bp.route('/api/archivo/estado', methods=['GET'])
 @login_required
 def obtener_estado_archivo():
@@ -287,50 +281,29 @@ def actualizar_estado_archivo():
             db.session.commit()
             current_app.logger.info(f'Notificación de estado creada para usuario {archivo.usuario_id}: {titulo}')
         
-        # Si el documento fue rechazado o validado, enviar notificaciones externas
-        if nuevo_estado == 'rechazado':
-            try:
-                usuario = User.query.get(archivo.usuario_id)
-                if usuario:
-                    from app.utils.external_notifications import enviar_notificacion_documento_rechazado
-                    current_app.logger.info(
-                        "Intentando notificación externa (rechazo): usuario=%s archivo=%s"
-                        % (usuario.email, archivo.nombre)
-                    )
-                    resultados = enviar_notificacion_documento_rechazado(
-                        usuario=usuario,
-                        archivo=archivo,
-                        comentario=comentario_texto
-                    )
-                    current_app.logger.info(
-                        f"Notificaciones externas enviadas para archivo rechazado: "
-                        f"Email={resultados['email']}, SMS={resultados['sms']}, WhatsApp={resultados['whatsapp']}"
-                    )
-            except Exception as e:
-                current_app.logger.error(f"Error al enviar notificaciones externas: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        # Si el documento fue validado/aprobado, enviar email de confirmación
-        elif nuevo_estado == 'validado':
+        # Si el documento fue rechazado o validado, encolar las notificaciones
+        # externas (email, SMS, WhatsApp); las envía el worker del outbox
+        if nuevo_estado in ('rechazado', 'validado'):
             try:
                 usuario = User.query.get(archivo.usuario_id)
                 if usuario:
-                    from app.utils.external_notifications import enviar_notificacion_documento_validado
-                    current_app.logger.info(
-                        "Intentando notificación externa (validado): usuario=%s archivo=%s"
-                        % (usuario.email, archivo.nombre)
-                    )
-                    resultados = enviar_notificacion_documento_validado(
+                    from app.notification_outbox import despertar_worker, encolar_notificaciones_documento
+                    encoladas = encolar_notificaciones_documento(
                         usuario=usuario,
                         archivo=archivo,
-                        comentario=None
+                        estado=nuevo_estado,
+                        comentario=comentario_texto if nuevo_estado == 'rechazado' else None
                     )
+                    db.session.commit()
                     current_app.logger.info(
-                        f"Email de validación enviado para archivo aprobado: Email={resultados['email']}"
+                        "Notificaciones externas encoladas (%s): usuario=%s archivo=%s canales=%s"
+                        % (nuevo_estado, usuario.email, archivo.nombre, [n.canal for n in encoladas])
                     )
+                    if encoladas:
+                        despertar_worker()
             except Exception as e:
-                current_app.logger.error(f"Error al enviar email de validación: {e}")
+                db.session.rollback()
+                current_app.logger.error(f"Error al encolar notificaciones externas: {e}")
                 import traceback
                 traceback.print_exc()
                 # No interrumpir el flujo si falla la notificación
@@ -593,161 +566,26 @@ def flatten_estructura(estructura, prefix=""):
     _rec(estructura, base)
     return {"folders": folders, "files": files}
 
-def filtra_archivos_ocultos(estructura, usuario_id, prefix=""):
+def filtra_ocultos(estructura, usuario_id, prefix=""):
     """
-    Filtra los archivos ocultos de la estructura basándose en la base de datos Y la ruta del usuario.
-    SEGURIDAD: Solo muestra archivos dentro del dropbox_folder_path del usuario específico.
+    Filtra archivos y carpetas ocultos del árbol de un usuario en una sola pasada.
+    SEGURIDAD: Solo muestra contenido dentro del dropbox_folder_path del usuario.
     - estructura: dict con formato {'_archivos': [...], '_subcarpetas': { ... }}
-    - usuario_id: ID del usuario para filtrar archivos ocultos
-    - prefix: path base actual para construir rutas completas
+    - usuario_id: ID del usuario dueño del árbol
+    - prefix: path base del árbol
+    Las reglas están en app.utils.visibilidad.VisibilidadUsuario.
     """
-    from app.models import Archivo, User
-    
-    if not estructura:
-        return estructura
-    
-    nueva_estructura = {"_archivos": [], "_subcarpetas": {}}
-    
-    # SEGURIDAD: Obtener la ruta base del usuario para verificar que solo vea sus archivos
-    usuario = User.query.get(usuario_id)
-    if not usuario:
-        print(f"DEBUG | Usuario {usuario_id} no encontrado para filtrar archivos, retornando estructura vacía")
-        return nueva_estructura
-    
-    user_base_path = usuario.dropbox_folder_path
-    if not user_base_path:
-        user_base_path = f"/{usuario.email}"
-        print(f"DEBUG | Usuario {usuario_id} sin dropbox_folder_path para archivos, usando email: {user_base_path}")
-    
-    # Normalizar rutas
-    user_base_path = user_base_path.rstrip('/')
-    prefix_normalized = prefix.rstrip('/')
-    
-    # VALIDACIÓN DE SEGURIDAD: Verificar que el prefix esté dentro de la ruta del usuario
-    if not prefix_normalized.startswith(user_base_path):
-        print(f"DEBUG | SEGURIDAD: Prefix {prefix_normalized} no está dentro de {user_base_path} para archivos, retornando vacío")
-        return nueva_estructura
-    
-    # Obtener archivos del usuario en la BD y mapear por ruta
-    archivos_visibles = Archivo.query.filter_by(usuario_id=usuario_id).all()
-    rutas_visibles = {archivo.dropbox_path for archivo in archivos_visibles}
-    path_a_archivo = {archivo.dropbox_path: archivo for archivo in archivos_visibles}
-    
-    # Importar usuario actual para aplicar reglas por rol
     from flask_login import current_user
-    
-    # Filtrar archivos: mostrar archivos que están en la BD O todos los archivos dentro de la ruta del usuario
-    for archivo_nombre in estructura.get("_archivos", []):
-        archivo_path = f"{prefix}/{archivo_nombre}".replace('//', '/')
-        
-        # VALIDACIÓN DE SEGURIDAD: Solo mostrar archivos dentro de la ruta del usuario
-        if not archivo_path.startswith(user_base_path):
-            print(f"DEBUG | SEGURIDAD: Archivo {archivo_path} no está dentro de {user_base_path}, saltando")
-            continue
-            
-        # Decidir visibilidad según rol y bandera es_publica
-        mostrar_archivo = False
-        archivo_bd = path_a_archivo.get(archivo_path)
-
-        # Roles admin/superadmin/lector: siempre pueden ver
-        if hasattr(current_user, "rol") and current_user.rol in ["admin", "superadmin", "lector"]:
-            mostrar_archivo = True
-        else:
-            # Rol cliente (u otros): si es el dueño, ocultar si es privado
-            if hasattr(current_user, "rol") and current_user.rol == "cliente" and current_user.id == usuario_id:
-                if archivo_bd is not None and getattr(archivo_bd, "es_publica", True) is False:
-                    mostrar_archivo = False
-                else:
-                    # Si no está en BD o es pública, se muestra
-                    mostrar_archivo = True
-            else:
-                # Por defecto, mantener la lógica anterior de pertenencia a la ruta/BD
-                mostrar_archivo = (archivo_path in rutas_visibles or archivo_path.startswith(user_base_path))
-
-        if mostrar_archivo:
-            nueva_estructura["_archivos"].append(archivo_nombre)
-            print(f"DEBUG | Archivo visible mostrado para usuario {usuario_id}: {archivo_nombre}")
-        else:
-            print(f"DEBUG | Archivo oculto filtrado para usuario {usuario_id}: {archivo_nombre} - {archivo_path}")
-    
-    # Procesar subcarpetas recursivamente
-    for subcarpeta, contenido in estructura.get("_subcarpetas", {}).items():
-        sub_prefix = f"{prefix}/{subcarpeta}".replace('//', '/')
-        
-        # VALIDACIÓN DE SEGURIDAD: Solo procesar subcarpetas dentro de la ruta del usuario
-        if sub_prefix.startswith(user_base_path):
-            nueva_estructura["_subcarpetas"][subcarpeta] = filtra_archivos_ocultos(
-                contenido, usuario_id, sub_prefix
-            )
-        else:
-            print(f"DEBUG | SEGURIDAD: Subcarpeta {sub_prefix} no está dentro de {user_base_path}, saltando")
-    
-    return nueva_estructura
+    from app.utils.visibilidad import VisibilidadUsuario
 
-def filtra_carpetas_ocultas(estructura, usuario_id, prefix=""):
-    """
-    Filtra las carpetas ocultas de la estructura basándose en la base de datos Y la ruta del usuario.
-    SEGURIDAD: Solo muestra carpetas dentro del dropbox_folder_path del usuario específico.
-    - estructura: dict con formato {'_archivos': [...], '_subcarpetas': { ... }}
-    - usuario_id: ID del usuario para filtrar carpetas ocultas
-    - prefix: path base actual para construir rutas completas
-    """
-    from app.models import Folder, User
-    
     if not estructura:
         return estructura
-    
-    nueva_estructura = {"_archivos": [], "_subcarpetas": {}}
-    
-    # SEGURIDAD: Obtener la ruta base del usuario para verificar que solo vea sus carpetas
-    usuario = User.query.get(usuario_id)
-    if not usuario:
-        print(f"DEBUG | Usuario {usuario_id} no encontrado, retornando estructura vacía")
-        return nueva_estructura
-    
-    user_base_path = usuario.dropbox_folder_path
-    if not user_base_path:
-        user_base_path = f"/{usuario.email}"
-        print(f"DEBUG | Usuario {usuario_id} sin dropbox_folder_path, usando email: {user_base_path}")
-    
-    # Normalizar rutas
-    user_base_path = user_base_path.rstrip('/')
-    prefix_normalized = prefix.rstrip('/')
-    
-    # VALIDACIÓN DE SEGURIDAD: Verificar que el prefix esté dentro de la ruta del usuario
-    if not prefix_normalized.startswith(user_base_path):
-        print(f"DEBUG | SEGURIDAD: Prefix {prefix_normalized} no está dentro de {user_base_path}, retornando vacío")
-        return nueva_estructura
-    
-    # Obtener carpetas visibles del usuario en la BD
-    carpetas_visibles = Folder.query.filter_by(user_id=usuario_id).all()
-    rutas_visibles = {carpeta.dropbox_path for carpeta in carpetas_visibles}
-    
-    # Filtrar archivos: mostrar todos los archivos dentro de la ruta del usuario
-    nueva_estructura["_archivos"] = estructura.get("_archivos", [])
-    
-    # Procesar subcarpetas recursivamente
-    for subcarpeta, contenido in estructura.get("_subcarpetas", {}).items():
-        sub_prefix = f"{prefix}/{subcarpeta}".replace('//', '/')
-        carpeta_path = sub_prefix.replace('//', '/')
-        
-        # VALIDACIÓN DE SEGURIDAD: Solo procesar carpetas dentro de la ruta del usuario
-        if not carpeta_path.startswith(user_base_path):
-            print(f"DEBUG | SEGURIDAD: Carpeta {carpeta_path} no está dentro de {user_base_path}, saltando")
-            continue
-        
-        # Mostrar la carpeta si:
-        # 1. Está en la BD del usuario, O
-        # 2. Tiene contenido (archivos o subcarpetas) Y está dentro de la ruta del usuario
-        if carpeta_path in rutas_visibles or (contenido.get("_archivos") or contenido.get("_subcarpetas")):
-            nueva_estructura["_subcarpetas"][subcarpeta] = filtra_carpetas_ocultas(
-                contenido, usuario_id, sub_prefix
-            )
-            print(f"DEBUG | Carpeta visible mostrada para usuario {usuario_id}: {subcarpeta} - {carpeta_path}")
-        else:
-            print(f"DEBUG | Carpeta oculta filtrada para usuario {usuario_id}: {subcarpeta} - {carpeta_path}")
-    
-    return nueva_estructura
+
+    reglas = VisibilidadUsuario.cargar(usuario_id, current_user)
+    if reglas is None:
+        print(f"DEBUG | Usuario {usuario_id} no encontrado para filtrar ocultos, retornando estructura vacía")
+        return {"_archivos": [], "_subcarpetas": {}}
+    return reglas.filtrar(estructura, prefix)
 
 def filtra_arbol_por_rutas(estructura, rutas_visibles, prefix, usuario_email):
     """
@@ -819,6 +657,30 @@ def carpetas_dropbox():
                 config_error=True,
             )
 
+        # Vista general de admin/superadmin/lector: no se lista Dropbox al cargar.
+        # Solo una página de usuarios con su resumen en BD; cada carpeta se carga
+        # al expandirla (/api/navegacion/carpeta) y el resto de usuarios con
+        # /api/navegacion/usuarios, así el tiempo de carga no crece con el total
+        # de clientes y archivos.
+        if not requested_user_id and _ve_todos_los_usuarios():
+            usuarios_pagina, siguiente_id = pagina_usuarios(User.query, None, USUARIOS_LIMITE_DEFECTO)
+            usuarios_next_cursor = None
+            if siguiente_id:
+                usuarios_next_cursor = firmar_cursor(current_app.secret_key, {"despues_de": siguiente_id, "q": ""})
+            return render_template(
+                "carpetas_dropbox.html",
+                estructuras_usuarios={},
+                usuarios={},
+                usuario_actual=current_user,
+                view_user_id=view_user_id,
+                estructuras_usuarios_json="{}",
+                usuarios_emails_json=json.dumps({u.id: u.email for u in usuarios_pagina}),
+                folders_por_ruta={},
+                modo_lazy=True,
+                resumen_usuarios=resumen_usuarios(usuarios_pagina),
+                usuarios_next_cursor=usuarios_next_cursor,
+            )
+
         # Determina qué usuarios cargar según rol (y opcionalmente por user_id)
         if requested_user_id:
             # Permisos para ver el user_id solicitado
@@ -882,41 +744,38 @@ def carpetas_dropbox():
             path = user.dropbox_folder_path or f"/{getattr(user, 'email', user.id)}"
 
             try:
-                # Intentar leer de caché
-                estructura = _get_cached_estructura(user.id)
-                if estructura is None:
-                    # Ajustar profundidad según rol para optimizar
-                    if current_user.rol in ["admin", "superadmin", "lector"]:
-                        max_depth = 4
-                    else:
-                        max_depth = 3
+                # Ajustar profundidad según rol para optimizar
+                if current_user.rol in ["admin", "superadmin", "lector"]:
+                    max_depth = 4
+                else:
+                    max_depth = 3
 
+                def _cargar_estructura(path=path, max_depth=max_depth, por_usuario=bool(requested_user_id)):
                     # Cuando estamos viendo un SOLO usuario (via ?user_id=), evitar listados recursivos
                     # de Dropbox porque pueden traer miles/millones de entradas y bloquear el request.
-                    if requested_user_id:
-                        estructura = obtener_estructura_dropbox_optimizada(
+                    if por_usuario:
+                        return obtener_estructura_dropbox_optimizada(
                             path=path,
                             dbx=dbx,
                             max_depth=max_depth,
                             current_depth=0,
                         )
-                    else:
-                        # Vista general: una sola pasada (puede ser pesada, pero minimiza llamadas)
-                        estructura = obtener_estructura_dropbox_recursiva_limitada(
-                            path=path,
-                            dbx=dbx,
-                            max_depth=max_depth,
-                            max_entries=5000,
-                        )
-                    # Guardar en caché
-                    _set_cached_estructura(user.id, estructura)
+                    # Vista general: una sola pasada (puede ser pesada, pero minimiza llamadas)
+                    return obtener_estructura_dropbox_recursiva_limitada(
+                        path=path,
+                        dbx=dbx,
+                        max_depth=max_depth,
+                        max_entries=5000,
+                    )
 
-                # Aplicar filtros de ocultos (archivos y carpetas)
-                print(f"DEBUG | Filtrando archivos ocultos para usuario {user.id} (path={path})")
-                estructura = filtra_archivos_ocultos(estructura, user.id, path)
+                # Caché compartida entre workers; si está vieja se recarga en segundo plano
+                estructura = get_structure_cache().get_or_load(
+                    user.id, path, _cargar_estructura, app=current_app._get_current_object()
+                )
 
-                print(f"DEBUG | Filtrando carpetas ocultas para usuario {user.id} (path={path})")
-                estructura = filtra_carpetas_ocultas(estructura, user.id, path)
+                # Aplicar filtros de ocultos (archivos y carpetas en una sola pasada)
+                print(f"DEBUG | Filtrando ocultos para usuario {user.id} (path={path})")
+                estructura = filtra_ocultos(estructura, user.id, path)
 
             except Exception as e:
                 # En caso de fallo, asegurarse de devolver estructura vacía para este usuario
@@ -1198,11 +1057,11 @@ def toggle_visibilidad():
                 carpeta.es_publica = bool(es_publica)
             # Propagar visibilidad a archivos dentro de la carpeta
             try:
-                prefijo = ruta_norm.rstrip('/') + '/%'
-                Archivo.query.filter(Archivo.dropbox_path.like(prefijo)).update({Archivo.es_publica: bool(es_publica)}, synchronize_session=False)
+                Archivo.query.filter(filtro_prefijo_ruta(Archivo.dropbox_path, ruta_norm)).update({Archivo.es_publica: bool(es_publica)}, synchronize_session=False)
             except Exception as _:
                 pass
             db.session.commit()
+            invalidar_estructuras(rutas=[ruta_norm])
             return jsonify({"success": True, "tipo": "carpeta", "ruta": carpeta.dropbox_path, "es_publica": carpeta.es_publica})
         else:
             archivo = Archivo.query.filter_by(dropbox_path=ruta_norm).first()
@@ -1226,6 +1085,7 @@ def toggle_visibilidad():
             else:
                 archivo.es_publica = bool(es_publica)
             db.session.commit()
+            invalidar_estructuras(rutas=[ruta_norm])
             return jsonify({"success": True, "tipo": "archivo", "ruta": archivo.dropbox_path, "es_publica": archivo.es_publica})
     except Exception as e:
         db.session.rollback()
@@ -1304,6 +1164,121 @@ def obtener_contenido_carpeta(ruta):
         return jsonify({"success": False, "error": f"Error de conexión: {str(e)}"}), 500
 
 
+def _ve_todos_los_usuarios():
+    return getattr(current_user, "rol", None) in ("admin", "superadmin", "lector")
+
+
+@bp.route("/api/navegacion/usuarios")
+@login_required
+def api_navegacion_usuarios():
+    """Página de usuarios visibles (cursor por id) con su resumen; no consulta Dropbox."""
+    limite = acotar(request.args.get("limit"), USUARIOS_LIMITE_DEFECTO, USUARIOS_LIMITE_MAXIMO)
+    q = (request.args.get("q") or "").strip()
+
+    despues_de = None
+    token = request.args.get("cursor")
+    if token:
+        try:
+            datos = leer_cursor(current_app.secret_key, token)
+            if datos.get("q", "") != q:
+                raise CursorInvalido("El cursor corresponde a otra búsqueda")
+            despues_de = int(datos["despues_de"])
+        except (CursorInvalido, KeyError, TypeError, ValueError):
+            return jsonify({"success": False, "error": "Cursor inválido o expirado"}), 400
+
+    if _ve_todos_los_usuarios():
+        consulta = User.query
+    else:
+        consulta = User.query.filter(User.id == current_user.id)
+    if q:
+        patron = f"%{q}%"
+        consulta = consulta.filter(db.or_(
+            User.email.ilike(patron), User.nombre.ilike(patron), User.apellido.ilike(patron)
+        ))
+
+    usuarios, siguiente_id = pagina_usuarios(consulta, despues_de, limite)
+    siguiente = None
+    if siguiente_id:
+        siguiente = firmar_cursor(current_app.secret_key, {"despues_de": siguiente_id, "q": q})
+    return jsonify({"success": True, "usuarios": resumen_usuarios(usuarios), "next_cursor": siguiente})
+
+
+@bp.route("/api/navegacion/carpeta")
+@login_required
+def api_navegacion_carpeta():
+    """
+    Contenido de UN nivel de la carpeta de un usuario, paginado con cursor.
+
+    Parámetros: ``user_id`` (por defecto el usuario actual), ``path`` (por
+    defecto la carpeta raíz del usuario), ``limit`` y ``cursor`` (el
+    ``next_cursor`` de la respuesta anterior).
+    """
+    from app.utils.visibilidad import VisibilidadUsuario
+
+    usuario_id = request.args.get("user_id", type=int) or current_user.id
+    if not _ve_todos_los_usuarios() and usuario_id != current_user.id:
+        return jsonify({"success": False, "error": "No tienes permisos para ver esta carpeta"}), 403
+
+    reglas = VisibilidadUsuario.cargar(usuario_id, current_user)
+    if reglas is None:
+        return jsonify({"success": False, "error": "Usuario no encontrado"}), 404
+
+    path = normalizar_ruta(request.args.get("path") or reglas.base_path)
+    if path is None or not reglas.dentro_de_base(path):
+        return jsonify({"success": False, "error": "La ruta no pertenece a la carpeta del usuario"}), 403
+
+    limite = acotar(request.args.get("limit"), NIVEL_LIMITE_DEFECTO, NIVEL_LIMITE_MAXIMO)
+    cursor_dropbox = None
+    token = request.args.get("cursor")
+    if token:
+        try:
+            datos = leer_cursor(current_app.secret_key, token)
+        except CursorInvalido:
+            return jsonify({"success": False, "error": "Cursor inválido o expirado"}), 400
+        if datos.get("u") != usuario_id or datos.get("p") != path:
+            return jsonify({"success": False, "error": "El cursor corresponde a otra carpeta"}), 400
+        cursor_dropbox = datos.get("c")
+
+    dbx = get_dbx()
+    if dbx is None:
+        return jsonify({"success": False, "error": "Dropbox no está configurado"}), 503
+
+    try:
+        carpetas, archivos, siguiente = listar_nivel(dbx, path, cursor_dropbox, limite)
+    except dropbox.exceptions.ApiError as e:
+        if "not_found" in str(e):
+            return jsonify({"success": False, "error": "Carpeta no encontrada en Dropbox"}), 404
+        if "reset" in str(e):
+            # Dropbox invalidó el cursor: el cliente debe recargar el nivel desde el inicio
+            return jsonify({"success": False, "error": "La carpeta cambió, vuelve a cargarla"}), 409
+        current_app.logger.warning(f"Error de Dropbox listando {path}: {e}")
+        return jsonify({"success": False, "error": "Error de Dropbox"}), 502
+
+    nombres_visibles, carpetas = reglas.filtrar_nivel(
+        path, [a["nombre"] for a in archivos], carpetas, carpetas_con_contenido
+    )
+    nombres_visibles = set(nombres_visibles)
+    archivos = [a for a in archivos if a["nombre"] in nombres_visibles]
+    for a in archivos:
+        a["path"] = f"{path}/{a['nombre']}"
+    estados = estados_archivos([a["path"] for a in archivos])
+    for a in archivos:
+        a["estado"] = estados.get(a["path"])
+
+    siguiente_token = None
+    if siguiente:
+        siguiente_token = firmar_cursor(current_app.secret_key, {"u": usuario_id, "p": path, "c": siguiente})
+
+    return jsonify({
+        "success": True,
+        "usuario_id": usuario_id,
+        "path": path,
+        "carpetas": [{"nombre": nombre, "path": f"{path}/{nombre}"} for nombre in carpetas],
+        "archivos": archivos,
+        "next_cursor": siguiente_token,
+    })
+
+
 @bp.route("/crear_carpeta", methods=["POST"])
 @login_required
 def crear_carpeta():
@@ -1422,6 +1397,7 @@ def crear_carpeta():
         db.session.commit()
 
         # Registrar actividad
+        invalidar_estructuras(usuarios=[usuario_id], rutas=[ruta])
         current_user.registrar_actividad('folder_created', f'Carpeta "{nombre}" creada en {ruta}')
         
         tipo_carpeta = "pública" if es_publica else "privada"
@@ -1530,6 +1506,7 @@ def subir_archivo():
     categoria = request.form.get("categoria")
     subcategoria = (request.form.get("subcategoria") or "").strip()
     archivos = request.files.getlist("archivo")  # Obtener lista de archivos
+    upload_id = (request.form.get("upload_id") or "").strip() or None  # Para consultar progreso
     
     print("=" * 60)
     print("POST: Procesando subida de archivos")
@@ -1704,20 +1681,21 @@ def subir_archivo():
         archivos_procesados = []
         
         print(f"🔄 Iniciando procesamiento de {len(archivos)} archivo(s)...")
-        
+
+        # Nombres libres resueltos con un solo listado de la carpeta destino
+        reserva = ReservaNombres(dbx, with_base_folder(ruta_categoria))
+        trabajos = []
+
         for idx, archivo in enumerate(archivos, 1):
             try:
-                # Leer el contenido del archivo
-                archivo_content = archivo.read()
-                archivo.seek(0)  # Resetear el puntero del archivo
-                
                 # Generar nombre final del archivo (sin incluir IDs/timestamps)
                 nombre_original = archivo.filename
                 nombre_base = nombre_original
                 ext = ""
-                if "." in nombre_original:
+                extension = extension_de_nombre(nombre_original)
+                if extension:
                     nombre_base = nombre_original.rsplit(".", 1)[0]
-                    ext = "." + nombre_original.rsplit(".", 1)[1].lower()
+                    ext = "." + extension
                 
                 # Normalizar el nombre base del archivo
                 nombre_base_normalizado = sanitize_dropbox_segment(nombre_base)
@@ -1740,63 +1718,56 @@ def subir_archivo():
                     nombre_usuario = sanitize_dropbox_segment(usuario.nombre or usuario.email.split('@')[0])
                     nombre_base_final = f"{nombre_usuario}_{nombre_base_normalizado}"
 
-                def _nombre_con_sufijo(idx_conflicto: int) -> str:
-                    if idx_conflicto == 0:
-                        return f"{nombre_base_final}{ext}"
-                    return f"{nombre_base_final}_{idx_conflicto}{ext}"
+                print(f"📄 Preparando archivo {idx}/{len(archivos)}: {nombre_original} -> {nombre_base_final}{ext}")
 
-                nombre_final = _nombre_con_sufijo(0)
+                destino = reserva.reservar(nombre_base_final, ext)
+                if destino is None:
+                    raise ValueError("No hay nombre disponible para el archivo en Dropbox")
+                trabajos.append(UploadJob(
+                    idx,
+                    nombre_original,
+                    archivo.stream,
+                    destino,
+                    alternativas=reserva.alternativas(nombre_base_final, ext),
+                    progress=progress_tracker(upload_id, current_user.id, idx, nombre_original),
+                ))
 
-                print(f"📄 Procesando archivo {idx}/{len(archivos)}: {nombre_original} -> {nombre_final}")
-
-                # Subir archivo con nombre final (sin sobrescribir)
-                try:
-                    dropbox_dest = None
-                    for intento in range(0, 50):
-                        nombre_final = _nombre_con_sufijo(intento)
-                        dropbox_dest = f"{ruta_categoria}/{nombre_final}"
-                        try:
-                            dbx.files_upload(
-                                archivo_content,
-                                with_base_folder(dropbox_dest),
-                                mode=dropbox.files.WriteMode("add"),
-                            )
-                            break
-                        except dropbox.exceptions.ApiError as e:
-                            if "conflict" in str(e).lower():
-                                continue
-                            raise
-                    if not dropbox_dest:
-                        raise RuntimeError("No se pudo determinar el destino en Dropbox")
-                except dropbox.exceptions.ApiError as e:
-                    raise e
-                print(f"✅ Archivo {idx}/{len(archivos)} subido exitosamente a Dropbox: {dropbox_dest}")
-
-                # Guardar en la base de datos
-                dropbox_dest_logico = without_base_folder(dropbox_dest)
-                nuevo_archivo = Archivo(  # type: ignore[call-arg]
-                    nombre=nombre_final,
-                    categoria=categoria,
-                    subcategoria="",
-                    dropbox_path=dropbox_dest_logico,
-                    usuario_id=getattr(usuario, "id", None),
-                    estado="en_revision"
-                )
-                db.session.add(nuevo_archivo)
-                archivos_procesados.append(nuevo_archivo)
-                archivos_subidos += 1
-                
             except Exception as e_archivo:
                 archivos_fallidos += 1
+                mark_progress_failed(upload_id, current_user.id, idx, archivo.filename, e_archivo)
                 print(f"❌ ERROR al procesar archivo {idx}/{len(archivos)} ({archivo.filename}): {e_archivo}")
                 import traceback
                 traceback.print_exc()
                 # Continuar con el siguiente archivo
                 continue
-        
-        # Commit de todos los archivos procesados
-        if archivos_procesados:
+
+        # Subida en paralelo por bloques y commit conjunto (finish_batch)
+        filas = []
+        for trabajo in upload_batch(dbx, trabajos, mode=dropbox.files.WriteMode("add")):
+            if not trabajo.ok:
+                archivos_fallidos += 1
+                mark_progress_failed(upload_id, current_user.id, trabajo.indice, trabajo.nombre_original, trabajo.error)
+                print(f"❌ ERROR al subir archivo {trabajo.indice}/{len(archivos)} ({trabajo.nombre_original}): {trabajo.error}")
+                continue
+            dropbox_dest_logico = without_base_folder(trabajo.destino)
+            nombre_final = dropbox_dest_logico.rsplit("/", 1)[-1]
+            print(f"✅ Archivo {trabajo.indice}/{len(archivos)} subido exitosamente a Dropbox: {dropbox_dest_logico}")
+            filas.append({
+                "nombre": nombre_final,
+                "categoria": categoria,
+                "subcategoria": "",
+                "dropbox_path": dropbox_dest_logico,
+                "tamano": getattr(trabajo.metadata, "size", None),
+                "extension": extension_de_nombre(nombre_final),
+                "usuario_id": getattr(usuario, "id", None),
+                "estado": "en_revision",
+            })
+
+        # Registrar todos los archivos subidos con un único INSERT
+        if filas:
             try:
+                archivos_procesados = insertar_archivos(filas)
+                archivos_subidos = len(archivos_procesados)
                 db.session.commit()
                 print(f"✅ {archivos_subidos} archivo(s) registrado(s) en la base de datos")
             except Exception as e_commit:
@@ -1804,19 +1775,14 @@ def subir_archivo():
                 print(f"❌ ERROR al hacer commit de archivos: {e_commit}")
                 import traceback
                 traceback.print_exc()
-                archivos_fallidos += len(archivos_procesados)
+                archivos_fallidos += len(filas)
                 archivos_subidos = 0
                 archivos_procesados = []
         
         print(f"📊 Resumen: {archivos_subidos} exitoso(s), {archivos_fallidos} fallido(s) de {len(archivos)} total")
         
-        # Invalidar caché de estructura para el usuario afectado
-        try:
-            afectado_id = getattr(usuario, "id", None)
-            if afectado_id in _estructuras_cache:
-                _estructuras_cache.pop(afectado_id, None)
-        except Exception:
-            pass
+        # Invalidar caché de estructura (en todos los workers) para el árbol afectado
+        invalidar_estructuras(usuarios=[getattr(usuario, "id", None)], rutas=[ruta_categoria])
 
         # Registrar actividad
         if archivos_subidos > 0:
@@ -1975,6 +1941,15 @@ def subir_archivo():
 
  
 
+@bp.route("/api/subida/progreso/<upload_id>", methods=["GET"])
+@login_required
+def progreso_subida(upload_id):
+    """Progreso por archivo de una subida en curso del usuario (campo upload_id del formulario)"""
+    archivos = get_progress(upload_id, current_user.id)
+    if archivos is None:
+        return jsonify({"success": False, "error": "Subida no encontrada"}), 404
+    return jsonify({"success": True, "archivos": archivos})
+
 @bp.route('/mover_archivo/<archivo_nombre>/<path:carpeta_actual>', methods=['GET', 'POST'])
 @login_required
 def mover_archivo(archivo_nombre, carpeta_actual):
@@ -2017,12 +1992,6 @@ def mover_archivo(archivo_nombre, carpeta_actual):
             raise e
     usuario.dropbox_folder_path = carpeta_usuario
     db.session.commit()
-    # Invalidar caché de estructura para el usuario afectado
-    try:
-        if usuario.id in _estructuras_cache:
-            _estructuras_cache.pop(usuario.id, None)
-    except Exception:
-        pass
     ruta_categoria = f"{carpeta_usuario}/{categoria}"
     try:
         dbx.files_create_folder_v2(with_base_folder(ruta_categoria))
@@ -2041,6 +2010,7 @@ def mover_archivo(archivo_nombre, carpeta_actual):
     db.session.commit()
     
     # Registrar actividad
+    invalidar_estructuras(usuarios=[usuario.id], rutas=[old_dropbox_path, nuevo_destino])
     current_user.registrar_actividad('file_moved', f'Archivo "{archivo_nombre}" movido a {categoria}')
     
     flash("Archivo movido correctamente.", "success")
@@ -2093,13 +2063,13 @@ def exportar_archivos_carpeta():
         if carpeta_origen.endswith('/'):
             carpeta_origen = carpeta_origen[:-1]
         
-        archivos_db = Archivo.query.filter(
-            Archivo.dropbox_path.like(f"{carpeta_origen}/%")
-        ).all()
+        total_archivos = Archivo.query.filter(
+            filtro_prefijo_ruta(Archivo.dropbox_path, carpeta_origen)
+        ).count()
         
-        print(f"🔧 Archivos encontrados en BD para carpeta '{carpeta_origen}': {len(archivos_db)}")
+        print(f"🔧 Archivos encontrados en BD para carpeta '{carpeta_origen}': {total_archivos}")
         
-        if not archivos_db:
+        if not total_archivos:
             # Buscar carpetas similares para sugerir al usuario
             todas_rutas = db.session.query(Archivo.dropbox_path).distinct().all()
             rutas_sugeridas = []
@@ -2119,77 +2089,26 @@ def exportar_archivos_carpeta():
             flash(mensaje, "warning")
             return redirect(url_for("listar_dropbox.exportar_archivos_carpeta"))
         
-        # Crear carpeta destino si no existe
-        try:
-            dbx.files_create_folder_v2(with_base_folder(carpeta_destino))
-            print(f"🔧 Carpeta destino creada: {carpeta_destino}")
-        except dropbox.exceptions.ApiError as e:
-            if "conflict" not in str(e).lower():
-                print(f"🔧 Error creando carpeta destino: {e}")
-                raise e
-            print(f"🔧 La carpeta destino ya existía: {carpeta_destino}")
-        
-        archivos_movidos = 0
-        errores = []
-        
-        for archivo in archivos_db:
-            try:
-                # Construir nueva ruta manteniendo la estructura de subcarpetas
-                ruta_relativa = archivo.dropbox_path[len(carpeta_origen):].lstrip('/')
-                nueva_ruta = f"{carpeta_destino}/{ruta_relativa}"
-                nueva_ruta = _normalize_dropbox_path(nueva_ruta)
-                
-                print(f"🔧 Moviendo: {archivo.dropbox_path} -> {nueva_ruta}")
-                
-                # Crear subcarpetas intermedias si es necesario
-                subcarpeta_destino = '/'.join(nueva_ruta.split('/')[:-1])
-                if subcarpeta_destino != carpeta_destino:
-                    try:
-                        dbx.files_create_folder_v2(with_base_folder(subcarpeta_destino))
-                        print(f"🔧 Subcarpeta creada: {subcarpeta_destino}")
-                    except dropbox.exceptions.ApiError as e:
-                        if "conflict" not in str(e).lower():
-                            print(f"🔧 Error creando subcarpeta: {e}")
-                
-                # Mover archivo en Dropbox
-                result = dbx.files_move_v2(
-                    with_base_folder(archivo.dropbox_path), 
-                    with_base_folder(nueva_ruta), 
-                    allow_shared_folder=True, 
-                    autorename=True
-                )
-                
-                # Obtener la ruta final en caso de que se haya renombrado
-                ruta_final = without_base_folder(result.metadata.path_display or result.metadata.path_lower)
-                
-                # Actualizar registro en la base de datos
-                archivo.dropbox_path = ruta_final
-                db.session.commit()
-                
-                archivos_movidos += 1
-                print(f"🔧 Archivo movido exitosamente: {archivo.nombre}")
-                
-            except Exception as e:
-                error_msg = f"Error moviendo {archivo.nombre}: {str(e)}"
-                errores.append(error_msg)
-                print(f"🔧 {error_msg}")
-                continue
-        
-        # Registrar actividad
-        current_user.registrar_actividad('bulk_export', 
-            f'Exportados {archivos_movidos} archivos de "{carpeta_origen}" a "{carpeta_destino}"')
-        
-        # Mostrar resultados
-        if archivos_movidos > 0:
-            flash(f"Exportación completada: {archivos_movidos} archivos movidos exitosamente.", "success")
+        # Mover en segundo plano por lotes (app/dropbox_batch_move.py, cola de app/job_runner.py)
+        from app import dropbox_batch_move
+        if dropbox_batch_move.en_curso(carpeta_origen):
+            flash(f"Ya hay una exportación en curso desde '{carpeta_origen}'.", "warning")
+            return redirect(url_for("listar_dropbox.carpetas_dropbox"))
+        movimiento, trabajo = dropbox_batch_move.lanzar(carpeta_origen, carpeta_destino, usuario_id=current_user.id)
+        if movimiento is None:
+            flash(f"Ya hay una exportación en curso desde '{carpeta_origen}'.", "warning")
+            return redirect(url_for("listar_dropbox.carpetas_dropbox"))
+        progreso_url = url_for("listar_dropbox.progreso_exportacion", trabajo_id=movimiento.id)
         
-        if errores:
-            flash(f"Se encontraron {len(errores)} errores durante la exportación.", "warning")
-            for error in errores[:5]:  # Mostrar solo los primeros 5 errores
-                flash(error, "error")
-            if len(errores) > 5:
-                flash(f"... y {len(errores) - 5} errores más.", "error")
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({
+                'success': True,
+                'trabajo_id': movimiento.id,
+                'progreso_url': progreso_url,
+                'estado_url': url_for("trabajos.estado", trabajo_id=trabajo.id),
+            }), 202
         
+        flash(f"Exportación de {total_archivos} archivos iniciada en segundo plano (#{movimiento.id}).", "info")
         return redirect(url_for("listar_dropbox.carpetas_dropbox"))
         
     except Exception as e:
@@ -2198,6 +2117,20 @@ def exportar_archivos_carpeta():
         flash(f"Error durante la exportación: {str(e)}", "error")
         return redirect(url_for("listar_dropbox.exportar_archivos_carpeta"))
 
+@bp.route('/exportar_archivos_carpeta/<int:trabajo_id>/progreso')
+@login_required
+def progreso_exportacion(trabajo_id):
+    """Progreso de una exportación masiva en segundo plano"""
+    from app.dropbox_batch_move import progreso
+    from app.models import MovimientoLote
+    
+    trabajo = db.session.get(MovimientoLote, trabajo_id)
+    if trabajo is None:
+        return jsonify({'success': False, 'error': 'Exportación no encontrada'}), 404
+    if trabajo.usuario_id != current_user.id and current_user.rol not in ["admin", "superadmin"]:
+        return jsonify({'success': False, 'error': 'Sin permisos'}), 403
+    return jsonify({'success': True, **progreso(trabajo)})
+
 @bp.route('/mover_archivo_modal', methods=['POST'])
 @login_required
 def mover_archivo_modal():
@@ -2415,6 +2348,7 @@ def mover_archivo_modal():
                         db.session.add(nuevo_archivo)
                 db.session.commit()
 
+                invalidar_estructuras(rutas=[without_base_folder(archivo_path), without_base_folder(result_path)])
                 current_user.registrar_actividad('file_moved', f'Archivo "{archivo_nombre}" movido a {result_path}')
                 flash(f"Archivo '{archivo_nombre}' movido exitosamente a '{nueva_carpeta}'", "success")
 
@@ -2652,6 +2586,7 @@ def mover_archivo_modal():
             print(f"DEBUG | Base de datos actualizada")
             
             # Registrar actividad
+            invalidar_estructuras(rutas=[without_base_folder(archivo_path), without_base_folder(result_path)])
             current_user.registrar_actividad('file_moved', f'Archivo "{archivo_nombre}" movido de {archivo_path} a {result_path}')
             
             # Mostrar mensaje de éxito
@@ -2900,12 +2835,8 @@ def renombrar_archivo():
     flash("Archivo renombrado correctamente.", "success")
 
     # Invalidar caché de estructura para reflejar el cambio inmediatamente en la UI
-    try:
-        _estructuras_cache.pop(usuario_id_int, None)
-        if hasattr(usuario, 'titular') and getattr(usuario, 'titular', None) is not None:
-            _estructuras_cache.pop(getattr(usuario.titular, 'id', None), None)
-    except Exception:
-        pass
+    titular_id = getattr(getattr(usuario, 'titular', None), 'id', None)
+    invalidar_estructuras(usuarios=[usuario_id_int, titular_id], rutas=[old_path, final_canonical])
     
     # Redirigir a la carpeta específica del usuario
     redirect_url = url_for("listar_dropbox.ver_usuario_carpetas", usuario_id=usuario_id_int)
@@ -2913,89 +2844,29 @@ def renombrar_archivo():
     return redirect(redirect_url)
 
 
-def sincronizar_dropbox_a_bd():
+def sincronizar_dropbox_a_bd(full=False):
+    """Sincroniza archivos y carpetas de todos los usuarios (incremental por cursor)."""
+    from app.dropbox_sync import sync_all_users
     print("🚩 Iniciando sincronización de Dropbox a BD...")
-    dbx = get_dbx()
-
-    # Obtén todos los paths que ya tienes en la base para comparar rápido
-    paths_existentes = set([a.dropbox_path for a in Archivo.query.all()])
-    print(f"DEBUG | Archivos existentes en BD: {len(paths_existentes)}")
-    
-    nuevos = 0
-    total_archivos = 0
-    
-    # Obtener todos los usuarios para mapear emails a IDs
-    usuarios = User.query.all()
-    usuarios_por_email = {u.email: u.id for u in usuarios}
-    print(f"DEBUG | Usuarios encontrados: {list(usuarios_por_email.keys())}")
-
-    # Buscar archivos en cada carpeta de usuario
-    for usuario in usuarios:
-        if not usuario.dropbox_folder_path:
-            print(f"DEBUG | Usuario {usuario.email} no tiene dropbox_folder_path")
-            continue
-            
-        print(f"DEBUG | Sincronizando archivos de usuario: {usuario.email}")
-        print(f"DEBUG | Path del usuario: {usuario.dropbox_folder_path}")
-        
-        try:
-            # Listar archivos del usuario en Dropbox
-            res = dbx.files_list_folder(usuario.dropbox_folder_path, recursive=True)
-            
-            for entry in res.entries:
-                if isinstance(entry, dropbox.files.FileMetadata):
-                    total_archivos += 1
-                    dropbox_path = entry.path_display
-                    
-                    if dropbox_path in paths_existentes:
-                        continue  # Ya está sincronizado
-
-                    print(f"DEBUG | Nuevo archivo encontrado: {dropbox_path}")
-                    
-                    # Extraer información del path
-                    partes = dropbox_path.strip("/").split("/")
-                    
-                    # Determina categoría y subcategoría si existen
-                    categoria = ""
-                    subcategoria = ""
-                    
-                    if len(partes) > 2:
-                        categoria = partes[2]  # Después del email y carpeta raíz
-                    if len(partes) > 3:
-                        subcategoria = partes[3]
-
-                    nuevo_archivo = Archivo(  # type: ignore[call-arg]
-                        nombre=entry.name,
-                        categoria=categoria,
-                        subcategoria=subcategoria,
-                        dropbox_path=without_base_folder(dropbox_path),
-                        usuario_id=usuario.id,
-                        estado="en_revision"  # Automáticamente asignar "Pendiente para revisión"
-                    )
-                    db.session.add(nuevo_archivo)
-                    nuevos += 1
-                    print(f"DEBUG | Agregado a BD: {entry.name} -> {dropbox_path}")
-                    
-        except Exception as e:
-            print(f"ERROR | Error sincronizando usuario {usuario.email}: {e}")
-            continue
-
-    db.session.commit()
-    print(f"🚩 Sincronización completa: {nuevos} archivos nuevos de {total_archivos} totales")
-    print(f"DEBUG | Total de archivos en BD después de sincronización: {Archivo.query.count()}")
+    totales = sync_all_users(full=full)
+    print(
+        f"🚩 Sincronización completa: {totales['archivos_nuevos']} archivos nuevos, "
+        f"{totales['archivos_movidos']} movidos, {totales['archivos_eliminados']} eliminados"
+    )
+    return totales
 
 @bp.route("/sincronizar_dropbox")
 @login_required
 def sincronizar_dropbox():
-    print("🚩 Iniciando sincronización completa...")
-    try:
-        sincronizar_dropbox_a_bd()
-        sincronizar_carpetas_dropbox()
-        flash("¡Sincronización completada!", "success")
-    except Exception as e:
-        print(f"ERROR | Error en sincronización: {e}")
-        flash(f"Error en sincronización: {e}", "error")
-    return redirect(url_for("listar_dropbox.carpetas_dropbox"))
+    """Encola la sincronización incremental Dropbox -> BD (app/job_tasks.py)"""
+    from app import job_runner
+    from app.routes.trabajos import responder_encolado
+
+    trabajo, nuevo = job_runner.encolar(
+        'sincronizar_dropbox', {'full': False}, usuario_id=current_user.id, clave='sincronizar_dropbox'
+    )
+    return responder_encolado(trabajo, nuevo, "Sincronización iniciada.",
+                              url_for("listar_dropbox.carpetas_dropbox"))
 
 @bp.route("/verificar_bd")
 @login_required
@@ -3030,6 +2901,7 @@ def verificar_bd():
 @login_required
 def sincronizar_usuario(email):
     """Sincroniza archivos de un usuario específico"""
+    from app.dropbox_sync import sync_user
     print(f"🔄 Sincronizando archivos del usuario: {email}")
     
     try:
@@ -3040,71 +2912,17 @@ def sincronizar_usuario(email):
             flash(f"Usuario {email} no encontrado", "error")
             return redirect(url_for("listar_dropbox.carpetas_dropbox"))
         
-        print(f"DEBUG | Usuario encontrado: {usuario.email} (ID: {usuario.id})")
-        
         # Verificar si tiene carpeta de Dropbox configurada
         if not usuario.dropbox_folder_path:
-            print(f"DEBUG | Usuario {email} no tiene dropbox_folder_path configurado")
             # Intentar usar el email como carpeta
             usuario.dropbox_folder_path = f"/{email}"
             db.session.commit()
             print(f"DEBUG | Configurado dropbox_folder_path: {usuario.dropbox_folder_path}")
         
-        dbx = get_dbx()
-        
-        # Obtener todos los archivos del usuario en Dropbox
-        print(f"DEBUG | Buscando archivos en: {usuario.dropbox_folder_path}")
-        res = dbx.files_list_folder(usuario.dropbox_folder_path, recursive=True)
-        print(f"DEBUG | Encontrados {len(res.entries)} elementos para {email}")
-        
-        archivos_procesados = 0
-        archivos_nuevos = 0
-        archivos_existentes = 0
-        
-        for entry in res.entries:
-            if isinstance(entry, dropbox.files.FileMetadata):
-                archivos_procesados += 1
-                dropbox_path = entry.path_display
-                
-                print(f"DEBUG | Procesando archivo: {entry.name} -> {dropbox_path}")
-                
-                # Verificar si ya existe en la BD
-                archivo_existente = Archivo.query.filter_by(dropbox_path=dropbox_path).first()
-                if archivo_existente:
-                    print(f"DEBUG | Archivo ya existe en BD: {archivo_existente.nombre}")
-                    archivos_existentes += 1
-                else:
-                    print(f"DEBUG | Archivo nuevo, agregando a BD: {entry.name}")
-                    
-                    # Extraer información del path
-                    partes = dropbox_path.strip("/").split("/")
-                    categoria = ""
-                    subcategoria = ""
-                    
-                    if len(partes) > 2:
-                        categoria = partes[2]  # Después del email
-                    if len(partes) > 3:
-                        subcategoria = partes[3]
-                    
-                    nuevo_archivo = Archivo(  # type: ignore[call-arg]
-                        nombre=entry.name,
-                        categoria=categoria,
-                        subcategoria=subcategoria,
-                        dropbox_path=without_base_folder(dropbox_path),
-                        usuario_id=usuario.id,
-                        estado="en_revision"  # Automáticamente asignar "Pendiente para revisión"
-                    )
-                    db.session.add(nuevo_archivo)
-                    archivos_nuevos += 1
-                    print(f"DEBUG | Archivo agregado: {entry.name} -> {dropbox_path}")
-        
-        db.session.commit()
-        print(f"🔄 Sincronización completada para {email}:")
-        print(f"DEBUG | - Archivos procesados: {archivos_procesados}")
-        print(f"DEBUG | - Archivos existentes: {archivos_existentes}")
-        print(f"DEBUG | - Archivos nuevos: {archivos_nuevos}")
+        stats = sync_user(usuario, full=request.args.get('full') == '1')
+        print(f"🔄 Sincronización completada para {email}: {dict(stats)}")
         
-        flash(f"Sincronización completada para {email}. {archivos_nuevos} archivos nuevos agregados.", "success")
+        flash(f"Sincronización completada para {email}. {stats['archivos_nuevos']} archivos nuevos agregados.", "success")
         
     except Exception as e:
         print(f"ERROR | Error sincronizando usuario {email}: {e}")
@@ -3373,118 +3191,25 @@ def buscar_archivo_dropbox(nombre_archivo):
 
 @bp.route("/sincronizar_dropbox_completo")
 def sincronizar_dropbox_completo():
-    """Sincronización alternativa que busca desde la raíz de Dropbox"""
-    print("🚩 Iniciando sincronización completa desde raíz...")
-    dbx = get_dbx()
-    
-    try:
-        # Buscar desde la raíz
-        res = dbx.files_list_folder(path="", recursive=True)
-        
-        # Obtener archivos existentes
-        paths_existentes = set([a.dropbox_path for a in Archivo.query.all()])
-        print(f"DEBUG | Archivos existentes en BD: {len(paths_existentes)}")
-        
-        nuevos = 0
-        archivos_procesados = 0
-        
-        for entry in res.entries:
-            if isinstance(entry, dropbox.files.FileMetadata):
-                archivos_procesados += 1
-                dropbox_path = entry.path_display
-                
-                if dropbox_path in paths_existentes:
-                    continue
-                
-                print(f"DEBUG | Nuevo archivo: {dropbox_path}")
-                
-                # Intentar encontrar usuario basado en el path
-                partes = dropbox_path.strip("/").split("/")
-                usuario_id = None
-                
-                if len(partes) > 0:
-                    # Buscar usuario por email en el path
-                    for parte in partes:
-                        usuario = User.query.filter_by(email=parte).first()
-                        if usuario:
-                            usuario_id = usuario.id
-                            break
-                
-                # Extraer categoría y subcategoría
-                categoria = ""
-                subcategoria = ""
-                if len(partes) > 1:
-                    categoria = partes[1]
-                if len(partes) > 2:
-                    subcategoria = partes[2]
-                
-                nuevo_archivo = Archivo(  # type: ignore[call-arg]
-                    nombre=entry.name,
-                    categoria=categoria,
-                    subcategoria=subcategoria,
-                    dropbox_path=dropbox_path,
-                    usuario_id=usuario_id
-                )
-                db.session.add(nuevo_archivo)
-                nuevos += 1
-                print(f"DEBUG | Agregado: {entry.name} -> {dropbox_path}")
-        
-        db.session.commit()
-        print(f"🚩 Sincronización completa: {nuevos} archivos nuevos de {archivos_procesados} procesados")
-        flash(f"¡Sincronización completa! {nuevos} archivos nuevos agregados.", "success")
-        
-    except Exception as e:
-        print(f"ERROR | Error en sincronización completa: {e}")
-        flash(f"Error en sincronización: {e}", "error")
-    
-    return redirect(url_for("listar_dropbox.carpetas_dropbox"))
+    """Sincronización completa: descarta los cursores y recorre de nuevo cada carpeta de usuario"""
+    from app import job_runner
+    from app.routes.trabajos import responder_encolado
+
+    # Misma clave que la incremental: no tiene sentido correr ambas a la vez
+    trabajo, nuevo = job_runner.encolar(
+        'sincronizar_dropbox', {'full': True},
+        usuario_id=current_user.id if current_user.is_authenticated else None,
+        clave='sincronizar_dropbox',
+    )
+    return responder_encolado(trabajo, nuevo, "Sincronización completa iniciada.",
+                              url_for("listar_dropbox.carpetas_dropbox"))
 
 def sincronizar_carpetas_dropbox():
-    """Sincroniza carpetas de Dropbox que no están en la base de datos"""
-    dbx = get_dbx()
-    
-    # Obtener todas las carpetas que ya están en la base de datos
-    carpetas_existentes = set([f.dropbox_path for f in Folder.query.all()])
-    
-    # Obtener todos los usuarios
-    usuarios = User.query.all()
-    usuarios_por_email = {u.email: u for u in usuarios}
-    
-    nuevos = 0
-    
-    for usuario in usuarios:
-        if not usuario.dropbox_folder_path:
-            continue
-            
-        try:
-            # Listar carpetas del usuario en Dropbox
-            res = dbx.files_list_folder(usuario.dropbox_folder_path, recursive=True)
-            
-            for entry in res.entries:
-                if isinstance(entry, dropbox.files.FolderMetadata):
-                    dropbox_path = entry.path_display
-                    
-                    # Si la carpeta no está en la base de datos, agregarla
-                    if dropbox_path not in carpetas_existentes:
-                        # Extraer nombre de la carpeta del path
-                        nombre = entry.name
-                        
-                        nueva_carpeta = Folder(  # type: ignore[call-arg]
-                            name=nombre,
-                            user_id=usuario.id,
-                            dropbox_path=dropbox_path,
-                            es_publica=True  # Por defecto las carpetas existentes son públicas
-                        )
-                        db.session.add(nueva_carpeta)
-                        nuevos += 1
-                        print(f"Nueva carpeta agregada: {dropbox_path}")
-                        
-        except dropbox.exceptions.ApiError as e:
-            print(f"Error accediendo a carpeta de {usuario.email}: {e}")
-            continue
-    
-    db.session.commit()
-    print(f"Sincronización de carpetas completada: {nuevos} carpetas nuevas agregadas a la base de datos.")
+    """Sincroniza carpetas de Dropbox que no están en la base de datos.
+
+    Las carpetas se aplican en la misma pasada incremental que los archivos.
+    """
+    return sincronizar_dropbox_a_bd()
 
 @bp.route("/subir_archivo_rapido", methods=["POST"])
 @login_required
@@ -3504,6 +3229,7 @@ def subir_archivo_rapido():
     usuario_id_field = (request.form.get("usuario_id") or "").strip()
     carpeta_destino = (request.form.get("carpeta_destino") or "").strip()
     archivos = request.files.getlist("archivo")  # Obtener lista de archivos
+    upload_id = (request.form.get("upload_id") or "").strip() or None  # Para consultar progreso
 
     print("=" * 60)
     print("POST subir_archivo_rapido: Procesando subida de archivos")
@@ -3638,13 +3364,13 @@ def subir_archivo_rapido():
         archivos_procesados = []
         
         print(f"🔄 Iniciando procesamiento de {len(archivos)} archivo(s) en subida rápida...")
-        
+
+        # nombres libres resueltos con un solo listado de la carpeta destino
+        reserva = ReservaNombres(dbx, with_base_folder(carpeta_destino_completa))
+        trabajos = []
+
         for idx, archivo_file in enumerate(archivos, 1):
             try:
-                # Leer el contenido del archivo
-                archivo_content = archivo_file.read()
-                archivo_file.seek(0)
-                
                 # preparar nombre de archivo normalizado y destino final
                 orig_name = archivo_file.filename or "upload.bin"
                 name_base = orig_name.rsplit(".", 1)[0]
@@ -3652,57 +3378,56 @@ def subir_archivo_rapido():
                 
                 base_normalizada = f"{normaliza(name_base)}"
 
-                def _nombre_con_sufijo(idx_conflicto: int) -> str:
-                    if idx_conflicto == 0:
-                        return f"{base_normalizada}{ext}"
-                    return f"{base_normalizada}_{idx_conflicto}{ext}"
-
-                nombre_normalizado = _nombre_con_sufijo(0)
-                dropbox_dest = f"{carpeta_destino_completa.rstrip('/')}/{nombre_normalizado}".replace("//", "/")
-
-                print(f"📄 Procesando archivo {idx}/{len(archivos)}: {orig_name} -> {nombre_normalizado}")
-
-                # intentar subir (mode=add). si conflicto, añadir sufijo
-                for intento in range(0, 50):
-                    nombre_normalizado = _nombre_con_sufijo(intento)
-                    dropbox_dest = f"{carpeta_destino_completa.rstrip('/')}/{nombre_normalizado}".replace("//", "/")
-                    try:
-                        dbx.files_upload(archivo_content, with_base_folder(dropbox_dest), mode=WriteMode.add)
-                        break
-                    except dropbox.exceptions.ApiError as e:
-                        if "conflict" in str(e).lower():
-                            continue
-                        raise
-
-                print(f"✅ Archivo {idx}/{len(archivos)} subido exitosamente a Dropbox: {dropbox_dest}")
-
-                # registrar en BD (guardar ruta lógica sin carpeta base para consistencia)
-                try:
-                    ruta_logica = without_base_folder(dropbox_dest)
-                except Exception:
-                    ruta_logica = dropbox_dest
-                nuevo = Archivo(  # type: ignore[call-arg]
-                    nombre=nombre_normalizado,
-                    categoria="Subida Rápida",
-                    subcategoria="Directo",
-                    dropbox_path=ruta_logica,
-                    usuario_id=getattr(usuario, "id", None),
-                    estado="en_revision"
-                )
-                db.session.add(nuevo)
-                archivos_procesados.append(nuevo)
-                archivos_subidos += 1
+                print(f"📄 Preparando archivo {idx}/{len(archivos)}: {orig_name} -> {base_normalizada}{ext}")
+
+                destino = reserva.reservar(base_normalizada, ext)
+                if destino is None:
+                    raise ValueError("No hay nombre disponible para el archivo en Dropbox")
+                trabajos.append(UploadJob(
+                    idx,
+                    orig_name,
+                    archivo_file.stream,
+                    destino,
+                    alternativas=reserva.alternativas(base_normalizada, ext),
+                    progress=progress_tracker(upload_id, current_user.id, idx, orig_name),
+                ))
                 
             except Exception as e_archivo:
                 archivos_fallidos += 1
+                mark_progress_failed(upload_id, current_user.id, idx, archivo_file.filename, e_archivo)
                 print(f"❌ ERROR al procesar archivo {idx}/{len(archivos)} ({archivo_file.filename}): {e_archivo}")
                 import traceback
                 traceback.print_exc()
                 continue
+
+        # subida en paralelo (mode=add) y commit conjunto con finish_batch
+        filas = []
+        for trabajo in upload_batch(dbx, trabajos, mode=WriteMode.add):
+            if not trabajo.ok:
+                archivos_fallidos += 1
+                mark_progress_failed(upload_id, current_user.id, trabajo.indice, trabajo.nombre_original, trabajo.error)
+                print(f"❌ ERROR al subir archivo {trabajo.indice}/{len(archivos)} ({trabajo.nombre_original}): {trabajo.error}")
+                continue
+            # registrar en BD (guardar ruta lógica sin carpeta base para consistencia)
+            ruta_logica = without_base_folder(trabajo.destino)
+            nombre_normalizado = ruta_logica.rsplit("/", 1)[-1]
+            print(f"✅ Archivo {trabajo.indice}/{len(archivos)} subido exitosamente a Dropbox: {ruta_logica}")
+            filas.append({
+                "nombre": nombre_normalizado,
+                "categoria": "Subida Rápida",
+                "subcategoria": "Directo",
+                "dropbox_path": ruta_logica,
+                "tamano": getattr(trabajo.metadata, "size", None),
+                "extension": extension_de_nombre(nombre_normalizado),
+                "usuario_id": getattr(usuario, "id", None),
+                "estado": "en_revision",
+            })
         
-        # Commit de todos los archivos procesados
-        if archivos_procesados:
+        # registrar todos los archivos con un único INSERT
+        if filas:
             try:
+                archivos_procesados = insertar_archivos(filas)
+                archivos_subidos = len(archivos_procesados)
                 db.session.commit()
                 print(f"✅ {archivos_subidos} archivo(s) registrado(s) en la base de datos")
             except Exception as e_commit:
@@ -3710,19 +3435,14 @@ def subir_archivo_rapido():
                 print(f"❌ ERROR al hacer commit de archivos: {e_commit}")
                 import traceback
                 traceback.print_exc()
-                archivos_fallidos += len(archivos_procesados)
+                archivos_fallidos += len(filas)
                 archivos_subidos = 0
                 archivos_procesados = []
         
         print(f"📊 Resumen subida rápida: {archivos_subidos} exitoso(s), {archivos_fallidos} fallido(s) de {len(archivos)} total")
 
-        # invalidar caché de estructuras si aplica
-        try:
-            uid = getattr(usuario, "id", None)
-            if uid in _estructuras_cache:
-                _estructuras_cache.pop(uid, None)
-        except Exception:
-            pass
+        # invalidar caché de estructuras (en todos los workers)
+        invalidar_estructuras(usuarios=[getattr(usuario, "id", None)], rutas=[carpeta_destino_completa])
 
         # Registrar actividad y enviar notificaciones
         if archivos_subidos > 0:
@@ -3973,6 +3693,7 @@ def eliminar_archivo():
         print(f"DEBUG | Archivo mantenido en Dropbox: {archivo_path}")
         
         # Registrar actividad
+        invalidar_estructuras(usuarios=[usuario_id_int], rutas=[archivo_bd.dropbox_path])
         current_user.registrar_actividad('file_hidden', f'Archivo "{archivo_nombre}" ocultado de la interfaz')
         
         
@@ -4129,6 +3850,7 @@ def renombrar_carpeta():
             db.session.commit()
             
             # Registrar actividad
+            invalidar_estructuras(usuarios=[usuario_id], rutas=[c.dropbox_path for c in carpetas_hijas])
             current_user.registrar_actividad('folder_renamed', f'Carpeta virtual "{carpeta_nombre_actual}" renombrada a "{nuevo_nombre}"')
             
             print(f"DEBUG | Carpeta virtual renombrada exitosamente: {carpeta_nombre_actual} -> {nuevo_nombre}")
@@ -4170,6 +3892,7 @@ def renombrar_carpeta():
     db.session.commit()
 
     # Registrar actividad
+    invalidar_estructuras(usuarios=[usuario_id], rutas=[old_path, new_path])
     current_user.registrar_actividad('folder_renamed', f'Carpeta renombrada de "{carpeta_nombre_actual}" a "{nuevo_nombre}"')
 
     print(f"DEBUG | Carpeta renombrada exitosamente: {old_path} -> {new_path}")
@@ -4308,6 +4031,7 @@ def ocultar_carpeta():
         print(f"DEBUG | Carpeta mantenida en Dropbox: {carpeta_path}")
         
         # Registrar actividad
+        invalidar_estructuras(usuarios=[usuario_id_int], rutas=[carpeta_path])
         current_user.registrar_actividad('folder_hidden', f'Carpeta "{carpeta_nombre}" ocultada de la interfaz')
         
     except Exception as e:
@@ -4371,7 +4095,10 @@ def eliminar_carpeta():
         
         # Eliminar registros de la base de datos
         # Primero eliminar archivos que estén en esta carpeta
-        archivos_eliminados = Archivo.query.filter(Archivo.dropbox_path.like(f"{carpeta_path}/%")).delete()
+        from app.utils.notification_utils import desvincular_archivos
+        archivo_ids = [a.id for a in Archivo.query.with_entities(Archivo.id).filter(filtro_prefijo_ruta(Archivo.dropbox_path, carpeta_path))]
+        desvincular_archivos(db.session.connection(), archivo_ids, db.session)
+        archivos_eliminados = Archivo.query.filter(filtro_prefijo_ruta(Archivo.dropbox_path, carpeta_path)).delete(synchronize_session=False)
         print(f"DEBUG | Archivos eliminados de BD: {archivos_eliminados}")
         
         # Luego eliminar la carpeta
@@ -4383,6 +4110,7 @@ def eliminar_carpeta():
         db.session.commit()
         
         # Registrar actividad
+        invalidar_estructuras(rutas=[carpeta_path])
         current_user.registrar_actividad('folder_deleted', f'Carpeta "{carpeta_nombre}" eliminada')
         
         flash("Carpeta eliminada correctamente.", "success")
@@ -4402,6 +4130,7 @@ def eliminar_carpeta():
 def buscar_archivos_avanzada():
     """Búsqueda avanzada de archivos con múltiples filtros"""
     from app.models import Archivo, User, Beneficiario
+    from app.utils.file_search import buscar_archivos
     
     if request.method == "GET":
         # Obtener datos para los filtros
@@ -4429,97 +4158,73 @@ def buscar_archivos_avanzada():
         extension = request.form.get("extension", "")
         tamano_min = request.form.get("tamano_min", "")
         tamano_max = request.form.get("tamano_max", "")
+        cursor = request.form.get("cursor", "")
+        limite = request.form.get("limite", type=int)
         
-        # Construir consulta base
-        consulta = Archivo.query
-        
-        # Filtros
-        if query:
-            consulta = consulta.filter(
-                db.or_(
-                    Archivo.nombre.ilike(f"%{query}%"),
-                    Archivo.descripcion.ilike(f"%{query}%"),
-                    Archivo.categoria.ilike(f"%{query}%"),
-                    Archivo.subcategoria.ilike(f"%{query}%")
-                )
-            )
+        # Filtros (el texto se busca en el índice, app/utils/file_search.py)
+        condiciones = []
         
         if usuario_id:
             if usuario_id.startswith("user-"):
                 real_id = int(usuario_id[5:])
-                consulta = consulta.filter(Archivo.usuario_id == real_id)
+                condiciones.append(Archivo.usuario_id == real_id)
             elif usuario_id.startswith("beneficiario-"):
                 # Para beneficiarios, buscar por el titular
                 real_id = int(usuario_id[13:])
-                beneficiario = Beneficiario.query.get(real_id)
+                beneficiario = db.session.get(Beneficiario, real_id)
                 if beneficiario and beneficiario.titular_id:
-                    consulta = consulta.filter(Archivo.usuario_id == beneficiario.titular_id)
+                    condiciones.append(Archivo.usuario_id == beneficiario.titular_id)
         
         if categoria:
-            consulta = consulta.filter(Archivo.categoria == categoria)
+            condiciones.append(Archivo.categoria == categoria)
         
         if subcategoria:
-            consulta = consulta.filter(Archivo.subcategoria == subcategoria)
+            condiciones.append(Archivo.subcategoria == subcategoria)
         
         if fecha_desde:
             try:
                 fecha_desde_obj = datetime.strptime(fecha_desde, "%Y-%m-%d")
-                consulta = consulta.filter(Archivo.fecha_subida >= fecha_desde_obj)
+                condiciones.append(Archivo.fecha_subida >= fecha_desde_obj)
             except ValueError:
                 pass
         
         if fecha_hasta:
             try:
                 fecha_hasta_obj = datetime.strptime(fecha_hasta, "%Y-%m-%d")
-                consulta = consulta.filter(Archivo.fecha_subida <= fecha_hasta_obj)
+                condiciones.append(Archivo.fecha_subida <= fecha_hasta_obj)
             except ValueError:
                 pass
         
         if extension:
-            consulta = consulta.filter(Archivo.nombre.ilike(f"%.{extension}"))
+            condiciones.append(Archivo.extension == extension.lower().lstrip('.'))
         
         if tamano_min:
             try:
                 tamano_min_bytes = int(tamano_min) * 1024 * 1024  # Convertir MB a bytes
-                consulta = consulta.filter(Archivo.tamano >= tamano_min_bytes)
+                condiciones.append(Archivo.tamano >= tamano_min_bytes)
             except ValueError:
                 pass
         
         if tamano_max:
             try:
                 tamano_max_bytes = int(tamano_max) * 1024 * 1024  # Convertir MB a bytes
-                consulta = consulta.filter(Archivo.tamano <= tamano_max_bytes)
+                condiciones.append(Archivo.tamano <= tamano_max_bytes)
             except ValueError:
                 pass
         
-        # Ejecutar consulta
-        archivos = consulta.order_by(Archivo.fecha_subida.desc()).all()
-        
-        # Preparar resultados
-        resultados = []
-        for archivo in archivos:
-            usuario = User.query.get(archivo.usuario_id) if archivo.usuario_id else None
-            resultados.append({
-                'id': archivo.id,
-                'nombre': archivo.nombre,
-                'categoria': archivo.categoria,
-                'subcategoria': archivo.subcategoria,
-                'dropbox_path': archivo.dropbox_path,
-                'fecha_subida': archivo.fecha_subida.strftime("%d/%m/%Y %H:%M") if archivo.fecha_subida else "",
-                'tamano': archivo.tamano,
-                'extension': archivo.extension,
-                'descripcion': archivo.descripcion,
-                'usuario': usuario.nombre_completo if usuario else "Sin usuario",
-                'usuario_email': usuario.email if usuario else ""
-            })
+        busqueda = buscar_archivos(query, condiciones, limite=limite, cursor=cursor)
+        resultados = busqueda['resultados']
         
-        # Registrar actividad
-        current_user.registrar_actividad('advanced_search', f'Búsqueda avanzada realizada con {len(resultados)} resultados')
+        # Registrar actividad (solo la primera página)
+        if busqueda['total'] is not None:
+            current_user.registrar_actividad('advanced_search', f'Búsqueda avanzada realizada con {busqueda["total"]} resultados')
         
         return jsonify({
             'success': True,
             'resultados': resultados,
-            'total': len(resultados)
+            'total': busqueda['total'],
+            'facetas': busqueda['facetas'],
+            'siguiente': busqueda['siguiente'],
         })
         
     except Exception as e:
@@ -4533,13 +4238,10 @@ def buscar_archivos_avanzada():
 @login_required
 def obtener_notificaciones():
     """Obtiene las notificaciones del usuario actual"""
-    from app.models import Notification
+    from app.utils.notification_feed import lector, obtener_feed
     
-    # Obtener notificaciones no leídas
-    notificaciones = Notification.query.filter_by(
-        user_id=current_user.id,
-        leida=False
-    ).order_by(Notification.fecha_creacion.desc()).limit(10).all()
+    # Obtener notificaciones no leídas (propias y difundidas a su rol)
+    notificaciones = obtener_feed(lector(current_user.id), 10, solo_no_leidas=True)
     
     # Preparar datos para JSON
     datos = []
@@ -4559,20 +4261,15 @@ def obtener_notificaciones():
         'total': len(datos)
     })
 
-@bp.route("/notificaciones/marcar_leida/<int:notif_id>", methods=["POST"])
+@bp.route("/notificaciones/marcar_leida/<notif_id>", methods=["POST"])
 @login_required
 def marcar_notificacion_leida(notif_id):
-    """Marca una notificación como leída"""
-    from app.models import Notification
-    
-    notificacion = Notification.query.filter_by(
-        id=notif_id,
-        user_id=current_user.id
-    ).first()
+    """Marca una notificación como leída (``d<id>`` para las difundidas)"""
+    from app.utils import notification_utils
     
-    if notificacion:
-        notificacion.marcar_como_leida()
-        db.session.commit()
+    if notif_id.isdigit():
+        notif_id = int(notif_id)
+    if notification_utils.marcar_notificacion_leida(notif_id, current_user.id):
         return jsonify({'success': True})
     
     return jsonify({'success': False, 'error': 'Notificación no encontrada'}), 404
@@ -4581,19 +4278,9 @@ def marcar_notificacion_leida(notif_id):
 @login_required
 def marcar_todas_notificaciones_leidas():
     """Marca todas las notificaciones del usuario como leídas"""
-    from app.models import Notification
-    
-    notificaciones = Notification.query.filter_by(
-        user_id=current_user.id,
-        leida=False
-    ).all()
+    from app.utils.notification_utils import marcar_todas_notificaciones_leidas
     
-    for notif in notificaciones:
-        notif.marcar_como_leida()
-    
-    db.session.commit()
-    
-    return jsonify({'success': True})
+    return jsonify({'success': marcar_todas_notificaciones_leidas(current_user.id)})
 
 def crear_notificacion(usuario_id, titulo, mensaje, tipo='info'):
     """Función helper para crear notificaciones"""
@@ -6,15 +6,20 @@ from werkzeug.security import check_password_hash
 
 from app import db
 from app.models import User, Folder, Archivo, UserActivityLog, Notification, Beneficiario, SystemSettings
+from app.activity_retention import historial_actividad
 from forms import ProfileForm
 from app.routes.auth import role_required
 from app.utils.dashboard_stats import (
     get_dashboard_stats, get_charts_data, get_file_types_stats, 
-    get_recent_files_with_users, get_recent_activity
+    get_recent_files_with_users, get_recent_files_page, get_recent_activity,
+    iter_recent_files, RECENT_FILES_CSV_COLUMNS
 )
+from app.utils.streaming_export import FORMATOS, respuesta_streaming
+from app.utils import notification_utils
+from app.utils.notification_feed import lector, obtener_feed, paginar_feed
 from app.utils.notification_utils import (
     obtener_notificaciones_no_leidas, contar_notificaciones_no_leidas,
-    marcar_notificacion_leida, marcar_todas_notificaciones_leidas
+    marcar_todas_notificaciones_leidas
 )
 
 bp = Blueprint('main', __name__)
@@ -140,162 +145,119 @@ def dashboard_admin():
         flash('No tienes permisos para acceder a esta página.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    # Registrar actividad de acceso al dashboard de admin
-    current_user.registrar_actividad('dashboard_admin_access', 'Acceso al dashboard de administrador')
-    
-    # Estadísticas del sistema
-    stats = {
-        'total_usuarios': User.query.count(),
-        'total_archivos': Archivo.query.count(),
-        'total_carpetas': Folder.query.count(),
-        'usuarios_activos': User.query.filter_by(activo=True).count(),
-        'usuarios_inactivos': User.query.filter_by(activo=False).count(),
-        'clientes': User.query.filter_by(rol='cliente').count(),
-        'admins': User.query.filter_by(rol='admin').count(),
-        'superadmins': User.query.filter_by(rol='superadmin').count(),
-        'lectores': User.query.filter_by(rol='lector').count()
-    }
-    
     # Obtener el período seleccionado (por defecto 'month') y si se debe mostrar todo el historial
     period = request.args.get('period', 'month')
     show_all = request.args.get('show_all', '0') in ['1', 'true', 'True']
     selected_period = period
     
-    # Generar todas las estadísticas
-    stats = get_dashboard_stats(period)
-    charts_data = get_charts_data()
+    # Estadísticas, gráficos y tipos de archivo del período (cacheados, ver
+    # app/utils/dashboard_snapshot.py)
+    from app.utils.dashboard_snapshot import obtener_snapshot
+    snapshot = obtener_snapshot(period)
     
-    # Tipos de archivo - general (todos los tiempos)
-    file_types_general = get_file_types_stats()
+    # Si es una petición AJAX, devolver solo los datos que necesita JavaScript
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({
+            'stats': snapshot['stats'],
+            'file_types_recent': snapshot['file_types_recent'],
+            'charts_data': snapshot['charts_data']
+        })
     
-    # Tipos de archivo - para el período seleccionado
-    from app.utils.dashboard_stats import calculate_period_dates
-    start_date, end_date = calculate_period_dates(period)
-    file_types_recent_initial = get_file_types_stats(start_date, end_date)
+    # Registrar actividad de acceso al dashboard de admin (solo la vista completa)
+    current_user.registrar_actividad('dashboard_admin_access', 'Acceso al dashboard de administrador')
     
-    # Archivos recientes con usuarios (soportar mostrar todo)
-    recent_files = get_recent_files_with_users(None if show_all else 10)
+    # Archivos recientes con usuarios; "mostrar todo" pagina por cursor
+    next_cursor = None
+    if show_all:
+        recent_files, next_cursor = get_recent_files_page(request.args.get('cursor') or None, 50)
+    else:
+        recent_files = get_recent_files_with_users(10)
     
     # Actividad reciente del sistema
     recent_activity = get_recent_activity(15)
     
-    # Distribución real de usuarios por rol
-    usuarios_por_rol = db.session.query(
-        User.rol, 
-        db.func.count(User.id).label('cantidad')
-    ).group_by(User.rol).all()
-    
-    distribucion_roles = {
-        'superadmin': 0,
-        'admin': 0,
-        'cliente': 0,
-        'lector': 0
-    }
-    
-    for rol, cantidad in usuarios_por_rol:
-        if rol in distribucion_roles:
-            distribucion_roles[rol] = cantidad
-    
-    # Usuarios más activos
-    usuarios_activos_raw = db.session.query(
-        User.id,
-        User.nombre,
-        User.apellido,
-        User.email,
-        db.func.count(UserActivityLog.id).label('actividades')
-    ).join(UserActivityLog)\
-     .group_by(User.id, User.nombre, User.apellido, User.email)\
-     .order_by(db.desc('actividades'))\
-     .limit(5).all()
-    
-    usuarios_activos = []
-    for resultado in usuarios_activos_raw:
-        usuario_data = {
-            'nombre_completo': f"{resultado.nombre} {resultado.apellido}" if resultado.nombre and resultado.apellido else resultado.email.split('@')[0],
-            'email': resultado.email,
-            'actividades': resultado.actividades
-        }
-        usuarios_activos.append(type('obj', (object,), usuario_data)())
-    
-    # Registrar actividad de acceso al dashboard admin
-    current_user.registrar_actividad('admin_dashboard_access', 'Acceso al dashboard administrativo')
-    
-    # Si es una petición AJAX, devolver solo los datos que necesita JavaScript
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return jsonify({
-            'stats': stats,
-            'file_types_recent': file_types_recent_initial,
-            'charts_data': charts_data
-        })
+    usuarios_activos = [type('obj', (object,), u)() for u in snapshot['usuarios_activos']]
     
     # Para peticiones normales, renderizar el template completo
     return render_template('dashboard/admin.html',
-                         stats=stats,
-                         charts_data=charts_data,
-                         file_types_general=file_types_general,
-                         file_types_recent_initial=file_types_recent_initial,
+                         stats=snapshot['stats'],
+                         charts_data=snapshot['charts_data'],
+                         file_types_general=snapshot['file_types_general'],
+                         file_types_recent_initial=snapshot['file_types_recent'],
                          recent_files=recent_files,
                          recent_activity=recent_activity,
-                         distribucion_roles=distribucion_roles,
+                         distribucion_roles=snapshot['distribucion_roles'],
                          usuarios_activos=usuarios_activos,
                          selected_period=selected_period,
-                         show_all=show_all)
+                         show_all=show_all,
+                         next_cursor=next_cursor)
+
+
+def _recent_file_json(archivo, usuario):
+    return {
+        'id': archivo.id,
+        'nombre': archivo.nombre,
+        'extension': getattr(archivo, 'extension', None),
+        'tamano': getattr(archivo, 'tamano', None),
+        'fecha_subida': archivo.fecha_subida.isoformat() if getattr(archivo, 'fecha_subida', None) else None,
+        'estado': getattr(archivo, 'estado', None),
+        'dropbox_path': getattr(archivo, 'dropbox_path', None),
+        'categoria': getattr(archivo, 'categoria', None),
+        'subcategoria': getattr(archivo, 'subcategoria', None),
+        'descripcion': getattr(archivo, 'descripcion', None),
+        'usuario': {
+            'id': usuario.id,
+            'username': getattr(usuario, 'username', None),
+            'email': getattr(usuario, 'email', None),
+            'nombre': getattr(usuario, 'nombre', None),
+            'apellido': getattr(usuario, 'apellido', None)
+        }
+    }
 
 
 @bp.route('/api/recent-files')
 @login_required
 def api_recent_files():
     """Devuelve en JSON el historial de archivos recientes con datos del usuario.
-    Acepta 'limit' (int) o 'all=1' para traer todo.
+    Acepta 'page'/'per_page', 'cursor' (paginación keyset; vacío para la
+    primera página) o 'all=1' para exportar todo por streaming
+    ('format=ndjson' por defecto, o 'format=csv').
     """
     try:
         all_param = request.args.get('all', '0') in ['1', 'true', 'True']
         if all_param:
-            # Modo "traer todo"
-            recent_files = get_recent_files_with_users(None)
-            total_records = db.session.query(func.count(Archivo.id)).scalar() or 0
-            files_data = []
-            for archivo, usuario in recent_files:
-                files_data.append({
-                    'id': archivo.id,
-                    'nombre': archivo.nombre,
-                    'extension': getattr(archivo, 'extension', None),
-                    'tamano': getattr(archivo, 'tamano', None),
-                    'fecha_subida': archivo.fecha_subida.isoformat() if getattr(archivo, 'fecha_subida', None) else None,
-                    'estado': getattr(archivo, 'estado', None),
-                    'dropbox_path': getattr(archivo, 'dropbox_path', None),
-                    'categoria': getattr(archivo, 'categoria', None),
-                    'subcategoria': getattr(archivo, 'subcategoria', None),
-                    'descripcion': getattr(archivo, 'descripcion', None),
-                    'usuario': {
-                        'id': usuario.id,
-                        'username': getattr(usuario, 'username', None),
-                        'email': getattr(usuario, 'email', None),
-                        'nombre': getattr(usuario, 'nombre', None),
-                        'apellido': getattr(usuario, 'apellido', None)
-                    }
-                })
+            # Exportación completa: NDJSON/CSV emitido mientras se lee la consulta
+            formato = (request.args.get('format') or 'ndjson').lower()
+            if formato not in FORMATOS:
+                return jsonify({'success': False, 'error': f'Formato no soportado: {formato}'}), 400
+            return respuesta_streaming(iter_recent_files(), formato, 'archivos_recientes', RECENT_FILES_CSV_COLUMNS)
+
+        per_page = request.args.get('per_page', 10, type=int) or 10
+        if per_page < 1:
+            per_page = 10
+        if per_page > 100:
+            per_page = 100
+
+        if 'cursor' in request.args:
+            # Paginación keyset: el total solo se calcula en la primera página
+            cursor = request.args.get('cursor') or None
+            recent_files, siguiente = get_recent_files_page(cursor, per_page)
+            files_data = [_recent_file_json(archivo, usuario) for archivo, usuario in recent_files]
+            total_records = None
+            if cursor is None:
+                total_records = db.session.query(func.count(Archivo.id)).join(
+                    User, Archivo.usuario_id == User.id
+                ).scalar() or 0
             return jsonify({
                 'success': True,
                 'count': len(files_data),
                 'files': files_data,
-                'pagination': {
-                    'page': 1,
-                    'per_page': len(files_data) or total_records,
-                    'total': total_records,
-                    'pages': 1,
-                    'has_prev': False,
-                    'has_next': False
-                }
+                'next_cursor': siguiente,
+                'total': total_records
             })
 
         # Paginación
         page = request.args.get('page', 1, type=int) or 1
-        per_page = request.args.get('per_page', 10, type=int) or 10
-        if per_page < 1:
-            per_page = 10
-        if per_page > 100:
-            per_page = 100
         offset = (page - 1) * per_page
 
         base_query = db.session.query(Archivo, User).join(
@@ -305,27 +267,7 @@ def api_recent_files():
         total_records = db.session.query(func.count(Archivo.id)).scalar() or 0
         recent_files = base_query.offset(offset).limit(per_page).all()
 
-        files_data = []
-        for archivo, usuario in recent_files:
-            files_data.append({
-                'id': archivo.id,
-                'nombre': archivo.nombre,
-                'extension': getattr(archivo, 'extension', None),
-                'tamano': getattr(archivo, 'tamano', None),
-                'fecha_subida': archivo.fecha_subida.isoformat() if getattr(archivo, 'fecha_subida', None) else None,
-                'estado': getattr(archivo, 'estado', None),
-                'dropbox_path': getattr(archivo, 'dropbox_path', None),
-                'categoria': getattr(archivo, 'categoria', None),
-                'subcategoria': getattr(archivo, 'subcategoria', None),
-                'descripcion': getattr(archivo, 'descripcion', None),
-                'usuario': {
-                    'id': usuario.id,
-                    'username': getattr(usuario, 'username', None),
-                    'email': getattr(usuario, 'email', None),
-                    'nombre': getattr(usuario, 'nombre', None),
-                    'apellido': getattr(usuario, 'apellido', None)
-                }
-            })
+        files_data = [_recent_file_json(archivo, usuario) for archivo, usuario in recent_files]
 
         total_pages = (total_records + per_page - 1) // per_page if per_page else 1
 
@@ -817,15 +759,7 @@ def marcar_notificacion_leida(notif_id):
 @login_required
 def api_notificaciones_no_leidas():
     """API para obtener el número de notificaciones no leídas"""
-
-    # Solo "Pendiente para revisión" debe quedar como pendiente: auto-marcar el resto.
-    try:
-        from app.utils.notification_utils import marcar_notificaciones_archivos_fuera_de_revision_como_leidas
-        marcar_notificaciones_archivos_fuera_de_revision_como_leidas(current_user.id)
-    except Exception:
-        pass
-
-    count = Notification.query.filter_by(user_id=current_user.id, leida=False).count()
+    count = contar_notificaciones_no_leidas(current_user.id)
     return jsonify({'count': count}) 
 
 @bp.route('/admin/carpetas')
@@ -870,9 +804,7 @@ def api_usuario_historial(usuario_id):
             return jsonify({'error': 'Acceso denegado'}), 403
         
         # Obtener actividades del usuario
-        actividades = UserActivityLog.query.filter_by(user_id=usuario_id)\
-            .order_by(desc(UserActivityLog.fecha))\
-            .limit(50).all()
+        actividades = historial_actividad(usuario_id, limit=50)
         
         # Mapeo de códigos de acción a etiquetas en español
         accion_labels = {
@@ -1398,12 +1330,16 @@ def refresh_dropbox_token():
 def validate_dropbox_config():
     """API endpoint para validar configuración de Dropbox"""
     from app.dropbox_token_manager import validate_dropbox_tokens
+    from app.dropbox_client_pool import get_client_pool_stats
+    from app.structure_cache import get_structure_cache
     
     try:
         validation_status = validate_dropbox_tokens()
         return jsonify({
             "success": True,
-            "validation": validation_status
+            "validation": validation_status,
+            "client_pool": get_client_pool_stats(),
+            "structure_cache": get_structure_cache().stats()
         })
     except Exception as e:
         logger.error(f"Error validando configuración: {e}")
@@ -1455,9 +1391,9 @@ def dropbox_webhook():
             
             # Procesar el webhook usando las funciones de utilidad
             from app.dropbox_utils import process_dropbox_webhook
-            success = process_dropbox_webhook(data)
+            result = process_dropbox_webhook(data)
             
-            if success:
+            if result.get('status') == 'ok':
                 print("Webhook procesado exitosamente")
                 return "OK", 200
             else:
@@ -1570,21 +1506,14 @@ def obtener_ultimas_notificaciones():
     Si no se provee paginación, respeta "limit" para compatibilidad.
     """
     try:
-        from app.models import Notification
-        from app.utils.notification_utils import marcar_notificaciones_archivos_fuera_de_revision_como_leidas
-
-        # Solo "Pendiente para revisión" debe quedar como pendiente.
-        marcar_notificaciones_archivos_fuera_de_revision_como_leidas(current_user.id)
-
-        q = Notification.query \
-            .filter_by(user_id=current_user.id) \
-            .order_by(Notification.fecha_creacion.desc())
+        # Feed combinado: notificaciones propias y difundidas a su rol
+        usuario = lector(current_user.id)
 
         # Soporta page/per_page. Si no vienen, usa "limit" como compatibilidad.
         page = request.args.get('page', type=int)
         per_page = request.args.get('per_page', type=int)
         if page and per_page:
-            pagination = q.paginate(page=page, per_page=per_page, error_out=False)
+            pagination = paginar_feed(usuario, page, per_page)
             items = pagination.items
             total = pagination.total
             meta = {
@@ -1602,7 +1531,7 @@ def obtener_ultimas_notificaciones():
                 limit = int(request.args.get('limit', '5'))
             except Exception:
                 limit = 5
-            items = q.limit(limit).all()
+            items = obtener_feed(usuario, limit)
             total = len(items)
             meta = {
                 'page': 1,
@@ -1648,8 +1577,6 @@ def obtener_ultimas_notificaciones():
 @login_required
 def ver_notificaciones():
     """Página con el historial completo de notificaciones del usuario actual (paginado)."""
-    from app.models import Notification
-    from app.utils.notification_utils import marcar_notificaciones_archivos_fuera_de_revision_como_leidas
     try:
         page = int(request.args.get('page', '1'))
     except Exception:
@@ -1657,11 +1584,7 @@ def ver_notificaciones():
     # Mostrar 10 notificaciones por página
     per_page = 10
 
-    # Solo "Pendiente para revisión" debe quedar como pendiente.
-    marcar_notificaciones_archivos_fuera_de_revision_como_leidas(current_user.id)
-
-    q = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.fecha_creacion.desc())
-    pagination = q.paginate(page=page, per_page=per_page, error_out=False)
+    pagination = paginar_feed(lector(current_user.id), page, per_page)
 
     return render_template(
         'notificaciones.html',
@@ -1695,12 +1618,14 @@ def contar_notificaciones():
         return response, 500
 
 
-@bp.route('/api/notificaciones/<int:notif_id>/marcar_leida', methods=['POST'])
+@bp.route('/api/notificaciones/<notif_id>/marcar_leida', methods=['POST'])
 @login_required
 def marcar_notif_leida(notif_id):
-    """Marca una notificación específica como leída"""
+    """Marca una notificación específica como leída (``d<id>`` para las difundidas)"""
     try:
-        success = marcar_notificacion_leida(notif_id, current_user.id)
+        if notif_id.isdigit():
+            notif_id = int(notif_id)
+        success = notification_utils.marcar_notificacion_leida(notif_id, current_user.id)
         
         if success:
             return jsonify({
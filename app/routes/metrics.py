@@ -0,0 +1,28 @@
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from app import dropbox_metrics
+
+bp = Blueprint('metrics', __name__)
+
+
+@bp.route('/metrics')
+def metrics():
+    """Métricas de la API de Dropbox para Prometheus (ver app/dropbox_metrics.py).
+
+    Exige ``Authorization: Bearer <METRICS_TOKEN>``. Sin ``METRICS_TOKEN``
+    configurado se rechaza (403) salvo que ``METRICS_ALLOW_ANONYMOUS`` lo
+    permita explícitamente.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        enviado = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(enviado.encode(), f'Bearer {token}'.encode()):
+            abort(401)
+    elif not current_app.config.get('METRICS_ALLOW_ANONYMOUS'):
+        abort(403)
+    if not dropbox_metrics.habilitadas():
+        return Response("prometheus_client no está instalado\n", status=503, mimetype='text/plain')
+    cuerpo, content_type = dropbox_metrics.exponer()
+    return Response(cuerpo, content_type=content_type)
@@ -0,0 +1,80 @@
+from flask import Blueprint, flash, jsonify, redirect, request, url_for
+from flask_login import current_user, login_required
+
+from app import db, job_runner
+from app.models import Trabajo
+
+bp = Blueprint('trabajos', __name__)
+
+ROLES_ADMIN = ('admin', 'superadmin')
+
+
+def _es_admin():
+    return getattr(current_user, 'rol', None) in ROLES_ADMIN
+
+
+def responder_encolado(trabajo, nuevo, mensaje, volver):
+    """
+    Respuesta de las rutas que encolan un trabajo: 202 con su id y la URL de
+    estado para AJAX; si no, flash y redirección a ``volver``.
+    """
+    estado_url = url_for('trabajos.estado', trabajo_id=trabajo.id)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({
+            'success': True,
+            'trabajo_id': trabajo.id,
+            'nuevo': nuevo,
+            'estado': trabajo.estado,
+            'estado_url': estado_url,
+        }), 202
+    if nuevo:
+        flash(f"{mensaje} Se ejecuta en segundo plano (#{trabajo.id}).", "info")
+    else:
+        flash(f"Ya hay un trabajo igual en curso (#{trabajo.id}).", "warning")
+    return redirect(volver)
+
+
+def _trabajo_visible(trabajo_id):
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    if trabajo is None:
+        return None, (jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404)
+    if trabajo.usuario_id != current_user.id and not _es_admin():
+        return None, (jsonify({'success': False, 'error': 'Sin permisos'}), 403)
+    return trabajo, None
+
+
+@bp.route('/trabajos')
+@login_required
+def lista():
+    """Últimos trabajos del usuario (todos, para administradores)."""
+    consulta = Trabajo.query
+    if not _es_admin():
+        consulta = consulta.filter(Trabajo.usuario_id == current_user.id)
+    if request.args.get('estado'):
+        consulta = consulta.filter(Trabajo.estado == request.args['estado'])
+    limite = min(request.args.get('limite', 50, type=int) or 50, 200)
+    trabajos = consulta.order_by(Trabajo.id.desc()).limit(limite).all()
+    return jsonify({'success': True, 'trabajos': [job_runner.progreso(t) for t in trabajos]})
+
+
+@bp.route('/trabajos/<int:trabajo_id>')
+@login_required
+def estado(trabajo_id):
+    """Estado y progreso de un trabajo en segundo plano (ver app/job_runner.py)."""
+    trabajo, error = _trabajo_visible(trabajo_id)
+    if error:
+        return error
+    return jsonify({'success': True, **job_runner.progreso(trabajo)})
+
+
+@bp.route('/trabajos/<int:trabajo_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar(trabajo_id):
+    """Cancela un trabajo pendiente o pide detener uno en ejecución."""
+    trabajo, error = _trabajo_visible(trabajo_id)
+    if error:
+        return error
+    if not job_runner.cancelar(trabajo):
+        return jsonify({'success': False, 'error': f'El trabajo ya terminó ({trabajo.estado})',
+                        **job_runner.progreso(trabajo)}), 409
+    return jsonify({'success': True, **job_runner.progreso(trabajo)})
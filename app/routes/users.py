@@ -2,7 +2,12 @@ from flask import Blueprint, redirect, render_template, request, jsonify, curren
 from flask_login import login_required, current_user
 from app import db
 from sqlalchemy import or_
-from app.models import Beneficiario, User, UserActivityLog, Archivo, Folder
+from app.models import (
+    Beneficiario, User, UserActivityLog, Archivo, Folder, ResumenActividad,
+    Notification, NotificacionDifundida, NotificacionDifundidaLeida, NotificacionSaliente,
+)
+from app.utils.notification_utils import desvincular_archivos
+from app.activity_retention import historial_actividad
 from app.dropbox_utils import create_dropbox_folder
 from app.routes.listar_dropbox import obtener_estructura_dropbox
 import dropbox
@@ -611,10 +616,7 @@ def get_user_history(user_id):
         }
         
         # Obtener actividades
-        activities = UserActivityLog.query.filter_by(user_id=user_id)\
-            .order_by(UserActivityLog.fecha.desc())\
-            .limit(50)\
-            .all()
+        activities = historial_actividad(user_id, limit=50)
         
         history = []
         
@@ -825,7 +827,10 @@ def delete_user(user_id):
         
         # Eliminar archivos y carpetas asociadas
         if archivos_count > 0:
-            Archivo.query.filter_by(usuario_id=user_id).delete()
+            # Las notificaciones sobre estos archivos dejan de estar pendientes
+            archivo_ids = [a.id for a in Archivo.query.with_entities(Archivo.id).filter_by(usuario_id=user_id)]
+            desvincular_archivos(db.session.connection(), archivo_ids, db.session)
+            Archivo.query.filter_by(usuario_id=user_id).delete(synchronize_session=False)
         
         if carpetas_count > 0:
             Folder.query.filter_by(user_id=user_id).delete()
@@ -835,8 +840,13 @@ def delete_user(user_id):
         if beneficiarios_count > 0:
             Beneficiario.query.filter_by(titular_id=user_id).delete()
         
-        # Eliminar actividades del usuario
+        # Eliminar actividades y notificaciones del usuario
         UserActivityLog.query.filter_by(user_id=user_id).delete()
+        ResumenActividad.query.filter_by(user_id=user_id).delete()
+        Notification.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        NotificacionDifundidaLeida.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        NotificacionDifundida.query.filter_by(autor_id=user_id).update({'autor_id': None}, synchronize_session=False)
+        NotificacionSaliente.query.filter_by(usuario_id=user_id).update({'usuario_id': None}, synchronize_session=False)
         
         # Eliminar el usuario
         db.session.delete(user)
@@ -1,9 +1,11 @@
 from app.dropbox_utils import get_dbx, with_base_folder
+from app.structure_cache import invalidar_estructuras
 # routes/usuarios.py
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
-from app.models import User, Folder, Archivo, UserActivityLog, Beneficiario, FolderPermiso
+from app.models import User, Folder, Archivo, Beneficiario, FolderPermiso
+from app.activity_retention import historial_actividad
 from app import db
 from sqlalchemy import or_
 import dropbox
@@ -119,10 +121,7 @@ def ver_historial_usuario(usuario_id):
     usuario = User.query.get_or_404(usuario_id)
     
     # Obtener actividades del usuario
-    actividades = UserActivityLog.query.filter_by(user_id=usuario_id)\
-        .order_by(UserActivityLog.fecha.desc())\
-        .limit(50)\
-        .all()
+    actividades = historial_actividad(usuario_id, limit=50)
     
     # Obtener archivos del usuario
     archivos = Archivo.query.filter_by(usuario_id=usuario_id)\
@@ -163,10 +162,7 @@ def obtener_historial_usuario_json(usuario_id):
     usuario = User.query.get_or_404(usuario_id)
     
     # Obtener actividades del usuario
-    actividades = UserActivityLog.query.filter_by(user_id=usuario_id)\
-        .order_by(UserActivityLog.fecha.desc())\
-        .limit(50)\
-        .all()
+    actividades = historial_actividad(usuario_id, limit=50)
     
     # Obtener archivos del usuario
     archivos = Archivo.query.filter_by(usuario_id=usuario_id)\
@@ -257,10 +253,7 @@ def api_historial_para_lectores(usuario_id):
         return jsonify({'error': 'Solo puedes ver historial de clientes'}), 403
 
     # Actividades (limitadas)
-    actividades = UserActivityLog.query.filter_by(user_id=usuario_id) \
-        .order_by(UserActivityLog.fecha.desc()) \
-        .limit(50) \
-        .all()
+    actividades = historial_actividad(usuario_id, limit=50)
 
     # Mapeo de acciones a etiquetas en español
     accion_labels = {
@@ -455,12 +448,10 @@ def importar_archivo_usuario(usuario_id):
         from flask import current_app
         dbx = get_dbx()
         
-        # Leer archivo
-        archivo_content = archivo.read()
-        
-        # Subir a Dropbox
+        # Subir a Dropbox por bloques desde el stream (memoria acotada)
+        from app.dropbox_upload import upload_stream
         dropbox_path = f"{carpeta.dropbox_path}/{archivo.filename}"
-        dbx.files_upload(archivo_content, with_base_folder(dropbox_path), mode=dropbox.files.WriteMode("overwrite"))
+        upload_stream(dbx, archivo.stream, with_base_folder(dropbox_path), mode=dropbox.files.WriteMode("overwrite"))
         
         # Guardar en base de datos
         nuevo_archivo = Archivo(
@@ -473,15 +464,14 @@ def importar_archivo_usuario(usuario_id):
         )
         db.session.add(nuevo_archivo)
         
+        db.session.commit()
+        
         # Registrar actividad
-        actividad = UserActivityLog(
-            user_id=current_user.id,
-            accion="importar_archivo",
-            descripcion=f"Importó archivo '{archivo.filename}' para usuario {usuario.email}"
+        current_user.registrar_actividad(
+            "importar_archivo",
+            f"Importó archivo '{archivo.filename}' para usuario {usuario.email}"
         )
-        db.session.add(actividad)
-        
-        db.session.commit()
+        invalidar_estructuras(usuarios=[usuario.id], rutas=[dropbox_path])
         
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({"success": True, "message": f"Archivo '{archivo.filename}' importado exitosamente."})
@@ -550,15 +540,13 @@ def editar_usuario(usuario_id):
         usuario.activo = activo
         usuario.alien_number = alien_number
         
+        db.session.commit()
+        
         # Registrar actividad
-        actividad = UserActivityLog(
-            user_id=current_user.id,
-            accion="editar_usuario",
-            descripcion=f"Editó información del usuario {usuario.email}"
+        current_user.registrar_actividad(
+            "editar_usuario",
+            f"Editó información del usuario {usuario.email}"
         )
-        db.session.add(actividad)
-        
-        db.session.commit()
         
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({"success": True, "message": "Usuario actualizado exitosamente."})
@@ -588,6 +576,10 @@ def _safe_delete_dropbox_folder(dbx, path):
 @bp.route('/usuarios/<int:usuario_id>/eliminar', methods=['POST'])
 @login_required
 def eliminar_usuario(usuario_id):
+    """Encola la eliminación del usuario: carpeta de Dropbox y contenido en la BD (app/job_tasks.py)."""
+    from app import job_runner
+    from app.routes.trabajos import responder_encolado
+
     if not current_user.puede_administrar():
         return jsonify({"success": False, "error": "No tienes permisos"}), 403
 
@@ -596,54 +588,9 @@ def eliminar_usuario(usuario_id):
     if usuario.id == current_user.id:
         return jsonify({"success": False, "error": "No puedes eliminar tu propia cuenta."}), 400
 
-    try:
-        dbx = get_dbx()
-        if dbx is None:
-            return jsonify({'success': False, 'error': 'No se pudo conectar a Dropbox (token inválido o no configurado)'}), 500
-        dropbox_path = getattr(usuario, 'dropbox_folder_path', None)
-        if dropbox_path:
-            try:
-                full_path = with_base_folder(dropbox_path)
-                dbx.files_delete_v2(full_path)
-            except ApiError as e:
-                # Ignorar error not_found (la carpeta ya no existe o nunca existió)
-                if (
-                    hasattr(e, "error") 
-                    and hasattr(e.error, "is_path_lookup") 
-                    and e.error.is_path_lookup()
-                    and hasattr(e.error.get_path_lookup(), "is_not_found")
-                    and e.error.get_path_lookup().is_not_found()
-                ):
-                    pass  # continuar con la eliminación, no es crítico
-                else:
-                    return jsonify({"success": False, "step": "dropbox_delete", "error": str(e)}), 500
-        carpeta_ids = [c.id for c in Folder.query.with_entities(Folder.id).filter_by(user_id=usuario_id).all()]
-        try:
-            if carpeta_ids:
-                FolderPermiso.query.filter(FolderPermiso.folder_id.in_(carpeta_ids)).delete(synchronize_session=False)
-            Archivo.query.filter_by(usuario_id=usuario_id).delete(synchronize_session=False)
-            Folder.query.filter_by(user_id=usuario_id).delete(synchronize_session=False)
-            Beneficiario.query.filter_by(titular_id=usuario_id).delete(synchronize_session=False)
-            UserActivityLog.query.filter_by(user_id=usuario_id).delete(synchronize_session=False)
-            # Eliminar notificaciones del usuario para evitar errores de clave externa NOT NULL
-            from app.models import Notification
-            Notification.query.filter_by(user_id=usuario_id).delete(synchronize_session=False)
-            db.session.delete(usuario)
-            actividad = UserActivityLog(
-                user_id=current_user.id,
-                accion="eliminar_usuario",
-                descripcion=f"Eliminó usuario {usuario.email} y todo su contenido (PRODUCCION)"
-            )
-            db.session.add(actividad)
-            db.session.commit()
-        except IntegrityError as ie:
-            db.session.rollback()
-            return jsonify({"success": False, "step": "db_commit", "error": str(ie.orig if getattr(ie, 'orig', None) else ie)}), 500
-        except Exception as db_e:
-            db.session.rollback()
-            return jsonify({"success": False, "step": "db_other", "error": str(db_e)}), 500
-        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True}), 200
-        return redirect(url_for('usuarios.lista_usuarios'))
-    except Exception as e:
-        return jsonify({"success": False, "step": "unexpected", "error": str(e)}), 500
\ No newline at end of file
+    trabajo, nuevo = job_runner.encolar(
+        'eliminar_usuario', {'usuario_id': usuario.id, 'solicitante_id': current_user.id},
+        usuario_id=current_user.id, clave=f"eliminar_usuario:{usuario.id}",
+    )
+    return responder_encolado(trabajo, nuevo, f"Eliminación de {usuario.email} iniciada.",
+                              url_for('usuarios.lista_usuarios'))
\ No newline at end of file
@@ -0,0 +1,476 @@
+"""
+Caché de estructuras de carpetas de Dropbox por usuario.
+
+Reemplaza el dict ``_estructuras_cache`` de ``listar_dropbox`` (por proceso,
+sin límite de tamaño ni invalidación entre workers) por dos niveles:
+
+- ``MemoryLRU``: LRU en el proceso, acotado en bytes.
+- ``SQLiteBackend`` (opcional): archivo SQLite compartido por todos los
+  workers de gunicorn. Guarda las estructuras serializadas y una generación
+  por clave; cada invalidación incrementa la generación, y un worker descarta
+  su copia en memoria cuando la generación compartida ya no coincide. Así la
+  invalidación hecha en un worker se ve en todos.
+
+Las entradas se sirven frescas durante ``fresh_ttl`` y, hasta
+``fresh_ttl + stale_ttl``, se sirven viejas mientras un hilo las recarga en
+segundo plano (stale-while-revalidate). La invalidación puede ser por usuario
+o por prefijo de ruta (afecta a todo árbol que contenga la ruta o esté
+contenido en ella).
+
+Configuración (config.py): STRUCTURE_CACHE_BACKEND (memory | sqlite),
+STRUCTURE_CACHE_SQLITE_PATH, STRUCTURE_CACHE_FRESH_TTL,
+STRUCTURE_CACHE_STALE_TTL, STRUCTURE_CACHE_MEMORY_MAX_BYTES,
+STRUCTURE_CACHE_SHARED_MAX_BYTES, STRUCTURE_CACHE_MAX_ENTRY_BYTES.
+"""
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FRESH_TTL_SECONDS = 300
+DEFAULT_STALE_TTL_SECONDS = 900
+DEFAULT_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_SHARED_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+
+
+def _ruta_relacionada(ruta, raiz):
+    """True si ``ruta`` está dentro del árbol ``raiz`` o lo contiene."""
+    ruta = (ruta or '').rstrip('/').lower()
+    raiz = (raiz or '').rstrip('/').lower()
+    if not ruta or not raiz:
+        return True
+    return ruta == raiz or ruta.startswith(raiz + '/') or raiz.startswith(ruta + '/')
+
+
+class _Entrada:
+    __slots__ = ('key', 'root', 'data', 'stored_at', 'size', 'gen')
+
+    def __init__(self, key, root, data, stored_at, size, gen):
+        self.key = key
+        self.root = root
+        self.data = data
+        self.stored_at = stored_at
+        self.size = size
+        self.gen = gen
+
+
+class MemoryLRU:
+    """LRU en memoria acotado por el tamaño serializado de las entradas."""
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, entry):
+        self.pop(entry.key)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[entry.key] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and self._entries:
+            _, viejo = self._entries.popitem(last=False)
+            self._bytes -= viejo.size
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        return entry
+
+    def keys_for_path(self, ruta):
+        return [k for k, e in self._entries.items() if _ruta_relacionada(ruta, e.root)]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self._bytes,
+                'max_bytes': self.max_bytes, 'evictions': self.evictions}
+
+
+class SQLiteBackend:
+    """Nivel compartido entre procesos sobre un archivo SQLite (modo WAL)."""
+
+    def __init__(self, path, max_bytes=DEFAULT_SHARED_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        directorio = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directorio, exist_ok=True)
+        with self._tx() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS estructuras ("
+                " key TEXT PRIMARY KEY, root TEXT NOT NULL, data TEXT NOT NULL,"
+                " stored_at REAL NOT NULL, size INTEGER NOT NULL, gen INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_estructuras_stored_at ON estructuras (stored_at)")
+            # Las generaciones sobreviven a la expulsión de la estructura para
+            # que los workers sigan detectando invalidaciones de su copia local.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generaciones ("
+                " key TEXT PRIMARY KEY, root TEXT, gen INTEGER NOT NULL)"
+            )
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se comparten tras un fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def generation(self, key):
+        row = self._conn().execute("SELECT gen FROM generaciones WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT root, data, stored_at, size, gen FROM estructuras WHERE key = ?", (key,)
+        ).fetchone()
+        return row
+
+    def put(self, key, root, data, stored_at, size, expected_gen):
+        """Guarda si nadie invalidó la clave desde ``expected_gen``."""
+        with self._tx() as conn:
+            row = conn.execute("SELECT gen FROM generaciones WHERE key = ?", (key,)).fetchone()
+            gen = row[0] if row else 0
+            if gen != expected_gen:
+                return False
+            conn.execute(
+                "INSERT INTO generaciones (key, root, gen) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET root = excluded.root",
+                (key, root, gen),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO estructuras (key, root, data, stored_at, size, gen) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, root, data, stored_at, size, gen),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM estructuras").fetchone()[0]
+            while total > self.max_bytes:
+                viejo = conn.execute(
+                    "SELECT key, size FROM estructuras WHERE key != ? ORDER BY stored_at LIMIT 1", (key,)
+                ).fetchone()
+                if viejo is None:
+                    break
+                conn.execute("DELETE FROM estructuras WHERE key = ?", (viejo[0],))
+                total -= viejo[1]
+        return True
+
+    def invalidate(self, keys):
+        with self._tx() as conn:
+            for key in keys:
+                conn.execute(
+                    "INSERT INTO generaciones (key, root, gen) VALUES (?, NULL, 1) "
+                    "ON CONFLICT(key) DO UPDATE SET gen = gen + 1",
+                    (key,),
+                )
+                conn.execute("DELETE FROM estructuras WHERE key = ?", (key,))
+
+    def keys_for_path(self, ruta):
+        rows = self._conn().execute("SELECT key, root FROM generaciones").fetchall()
+        return [k for k, root in rows if root is None or _ruta_relacionada(ruta, root)]
+
+    def stats(self):
+        conn = self._conn()
+        entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM estructuras").fetchone()
+        return {'entries': entries, 'bytes': total, 'max_bytes': self.max_bytes, 'path': self.path}
+
+
+class StructureCache:
+    """Fachada de dos niveles (memoria + compartido opcional), segura entre hilos."""
+
+    def __init__(self, shared=None, memory_max_bytes=DEFAULT_MEMORY_MAX_BYTES,
+                 fresh_ttl=DEFAULT_FRESH_TTL_SECONDS, stale_ttl=DEFAULT_STALE_TTL_SECONDS,
+                 max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.shared = shared
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._memory = MemoryLRU(memory_max_bytes)
+        self._generaciones = {}  # solo se usan sin nivel compartido
+        self._refrescando = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0,
+                       'refresh_errors': 0, 'invalidations': 0, 'shared_errors': 0}
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._memory.clear()
+            self._refrescando = set()
+
+    def generation(self, key):
+        key = str(key)
+        if self.shared is not None:
+            try:
+                return self.shared.generation(key)
+            except sqlite3.Error as e:
+                self._stats['shared_errors'] += 1
+                logger.warning(f"Caché de estructuras compartida no disponible: {e}")
+        with self._lock:
+            return self._generaciones.get(key, 0)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+        if self.shared is None:
+            return entry
+        try:
+            if entry is not None:
+                if self.shared.generation(key) == entry.gen:
+                    return entry
+                with self._lock:
+                    self._memory.pop(key)
+            row = self.shared.get(key)
+        except sqlite3.Error as e:
+            self._stats['shared_errors'] += 1
+            logger.warning(f"Caché de estructuras compartida no disponible: {e}")
+            return entry
+        if row is None:
+            return None
+        root, data, stored_at, size, gen = row
+        entry = _Entrada(key, root, json.loads(data), stored_at, size, gen)
+        with self._lock:
+            self._memory.put(entry)
+        return entry
+
+    def get(self, key):
+        """Retorna ``(estructura, estado)`` con estado 'fresh', 'stale' o None."""
+        self._check_fork()
+        key = str(key)
+        entry = self._lookup(key)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None, None
+        edad = time.time() - entry.stored_at
+        if edad <= self.fresh_ttl:
+            self._stats['hits'] += 1
+            return entry.data, 'fresh'
+        if edad <= self.fresh_ttl + self.stale_ttl:
+            self._stats['stale_hits'] += 1
+            return entry.data, 'stale'
+        with self._lock:
+            self._memory.pop(key)
+        self._stats['misses'] += 1
+        return None, None
+
+    def set(self, key, root, estructura, gen=None):
+        """Guarda la estructura; se descarta si la clave se invalidó desde ``gen``."""
+        self._check_fork()
+        key = str(key)
+        if gen is None:
+            gen = self.generation(key)
+        data = json.dumps(estructura, separators=(',', ':'))
+        size = len(data)
+        if size > self.max_entry_bytes:
+            logger.info(f"Estructura {key} demasiado grande para la caché ({size} bytes)")
+            return False
+        stored_at = time.time()
+        if self.shared is not None:
+            try:
+                if not self.shared.put(key, root, data, stored_at, size, gen):
+                    return False
+            except sqlite3.Error as e:
+                self._stats['shared_errors'] += 1
+                logger.warning(f"No se pudo guardar en la caché compartida: {e}")
+        else:
+            with self._lock:
+                if self._generaciones.get(key, 0) != gen:
+                    return False
+        with self._lock:
+            self._memory.put(_Entrada(key, root, estructura, stored_at, size, gen))
+        return True
+
+    def get_or_load(self, key, root, loader, app=None):
+        """
+        Estructura de la caché o de ``loader()``. Si la entrada está vieja se
+        sirve igualmente y se recarga en segundo plano (con ``app`` como
+        contexto de aplicación del hilo).
+        """
+        estructura, estado = self.get(key)
+        if estado == 'fresh':
+            return estructura
+        if estado == 'stale':
+            self._refresh_async(str(key), root, loader, app)
+            return estructura
+        gen = self.generation(key)
+        estructura = loader()
+        self.set(key, root, estructura, gen)
+        return estructura
+
+    def _refresh_async(self, key, root, loader, app):
+        with self._lock:
+            if key in self._refrescando:
+                return
+            self._refrescando.add(key)
+
+        def _run():
+            try:
+                ctx = app.app_context() if app is not None else contextlib.nullcontext()
+                with ctx:
+                    gen = self.generation(key)
+                    self.set(key, root, loader(), gen)
+                self._stats['refreshes'] += 1
+            except Exception as e:
+                self._stats['refresh_errors'] += 1
+                logger.warning(f"Error recargando estructura {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refrescando.discard(key)
+
+        threading.Thread(target=_run, name=f"estructura-refresh-{key}", daemon=True).start()
+
+    def _invalidate_keys(self, keys):
+        keys = {str(k) for k in keys if k is not None}
+        if not keys:
+            return 0
+        with self._lock:
+            for key in keys:
+                self._memory.pop(key)
+                if self.shared is None:
+                    self._generaciones[key] = self._generaciones.get(key, 0) + 1
+        if self.shared is not None:
+            try:
+                self.shared.invalidate(keys)
+            except sqlite3.Error as e:
+                self._stats['shared_errors'] += 1
+                logger.warning(f"No se pudo invalidar en la caché compartida: {e}")
+        self._stats['invalidations'] += len(keys)
+        return len(keys)
+
+    def invalidate(self, *keys):
+        """Invalida claves concretas."""
+        self._check_fork()
+        return self._invalidate_keys(keys)
+
+    def invalidate_user(self, *user_ids):
+        """Invalida la estructura de uno o varios usuarios."""
+        return self.invalidate(*user_ids)
+
+    def invalidate_path(self, *rutas):
+        """Invalida todo árbol que contenga alguna de las rutas (o esté dentro)."""
+        self._check_fork()
+        keys = set()
+        for ruta in rutas:
+            if not ruta:
+                continue
+            with self._lock:
+                keys.update(self._memory.keys_for_path(ruta))
+            if self.shared is not None:
+                try:
+                    keys.update(self.shared.keys_for_path(ruta))
+                except sqlite3.Error as e:
+                    self._stats['shared_errors'] += 1
+                    logger.warning(f"No se pudo consultar la caché compartida: {e}")
+        return self._invalidate_keys(keys)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['memory'] = self._memory.stats()
+        if self.shared is not None:
+            try:
+                data['shared'] = self.shared.stats()
+            except sqlite3.Error as e:
+                data['shared'] = {'error': str(e)}
+        data['fresh_ttl'] = self.fresh_ttl
+        data['stale_ttl'] = self.stale_ttl
+        return data
+
+
+# Instancia global (una por proceso; el nivel compartido une a los workers)
+structure_cache = None
+_structure_cache_lock = threading.Lock()
+
+
+def get_structure_cache():
+    """Obtiene la caché global, creada a partir de la configuración de la app."""
+    global structure_cache
+    if structure_cache is None:
+        with _structure_cache_lock:
+            if structure_cache is None:
+                structure_cache = _build_from_config()
+    return structure_cache
+
+
+def _build_from_config():
+    try:
+        from flask import current_app
+        cfg = current_app.config
+        instance_path = current_app.instance_path
+    except RuntimeError:
+        cfg, instance_path = {}, os.getcwd()
+
+    shared = None
+    backend = (cfg.get('STRUCTURE_CACHE_BACKEND') or 'memory').strip().lower()
+    if backend == 'sqlite':
+        path = cfg.get('STRUCTURE_CACHE_SQLITE_PATH') or os.path.join(instance_path, 'structure_cache.sqlite3')
+        try:
+            shared = SQLiteBackend(
+                path, max_bytes=int(cfg.get('STRUCTURE_CACHE_SHARED_MAX_BYTES') or DEFAULT_SHARED_MAX_BYTES)
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"No se pudo abrir la caché compartida en {path}, usando solo memoria: {e}")
+
+    return StructureCache(
+        shared=shared,
+        memory_max_bytes=int(cfg.get('STRUCTURE_CACHE_MEMORY_MAX_BYTES') or DEFAULT_MEMORY_MAX_BYTES),
+        fresh_ttl=int(cfg.get('STRUCTURE_CACHE_FRESH_TTL') or DEFAULT_FRESH_TTL_SECONDS),
+        stale_ttl=int(cfg.get('STRUCTURE_CACHE_STALE_TTL') or DEFAULT_STALE_TTL_SECONDS),
+        max_entry_bytes=int(cfg.get('STRUCTURE_CACHE_MAX_ENTRY_BYTES') or DEFAULT_MAX_ENTRY_BYTES),
+    )
+
+
+def invalidar_estructuras(usuarios=(), rutas=()):
+    """
+    Atajo para las rutas que modifican Dropbox: nunca lanza excepción.
+
+    También descarta los enlaces temporales cacheados bajo ``rutas``
+    (app/dropbox_download.py).
+    """
+    try:
+        cache = get_structure_cache()
+        if usuarios:
+            cache.invalidate_user(*usuarios)
+        if rutas:
+            cache.invalidate_path(*rutas)
+    except Exception as e:
+        logger.warning(f"No se pudo invalidar la caché de estructuras: {e}")
+    if rutas:
+        from app.dropbox_download import invalidar_enlaces
+
+        invalidar_enlaces(*rutas)
@@ -1,9 +1,8 @@
 """
 Utilidades para registrar actividades de usuarios en el sistema
 """
-from flask import request
-from ..models import UserActivityLog, db
-from datetime import datetime
+from ..models import db
+from ..activity_log_writer import registrar
 
 def log_user_activity(user_id, accion, descripcion=None, ip_address=None, user_agent=None):
     """
@@ -17,28 +16,9 @@ def log_user_activity(user_id, accion, descripcion=None, ip_address=None, user_a
         user_agent (str, optional): User agent del navegador
     """
     try:
-        # Si no se proporciona IP, intentar obtenerla de la request
-        if ip_address is None and request:
-            ip_address = request.remote_addr
-        
-        # Si no se proporciona user agent, intentar obtenerlo de la request
-        if user_agent is None and request:
-            user_agent = request.headers.get('User-Agent', '')
-        
-        # Crear el registro de actividad
-        activity = UserActivityLog(
-            user_id=user_id,
-            accion=accion,
-            descripcion=descripcion,
-            ip_address=ip_address,
-            user_agent=user_agent,
-            fecha=datetime.utcnow()
-        )
-        
-        # Guardar en la base de datos
-        db.session.add(activity)
-        db.session.commit()
-        
+        # IP y user agent se toman de la request si no se proporcionan; la
+        # entrada se escribe en lote (app/activity_log_writer.py)
+        registrar(user_id, accion, descripcion, ip_address=ip_address, user_agent=user_agent)
         return True
         
     except Exception as e:
@@ -0,0 +1,180 @@
+"""
+Snapshot del dashboard de administración por período.
+
+``main.dashboard_admin`` recalculaba en cada vista y en cada cambio de período
+(AJAX) todos los conteos, los gráficos, dos desgloses por tipo de archivo, la
+distribución por rol y los usuarios más activos (join sobre todo
+``UserActivityLog``). Aquí ese payload se calcula una vez por período y se
+guarda en una ``StructureCache`` propia (memoria + SQLite compartido entre
+workers si ``STRUCTURE_CACHE_BACKEND`` es sqlite) durante
+``DASHBOARD_SNAPSHOT_TTL`` segundos.
+
+Los cambios en ``Archivo``, ``User``, ``Folder`` y ``Beneficiario`` invalidan
+todos los períodos al hacer commit (eventos en app/events.py). La actividad de
+usuarios no invalida: los "más activos" se refrescan con el TTL.
+"""
+import logging
+import os
+import threading
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+PERIODOS = ('today', 'week', 'month', 'year', 'total')
+DEFAULT_TTL_SECONDS = 60
+# Tablas cuyos cambios invalidan el snapshot
+TABLAS = frozenset(('archivo', 'user', 'folder', 'beneficiario'))
+# Columnas de User que muestra el dashboard (otras, como el último acceso, no invalidan)
+COLUMNAS_USER = frozenset(('rol', 'activo', 'nombre', 'apellido', 'email', 'fecha_registro'))
+_MARCA_SESION = 'dashboard_snapshot_sucio'
+
+
+def _clave(period):
+    return f"dashboard:{period}"
+
+
+def calcular_snapshot(period):
+    """Payload del dashboard para ``period`` (solo tipos serializables en JSON)."""
+    from app.models import ResumenActividad, User, UserActivityLog
+    from app.utils.dashboard_stats import (
+        calculate_period_dates, get_charts_data, get_dashboard_stats, get_file_types_stats
+    )
+
+    start_date, end_date = calculate_period_dates(period)
+
+    distribucion_roles = {'superadmin': 0, 'admin': 0, 'cliente': 0, 'lector': 0}
+    for rol, cantidad in db.session.query(User.rol, db.func.count(User.id)).group_by(User.rol):
+        if rol in distribucion_roles:
+            distribucion_roles[rol] = cantidad
+
+    # Actividad en la tabla caliente más la ya archivada (app/activity_retention.py)
+    calientes = db.select(
+        UserActivityLog.user_id.label('user_id'), db.func.count(UserActivityLog.id).label('total')
+    ).group_by(UserActivityLog.user_id)
+    archivadas = db.select(
+        ResumenActividad.user_id.label('user_id'), ResumenActividad.total.label('total')
+    )
+    actividad = db.union_all(calientes, archivadas).subquery()
+    usuarios_activos = []
+    for resultado in (
+        db.session.query(
+            User.id, User.nombre, User.apellido, User.email,
+            db.func.sum(actividad.c.total).label('actividades')
+        ).join(actividad, actividad.c.user_id == User.id)
+        .group_by(User.id, User.nombre, User.apellido, User.email)
+        .order_by(db.desc('actividades'))
+        .limit(5)
+    ):
+        usuarios_activos.append({
+            'nombre_completo': f"{resultado.nombre} {resultado.apellido}" if resultado.nombre and resultado.apellido else resultado.email.split('@')[0],
+            'email': resultado.email,
+            'actividades': int(resultado.actividades or 0)
+        })
+
+    return {
+        'stats': get_dashboard_stats(period),
+        'charts_data': get_charts_data(),
+        'file_types_general': get_file_types_stats(),
+        'file_types_recent': get_file_types_stats(start_date, end_date),
+        'distribucion_roles': distribucion_roles,
+        'usuarios_activos': usuarios_activos,
+    }
+
+
+# Instancia global (una por proceso; el nivel compartido une a los workers)
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_dashboard_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = _build_from_config()
+    return _cache
+
+
+def _build_from_config():
+    import sqlite3
+
+    from flask import current_app
+
+    from app.structure_cache import SQLiteBackend, StructureCache
+
+    cfg = current_app.config
+    shared = None
+    if (cfg.get('STRUCTURE_CACHE_BACKEND') or 'memory').strip().lower() == 'sqlite':
+        path = cfg.get('DASHBOARD_SNAPSHOT_SQLITE_PATH') or os.path.join(
+            current_app.instance_path, 'dashboard_cache.sqlite3'
+        )
+        try:
+            shared = SQLiteBackend(path, max_bytes=16 * 1024 * 1024)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"No se pudo abrir la caché compartida del dashboard en {path}: {e}")
+    return StructureCache(
+        shared=shared,
+        memory_max_bytes=4 * 1024 * 1024,
+        fresh_ttl=int(cfg.get('DASHBOARD_SNAPSHOT_TTL') or DEFAULT_TTL_SECONDS),
+        stale_ttl=0,
+    )
+
+
+def obtener_snapshot(period):
+    """Snapshot de ``period`` desde la caché o recién calculado."""
+    if period not in PERIODOS:
+        period = 'month'
+    return get_dashboard_cache().get_or_load(_clave(period), '', lambda: calcular_snapshot(period))
+
+
+def invalidar_snapshot():
+    """Descarta el snapshot de todos los períodos: nunca lanza excepción."""
+    try:
+        get_dashboard_cache().invalidate(*(_clave(p) for p in PERIODOS))
+    except Exception as e:
+        logger.warning(f"No se pudo invalidar el snapshot del dashboard: {e}")
+
+
+# --- Eventos de sesión (registrados en app/events.py)
+
+def _afecta_dashboard(obj, nuevo_o_borrado):
+    from app.models import Archivo, Beneficiario, Folder, User
+
+    if isinstance(obj, (Archivo, Folder, Beneficiario)):
+        return True
+    if isinstance(obj, User):
+        if nuevo_o_borrado:
+            return True
+        estado = db.inspect(obj)
+        return any(estado.attrs[c].history.has_changes() for c in COLUMNAS_USER)
+    return False
+
+
+def marcar_tras_flush(session, flush_context=None):
+    if session.info.get(_MARCA_SESION):
+        return
+    if any(_afecta_dashboard(o, True) for o in session.new) \
+            or any(_afecta_dashboard(o, True) for o in session.deleted) \
+            or any(_afecta_dashboard(o, False) for o in session.dirty):
+        session.info[_MARCA_SESION] = True
+
+
+def marcar_tras_execute(orm_execute_state):
+    """INSERT/UPDATE/DELETE masivos (``query.delete()``, ``tabla.insert()``)."""
+    if orm_execute_state.session.info.get(_MARCA_SESION):
+        return
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    tabla = getattr(orm_execute_state.statement, 'table', None)
+    if getattr(tabla, 'name', None) in TABLAS:
+        orm_execute_state.session.info[_MARCA_SESION] = True
+
+
+def invalidar_tras_commit(session):
+    if session.info.pop(_MARCA_SESION, False):
+        invalidar_snapshot()
+
+
+def limpiar_tras_rollback(session):
+    session.info.pop(_MARCA_SESION, None)
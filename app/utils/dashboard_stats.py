@@ -3,6 +3,8 @@ from datetime import datetime, timedelta
 from sqlalchemy import func, desc
 from app.models import User, Archivo, UserActivityLog, Folder, Beneficiario
 from app import db
+from app.utils.query_utils import codificar_cursor, decodificar_cursor, despues_de_fecha
+from app.utils.rollups import conteos_por_dia, conteos_por_hora
 
 
 def get_colombia_datetime():
@@ -168,12 +170,53 @@ def debug_file_extensions():
     print(f"\nTotal de archivos: {total_files}")
     return results
 
+def backfill_file_extensions(batch_size=1000):
+    """
+    Completa ``Archivo.extension`` en filas antiguas (vacía o sin normalizar)
+    a partir del nombre, por lotes de id. Retorna cuántas filas actualizó.
+    """
+    from sqlalchemy import bindparam, or_
+    from app.models import extension_de_nombre
+
+    tabla = Archivo.__table__
+    actualizadas = 0
+    ultimo_id = 0
+    while True:
+        filas = db.session.query(Archivo.id, Archivo.nombre, Archivo.extension).filter(
+            Archivo.id > ultimo_id,
+            or_(
+                Archivo.extension.is_(None),
+                Archivo.extension == '',
+                Archivo.extension != func.lower(Archivo.extension),
+                Archivo.extension.like('.%'),
+            )
+        ).order_by(Archivo.id).limit(batch_size).all()
+        if not filas:
+            break
+        ultimo_id = filas[-1].id
+        cambios = []
+        for fila in filas:
+            extension = extension_de_nombre(fila.nombre) \
+                or (fila.extension or '').strip().lstrip('.').lower()[:20] or None
+            if extension != fila.extension:
+                cambios.append({'b_id': fila.id, 'b_extension': extension})
+        if cambios:
+            db.session.execute(
+                tabla.update().where(tabla.c.id == bindparam('b_id')).values(extension=bindparam('b_extension')),
+                cambios
+            )
+            actualizadas += len(cambios)
+        db.session.commit()
+    return actualizadas
+
+
 def get_file_types_stats(start_date=None, end_date=None):
-    """Obtiene estadísticas de tipos de archivo para el período especificado"""
-    from app.models import Archivo
-    
-    # Obtener todos los archivos del período
-    query = Archivo.query
+    """
+    Obtiene estadísticas de tipos de archivo para el período especificado
+    (un GROUP BY sobre ``Archivo.extension``, que se completa al escribir;
+    ver ``backfill_file_extensions`` para filas antiguas)
+    """
+    query = db.session.query(Archivo.extension, func.count(Archivo.id))
     
     if start_date and end_date:
         query = query.filter(
@@ -181,21 +224,10 @@ def get_file_types_stats(start_date=None, end_date=None):
             Archivo.fecha_subida <= end_date
         )
     
-    archivos = query.all()
-    
-    # Contar extensiones extraídas de nombres
     extension_counts = {}
-    for archivo in archivos:
-        # Intentar obtener extensión del campo extension primero
-        extension = archivo.extension
-        
-        # Si no hay extensión, extraerla del nombre del archivo
-        if not extension and '.' in archivo.nombre:
-            extension = archivo.nombre.split('.')[-1].lower()
-        elif not extension:
-            extension = 'sin_extension'
-        
-        extension_counts[extension] = extension_counts.get(extension, 0) + 1
+    for extension, count in query.group_by(Archivo.extension):
+        extension = extension or 'sin_extension'
+        extension_counts[extension] = extension_counts.get(extension, 0) + count
     
     total_count = sum(extension_counts.values())
     
@@ -218,7 +250,8 @@ def get_file_types_stats(start_date=None, end_date=None):
     ]
     
     stats = []
-    for i, (extension, count) in enumerate(extension_counts.items()):
+    ordenadas = sorted(extension_counts.items(), key=lambda x: (-x[1], x[0]))
+    for i, (extension, count) in enumerate(ordenadas):
         # Manejar extensiones nulas o vacías
         if extension == 'sin_extension':
             friendly_name = "Sin extensión"
@@ -264,151 +297,64 @@ def get_file_types_stats(start_date=None, end_date=None):
     return stats
 
 
-def get_charts_data():
-    """Genera datos para los gráficos del dashboard"""
-    today = get_colombia_datetime().date()
-    
-    # Datos para gráfico semanal
+DIAS_SEMANA = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
+MESES = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
+
+
+def _series_grafico(metrica, today):
+    """
+    Series de un gráfico (hoy por horas, semana, mes por semanas y año por
+    meses) a partir de los conteos pre-agregados: dos consultas por métrica.
+    """
+    desde = min(today - timedelta(days=6), today.replace(month=1, day=1))
+    por_dia = conteos_por_dia(metrica, desde, today)
+    por_hora = conteos_por_hora(metrica, today)
+
+    def total_dias(inicio, fin):
+        return sum(v for d, v in por_dia.items() if inicio <= d <= fin)
+
     week_data = []
     for i in range(6, -1, -1):
         date = today - timedelta(days=i)
-        file_count = Archivo.query.filter(func.date(Archivo.fecha_subida) == date).count()
-        day_name = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"][date.weekday()]
-        week_data.append({"label": day_name, "value": file_count})
-    
-    # Datos para gráfico mensual (por semanas)
+        week_data.append({"label": DIAS_SEMANA[date.weekday()], "value": por_dia.get(date, 0)})
+
+    # Mes en curso por semanas (días 1-7, 8-14, 15-21, 22-28)
     month_data = []
     first_day = today.replace(day=1)
     days_in_month = calendar.monthrange(today.year, today.month)[1]
-    
     for week in range(4):
-        start_day = min(week * 7 + 1, days_in_month)
-        end_day = min((week + 1) * 7, days_in_month)
-        
-        start_date = first_day.replace(day=start_day)
-        end_date = first_day.replace(day=end_day)
-        
-        file_count = Archivo.query.filter(
-            func.date(Archivo.fecha_subida) >= start_date,
-            func.date(Archivo.fecha_subida) <= end_date
-        ).count()
-        
-        month_data.append({"label": f"Sem {week+1}", "value": file_count})
-    
-    # Datos para gráfico anual (por meses)
+        start_date = first_day.replace(day=min(week * 7 + 1, days_in_month))
+        end_date = first_day.replace(day=min((week + 1) * 7, days_in_month))
+        month_data.append({"label": f"Sem {week+1}", "value": total_dias(start_date, end_date)})
+
     year_data = []
-    current_year = today.year
-    
     for month in range(1, 13):
-        start_date = datetime(current_year, month, 1).date()
-        if month == 12:
-            end_date = datetime(current_year, month, 31).date()
-        else:
-            end_date = datetime(current_year, month + 1, 1).date() - timedelta(days=1)
-        
-        file_count = Archivo.query.filter(
-            func.date(Archivo.fecha_subida) >= start_date,
-            func.date(Archivo.fecha_subida) <= end_date
-        ).count()
-        
-        month_name = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"][month-1]
-        year_data.append({"label": month_name, "value": file_count})
-    
-    # Datos para gráfico por horas (HOY)
+        start_date = today.replace(month=month, day=1)
+        end_date = start_date.replace(day=calendar.monthrange(today.year, month)[1])
+        year_data.append({"label": MESES[month-1], "value": total_dias(start_date, end_date)})
+
     today_data = []
-    today_start = datetime.combine(today, datetime.min.time())
-    
-    for hour in range(24):
-        hour_start = today_start + timedelta(hours=hour)
-        hour_end = hour_start + timedelta(hours=1)
-        
-        # Convertir a UTC para la consulta
-        utc_offset = timedelta(hours=5)  # Colombia es UTC-5
-        utc_hour_start = hour_start + utc_offset
-        utc_hour_end = hour_end + utc_offset
-        
-        file_count = Archivo.query.filter(
-            Archivo.fecha_subida >= utc_hour_start,
-            Archivo.fecha_subida < utc_hour_end
-        ).count()
-        
-        hour_label = f"{(hour % 12) or 12}:00 {'PM' if hour >= 12 else 'AM'}"
-        today_data.append({"label": hour_label, "value": file_count})
-    
-    # Datos similares para usuarios
-    user_week_data = []
-    user_month_data = []
-    user_year_data = []
-    user_today_data = []
-    
-    # Usuarios por semana
-    for i in range(6, -1, -1):
-        date = today - timedelta(days=i)
-        user_count = User.query.filter(func.date(User.fecha_registro) == date).count()
-        day_name = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"][date.weekday()]
-        user_week_data.append({"label": day_name, "value": user_count})
-    
-    # Usuarios por mes (semanas)
-    for week in range(4):
-        start_day = min(week * 7 + 1, days_in_month)
-        end_day = min((week + 1) * 7, days_in_month)
-        
-        start_date = first_day.replace(day=start_day)
-        end_date = first_day.replace(day=end_day)
-        
-        user_count = User.query.filter(
-            func.date(User.fecha_registro) >= start_date,
-            func.date(User.fecha_registro) <= end_date
-        ).count()
-        
-        user_month_data.append({"label": f"Sem {week+1}", "value": user_count})
-    
-    # Usuarios por año (meses)
-    for month in range(1, 13):
-        start_date = datetime(current_year, month, 1).date()
-        if month == 12:
-            end_date = datetime(current_year, month, 31).date()
-        else:
-            end_date = datetime(current_year, month + 1, 1).date() - timedelta(days=1)
-        
-        user_count = User.query.filter(
-            func.date(User.fecha_registro) >= start_date,
-            func.date(User.fecha_registro) <= end_date
-        ).count()
-        
-        month_name = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"][month-1]
-        user_year_data.append({"label": month_name, "value": user_count})
-    
-    # Usuarios por hora (HOY)
     for hour in range(24):
-        hour_start = today_start + timedelta(hours=hour)
-        hour_end = hour_start + timedelta(hours=1)
-        
-        utc_offset = timedelta(hours=5)
-        utc_hour_start = hour_start + utc_offset
-        utc_hour_end = hour_end + utc_offset
-        
-        user_count = User.query.filter(
-            User.fecha_registro >= utc_hour_start,
-            User.fecha_registro < utc_hour_end
-        ).count()
-        
         hour_label = f"{(hour % 12) or 12}:00 {'PM' if hour >= 12 else 'AM'}"
-        user_today_data.append({"label": hour_label, "value": user_count})
-    
+        today_data.append({"label": hour_label, "value": por_hora.get(hour, 0)})
+
     return {
-        "files": {
-            "week": week_data,
-            "month": month_data,
-            "year": year_data,
-            "today": today_data
-        },
-        "users": {
-            "week": user_week_data,
-            "month": user_month_data,
-            "year": user_year_data,
-            "today": user_today_data
-        }
+        "week": week_data,
+        "month": month_data,
+        "year": year_data,
+        "today": today_data
+    }
+
+
+def get_charts_data():
+    """
+    Genera datos para los gráficos del dashboard (archivos subidos y usuarios
+    registrados), en hora de Colombia, desde app/utils/rollups.py
+    """
+    today = get_colombia_datetime().date()
+    return {
+        "files": _series_grafico('archivos', today),
+        "users": _series_grafico('usuarios', today)
     }
 
 
@@ -487,6 +433,73 @@ def get_recent_files_with_users(limit=10):
     return recent_files
 
 
+def _orden_recientes(query):
+    return query.order_by(Archivo.fecha_subida.desc().nulls_last(), Archivo.id.desc())
+
+
+def get_recent_files_page(cursor=None, per_page=50):
+    """Una página del historial de archivos con su usuario, por cursor (keyset).
+
+    Retorna ``(pares (Archivo, User), cursor de la página siguiente o None)``.
+    """
+    query = _orden_recientes(db.session.query(Archivo, User).join(User, Archivo.usuario_id == User.id))
+    posicion = decodificar_cursor(cursor)
+    if posicion is not None:
+        query = query.filter(despues_de_fecha(Archivo.fecha_subida, Archivo.id, posicion))
+    recent_files = query.limit(per_page + 1).all()
+    siguiente = None
+    if len(recent_files) > per_page:
+        recent_files = recent_files[:per_page]
+        ultimo = recent_files[-1][0]
+        siguiente = codificar_cursor(ultimo.fecha_subida, ultimo.id)
+    return recent_files, siguiente
+
+
+# Columnas de la exportación CSV del historial (las claves con punto son del usuario)
+RECENT_FILES_CSV_COLUMNS = (
+    'id', 'nombre', 'extension', 'tamano', 'fecha_subida', 'estado', 'dropbox_path',
+    'categoria', 'subcategoria', 'descripcion',
+    'usuario.id', 'usuario.username', 'usuario.email', 'usuario.nombre', 'usuario.apellido',
+)
+
+
+def iter_recent_files(batch_size=1000):
+    """Todo el historial de archivos con su usuario, fila a fila.
+
+    Lee con un cursor del servidor (``yield_per``) y sin crear objetos ORM:
+    la memoria no depende del número de archivos.
+    """
+    consulta = _orden_recientes(
+        db.select(
+            Archivo.id, Archivo.nombre, Archivo.extension, Archivo.tamano, Archivo.fecha_subida,
+            Archivo.estado, Archivo.dropbox_path, Archivo.categoria, Archivo.subcategoria,
+            Archivo.descripcion, User.id.label('usuario_id'), User.email.label('usuario_email'),
+            User.nombre.label('usuario_nombre'), User.apellido.label('usuario_apellido'),
+        ).join(User, Archivo.usuario_id == User.id)
+    ).execution_options(yield_per=batch_size)
+    for fila in db.session.execute(consulta):
+        yield {
+            'id': fila.id,
+            'nombre': fila.nombre,
+            'extension': fila.extension,
+            'tamano': fila.tamano,
+            'fecha_subida': fila.fecha_subida.isoformat() if fila.fecha_subida else None,
+            'estado': fila.estado,
+            'dropbox_path': fila.dropbox_path,
+            'categoria': fila.categoria,
+            'subcategoria': fila.subcategoria,
+            'descripcion': fila.descripcion,
+            'usuario': {
+                'id': fila.usuario_id,
+                # Igual que User.username
+                'username': fila.usuario_nombre or fila.usuario_email.split('@')[0],
+                'email': fila.usuario_email,
+                'nombre': fila.usuario_nombre,
+                'apellido': fila.usuario_apellido,
+            },
+        }
+
+
 def get_recent_activity(limit=10):
     """Obtiene la actividad reciente del sistema"""
     recent_activity = db.session.query(UserActivityLog, User).join(
@@ -91,7 +91,8 @@ def _sendgrid_send_email(
 
     data = _json.dumps(payload).encode("utf-8")
     req = urllib.request.Request(
-        "https://api.sendgrid.com/v3/mail/send",
+        # SENDGRID_API_URL permite apuntar a un servidor HTTP local en pruebas
+        os.environ.get('SENDGRID_API_URL') or "https://api.sendgrid.com/v3/mail/send",
         data=data,
         headers={
             "Authorization": f"Bearer {api_key}",
@@ -394,6 +395,121 @@ def _mail_config_summary(
     )
 
 
+def _app_url() -> str:
+    return (
+        os.environ.get('APP_URL')
+        or current_app.config.get('APP_URL')
+        or 'http://localhost:5000'
+    ).strip().rstrip('/')
+
+
+def proveedor_canal(canal: str) -> str:
+    """Proveedor externo que atiende un canal (para límites de concurrencia)."""
+    if canal == 'email':
+        return _email_backend()
+    return 'twilio'
+
+
+def canal_configurado(canal: str) -> bool:
+    """
+    True si el canal tiene la configuración mínima para enviar. Sin ella los
+    envíos fallan siempre, así que el outbox no los reintenta.
+    """
+    if canal == 'email':
+        if _email_backend() == 'sendgrid':
+            return bool(os.environ.get('SENDGRID_API_KEY'))
+        return FLASK_MAIL_AVAILABLE and all(
+            os.environ.get(clave) or current_app.config.get(clave)
+            for clave in ('MAIL_SERVER', 'MAIL_USERNAME', 'MAIL_PASSWORD')
+        )
+    numero = 'TWILIO_WHATSAPP_NUMBER' if canal == 'whatsapp' else 'TWILIO_PHONE_NUMBER'
+    return TWILIO_AVAILABLE and all(
+        os.environ.get(clave) for clave in ('TWILIO_ACCOUNT_SID', 'TWILIO_AUTH_TOKEN', numero)
+    )
+
+
+def trabajos_notificacion_documento(
+    usuario: User,
+    archivo: Archivo,
+    estado: str,
+    comentario: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Envíos externos que corresponden al cambio de estado de un documento,
+    sin ejecutarlos (los usa el outbox de app.notification_outbox).
+
+    Cada trabajo tiene: canal, funcion (clave de ENVIADORES), destinatario y
+    kwargs para la función.
+    """
+    trabajos: List[Dict[str, Any]] = []
+    nombre_usuario = usuario.nombre_completo or usuario.email.split('@')[0]
+
+    if estado == 'validado':
+        if usuario.email:
+            trabajos.append({
+                'canal': 'email',
+                'funcion': 'email_validado',
+                'destinatario': usuario.email,
+                'kwargs': {
+                    'destinatario': usuario.email,
+                    'nombre_usuario': nombre_usuario,
+                    'nombre_archivo': archivo.nombre,
+                    'comentario': comentario,
+                    'url_archivo': _app_url(),
+                },
+            })
+        return trabajos
+
+    if estado != 'rechazado':
+        return trabajos
+
+    # Usar la ruta directamente en lugar de url_for para evitar problemas de contexto
+    url_archivo = f"{_app_url()}/carpetas_dropbox"
+    if usuario.email:
+        trabajos.append({
+            'canal': 'email',
+            'funcion': 'email_rechazo',
+            'destinatario': usuario.email,
+            'kwargs': {
+                'destinatario': usuario.email,
+                'nombre_usuario': nombre_usuario,
+                'nombre_archivo': archivo.nombre,
+                'comentario': comentario,
+                'url_archivo': url_archivo,
+            },
+        })
+    if usuario.telefono:
+        trabajos.append({
+            'canal': 'sms',
+            'funcion': 'sms_rechazo',
+            'destinatario': usuario.telefono,
+            'kwargs': {
+                'telefono': usuario.telefono,
+                'nombre_usuario': nombre_usuario,
+                'nombre_archivo': archivo.nombre,
+                'url_archivo': url_archivo,
+            },
+        })
+        trabajos.append({
+            'canal': 'whatsapp',
+            'funcion': 'whatsapp_rechazo',
+            'destinatario': usuario.telefono,
+            'kwargs': {
+                'telefono': usuario.telefono,
+                'nombre_usuario': nombre_usuario,
+                'nombre_archivo': archivo.nombre,
+                'comentario': comentario,
+                'url_archivo': url_archivo,
+            },
+        })
+    return trabajos
+
+
+def ejecutar_trabajo(funcion: str, kwargs: Dict[str, Any]) -> bool:
+    """Ejecuta un trabajo de ``trabajos_notificacion_documento``."""
+    return bool(ENVIADORES[funcion](**kwargs))
+
+
 def enviar_notificacion_documento_validado(
     usuario: User,
     archivo: Archivo,
@@ -417,23 +533,8 @@ def enviar_notificacion_documento_validado(
     }
     
     try:
-        nombre_usuario = usuario.nombre_completo or usuario.email.split('@')[0]
-        app_url = (
-            os.environ.get('APP_URL')
-            or current_app.config.get('APP_URL')
-            or 'http://localhost:5000'
-        ).strip().rstrip('/')
-        url_archivo = f"{app_url}"
-        
-        # Enviar email de aprobación
-        if usuario.email:
-            resultados['email'] = enviar_email_validado(
-                destinatario=usuario.email,
-                nombre_usuario=nombre_usuario,
-                nombre_archivo=archivo.nombre,
-                comentario=comentario,
-                url_archivo=url_archivo
-            )
+        for trabajo in trabajos_notificacion_documento(usuario, archivo, 'validado', comentario):
+            resultados[trabajo['canal']] = ejecutar_trabajo(trabajo['funcion'], trabajo['kwargs'])
         
         if resultados['email']:
             current_app.logger.info(
@@ -470,50 +571,8 @@ def enviar_notificacion_documento_rechazado(
     }
     
     try:
-        # Preparar mensaje
-        nombre_usuario = usuario.nombre_completo or usuario.email.split('@')[0]
-        mensaje_base = f"Tu documento '{archivo.nombre}' ha sido rechazado."
-        if comentario:
-            mensaje_base += f" Motivo: {comentario}"
-        mensaje_base += " Por favor, ingresa a la aplicación para revisar los detalles y subir una nueva versión."
-        
-        # URL de la aplicación (ajustar según tu dominio)
-        app_url = (
-            os.environ.get('APP_URL')
-            or current_app.config.get('APP_URL')
-            or 'http://localhost:5000'
-        ).strip().rstrip('/')
-        # Usar la ruta directamente en lugar de url_for para evitar problemas de contexto
-        url_archivo = f"{app_url}/carpetas_dropbox"
-        
-        # Enviar email
-        if usuario.email:
-            resultados['email'] = enviar_email_rechazo(
-                destinatario=usuario.email,
-                nombre_usuario=nombre_usuario,
-                nombre_archivo=archivo.nombre,
-                comentario=comentario,
-                url_archivo=url_archivo
-            )
-        
-        # Enviar SMS
-        if usuario.telefono:
-            resultados['sms'] = enviar_sms_rechazo(
-                telefono=usuario.telefono,
-                nombre_usuario=nombre_usuario,
-                nombre_archivo=archivo.nombre,
-                url_archivo=url_archivo
-            )
-        
-        # Enviar WhatsApp
-        if usuario.telefono:
-            resultados['whatsapp'] = enviar_whatsapp_rechazo(
-                telefono=usuario.telefono,
-                nombre_usuario=nombre_usuario,
-                nombre_archivo=archivo.nombre,
-                comentario=comentario,
-                url_archivo=url_archivo
-            )
+        for trabajo in trabajos_notificacion_documento(usuario, archivo, 'rechazado', comentario):
+            resultados[trabajo['canal']] = ejecutar_trabajo(trabajo['funcion'], trabajo['kwargs'])
         
         # Log de resultados
         notificaciones_exitosas = sum(1 for v in resultados.values() if v)
@@ -1024,3 +1083,11 @@ def enviar_whatsapp_rechazo(
         traceback.print_exc()
         return False
 
+
+# Funciones de envío por nombre (el outbox guarda el nombre, no la función)
+ENVIADORES = {
+    'email_validado': enviar_email_validado,
+    'email_rechazo': enviar_email_rechazo,
+    'sms_rechazo': enviar_sms_rechazo,
+    'whatsapp_rechazo': enviar_whatsapp_rechazo,
+}
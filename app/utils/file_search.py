@@ -0,0 +1,226 @@
+"""
+Búsqueda de archivos con índice de texto completo.
+
+``buscar_archivos_avanzada`` filtraba con ``ilike('%q%')`` sobre ``nombre``,
+``descripcion``, ``categoria`` y ``subcategoria`` (recorrido completo de
+``archivo`` en cada búsqueda), devolvía todas las coincidencias y cargaba el
+usuario de cada resultado con una consulta aparte.
+
+El índice vive en la base de datos y se mantiene solo, por cualquier camino
+de escritura (ORM, INSERT multi-fila de la sincronización, borrados masivos):
+
+- SQLite: tabla FTS5 ``archivo_fts`` de contenido externo sobre ``archivo``
+  con triggers de inserción, actualización y borrado.
+- PostgreSQL: columna generada ``archivo.busqueda`` (``tsvector``, nombre con
+  más peso que descripción y categorías) con índice GIN.
+
+Cada término buscado es un prefijo ("contra" encuentra "contrato_2024.pdf").
+Los resultados se ordenan por relevancia (por fecha si no hay texto), se
+paginan por cursor (keyset) y traen el usuario en la misma consulta. Las
+facetas por categoría y extensión se calculan sobre el mismo conjunto.
+
+El índice se crea con la migración e9f0a1b2c3d4 o con ``db.create_all()``
+(evento ``after_create`` registrado en app/events.py);
+``python manage.py search_reindex`` lo reconstruye.
+"""
+import logging
+import re
+
+from sqlalchemy import and_, column, func, literal, literal_column, or_, select, table, text
+
+from app import db
+from app.utils.query_utils import codificar_cursor, decodificar_cursor, despues_de_fecha
+
+logger = logging.getLogger(__name__)
+
+LIMITE = 50
+LIMITE_MAXIMO = 200
+MAX_TERMINOS = 8
+# Pesos de bm25 por columna del índice (nombre, descripcion, categoria, subcategoria)
+PESOS_SQLITE = (10.0, 3.0, 1.0, 1.0)
+
+DDL_SQLITE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS archivo_fts USING fts5("
+    "nombre, descripcion, categoria, subcategoria, "
+    "content='archivo', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_ai AFTER INSERT ON archivo BEGIN "
+    "INSERT INTO archivo_fts(rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.subcategoria); END",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_ad AFTER DELETE ON archivo BEGIN "
+    "INSERT INTO archivo_fts(archivo_fts, rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.subcategoria); END",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_au AFTER UPDATE OF nombre, descripcion, categoria, subcategoria "
+    "ON archivo BEGIN "
+    "INSERT INTO archivo_fts(archivo_fts, rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.subcategoria); "
+    "INSERT INTO archivo_fts(rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.subcategoria); END",
+)
+
+# Los separadores (_ . -) se cambian por espacios para que "contrato_2024.pdf"
+# quede como palabras sueltas y no como un solo token de tipo archivo.
+_VECTOR_POSTGRESQL = (
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace(coalesce(nombre, ''), '[^[:alnum:]]+', ' ', 'g')), 'A') || "
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace(coalesce(descripcion, ''), '[^[:alnum:]]+', ' ', 'g')), 'B') || "
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace("
+    "coalesce(categoria, '') || ' ' || coalesce(subcategoria, ''), '[^[:alnum:]]+', ' ', 'g')), 'C')"
+)
+DDL_POSTGRESQL = (
+    f"ALTER TABLE archivo ADD COLUMN IF NOT EXISTS busqueda tsvector GENERATED ALWAYS AS ({_VECTOR_POSTGRESQL}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_archivo_busqueda ON archivo USING gin (busqueda)",
+)
+
+
+# --- Índice
+
+def crear_indice_busqueda(target=None, connection=None, **kw):
+    """Crea el índice del dialecto de ``connection`` si no existe (evento ``after_create``)."""
+    dialecto = connection.dialect.name
+    sentencias = DDL_SQLITE if dialecto == 'sqlite' else DDL_POSTGRESQL if dialecto == 'postgresql' else ()
+    for sentencia in sentencias:
+        connection.execute(text(sentencia))
+
+
+def eliminar_indice_busqueda(target=None, connection=None, **kw):
+    """Evento ``before_drop``: la tabla FTS5 no se borra junto con ``archivo``."""
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS archivo_fts"))
+
+
+def reconstruir_indice():
+    """Crea el índice si falta y lo rehace desde ``archivo``. Retorna las filas indexadas."""
+    connection = db.session.connection()
+    crear_indice_busqueda(connection=connection)
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("INSERT INTO archivo_fts(archivo_fts) VALUES ('rebuild')"))
+    # En PostgreSQL la columna generada ya está al día
+    total = connection.execute(text("SELECT count(*) FROM archivo")).scalar()
+    db.session.commit()
+    return total
+
+
+# --- Consulta
+
+def terminos(texto):
+    """Palabras de ``texto`` en minúsculas (se descartan operadores y comillas)."""
+    return re.findall(r'\w+', (texto or '').lower())[:MAX_TERMINOS]
+
+
+def _coincidencia(dialecto, palabras):
+    """(join o None, condición, rango ascendente: menor es más relevante)."""
+    from app.models import Archivo
+
+    if dialecto == 'sqlite':
+        indice = table('archivo_fts', column('rowid'))
+        fts = literal_column('archivo_fts')
+        consulta = ' '.join(f'"{p}"*' for p in palabras)
+        return (
+            (indice, indice.c.rowid == Archivo.id),
+            fts.op('MATCH')(consulta),
+            func.bm25(fts, *PESOS_SQLITE),
+        )
+    if dialecto == 'postgresql':
+        vector = literal_column('archivo.busqueda')
+        consulta = func.to_tsquery(literal_column("'simple'::regconfig"), ' & '.join(f'{p}:*' for p in palabras))
+        return None, vector.op('@@')(consulta), -func.ts_rank_cd(vector, consulta)
+    columnas = (Archivo.nombre, Archivo.descripcion, Archivo.categoria, Archivo.subcategoria)
+    condicion = and_(*(or_(*(c.ilike(f'%{p}%') for c in columnas)) for p in palabras))
+    return None, condicion, literal(0)
+
+
+def _nombre_usuario(fila):
+    if fila.usuario_nombre and fila.usuario_apellido:
+        return f"{fila.usuario_nombre} {fila.usuario_apellido}"
+    if fila.usuario_nombre:
+        return fila.usuario_nombre
+    if fila.usuario_email:
+        return fila.usuario_email.split('@')[0]
+    return "Sin usuario"
+
+
+def _facetas(base, columna, limite=None):
+    consulta = (
+        base.with_only_columns(columna, func.count().label('total'))
+        .group_by(columna)
+        .order_by(func.count().desc(), columna)
+    )
+    if limite:
+        consulta = consulta.limit(limite)
+    return [{'valor': valor, 'total': total} for valor, total in db.session.execute(consulta)]
+
+
+def buscar_archivos(texto='', condiciones=(), limite=LIMITE, cursor=None, con_facetas=None):
+    """
+    Busca archivos que contengan ``texto`` y cumplan ``condiciones`` (filtros
+    sobre ``Archivo``).
+
+    Retorna ``{'resultados', 'siguiente', 'facetas', 'total'}``. ``siguiente``
+    es el cursor de la página siguiente (None en la última). Las facetas y el
+    total se calculan solo en la primera página, salvo ``con_facetas``.
+    """
+    from app.models import Archivo, User
+
+    limite = max(1, min(int(limite or LIMITE), LIMITE_MAXIMO))
+    palabras = terminos(texto)
+    posicion = decodificar_cursor(cursor)
+    if con_facetas is None:
+        con_facetas = posicion is None
+
+    base = select(Archivo.id).select_from(Archivo)
+    filtros = list(condiciones)
+    rango = None
+    if palabras:
+        join, condicion, rango = _coincidencia(db.engine.dialect.name, palabras)
+        if join is not None:
+            base = base.join(*join)
+        filtros.append(condicion)
+    base = base.where(*filtros)
+
+    consulta = base.with_only_columns(
+        Archivo.id, Archivo.nombre, Archivo.categoria, Archivo.subcategoria, Archivo.dropbox_path,
+        Archivo.fecha_subida, Archivo.tamano, Archivo.extension, Archivo.descripcion,
+        User.nombre.label('usuario_nombre'), User.apellido.label('usuario_apellido'),
+        User.email.label('usuario_email'),
+        (rango if rango is not None else Archivo.fecha_subida).label('orden'),
+    ).outerjoin(User, User.id == Archivo.usuario_id)
+
+    if rango is not None:
+        consulta = consulta.order_by(rango, Archivo.id.desc())
+        if posicion is not None:
+            valor, ultimo_id = posicion
+            consulta = consulta.where(or_(rango > valor, and_(rango == valor, Archivo.id < ultimo_id)))
+    else:
+        consulta = consulta.order_by(Archivo.fecha_subida.desc().nulls_last(), Archivo.id.desc())
+        if posicion is not None:
+            consulta = consulta.where(despues_de_fecha(Archivo.fecha_subida, Archivo.id, posicion))
+
+    filas = db.session.execute(consulta.limit(limite + 1)).all()
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1].orden, filas[-1].id)
+
+    resultados = [{
+        'id': f.id,
+        'nombre': f.nombre,
+        'categoria': f.categoria,
+        'subcategoria': f.subcategoria,
+        'dropbox_path': f.dropbox_path,
+        'fecha_subida': f.fecha_subida.strftime("%d/%m/%Y %H:%M") if f.fecha_subida else "",
+        'tamano': f.tamano,
+        'extension': f.extension,
+        'descripcion': f.descripcion,
+        'usuario': _nombre_usuario(f),
+        'usuario_email': f.usuario_email or "",
+    } for f in filas]
+
+    facetas = total = None
+    if con_facetas:
+        categorias = _facetas(base, Archivo.categoria)
+        facetas = {
+            'categoria': categorias,
+            'extension': _facetas(base, Archivo.extension, limite=20),
+        }
+        # categoria no admite NULL: la suma de sus facetas es el total
+        total = sum(c['total'] for c in categorias)
+    return {'resultados': resultados, 'siguiente': siguiente, 'facetas': facetas, 'total': total}
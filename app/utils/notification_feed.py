@@ -0,0 +1,272 @@
+"""
+Notificaciones difundidas (fan-out en lectura) y feed de notificaciones.
+
+``notificar_archivo_subido`` insertaba una fila ``Notification`` por cada
+admin, superadmin y lector en cada subida (y luego la releía para
+"verificarla"): con decenas de usuarios de staff y miles de subidas al día la
+tabla crecía por el número de destinatarios, no por el de eventos.
+
+Ahora un evento para un grupo de roles es una sola fila
+``NotificacionDifundida`` con su ``audiencia``. El estado de lectura de cada
+usuario es:
+
+- ``User.difundidas_leidas_hasta``: cursor que mueve "marcar todas como
+  leídas" (todo lo creado hasta esa fecha queda leído);
+- ``NotificacionDifundidaLeida``: marcas individuales posteriores al cursor;
+- la regla de "solo pendientes de revisión": una difusión de un archivo que ya
+  no está en 'en_revision' (o que se eliminó) cuenta como leída.
+
+El feed de cada usuario se arma al leer: una consulta ``UNION ALL`` de sus
+``Notification`` y de las difusiones de su audiencia posteriores a su
+registro. Las difusiones aparecen con id ``"d<id>"``.
+"""
+import logging
+from datetime import datetime
+
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import and_, case, delete, exists, func, literal, select, union_all, update
+
+from app import db
+from app.models import (
+    Archivo, Notification, NotificacionDifundida, NotificacionDifundidaLeida, User
+)
+
+logger = logging.getLogger(__name__)
+
+AUDIENCIAS = {
+    'staff': ('admin', 'superadmin', 'lector'),
+}
+PREFIJO_DIFUNDIDA = 'd'
+
+
+def audiencias_de(rol):
+    """Audiencias que incluyen el rol ``rol``."""
+    return [audiencia for audiencia, roles in AUDIENCIAS.items() if rol in roles]
+
+
+def lector(user_id):
+    """Datos del usuario que necesita el feed (id, rol, registro, cursor) o None."""
+    return db.session.execute(
+        select(User.id, User.rol, User.fecha_registro, User.difundidas_leidas_hasta,
+               User.notificaciones_no_leidas)
+        .where(User.id == user_id)
+    ).first()
+
+
+def difundir(audiencia, titulo, mensaje, archivo_id=None, autor_id=None,
+             titulo_autor=None, mensaje_autor=None, tipo='info'):
+    """Agrega a la sesión una notificación para toda ``audiencia``; el llamador hace commit."""
+    if audiencia not in AUDIENCIAS:
+        raise ValueError(f"Audiencia desconocida: {audiencia}")
+    notificacion = NotificacionDifundida(
+        audiencia=audiencia,
+        archivo_id=archivo_id,
+        autor_id=autor_id,
+        titulo=titulo,
+        mensaje=mensaje,
+        titulo_autor=titulo_autor,
+        mensaje_autor=mensaje_autor,
+        tipo=tipo,
+        fecha_creacion=datetime.utcnow(),
+    )
+    db.session.add(notificacion)
+    return notificacion
+
+
+# --- Consultas
+
+def _visibles(usuario):
+    """Condiciones de las difusiones que ve ``usuario``, o None si no pertenece a ninguna audiencia."""
+    audiencias = audiencias_de(usuario.rol)
+    if not audiencias:
+        return None
+    condiciones = [NotificacionDifundida.audiencia.in_(audiencias)]
+    if usuario.fecha_registro is not None:
+        condiciones.append(NotificacionDifundida.fecha_creacion >= usuario.fecha_registro)
+    return condiciones
+
+
+def _no_leida(usuario, en_revision=None):
+    """
+    Condición de difusión no leída. ``en_revision`` es la condición de
+    "archivo pendiente"; por defecto ``Archivo.estado`` (requiere el join con
+    ``archivo``).
+    """
+    D = NotificacionDifundida
+    condiciones = [
+        Archivo.estado == 'en_revision' if en_revision is None else en_revision,
+        ~exists().where(
+            NotificacionDifundidaLeida.notificacion_id == D.id,
+            NotificacionDifundidaLeida.user_id == usuario.id,
+        ),
+    ]
+    if usuario.difundidas_leidas_hasta is not None:
+        condiciones.append(D.fecha_creacion > usuario.difundidas_leidas_hasta)
+    return and_(*condiciones)
+
+
+def contar_difundidas_no_leidas(usuario):
+    """
+    Difusiones no leídas de ``usuario``. Parte de los archivos en revisión
+    (índice por ``archivo.estado``) y no del historial de difusiones, así que
+    el costo depende de la cola de revisión y no de cuántas se han enviado.
+    """
+    visibles = _visibles(usuario)
+    if visibles is None:
+        return 0
+    en_revision = NotificacionDifundida.archivo_id.in_(
+        select(Archivo.id).where(Archivo.estado == 'en_revision')
+    )
+    return db.session.execute(
+        select(func.count())
+        .select_from(NotificacionDifundida)
+        .where(*visibles, _no_leida(usuario, en_revision))
+    ).scalar() or 0
+
+
+def _select_propias(usuario, solo_no_leidas):
+    N = Notification
+    consulta = select(
+        literal('usuario').label('origen'), N.id.label('id'), N.titulo.label('titulo'),
+        N.mensaje.label('mensaje'), N.tipo.label('tipo'), N.archivo_id.label('archivo_id'),
+        func.coalesce(N.leida, False).label('leida'), N.fecha_creacion.label('fecha_creacion'),
+    ).where(N.user_id == usuario.id)
+    if solo_no_leidas:
+        consulta = consulta.where(N.leida.is_(False))
+    return consulta
+
+
+def _select_difundidas(usuario, visibles, solo_no_leidas):
+    D = NotificacionDifundida
+    es_autor = D.autor_id == usuario.id
+    no_leida = _no_leida(usuario)
+    consulta = (
+        select(
+            literal('difundida').label('origen'), D.id.label('id'),
+            func.coalesce(case((es_autor, D.titulo_autor)), D.titulo).label('titulo'),
+            func.coalesce(case((es_autor, D.mensaje_autor)), D.mensaje).label('mensaje'),
+            D.tipo.label('tipo'), D.archivo_id.label('archivo_id'),
+            case((no_leida, False), else_=True).label('leida'), D.fecha_creacion.label('fecha_creacion'),
+        )
+        .select_from(D)
+        .outerjoin(Archivo, Archivo.id == D.archivo_id)
+        .where(*visibles)
+    )
+    if solo_no_leidas:
+        consulta = consulta.where(no_leida)
+    return consulta
+
+
+def _recientes(consulta, columnas, limite):
+    """``consulta`` acotada a sus ``limite`` filas más recientes (None: sin acotar)."""
+    if limite is None:
+        return consulta
+    # Envuelta en una subconsulta: SQLite no admite ORDER BY/LIMIT en las ramas de un UNION
+    sub = consulta.order_by(columnas.fecha_creacion.desc(), columnas.id.desc()).limit(limite).subquery()
+    return select(*sub.c)
+
+
+def _feed(usuario, solo_no_leidas=False, limite=None):
+    """
+    Feed combinado. Con ``limite`` cada rama trae solo sus ``limite`` filas más
+    recientes (las únicas que pueden entrar en la página), así que la base no
+    ordena el historial completo de las dos tablas.
+    """
+    propias = _recientes(_select_propias(usuario, solo_no_leidas), Notification, limite)
+    visibles = _visibles(usuario)
+    if visibles is None:
+        return propias.subquery()
+    difundidas = _recientes(_select_difundidas(usuario, visibles, solo_no_leidas), NotificacionDifundida, limite)
+    return union_all(propias, difundidas).subquery()
+
+
+class ItemNotificacion:
+    """Notificación del feed con los atributos que usan las plantillas y la API."""
+
+    __slots__ = ('origen', 'id', 'titulo', 'mensaje', 'tipo', 'archivo_id', 'leida',
+                 'fecha_creacion', 'archivo')
+
+    def __init__(self, fila, archivo=None):
+        self.origen = fila.origen
+        self.id = f"{PREFIJO_DIFUNDIDA}{fila.id}" if fila.origen == 'difundida' else fila.id
+        self.titulo = fila.titulo
+        self.mensaje = fila.mensaje
+        self.tipo = fila.tipo
+        self.archivo_id = fila.archivo_id
+        self.leida = bool(fila.leida)
+        self.fecha_creacion = fila.fecha_creacion
+        self.archivo = archivo
+
+
+def obtener_feed(usuario, limit, offset=0, solo_no_leidas=False):
+    """Notificaciones de ``usuario`` (propias y difundidas), las más recientes primero."""
+    feed = _feed(usuario, solo_no_leidas, None if limit is None else offset + limit)
+    consulta = select(feed).order_by(feed.c.fecha_creacion.desc(), feed.c.id.desc()).offset(offset)
+    if limit is not None:
+        consulta = consulta.limit(limit)
+    filas = db.session.execute(consulta).all()
+
+    archivo_ids = {f.archivo_id for f in filas if f.archivo_id is not None}
+    archivos = {}
+    if archivo_ids:
+        archivos = {a.id: a for a in Archivo.query.filter(Archivo.id.in_(archivo_ids))}
+    return [ItemNotificacion(f, archivos.get(f.archivo_id)) for f in filas]
+
+
+def contar_feed(usuario, solo_no_leidas=False):
+    return db.session.execute(select(func.count()).select_from(_feed(usuario, solo_no_leidas))).scalar() or 0
+
+
+class FeedPagination(Pagination):
+    """Paginación de Flask-SQLAlchemy sobre el feed combinado."""
+
+    def _query_items(self):
+        return obtener_feed(self._query_args['usuario'], self.per_page, self._query_offset)
+
+    def _query_count(self):
+        return contar_feed(self._query_args['usuario'])
+
+
+def paginar_feed(usuario, page, per_page):
+    return FeedPagination(page=page, per_page=per_page, error_out=False, usuario=usuario)
+
+
+# --- Lectura
+
+def parsear_id_difundida(valor):
+    """``"d12"`` -> 12; None si ``valor`` no es el id de una difusión."""
+    valor = str(valor or '')
+    if valor.startswith(PREFIJO_DIFUNDIDA) and valor[len(PREFIJO_DIFUNDIDA):].isdigit():
+        return int(valor[len(PREFIJO_DIFUNDIDA):])
+    return None
+
+
+def marcar_difundida_leida(notificacion_id, usuario):
+    """Registra la lectura de una difusión visible para ``usuario``. No hace commit.
+
+    Retorna False si la difusión no existe o no pertenece a su audiencia.
+    """
+    visibles = _visibles(usuario)
+    if visibles is None:
+        return False
+    existe = db.session.execute(
+        select(NotificacionDifundida.id).where(NotificacionDifundida.id == notificacion_id, *visibles)
+    ).first()
+    if not existe:
+        return False
+    ya_leida = db.session.get(NotificacionDifundidaLeida, (notificacion_id, usuario.id))
+    if ya_leida is None:
+        db.session.add(NotificacionDifundidaLeida(
+            notificacion_id=notificacion_id, user_id=usuario.id, fecha_leida=datetime.utcnow()
+        ))
+    return True
+
+
+def marcar_difundidas_leidas(usuario):
+    """Mueve el cursor de ``usuario`` a ahora; las marcas individuales ya no hacen falta. No hace commit."""
+    # Por la conexión: el cursor no es un cambio que deba invalidar el snapshot del dashboard
+    tabla = User.__table__
+    db.session.connection().execute(
+        update(tabla).where(tabla.c.id == usuario.id).values(difundidas_leidas_hasta=datetime.utcnow())
+    )
+    db.session.execute(delete(NotificacionDifundidaLeida).where(NotificacionDifundidaLeida.user_id == usuario.id))
@@ -1,13 +1,22 @@
 """
 Utilidades para el sistema de notificaciones
 """
-from app.models import User, Notification, Beneficiario, Archivo
+from app.models import (
+    User, Notification, NotificacionDifundida, NotificacionSaliente, Beneficiario, Archivo
+)
 from app import db
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterable, Optional
+from sqlalchemy import and_, case, func, select, update
+from sqlalchemy.orm.attributes import set_committed_value
 from flask import current_app
 import traceback
 
+from app.utils.notification_feed import (
+    audiencias_de, contar_difundidas_no_leidas, difundir, lector, marcar_difundida_leida,
+    marcar_difundidas_leidas, obtener_feed, parsear_id_difundida,
+)
+
 
 def archivo_tiene_etiqueta_pendiente_revision(archivo: Optional[Archivo]) -> bool:
     """Retorna True si, según la UI, el archivo mostraría la etiqueta 'Pendiente para revisión'.
@@ -22,12 +31,153 @@ def archivo_tiene_etiqueta_pendiente_revision(archivo: Optional[Archivo]) -> boo
     return estado.strip() == 'en_revision'
 
 
+# --- Contador de no leídas (User.notificaciones_no_leidas)
+#
+# El header y los endpoints de polling leen el contador en vez de contar
+# filas. Los eventos de app/events.py lo mantienen en la misma transacción que
+# crea, marca o borra la notificación; las operaciones masivas (UPDATE/DELETE
+# sin ORM) deben usar ``marcar_leidas_por_archivos`` o ``recalcular_no_leidas``.
+
+def ajustar_no_leidas(connection, deltas: Dict[int, int]) -> None:
+    """Suma ``deltas`` ({user_id: delta}) al contador de cada usuario (sin bajar de 0)."""
+    tabla = User.__table__
+    for user_id, delta in deltas.items():
+        if not delta or user_id is None:
+            continue
+        nuevo = tabla.c.notificaciones_no_leidas + delta
+        connection.execute(
+            update(tabla)
+            .where(tabla.c.id == user_id)
+            .values(notificaciones_no_leidas=case((nuevo < 0, 0), else_=nuevo))
+        )
+
+
+def recalcular_no_leidas(user_ids: Optional[Iterable[int]] = None) -> None:
+    """Recalcula el contador desde la tabla ``notification`` (todos o ``user_ids``). No hace commit."""
+    tabla = User.__table__
+    conteo = (
+        select(func.count(Notification.id))
+        .where(Notification.user_id == tabla.c.id, Notification.leida.is_(False))
+        .scalar_subquery()
+    )
+    stmt = update(tabla).values(notificaciones_no_leidas=conteo)
+    if user_ids is not None:
+        stmt = stmt.where(tabla.c.id.in_(list(user_ids)))
+    db.session.execute(stmt)
+
+
+def marcar_leidas_por_archivos(connection, archivo_ids: Iterable[int], session=None) -> int:
+    """Marca como leídas las notificaciones *no leídas* de ``archivo_ids`` (salvo las de
+    cambio de estado) y descuenta el contador de cada usuario.
+
+    Regla UX: solo los documentos con etiqueta "Pendiente para revisión" deben aparecer
+    como pendientes por leer. Se aplica cuando el archivo sale de 'en_revision' o se borra.
+    """
+    archivo_ids = [i for i in archivo_ids if i is not None]
+    if not archivo_ids:
+        return 0
+    tabla = Notification.__table__
+    condicion = and_(
+        tabla.c.archivo_id.in_(archivo_ids),
+        tabla.c.leida.is_(False),
+        # No auto-marcar las notificaciones de cambio de estado (validado/rechazado)
+        # porque el cliente debe enterarse.
+        tabla.c.tipo != 'estado_archivo',
+    )
+    por_usuario = dict(
+        connection.execute(select(tabla.c.user_id, func.count()).where(condicion).group_by(tabla.c.user_id)).all()
+    )
+    if not por_usuario:
+        return 0
+    connection.execute(update(tabla).where(condicion).values(leida=True, fecha_leida=datetime.utcnow()))
+    ajustar_no_leidas(connection, {uid: -total for uid, total in por_usuario.items()})
+
+    # Las instancias ya cargadas en la sesión no deben volver a descontar
+    if session is not None:
+        ids = set(archivo_ids)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Notification) and obj.archivo_id in ids \
+                    and obj.tipo != 'estado_archivo' and not obj.leida:
+                set_committed_value(obj, 'leida', True)
+    return sum(por_usuario.values())
+
+
+def _auto_leible(notificacion: Notification) -> bool:
+    return (notificacion.archivo_id is not None or notificacion.archivo is not None) \
+        and notificacion.tipo != 'estado_archivo'
+
+
+def aplicar_regla_auto_leida(session, flush_context=None, instances=None) -> None:
+    """Evento ``before_flush``: aplica la regla de "solo pendientes de revisión" al escribir.
+
+    - Notificaciones nuevas de un archivo que no está en revisión se guardan leídas.
+    - Si un archivo sale de 'en_revision' (o se elimina) se marcan leídas sus notificaciones.
+    """
+    with session.no_autoflush:
+        for obj in session.deleted:
+            if isinstance(obj, Notification):
+                obj.leida  # cargar el valor para actualizar_contadores si la instancia expiró
+        for obj in session.new:
+            if isinstance(obj, Notification) and not obj.leida and _auto_leible(obj):
+                archivo = obj.archivo or session.get(Archivo, obj.archivo_id)
+                if archivo in session.new and archivo.estado is None:
+                    continue  # Se insertará con el estado por defecto ('en_revision')
+                if not archivo_tiene_etiqueta_pendiente_revision(archivo):
+                    obj.leida = True
+                    obj.fecha_leida = obj.fecha_leida or datetime.utcnow()
+
+    eliminados = [obj.id for obj in session.deleted if isinstance(obj, Archivo) and obj.id is not None]
+    if eliminados:
+        desvincular_archivos(session.connection(), eliminados, session)
+
+    archivo_ids = []
+    for obj in session.dirty:
+        if isinstance(obj, Archivo) and obj.id is not None \
+                and db.inspect(obj).attrs.estado.history.has_changes() \
+                and not archivo_tiene_etiqueta_pendiente_revision(obj):
+            archivo_ids.append(obj.id)
+    if archivo_ids:
+        marcar_leidas_por_archivos(session.connection(), archivo_ids, session)
+
+
+def actualizar_contadores(session, flush_context=None) -> None:
+    """Evento ``after_flush``: ajusta ``User.notificaciones_no_leidas`` con las notificaciones del flush."""
+    deltas: Dict[int, int] = {}
+
+    def sumar(user_id, delta):
+        deltas[user_id] = deltas.get(user_id, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Notification) and not obj.leida:
+            sumar(obj.user_id, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Notification):
+            # Estado en la BD antes del flush
+            leida = db.inspect(obj).attrs.leida.history
+            antes = leida.deleted[0] if leida.deleted else obj.leida
+            if not antes:
+                sumar(obj.user_id, -1)
+    for obj in session.dirty:
+        if isinstance(obj, Notification):
+            leida = db.inspect(obj).attrs.leida.history
+            if leida.has_changes():
+                antes = bool(leida.deleted[0]) if leida.deleted else False
+                ahora = bool(obj.leida)
+                if antes != ahora:
+                    sumar(obj.user_id, -1 if ahora else 1)
+    if any(deltas.values()):
+        ajustar_no_leidas(session.connection(), deltas)
+
+
 def marcar_notificaciones_archivos_fuera_de_revision_como_leidas(user_id: int) -> int:
     """Marca como leídas las notificaciones *no leídas* asociadas a archivos cuyo estado NO es 'en_revision'.
 
     Regla UX: solo los documentos con etiqueta "Pendiente para revisión" deben aparecer como
     pendientes por leer en el centro de notificaciones.
 
+    La regla ya se aplica al cambiar ``Archivo.estado`` (app/events.py); esta función queda
+    para reconciliar datos de un usuario (p. ej. tras cambios hechos fuera de la aplicación).
+
     Returns:
         Cantidad de notificaciones actualizadas.
     """
@@ -66,6 +216,7 @@ def marcar_notificaciones_archivos_fuera_de_revision_como_leidas(user_id: int) -
             )
         )
         if updated:
+            recalcular_no_leidas([user_id])
             db.session.commit()
         return int(updated or 0)
     except Exception as e:
@@ -79,8 +230,11 @@ def marcar_notificaciones_archivos_fuera_de_revision_como_leidas(user_id: int) -
 
 def notificar_archivo_subido(nombre_archivo: str, usuario_subio, categoria: str, archivo_id: Optional[int] = None):
     """
-    Envía notificaciones a usuarios admin y lector cuando se sube un archivo
-    
+    Notifica a los usuarios admin, superadmin y lector cuando se sube un archivo.
+
+    Se guarda una sola notificación difundida a la audiencia 'staff' (ver
+    app/utils/notification_feed.py); cada usuario la ve en su feed al leer.
+
     Args:
         nombre_archivo: Nombre del archivo subido
         usuario_subio: Usuario o Beneficiario que subió el archivo
@@ -93,7 +247,7 @@ def notificar_archivo_subido(nombre_archivo: str, usuario_subio, categoria: str,
         if not archivo_id:
             return True
         try:
-            archivo = Archivo.query.get(archivo_id)
+            archivo = db.session.get(Archivo, archivo_id)
         except Exception:
             archivo = None
         if not archivo_tiene_etiqueta_pendiente_revision(archivo):
@@ -108,7 +262,7 @@ def notificar_archivo_subido(nombre_archivo: str, usuario_subio, categoria: str,
             nombre_usuario = usuario_subio.nombre_completo
             rol_usuario = getattr(usuario_subio, 'rol', None)
             tipo_usuario = rol_usuario or "usuario"
-        
+
         # Preparar mensaje según quién subió
         titulo = "Nuevo archivo subido"
         if rol_usuario in ['admin', 'superadmin', 'lector']:
@@ -117,122 +271,54 @@ def notificar_archivo_subido(nombre_archivo: str, usuario_subio, categoria: str,
         else:
             # Mensaje para cuando un cliente/beneficiario sube archivo
             mensaje = f"{nombre_usuario} ({tipo_usuario}) ha subido un nuevo archivo: {nombre_archivo}"
-        
+
         if categoria:
             mensaje += f" en la categoría {categoria}"
-        
-        # Obtener todos los usuarios admin y lector
-        usuarios_notificar = User.query.filter(
-            User.rol.in_(['admin', 'superadmin', 'lector'])
-        ).all()
-        
-        try:
-            current_app.logger.info(f"🔔 Preparando notificaciones - Archivo: {nombre_archivo}, Archivo ID: {archivo_id}, Usuario subió: {nombre_usuario}, Rol: {getattr(usuario_subio, 'rol', 'N/A')}, Usuarios a notificar: {len(usuarios_notificar)}")
-        except Exception:
-            print(f"🔔 DEBUG: Preparando notificaciones - Archivo: {nombre_archivo}, Archivo ID: {archivo_id}, Usuario subió: {nombre_usuario}, Rol: {getattr(usuario_subio, 'rol', 'N/A')}, Usuarios a notificar: {len(usuarios_notificar)}")
-        
-        # Verificar que hay usuarios para notificar
-        if not usuarios_notificar:
-            print("⚠️ WARNING: No hay usuarios admin/lector para notificar")
-            return False
-        
-        # Crear notificaciones para cada usuario
-        notificaciones_enviadas = 0
-        notificaciones_creadas = []
-        
-        for usuario in usuarios_notificar:
-            # Notificar a todos los admin/lector, incluyendo quien subió el archivo
-            # Solo omitir si quien subió es un cliente
-            if isinstance(usuario_subio, User) and usuario.id == usuario_subio.id and usuario_subio.rol == 'cliente':
-                try:
-                    current_app.logger.info(f"⏭️ Omitiendo notificación para cliente que subió archivo (ID: {usuario.id})")
-                except Exception:
-                    print(f"⏭️ Omitiendo notificación para cliente que subió archivo (ID: {usuario.id})")
-                continue
-            
-            try:
-                # Personalizar el mensaje según quién recibe la notificación
-                mensaje_personalizado = mensaje
-                titulo_personalizado = titulo
-                
-                # Si quien recibe es quien subió el archivo
-                if isinstance(usuario_subio, User) and usuario.id == usuario_subio.id:
-                    titulo_personalizado = "Archivo subido exitosamente"
-                    mensaje_personalizado = f"Has subido exitosamente el archivo: {nombre_archivo}"
-                    if categoria:
-                        mensaje_personalizado += f" en la categoría {categoria}"
-                
-                notificacion = Notification(
-                    user_id=usuario.id,
-                    archivo_id=archivo_id,
-                    titulo=titulo_personalizado,
-                    mensaje=mensaje_personalizado,
-                    tipo='info',
-                    leida=False,
-                    fecha_creacion=datetime.utcnow()
-                )
-                db.session.add(notificacion)
-                notificaciones_creadas.append(notificacion)
-                notificaciones_enviadas += 1
-                try:
-                    current_app.logger.info(f"🔔 Notificación creada para usuario ID {usuario.id} ({usuario.email}) - Archivo ID: {archivo_id}")
-                except Exception:
-                    print(f"🔔 DEBUG: Notificación creada para usuario ID {usuario.id} ({usuario.email}) - Archivo ID: {archivo_id}")
-            except Exception as e_notif:
-                print(f"❌ ERROR al crear notificación para usuario {usuario.id}: {e_notif}")
-                traceback.print_exc()
-                continue
-        
-        # Confirmar las notificaciones solo si se crearon algunas
-        if notificaciones_creadas:
-            try:
-                db.session.commit()
-                try:
-                    current_app.logger.info(f"✅ {notificaciones_enviadas} notificaciones guardadas exitosamente en la base de datos")
-                except Exception:
-                    print(f"✅ {notificaciones_enviadas} notificaciones guardadas exitosamente en la base de datos")
-                
-                # Verificar que se guardaron correctamente consultando la BD
-                for notif in notificaciones_creadas:
-                    try:
-                        # Consultar directamente en la BD para verificar
-                        notif_id = notif.id if hasattr(notif, 'id') and notif.id else None
-                        if notif_id:
-                            notif_verificada = Notification.query.get(notif_id)
-                            if notif_verificada:
-                                try:
-                                    current_app.logger.info(f"✅ Verificado: Notificación ID {notif_id} guardada correctamente en BD (Usuario: {notif_verificada.user_id}, Archivo: {notif_verificada.archivo_id})")
-                                except Exception:
-                                    print(f"✅ Verificado: Notificación ID {notif_id} guardada correctamente en BD (Usuario: {notif_verificada.user_id}, Archivo: {notif_verificada.archivo_id})")
-                            else:
-                                print(f"❌ ERROR: Notificación ID {notif_id} no encontrada en la base de datos después del commit")
-                        else:
-                            print(f"⚠️ WARNING: Notificación no tiene ID asignado después del commit")
-                    except Exception as e_verif:
-                        print(f"⚠️ WARNING: No se pudo verificar notificación: {e_verif}")
-                        traceback.print_exc()
-                
-                return True
-            except Exception as e_commit:
-                db.session.rollback()
-                print(f"❌ ERROR al hacer commit de notificaciones: {e_commit}")
-                traceback.print_exc()
-                return False
-        else:
-            print("⚠️ WARNING: No se crearon notificaciones para guardar")
-            return False
-        
+
+        # Quien subió el archivo (si es del staff) ve su propia variante del mensaje
+        autor_id = titulo_autor = mensaje_autor = None
+        if isinstance(usuario_subio, User):
+            autor_id = usuario_subio.id
+            titulo_autor = "Archivo subido exitosamente"
+            mensaje_autor = f"Has subido exitosamente el archivo: {nombre_archivo}"
+            if categoria:
+                mensaje_autor += f" en la categoría {categoria}"
+
+        notificacion = difundir(
+            'staff', titulo, mensaje,
+            archivo_id=archivo_id,
+            autor_id=autor_id,
+            titulo_autor=titulo_autor,
+            mensaje_autor=mensaje_autor,
+        )
+        db.session.commit()
+        current_app.logger.info(
+            f"🔔 Notificación difundida #{notificacion.id} a staff - Archivo ID: {archivo_id}, Usuario subió: {nombre_usuario}"
+        )
+        return True
+
     except Exception as e:
         db.session.rollback()
         print(f"❌ ERROR general al enviar notificaciones: {e}")
-        import traceback
         traceback.print_exc()
         return False
 
 
+def desvincular_archivos(connection, archivo_ids: Iterable[int], session=None) -> None:
+    """Antes de un DELETE masivo de archivos: marca leídas sus notificaciones (ajustando
+    los contadores) y quita las referencias a ``archivo_ids`` de las tablas de notificaciones."""
+    archivo_ids = [i for i in archivo_ids if i is not None]
+    if not archivo_ids:
+        return
+    marcar_leidas_por_archivos(connection, archivo_ids, session)
+    for modelo in (Notification, NotificacionDifundida, NotificacionSaliente):
+        tabla = modelo.__table__
+        connection.execute(update(tabla).where(tabla.c.archivo_id.in_(archivo_ids)).values(archivo_id=None))
+
+
 def obtener_notificaciones_no_leidas(user_id: int):
     """
-    Obtiene las notificaciones no leídas de un usuario
+    Obtiene las notificaciones no leídas de un usuario (propias y difundidas)
     
     Args:
         user_id: ID del usuario
@@ -241,14 +327,10 @@ def obtener_notificaciones_no_leidas(user_id: int):
         Lista de notificaciones no leídas
     """
     try:
-        # Auto-marcar como leídas las notificaciones de archivos fuera de revisión,
-        # para que solo "Pendiente para revisión" quede como pendiente.
-        marcar_notificaciones_archivos_fuera_de_revision_como_leidas(user_id)
-        notificaciones = Notification.query.filter_by(
-            user_id=user_id,
-            leida=False
-        ).order_by(Notification.fecha_creacion.desc()).all()
-        return notificaciones
+        usuario = lector(user_id)
+        if usuario is None:
+            return []
+        return obtener_feed(usuario, None, solo_no_leidas=True)
     except Exception as e:
         print(f"Error al obtener notificaciones: {e}")
         return []
@@ -265,31 +347,35 @@ def contar_notificaciones_no_leidas(user_id: int):
         Número de notificaciones no leídas
     """
     try:
-        # Auto-marcar como leídas las notificaciones de archivos fuera de revisión,
-        # para que solo "Pendiente para revisión" quede como pendiente.
-        marcar_notificaciones_archivos_fuera_de_revision_como_leidas(user_id)
-        count = Notification.query.filter_by(
-            user_id=user_id,
-            leida=False
-        ).count()
-        return count
+        usuario = lector(user_id)
+        if usuario is None:
+            return 0
+        return int(usuario.notificaciones_no_leidas or 0) + contar_difundidas_no_leidas(usuario)
     except Exception as e:
         print(f"Error al contar notificaciones: {e}")
         return 0
 
 
-def marcar_notificacion_leida(notificacion_id: int, user_id: int):
+def marcar_notificacion_leida(notificacion_id, user_id: int):
     """
     Marca una notificación como leída
     
     Args:
-        notificacion_id: ID de la notificación
+        notificacion_id: ID de la notificación (``"d<id>"`` para las difundidas)
         user_id: ID del usuario (para validación)
         
     Returns:
         True si se marcó correctamente, False en caso contrario
     """
     try:
+        difundida_id = parsear_id_difundida(notificacion_id)
+        if difundida_id is not None:
+            usuario = lector(user_id)
+            if usuario is None or not marcar_difundida_leida(difundida_id, usuario):
+                return False
+            db.session.commit()
+            return True
+
         notificacion = Notification.query.filter_by(
             id=notificacion_id,
             user_id=user_id
@@ -328,6 +414,10 @@ def marcar_todas_notificaciones_leidas(user_id: int):
         for notif in notificaciones:
             notif.leida = True
             notif.fecha_leida = datetime.utcnow()
+
+        usuario = lector(user_id)
+        if usuario is not None and audiencias_de(usuario.rol):
+            marcar_difundidas_leidas(usuario)
         
         db.session.commit()
         return True
@@ -336,4 +426,3 @@ def marcar_todas_notificaciones_leidas(user_id: int):
         db.session.rollback()
         print(f"Error al marcar todas las notificaciones como leídas: {e}")
         return False
-
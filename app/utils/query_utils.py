@@ -0,0 +1,78 @@
+"""
+Utilidades de consultas compartidas por las rutas.
+"""
+import base64
+import json
+from datetime import datetime
+
+from app import db
+
+
+def _escapar_like(texto):
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def filtro_prefijo_ruta(columna, carpeta, dialecto=None):
+    """
+    Condición "la ruta está dentro de ``carpeta``" sin distinguir mayúsculas
+    (como Dropbox), que puede usar el índice sobre ``lower(dropbox_path)``.
+
+    - SQLite: rango ``lower(ruta) >= lower('carpeta/')`` y
+      ``< lower('carpeta0')`` (``0`` es el carácter siguiente a ``/``); el
+      ``LIKE`` no usa índices de expresión.
+    - PostgreSQL: ``lower(ruta) LIKE 'carpeta/%'`` con la carpeta ya en
+      minúsculas (índice ``varchar_pattern_ops`` sobre ``lower()``).
+    - MySQL: ``LIKE 'carpeta/%'`` (la collation ya no distingue mayúsculas).
+
+    Los comodines presentes en el nombre de la carpeta se escapan, así que una
+    carpeta con ``_`` o ``%`` no coincide con carpetas vecinas.
+
+    ``dialecto`` permite usarla fuera de la app (por defecto, el de ``db``).
+    """
+    carpeta = (carpeta or '').rstrip('/')
+    dialecto = dialecto or db.engine.dialect.name
+    if dialecto == 'sqlite':
+        # lower() del lado de SQLite en ambos lados: solo pasa ASCII a minúsculas
+        ruta = db.func.lower(columna)
+        return db.and_(ruta >= db.func.lower(carpeta + '/'), ruta < db.func.lower(carpeta + '0'))
+    if dialecto == 'postgresql':
+        return db.func.lower(columna).like(_escapar_like(carpeta.lower()) + '/%', escape='\\')
+    return columna.like(_escapar_like(carpeta) + '/%', escape='\\')
+
+
+# --- Paginación por cursor (keyset)
+
+def codificar_cursor(valor, fila_id):
+    """Cursor opaco de la última fila de una página: su valor de orden y su id."""
+    if isinstance(valor, datetime):
+        valor = valor.isoformat()
+    datos = json.dumps([valor, fila_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(datos).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
+    """``(valor, id)`` del cursor, o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        datos = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        valor, fila_id = json.loads(datos)
+        return valor, int(fila_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def despues_de_fecha(columna_fecha, columna_id, posicion):
+    """
+    Condición "después de ``posicion``" para el orden
+    ``columna_fecha DESC NULLS LAST, columna_id DESC``.
+    """
+    valor, ultimo_id = posicion
+    if valor is None:
+        return db.and_(columna_fecha.is_(None), columna_id < ultimo_id)
+    valor = datetime.fromisoformat(valor)
+    return db.or_(
+        columna_fecha < valor,
+        db.and_(columna_fecha == valor, columna_id < ultimo_id),
+        columna_fecha.is_(None),
+    )
@@ -0,0 +1,167 @@
+"""
+Conteos pre-agregados (rollups) de archivos subidos y usuarios registrados.
+
+``get_charts_data`` hacía unas 94 consultas ``COUNT`` por carga del dashboard
+(7 días, 4 semanas, 12 meses y 24 horas, para archivos y para usuarios), muchas
+con ``func.date(columna)``, que no puede usar el índice de la fecha. El costo
+crecía con el tamaño de ``archivo``.
+
+Aquí cada archivo o usuario nuevo suma 1 a su bucket de hora y de día (hora
+local de Colombia, UTC-5) en ``conteo_periodo``, en la misma transacción que
+lo inserta: evento ``after_flush`` registrado en app/events.py y
+``sumar_fechas`` en los INSERT multi-fila (sincronización y subida por lotes).
+Los gráficos leen dos rangos pequeños por métrica: los días del año en curso y
+las horas de hoy.
+
+Los conteos registran altas; los borrados no los restan.
+``python manage.py rollups_backfill`` reconstruye la tabla desde las filas
+actuales de ``archivo`` y ``user`` (al desplegar por primera vez, o para
+descontar lo eliminado).
+"""
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Colombia es UTC-5 (sin horario de verano)
+COLOMBIA_OFFSET = timedelta(hours=5)
+HORA = "hora"
+DIA = "dia"
+
+
+def _metricas():
+    from app.models import Archivo, User
+
+    return {"archivos": Archivo.fecha_subida, "usuarios": User.fecha_registro}
+
+
+def buckets(fecha_utc):
+    """Inicio (hora local) de los buckets de hora y de día de ``fecha_utc``."""
+    local = fecha_utc - COLOMBIA_OFFSET
+    return (
+        (HORA, local.replace(minute=0, second=0, microsecond=0)),
+        (DIA, datetime.combine(local.date(), datetime.min.time())),
+    )
+
+
+def _sumar(connection, metrica, granularidad, inicio, delta):
+    from app.models import ConteoPeriodo
+
+    tabla = ConteoPeriodo.__table__
+    clave = {"metrica": metrica, "granularidad": granularidad, "inicio": inicio}
+    dialecto = connection.dialect.name
+    if dialecto in ("postgresql", "sqlite"):
+        modulo = postgresql if dialecto == "postgresql" else sqlite
+        connection.execute(
+            modulo.insert(tabla)
+            .values(total=delta, **clave)
+            .on_conflict_do_update(
+                index_elements=["metrica", "granularidad", "inicio"],
+                set_={"total": tabla.c.total + delta},
+            )
+        )
+        return
+    res = connection.execute(
+        update(tabla)
+        .where(tabla.c.metrica == metrica, tabla.c.granularidad == granularidad, tabla.c.inicio == inicio)
+        .values(total=tabla.c.total + delta)
+    )
+    if res.rowcount == 0:
+        connection.execute(insert(tabla).values(total=delta, **clave))
+
+
+def sumar_fechas(metrica, fechas, connection=None):
+    """
+    Suma ``fechas`` (UTC) a los buckets de ``metrica``, agrupadas. Para
+    inserciones que no pasan por la sesión (``tabla.insert()`` multi-fila).
+    """
+    cambios = Counter()
+    for fecha in fechas:
+        if fecha is not None:
+            for bucket in buckets(fecha):
+                cambios[bucket] += 1
+    if not cambios:
+        return
+    connection = connection or db.session.connection()
+    for (granularidad, inicio), delta in cambios.items():
+        _sumar(connection, metrica, granularidad, inicio, delta)
+
+
+def registrar_cambios(session, flush_context=None):
+    """Evento ``after_flush``: suma los archivos/usuarios insertados en este flush."""
+    from app.models import Archivo, User
+
+    fechas = {"archivos": [], "usuarios": []}
+    for obj in session.new:
+        if isinstance(obj, Archivo):
+            fechas["archivos"].append(obj.fecha_subida)
+        elif isinstance(obj, User):
+            fechas["usuarios"].append(obj.fecha_registro)
+    for metrica, lista in fechas.items():
+        if lista:
+            sumar_fechas(metrica, lista, session.connection())
+
+
+def conteos(metrica, granularidad, desde, hasta):
+    """Mapa inicio del bucket -> total, para ``desde <= inicio < hasta`` (hora local)."""
+    from app.models import ConteoPeriodo
+
+    filas = db.session.execute(
+        select(ConteoPeriodo.inicio, ConteoPeriodo.total).where(
+            ConteoPeriodo.metrica == metrica,
+            ConteoPeriodo.granularidad == granularidad,
+            ConteoPeriodo.inicio >= desde,
+            ConteoPeriodo.inicio < hasta,
+        )
+    )
+    return {inicio: total for inicio, total in filas}
+
+
+def conteos_por_dia(metrica, desde, hasta):
+    """Mapa ``date`` -> total de los días locales entre ``desde`` y ``hasta`` (incluidos)."""
+    inicio = datetime.combine(desde, datetime.min.time())
+    fin = datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+    return {dia.date(): total for dia, total in conteos(metrica, DIA, inicio, fin).items()}
+
+
+def conteos_por_hora(metrica, dia):
+    """Mapa hora (0-23) -> total del día local ``dia``."""
+    inicio = datetime.combine(dia, datetime.min.time())
+    return {hora.hour: total for hora, total in conteos(metrica, HORA, inicio, inicio + timedelta(days=1)).items()}
+
+
+def reconstruir_rollups(lote=10000):
+    """
+    Recalcula ``conteo_periodo`` completo desde las tablas de origen.
+    Retorna ``{metrica: filas contadas}``.
+    """
+    from app.models import ConteoPeriodo
+
+    tabla = ConteoPeriodo.__table__
+    db.session.execute(delete(tabla))
+    resumen = {}
+    for metrica, columna in _metricas().items():
+        conteo = Counter()
+        filas = 0
+        consulta = select(columna).where(columna.isnot(None)).execution_options(yield_per=lote)
+        for (fecha,) in db.session.execute(consulta):
+            filas += 1
+            for bucket in buckets(fecha):
+                conteo[bucket] += 1
+        valores = [
+            {"metrica": metrica, "granularidad": granularidad, "inicio": inicio, "total": total}
+            for (granularidad, inicio), total in conteo.items()
+        ]
+        for i in range(0, len(valores), lote):
+            db.session.execute(insert(tabla), valores[i:i + lote])
+        resumen[metrica] = filas
+        logger.info(f"Rollups de {metrica}: {filas} filas en {len(valores)} buckets")
+    db.session.commit()
+    return resumen
+
@@ -0,0 +1,70 @@
+"""
+Respuestas de exportación por streaming (NDJSON y CSV).
+
+Las filas llegan de un generador (normalmente una consulta con ``yield_per``)
+y se escriben por bloques a medida que se producen: la memoria del worker no
+crece con el tamaño de la exportación.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+from flask import Response, stream_with_context
+
+FORMATOS = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+FILAS_POR_BLOQUE = 500
+
+
+def _valor(fila, clave):
+    """Valor de ``clave`` en ``fila``; ``'usuario.email'`` entra en diccionarios anidados."""
+    for parte in clave.split('.'):
+        if fila is None:
+            return None
+        fila = fila.get(parte)
+    return fila
+
+
+def ndjson(filas):
+    """Una línea JSON por fila."""
+    bloque = []
+    for fila in filas:
+        bloque.append(json.dumps(fila, ensure_ascii=False, default=str))
+        if len(bloque) >= FILAS_POR_BLOQUE:
+            yield '\n'.join(bloque) + '\n'
+            bloque = []
+    if bloque:
+        yield '\n'.join(bloque) + '\n'
+
+
+def csv_texto(filas, columnas):
+    """CSV con encabezado ``columnas`` (claves, admite ``'a.b'`` para anidados)."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for i, fila in enumerate(filas, 1):
+        valores = []
+        for columna in columnas:
+            valor = _valor(fila, columna)
+            valores.append(valor.isoformat() if isinstance(valor, datetime) else valor)
+        escritor.writerow(valores)
+        if i % FILAS_POR_BLOQUE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def respuesta_streaming(filas, formato, nombre, columnas_csv):
+    """``Response`` que emite ``filas`` como NDJSON o CSV mientras se consultan."""
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato de exportación no soportado: {formato}")
+    cuerpo = ndjson(filas) if formato == 'ndjson' else csv_texto(filas, columnas_csv)
+    respuesta = Response(stream_with_context(cuerpo), content_type=FORMATOS[formato])
+    respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre}.{formato}"'
+    respuesta.headers['X-Accel-Buffering'] = 'no'  # nginx: no acumular la respuesta
+    return respuesta
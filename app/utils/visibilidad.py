@@ -0,0 +1,139 @@
+"""
+Filtro de visibilidad de árboles de Dropbox en una sola pasada.
+
+Reemplaza a ``filtra_archivos_ocultos`` + ``filtra_carpetas_ocultas``, que se
+llamaban a sí mismas por cada subcarpeta y repetían en cada nodo la consulta
+del usuario y la de todos sus archivos/carpetas. Aquí las filas del usuario se
+cargan una vez en un mapa ruta -> banderas y el árbol se recorre una sola vez
+sin E/S por nodo.
+"""
+from app import db
+
+ROLES_VEN_TODO = ("admin", "superadmin", "lector")
+
+
+def _vacia():
+    """Estructura vacía (el usuario no puede ver nada)."""
+    return {"_archivos": [], "_subcarpetas": {}}
+
+
+class VisibilidadUsuario:
+    """
+    Reglas de visibilidad del árbol de un usuario para quien lo consulta.
+
+    - Solo se muestra lo que está dentro de ``base_path`` (carpeta del usuario).
+    - admin/superadmin/lector ven todos los archivos.
+    - El cliente dueño no ve sus archivos marcados como privados
+      (``es_publica`` False en BD).
+    - Una subcarpeta se muestra si está registrada en BD o si tiene contenido
+      visible (archivos o subcarpetas).
+    """
+
+    __slots__ = ("base_path", "privados", "carpetas_bd", "ve_todo", "es_duenio")
+
+    def __init__(self, base_path, privados=(), carpetas_bd=(), rol_visor=None, es_duenio=False):
+        self.base_path = (base_path or "").rstrip("/")
+        self.privados = set(privados)
+        self.carpetas_bd = set(carpetas_bd)
+        self.ve_todo = rol_visor in ROLES_VEN_TODO
+        self.es_duenio = bool(es_duenio) and rol_visor == "cliente"
+
+    @classmethod
+    def cargar(cls, usuario_id, visor=None):
+        """
+        Construye las reglas con tres consultas (usuario, archivos privados y
+        carpetas). Retorna None si el usuario no existe.
+        """
+        from app.models import Archivo, Folder, User
+
+        usuario = db.session.get(User, usuario_id)
+        if not usuario:
+            return None
+        base_path = usuario.dropbox_folder_path or f"/{usuario.email}"
+
+        rol_visor = getattr(visor, "rol", None)
+        es_duenio = getattr(visor, "id", None) == usuario_id
+        privados = ()
+        if es_duenio and rol_visor == "cliente":
+            # Solo importan los privados: el resto del árbol se muestra
+            privados = (
+                path for (path,) in db.session.query(Archivo.dropbox_path)
+                .filter(Archivo.usuario_id == usuario_id, Archivo.es_publica.is_(False))
+            )
+        carpetas_bd = (
+            path for (path,) in db.session.query(Folder.dropbox_path).filter(Folder.user_id == usuario_id)
+        )
+        return cls(base_path, privados, carpetas_bd, rol_visor, es_duenio)
+
+    def _archivo_visible(self, path):
+        if self.ve_todo:
+            return True
+        if self.es_duenio:
+            return path not in self.privados
+        return True
+
+    def dentro_de_base(self, path):
+        """True si ``path`` es la carpeta del usuario o está dentro de ella."""
+        path = (path or "").rstrip("/")
+        return path == self.base_path or path.startswith(self.base_path + "/")
+
+    def filtrar_nivel(self, prefix, archivos, carpetas, con_contenido=None):
+        """
+        Filtra un solo nivel (navegación perezosa, sin el árbol completo).
+
+        ``con_contenido(rutas)`` recibe las subcarpetas no registradas en BD y
+        retorna las que tienen contenido; sin él se muestran todas.
+        """
+        prefix = (prefix or "").rstrip("/")
+        if not self.dentro_de_base(prefix):
+            return [], []
+        visibles = [
+            nombre for nombre in archivos
+            if self._archivo_visible(f"{prefix}/{nombre}")
+        ]
+        no_registradas = [
+            f"{prefix}/{nombre}" for nombre in carpetas
+            if f"{prefix}/{nombre}" not in self.carpetas_bd
+        ]
+        con_datos = set(con_contenido(no_registradas)) if (con_contenido and no_registradas) else set(no_registradas)
+        subcarpetas = [
+            nombre for nombre in carpetas
+            if f"{prefix}/{nombre}" in self.carpetas_bd or f"{prefix}/{nombre}" in con_datos
+        ]
+        return visibles, subcarpetas
+
+    def filtrar(self, estructura, prefix=""):
+        """
+        Retorna una copia filtrada de ``estructura``
+        (``{'_archivos': [...], '_subcarpetas': {...}}``) cuya raíz es ``prefix``.
+        """
+        if not estructura:
+            return estructura
+        base = self.base_path
+        if not prefix.rstrip("/").startswith(base):
+            return _vacia()
+        return self._filtrar_nodo(estructura, prefix)
+
+    def _filtrar_nodo(self, nodo, prefix):
+        base = self.base_path
+        archivos = []
+        for nombre in nodo.get("_archivos", []):
+            path = f"{prefix}/{nombre}".replace("//", "/")
+            if path.startswith(base) and self._archivo_visible(path):
+                archivos.append(nombre)
+
+        subcarpetas = {}
+        for nombre, contenido in nodo.get("_subcarpetas", {}).items():
+            path = f"{prefix}/{nombre}".replace("//", "/")
+            if not path.startswith(base):
+                continue
+            if not contenido:
+                if path in self.carpetas_bd:
+                    subcarpetas[nombre] = contenido
+                continue
+            filtrado = self._filtrar_nodo(contenido, path)
+            # Tiene contenido si quedan archivos visibles o tenía subcarpetas
+            # (las subcarpetas vacías se evalúan en su propio nivel)
+            if path in self.carpetas_bd or filtrado["_archivos"] or contenido.get("_subcarpetas"):
+                subcarpetas[nombre] = filtrado
+        return {"_archivos": archivos, "_subcarpetas": subcarpetas}
@@ -43,6 +43,98 @@ class Config:
     # Subcarpeta del proyecto dentro de la carpeta base.
     # Si está vacía, NO se agrega ninguna subcarpeta adicional.
     DROPBOX_PROJECT_SUBFOLDER = os.environ.get('DROPBOX_PROJECT_SUBFOLDER') or ''
+
+    # Caché de estructuras de carpetas (app/structure_cache.py)
+    # memory: solo en el proceso; sqlite: compartida entre workers de gunicorn
+    # (también los enlaces temporales de descarga, app/dropbox_download.py)
+    STRUCTURE_CACHE_BACKEND = os.environ.get('STRUCTURE_CACHE_BACKEND', 'sqlite')
+    # Por defecto: <instance>/structure_cache.sqlite3
+    STRUCTURE_CACHE_SQLITE_PATH = os.environ.get('STRUCTURE_CACHE_SQLITE_PATH')
+    STRUCTURE_CACHE_FRESH_TTL = int(os.environ.get('STRUCTURE_CACHE_FRESH_TTL', 300))
+    STRUCTURE_CACHE_STALE_TTL = int(os.environ.get('STRUCTURE_CACHE_STALE_TTL', 900))
+    STRUCTURE_CACHE_MEMORY_MAX_BYTES = int(os.environ.get('STRUCTURE_CACHE_MEMORY_MAX_BYTES', 64 * 1024 * 1024))
+    STRUCTURE_CACHE_SHARED_MAX_BYTES = int(os.environ.get('STRUCTURE_CACHE_SHARED_MAX_BYTES', 256 * 1024 * 1024))
+    STRUCTURE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('STRUCTURE_CACHE_MAX_ENTRY_BYTES', 16 * 1024 * 1024))
+
+    # Snapshot del dashboard de administración (app/utils/dashboard_snapshot.py)
+    # Se comparte entre workers con STRUCTURE_CACHE_BACKEND=sqlite
+    DASHBOARD_SNAPSHOT_TTL = int(os.environ.get('DASHBOARD_SNAPSHOT_TTL', 60))
+    # Por defecto: <instance>/dashboard_cache.sqlite3
+    DASHBOARD_SNAPSHOT_SQLITE_PATH = os.environ.get('DASHBOARD_SNAPSHOT_SQLITE_PATH')
+
+    # Progreso de subidas por archivo (app/dropbox_upload.py), compartido
+    # entre workers con STRUCTURE_CACHE_BACKEND=sqlite
+    # Por defecto: <instance>/upload_progress.sqlite3
+    UPLOAD_PROGRESS_SQLITE_PATH = os.environ.get('UPLOAD_PROGRESS_SQLITE_PATH')
+
+    # Descargas desde Dropbox (app/dropbox_download.py)
+    # stream: el servidor reenvía el archivo por bloques (Range, ETag);
+    # redirect: 302 al enlace temporal de Dropbox (cacheado hasta que expira)
+    DROPBOX_DOWNLOAD_MODE = os.environ.get('DROPBOX_DOWNLOAD_MODE', 'stream')
+
+    # Outbox de notificaciones externas (app/notification_outbox.py)
+    # thread: worker en un hilo de cada proceso web;
+    # external: solo encola, procesa `python manage.py notification_worker`
+    NOTIFICATION_OUTBOX_WORKER = os.environ.get('NOTIFICATION_OUTBOX_WORKER', 'thread')
+    # Envíos simultáneos por proveedor (por proceso)
+    NOTIFICATION_OUTBOX_CONCURRENCY = os.environ.get('NOTIFICATION_OUTBOX_CONCURRENCY', 'smtp=2,sendgrid=4,twilio=2')
+    NOTIFICATION_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_OUTBOX_MAX_ATTEMPTS', 6))
+    NOTIFICATION_OUTBOX_BACKOFF_SECONDS = int(os.environ.get('NOTIFICATION_OUTBOX_BACKOFF_SECONDS', 30))
+    NOTIFICATION_OUTBOX_DEDUP_SECONDS = int(os.environ.get('NOTIFICATION_OUTBOX_DEDUP_SECONDS', 600))
+    # Espera máxima a los envíos en curso cuando un worker de gunicorn termina (worker_exit)
+    NOTIFICATION_OUTBOX_DRAIN_SECONDS = int(os.environ.get('NOTIFICATION_OUTBOX_DRAIN_SECONDS', 10))
+
+    # Cola de trabajos en segundo plano (app/job_runner.py): sincronizaciones,
+    # exportaciones y borrados masivos. thread: worker en un hilo de cada proceso
+    # web; external: solo encola, procesa `python manage.py job_worker`
+    JOB_RUNNER_WORKER = os.environ.get('JOB_RUNNER_WORKER', 'thread')
+    # Trabajos simultáneos por proceso
+    JOB_RUNNER_CONCURRENCY = int(os.environ.get('JOB_RUNNER_CONCURRENCY', 2))
+    JOB_RUNNER_MAX_ATTEMPTS = int(os.environ.get('JOB_RUNNER_MAX_ATTEMPTS', 3))
+    JOB_RUNNER_BACKOFF_SECONDS = int(os.environ.get('JOB_RUNNER_BACKOFF_SECONDS', 60))
+    # Espera máxima a los trabajos en curso cuando un worker de gunicorn termina
+    # (worker_exit); con la del outbox, menor que graceful_timeout (40 s) para
+    # que no lo maten antes
+    JOB_RUNNER_DRAIN_SECONDS = int(os.environ.get('JOB_RUNNER_DRAIN_SECONDS', 25))
+    
+    # Registro de actividad (app/activity_log_writer.py)
+    # buffered: cola en el proceso escrita por lotes; sync: commit por entrada
+    ACTIVITY_LOG_MODE = os.environ.get('ACTIVITY_LOG_MODE', 'buffered')
+    ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get('ACTIVITY_LOG_BATCH_SIZE', 200))
+    ACTIVITY_LOG_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_LOG_FLUSH_SECONDS', 2))
+    ACTIVITY_LOG_MAX_QUEUE = int(os.environ.get('ACTIVITY_LOG_MAX_QUEUE', 10000))
+    # Retención (app/activity_retention.py): días en la tabla y directorio de los segmentos archivados
+    ACTIVITY_LOG_HOT_DAYS = int(os.environ.get('ACTIVITY_LOG_HOT_DAYS', 90))
+    ACTIVITY_ARCHIVE_DIR = os.environ.get('ACTIVITY_ARCHIVE_DIR')  # None: instance/activity_archive
+
+    # Perfilado por petición (app/request_profiler.py): cabecera Server-Timing y /admin/perf
+    REQUEST_PROFILER_ENABLED = os.environ.get('REQUEST_PROFILER_ENABLED', 'false').lower() == 'true'
+    # Perfiles recientes guardados; compartidos entre workers con STRUCTURE_CACHE_BACKEND=sqlite
+    REQUEST_PROFILER_BUFFER = int(os.environ.get('REQUEST_PROFILER_BUFFER', 200))
+    # Peticiones más lentas que esto (ms) se registran en el log; 0 desactiva
+    REQUEST_PROFILER_SLOW_MS = float(os.environ.get('REQUEST_PROFILER_SLOW_MS', 2000))
+
+    # Métricas de la API de Dropbox en /metrics (app/dropbox_metrics.py).
+    # Prometheus debe enviar 'Authorization: Bearer <METRICS_TOKEN>'; sin
+    # token el endpoint responde 403, salvo con METRICS_ALLOW_ANONYMOUS=true
+    # (solo si /metrics no es accesible desde fuera: detrás del proxy todas
+    # las peticiones llegan desde 127.0.0.1).
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_ALLOW_ANONYMOUS = os.environ.get('METRICS_ALLOW_ANONYMOUS', 'false').lower() == 'true'
+
+    # Límite de tasa compartido de la API de Dropbox (app/dropbox_rate_limit.py)
+    DROPBOX_RATE_LIMIT_ENABLED = os.environ.get('DROPBOX_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    # Por defecto: <instance>/dropbox_rate_limit.sqlite3
+    DROPBOX_RATE_LIMIT_SQLITE_PATH = os.environ.get('DROPBOX_RATE_LIMIT_SQLITE_PATH')
+    DROPBOX_RATE_LIMIT_PER_SECOND = float(os.environ.get('DROPBOX_RATE_LIMIT_PER_SECOND', 10))
+    DROPBOX_RATE_LIMIT_BURST = float(os.environ.get('DROPBOX_RATE_LIMIT_BURST', 20))
+    # Tokens y llamadas simultáneas que solo pueden usar las peticiones web
+    DROPBOX_RATE_LIMIT_INTERACTIVE_RESERVE = float(os.environ.get('DROPBOX_RATE_LIMIT_INTERACTIVE_RESERVE', 5))
+    DROPBOX_MAX_CONCURRENCY = int(os.environ.get('DROPBOX_MAX_CONCURRENCY', 8))
+    DROPBOX_INTERACTIVE_CONCURRENCY_RESERVE = int(os.environ.get('DROPBOX_INTERACTIVE_CONCURRENCY_RESERVE', 2))
+    # Espera máxima por turno (s) antes de responder 503 / fallar la tarea
+    DROPBOX_INTERACTIVE_MAX_WAIT = float(os.environ.get('DROPBOX_INTERACTIVE_MAX_WAIT', 10))
+    DROPBOX_BACKGROUND_MAX_WAIT = float(os.environ.get('DROPBOX_BACKGROUND_MAX_WAIT', 300))
     
     # Configuración de logging
     LOG_LEVEL = 'INFO'
@@ -72,7 +164,17 @@ class Config:
     
     @staticmethod
     def init_app(app):
-        pass
+        # Con workers gthread cada proceso usa hasta GUNICORN_THREADS conexiones a la vez,
+        # más las de sus hilos de fondo (registro de actividad, outbox, movimientos).
+        uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+        if not uri.startswith('sqlite'):
+            opciones = {
+                'pool_size': int(os.environ.get('GUNICORN_THREADS', 4)) + 4,
+                'max_overflow': 10,
+                'pool_pre_ping': True,
+            }
+            opciones.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -91,6 +193,11 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    STRUCTURE_CACHE_BACKEND = 'memory'
+    NOTIFICATION_OUTBOX_WORKER = 'external'
+    JOB_RUNNER_WORKER = 'external'
+    ACTIVITY_LOG_MODE = 'sync'
+    DROPBOX_RATE_LIMIT_ENABLED = False
 
 config = {
     'development': DevelopmentConfig,
@@ -1,16 +1,25 @@
 # Configuración de Gunicorn para archivos grandes
 import multiprocessing
+import os
+import shutil
 
 # Configuración básica
 bind = "127.0.0.1:8000"
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# Casi todas las peticiones esperan a Dropbox o al SMTP: con gthread cada worker
+# atiende varias a la vez en hilos. GUNICORN_WORKER_CLASS=sync vuelve al modelo
+# de una petición por proceso. (gevent no se usa: psycopg2 bloquearía el bucle.)
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
 worker_connections = 1000
 
 # Configuración para archivos grandes
 max_requests = 1000
 max_requests_jitter = 50
 timeout = 300  # 5 minutos
+# Tiempo para drenar el outbox y los trabajos en curso al reciclar un worker
+# (NOTIFICATION_OUTBOX_DRAIN_SECONDS + JOB_RUNNER_DRAIN_SECONDS)
+graceful_timeout = 40
 keepalive = 2
 preload_app = True
 
@@ -26,4 +35,68 @@ limit_request_fields = 100
 limit_request_field_size = 8190
 
 # Configuración para archivos grandes
-worker_tmp_dir = "/dev/shm"  # Usar memoria compartida para archivos temporales 
\ No newline at end of file
+worker_tmp_dir = "/dev/shm"  # Usar memoria compartida para archivos temporales
+
+# Métricas de Dropbox compartidas entre workers (app/dropbox_metrics.py).
+# Debe definirse antes de cargar la app (preload_app) para que prometheus_client
+# use el modo multiproceso.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/dev/shm/dropboxapp_metrics")
+
+# Hooks
+def on_starting(server):
+    """Descarta las métricas de una ejecución anterior del servidor."""
+    directorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+
+def child_exit(server, worker):
+    """Libera los ficheros de métricas del worker que terminó."""
+    try:
+        from app.dropbox_metrics import proceso_terminado
+        proceso_terminado(worker.pid)
+    except Exception as e:
+        server.log.warning(f"No se pudieron liberar las métricas del worker {worker.pid}: {e}")
+
+def post_worker_init(worker):
+    """
+    Arranca el outbox de notificaciones y la cola de trabajos en el worker
+    (modo thread) para retomar los pendientes y encola la sincronización de
+    los cambios de Dropbox que la cola del webhook de un worker anterior no
+    llegó a aplicar.
+    """
+    try:
+        from app.notification_outbox import iniciar_worker
+        iniciar_worker(worker.wsgi)
+    except Exception as e:
+        worker.log.warning(f"No se pudo arrancar el outbox de notificaciones: {e}")
+    try:
+        from app.job_runner import iniciar_worker
+        iniciar_worker(worker.wsgi)
+    except Exception as e:
+        worker.log.warning(f"No se pudo arrancar la cola de trabajos: {e}")
+    try:
+        from app.dropbox_sync import ponerse_al_dia
+        ponerse_al_dia(worker.wsgi)
+    except Exception as e:
+        worker.log.warning(f"No se pudo encolar la sincronización de los cambios pendientes de Dropbox: {e}")
+
+def worker_exit(server, worker):
+    """
+    Drena el outbox de notificaciones y la cola de trabajos y escribe el
+    registro de actividad pendiente antes de que el worker termine.
+    """
+    try:
+        from app.notification_outbox import detener_worker
+        detener_worker()
+    except Exception as e:
+        server.log.warning(f"No se pudo detener el outbox de notificaciones: {e}")
+    try:
+        from app.job_runner import detener_worker
+        detener_worker()
+    except Exception as e:
+        server.log.warning(f"No se pudo detener la cola de trabajos: {e}")
+    try:
+        from app.activity_log_writer import cerrar_writer
+        cerrar_writer()
+    except Exception as e:
+        server.log.warning(f"No se pudo vaciar el registro de actividad: {e}")
@@ -26,12 +26,76 @@ def main():
     
     if len(sys.argv) > 1 and sys.argv[1] == 'run':
         # Ejecutar en modo desarrollo
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            # Outbox y cola de trabajos en el proceso que sirve (no en el vigilante del reloader)
+            from app import job_runner, notification_outbox
+            notification_outbox.iniciar_worker(app)
+            job_runner.iniciar_worker(app)
         app.run(
             host='0.0.0.0',
             port=5001,
             debug=True,
             use_reloader=True
         )
+    elif len(sys.argv) > 1 and sys.argv[1] == 'sync_dropbox':
+        # Sincronización incremental Dropbox -> BD (usa los cursores guardados)
+        from app.dropbox_sync import sync_all_users
+        with app.app_context():
+            totales = sync_all_users(full='--full' in sys.argv[2:])
+            print(f"Sincronización terminada: {dict(totales)}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'notification_worker':
+        # Worker del outbox de notificaciones externas (email, SMS, WhatsApp)
+        from app.notification_outbox import OutboxWorker
+        worker = OutboxWorker(app)
+        if '--once' in sys.argv[2:]:
+            print(f"Notificaciones procesadas: {worker.drenar()}")
+            worker.detener()
+        else:
+            try:
+                worker.run_forever()
+            except KeyboardInterrupt:
+                worker.detener()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'job_worker':
+        # Worker de la cola de trabajos largos (sincronizaciones, exportaciones, borrados)
+        from app.job_runner import TrabajoWorker
+        worker = TrabajoWorker(app)
+        if '--once' in sys.argv[2:]:
+            print(f"Trabajos procesados: {worker.drenar()}")
+            worker.detener()
+        else:
+            try:
+                worker.run_forever()
+            except KeyboardInterrupt:
+                worker.detener()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'rollups_backfill':
+        # Reconstruye los conteos por hora/día del dashboard
+        from app.utils.rollups import reconstruir_rollups
+        with app.app_context():
+            print(f"Rollups reconstruidos: {reconstruir_rollups()}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'backfill_extensions':
+        # Completa Archivo.extension en filas antiguas
+        from app.utils.dashboard_stats import backfill_file_extensions
+        with app.app_context():
+            print(f"Extensiones actualizadas: {backfill_file_extensions()}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'activity_retention':
+        # Archiva (y opcionalmente compacta) el registro de actividad antiguo
+        from app.activity_retention import LOTE, archivar, compactar
+        opciones = dict(a[2:].split('=', 1) for a in sys.argv[2:] if a.startswith('--') and '=' in a)
+        hot_days = int(opciones['hot-days']) if 'hot-days' in opciones else None
+        with app.app_context():
+            resumen = archivar(
+                hot_days=hot_days,
+                lote=int(opciones.get('batch', LOTE)),
+                max_lotes=int(opciones['max-batches']) if 'max-batches' in opciones else None,
+            )
+            print(f"Actividad archivada: {resumen['filas']} filas en {resumen['lotes']} lotes")
+            if '--compact' in sys.argv[2:]:
+                print(f"Meses compactados: {compactar(hot_days=hot_days)}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'search_reindex':
+        # Crea y reconstruye el índice de búsqueda de archivos
+        from app.utils.file_search import reconstruir_indice
+        with app.app_context():
+            print(f"Archivos indexados: {reconstruir_indice()}")
     elif len(sys.argv) > 1 and sys.argv[1] == 'shell':
         # Ejecutar shell interactivo
         from flask.cli import with_appcontext
@@ -39,9 +103,16 @@ def main():
             import code
             code.interact(local=locals())
     else:
-        print("Uso: python manage.py [run|shell]")
+        print("Uso: python manage.py [run|shell|sync_dropbox|notification_worker|job_worker|rollups_backfill|backfill_extensions|activity_retention|search_reindex]")
         print("  run   - Ejecutar servidor de desarrollo")
         print("  shell - Ejecutar shell interactivo")
+        print("  sync_dropbox [--full] - Sincronizar Dropbox a BD por cursores")
+        print("  notification_worker [--once] - Enviar notificaciones externas pendientes")
+        print("  job_worker [--once] - Ejecutar los trabajos en segundo plano encolados")
+        print("  rollups_backfill - Reconstruir los conteos de los gráficos del dashboard")
+        print("  backfill_extensions - Completar la extensión de archivos antiguos")
+        print("  activity_retention [--hot-days=N] [--batch=N] [--max-batches=N] [--compact] - Archivar el registro de actividad antiguo")
+        print("  search_reindex - Reconstruir el índice de búsqueda de archivos")
 
 if __name__ == '__main__':
     main()
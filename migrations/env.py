@@ -51,6 +51,25 @@ def get_metadata():
     return target_db.metadata
 
 
+# Búsqueda de texto completo (app/utils/file_search.py), creada con SQL propio
+# del motor en la migración e9f0a1b2c3d4: no está en los modelos.
+# SQLite: tabla virtual FTS5 archivo_fts y sus tablas internas (archivo_fts_*).
+TABLA_BUSQUEDA = 'archivo_fts'
+# PostgreSQL: columna generada archivo.busqueda y su índice GIN.
+COLUMNA_BUSQUEDA = ('archivo', 'busqueda')
+INDICE_BUSQUEDA = 'ix_archivo_busqueda'
+
+
+def include_name(name, type_, parent_names):
+    if type_ == 'table':
+        return not (name == TABLA_BUSQUEDA or name.startswith(TABLA_BUSQUEDA + '_'))
+    if type_ == 'column':
+        return (parent_names.get('table_name'), name) != COLUMNA_BUSQUEDA
+    if type_ == 'index':
+        return name != INDICE_BUSQUEDA
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -65,7 +84,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        include_name=include_name
     )
 
     with context.begin_transaction():
@@ -93,6 +113,7 @@ def run_migrations_online():
     conf_args = current_app.extensions['migrate'].configure_args
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
+    conf_args.setdefault("include_name", include_name)
 
     connectable = get_engine()
 
@@ -0,0 +1,51 @@
+"""add trabajo background job queue
+
+Revision ID: a0b1c2d3e4f6
+Revises: f0a1b2c3d4e5
+Create Date: 2026-10-18 23:52:10.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a0b1c2d3e4f6'
+down_revision = 'f0a1b2c3d4e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trabajo',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('tipo', sa.String(length=50), nullable=False),
+    sa.Column('parametros', sa.Text(), nullable=False),
+    sa.Column('clave', sa.String(length=255), nullable=True),
+    sa.Column('estado', sa.String(length=20), nullable=False),
+    sa.Column('usuario_id', sa.Integer(), nullable=True),
+    sa.Column('progreso', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('mensaje', sa.String(length=500), nullable=True),
+    sa.Column('resultado', sa.Text(), nullable=True),
+    sa.Column('ultimo_error', sa.Text(), nullable=True),
+    sa.Column('intentos', sa.Integer(), nullable=False),
+    sa.Column('max_intentos', sa.Integer(), nullable=False),
+    sa.Column('cancelar', sa.Boolean(), nullable=False),
+    sa.Column('proximo_intento', sa.DateTime(), nullable=False),
+    sa.Column('bloqueado_hasta', sa.DateTime(), nullable=True),
+    sa.Column('latido', sa.DateTime(), nullable=True),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=True),
+    sa.Column('fecha_inicio', sa.DateTime(), nullable=True),
+    sa.Column('fecha_fin', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['usuario_id'], ['user.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_trabajo_estado_proximo_intento', 'trabajo', ['estado', 'proximo_intento'], unique=False)
+    op.create_index('ix_trabajo_clave', 'trabajo', ['clave'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_trabajo_clave', table_name='trabajo')
+    op.drop_index('ix_trabajo_estado_proximo_intento', table_name='trabajo')
+    op.drop_table('trabajo')
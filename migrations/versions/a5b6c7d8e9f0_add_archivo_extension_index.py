@@ -0,0 +1,26 @@
+"""add index on archivo.extension
+
+Revision ID: a5b6c7d8e9f0
+Revises: f4a5b6c7d8e9
+Create Date: 2026-10-18 17:48:36.015829
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5b6c7d8e9f0'
+down_revision = 'f4a5b6c7d8e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Las filas antiguas sin extensión se completan con
+    # `python manage.py backfill_extensions`
+    op.create_index('ix_archivo_extension', 'archivo', ['extension'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_archivo_extension', table_name='archivo')
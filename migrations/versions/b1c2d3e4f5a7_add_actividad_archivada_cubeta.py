@@ -0,0 +1,28 @@
+"""add cubeta to actividad_archivada
+
+Revision ID: b1c2d3e4f5a7
+Revises: a0b1c2d3e4f6
+Create Date: 2026-10-19 10:12:44.501937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1c2d3e4f5a7'
+down_revision = 'a0b1c2d3e4f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('actividad_archivada', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cubeta', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_actividad_archivada_mes_cubeta', ['mes', 'cubeta'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('actividad_archivada', schema=None) as batch_op:
+        batch_op.drop_index('ix_actividad_archivada_mes_cubeta')
+        batch_op.drop_column('cubeta')
@@ -0,0 +1,57 @@
+"""add user.notificaciones_no_leidas counter
+
+Revision ID: b6c7d8e9f0a1
+Revises: a5b6c7d8e9f0
+Create Date: 2026-10-18 18:31:57.640213
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6c7d8e9f0a1'
+down_revision = 'a5b6c7d8e9f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('notificaciones_no_leidas', sa.Integer(), nullable=False, server_default='0'))
+
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('notificaciones_no_leidas', sa.Integer))
+    notification = sa.table(
+        'notification',
+        sa.column('user_id', sa.Integer), sa.column('archivo_id', sa.Integer),
+        sa.column('tipo', sa.String), sa.column('leida', sa.Boolean), sa.column('fecha_leida', sa.DateTime),
+    )
+    archivo = sa.table('archivo', sa.column('id', sa.Integer), sa.column('estado', sa.String))
+
+    # Aplicar una vez la regla que antes corría en cada página: las
+    # notificaciones de archivos que ya no están en revisión quedan leídas
+    en_revision = sa.exists().where(archivo.c.id == notification.c.archivo_id, archivo.c.estado == 'en_revision')
+    op.execute(
+        notification.update()
+        .where(
+            notification.c.leida == sa.false(),
+            notification.c.archivo_id.isnot(None),
+            notification.c.tipo != 'estado_archivo',
+            ~en_revision,
+        )
+        .values(leida=True, fecha_leida=datetime.utcnow())
+    )
+
+    no_leidas = (
+        sa.select(sa.func.count())
+        .where(notification.c.user_id == user.c.id, notification.c.leida == sa.false())
+        .scalar_subquery()
+    )
+    op.execute(user.update().values(notificaciones_no_leidas=no_leidas))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('notificaciones_no_leidas')
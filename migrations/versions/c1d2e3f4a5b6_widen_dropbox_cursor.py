@@ -0,0 +1,33 @@
+"""widen user.dropbox_cursor for list_folder cursors
+
+Revision ID: c1d2e3f4a5b6
+Revises: ee0fc1e05e3d
+Create Date: 2026-10-18 10:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1d2e3f4a5b6'
+down_revision = 'ee0fc1e05e3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Los cursores de files_list_folder pueden superar 500 caracteres
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('dropbox_cursor',
+                              existing_type=sa.String(length=500),
+                              type_=sa.Text(),
+                              existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('dropbox_cursor',
+                              existing_type=sa.Text(),
+                              type_=sa.String(length=500),
+                              existing_nullable=True)
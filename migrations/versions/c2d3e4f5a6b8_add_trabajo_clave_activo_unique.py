@@ -0,0 +1,45 @@
+"""unique active trabajo per clave
+
+Revision ID: c2d3e4f5a6b8
+Revises: b1c2d3e4f5a7
+Create Date: 2026-10-19 12:31:05.227419
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d3e4f5a6b8'
+down_revision = 'b1c2d3e4f5a7'
+branch_labels = None
+depends_on = None
+
+ACTIVOS = ('pendiente', 'ejecutando')
+ACTIVO = "estado IN ('pendiente', 'ejecutando')"
+
+
+def upgrade():
+    # Duplicados activos que se colaron antes del índice: se conserva el más antiguo
+    trabajo = sa.table('trabajo', sa.column('id', sa.Integer), sa.column('clave', sa.String),
+                       sa.column('estado', sa.String), sa.column('cancelar', sa.Boolean),
+                       sa.column('mensaje', sa.String), sa.column('fecha_fin', sa.DateTime))
+    otro = trabajo.alias('otro')
+    primero = (
+        sa.select(sa.func.min(otro.c.id))
+        .where(otro.c.clave == trabajo.c.clave, otro.c.estado.in_(ACTIVOS))
+        .scalar_subquery()
+    )
+    op.execute(
+        trabajo.update()
+        .where(trabajo.c.clave.isnot(None), trabajo.c.estado.in_(ACTIVOS), trabajo.c.id > primero)
+        .values(estado='cancelado', cancelar=True, mensaje='Duplicado', fecha_fin=sa.func.current_timestamp())
+    )
+    op.drop_index('ix_trabajo_clave', table_name='trabajo')
+    op.create_index('ux_trabajo_clave_activo', 'trabajo', ['clave'], unique=True,
+                    postgresql_where=sa.text(ACTIVO), sqlite_where=sa.text(ACTIVO))
+
+
+def downgrade():
+    op.drop_index('ux_trabajo_clave_activo', table_name='trabajo')
+    op.create_index('ix_trabajo_clave', 'trabajo', ['clave'], unique=False)
@@ -0,0 +1,59 @@
+"""add notificacion_difundida broadcast notifications
+
+Revision ID: c7d8e9f0a1b2
+Revises: b6c7d8e9f0a1
+Create Date: 2026-10-18 19:12:05.402817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d8e9f0a1b2'
+down_revision = 'b6c7d8e9f0a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('notificacion_difundida',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('audiencia', sa.String(length=20), nullable=False),
+    sa.Column('archivo_id', sa.Integer(), nullable=True),
+    sa.Column('autor_id', sa.Integer(), nullable=True),
+    sa.Column('titulo', sa.String(length=200), nullable=False),
+    sa.Column('mensaje', sa.Text(), nullable=False),
+    sa.Column('titulo_autor', sa.String(length=200), nullable=True),
+    sa.Column('mensaje_autor', sa.Text(), nullable=True),
+    sa.Column('tipo', sa.String(length=50), nullable=False),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['archivo_id'], ['archivo.id'], ),
+    sa.ForeignKeyConstraint(['autor_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_notificacion_difundida_audiencia_fecha_creacion', 'notificacion_difundida',
+                    ['audiencia', 'fecha_creacion'], unique=False)
+    op.create_index('ix_notificacion_difundida_archivo_id', 'notificacion_difundida', ['archivo_id'], unique=False)
+
+    op.create_table('notificacion_difundida_leida',
+    sa.Column('notificacion_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('fecha_leida', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['notificacion_id'], ['notificacion_difundida.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('notificacion_id', 'user_id')
+    )
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('difundidas_leidas_hasta', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('difundidas_leidas_hasta')
+
+    op.drop_table('notificacion_difundida_leida')
+    op.drop_index('ix_notificacion_difundida_archivo_id', table_name='notificacion_difundida')
+    op.drop_index('ix_notificacion_difundida_audiencia_fecha_creacion', table_name='notificacion_difundida')
+    op.drop_table('notificacion_difundida')
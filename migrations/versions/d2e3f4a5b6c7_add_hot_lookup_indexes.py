@@ -0,0 +1,58 @@
+"""add indexes for hot lookup columns
+
+Revision ID: d2e3f4a5b6c7
+Revises: c1d2e3f4a5b6
+Create Date: 2026-10-18 14:02:11.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2e3f4a5b6c7'
+down_revision = 'c1d2e3f4a5b6'
+branch_labels = None
+depends_on = None
+
+
+# (nombre, tabla, columnas)
+INDICES = [
+    ('ix_archivo_dropbox_path', 'archivo', ['dropbox_path']),
+    ('ix_archivo_usuario_id_fecha_subida', 'archivo', ['usuario_id', 'fecha_subida']),
+    ('ix_archivo_estado_fecha_subida', 'archivo', ['estado', 'fecha_subida']),
+    ('ix_archivo_fecha_subida', 'archivo', ['fecha_subida']),
+    ('ix_folder_dropbox_path', 'folder', ['dropbox_path']),
+    ('ix_folder_user_id', 'folder', ['user_id']),
+    ('ix_notification_user_id_leida_fecha_creacion', 'notification', ['user_id', 'leida', 'fecha_creacion']),
+    ('ix_user_activity_log_user_id_fecha', 'user_activity_log', ['user_id', 'fecha']),
+    ('ix_comentario_dropbox_path', 'comentario', ['dropbox_path']),
+]
+
+# En PostgreSQL un btree normal solo sirve a LIKE 'prefijo%' con collation C;
+# varchar_pattern_ops lo habilita con cualquier collation. En SQLite y MySQL
+# los índices de arriba ya cubren las búsquedas por prefijo (ver
+# app.utils.query_utils.filtro_prefijo_ruta).
+INDICES_PREFIJO_POSTGRES = [
+    ('ix_archivo_dropbox_path_prefix', 'archivo', 'dropbox_path'),
+    ('ix_folder_dropbox_path_prefix', 'folder', 'dropbox_path'),
+]
+
+
+def upgrade():
+    for nombre, tabla, columnas in INDICES:
+        op.create_index(nombre, tabla, columnas, unique=False)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        for nombre, tabla, columna in INDICES_PREFIJO_POSTGRES:
+            op.create_index(nombre, tabla, [columna], unique=False,
+                            postgresql_ops={columna: 'varchar_pattern_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for nombre, tabla, _ in reversed(INDICES_PREFIJO_POSTGRES):
+            op.drop_index(nombre, table_name=tabla)
+
+    for nombre, tabla, _ in reversed(INDICES):
+        op.drop_index(nombre, table_name=tabla)
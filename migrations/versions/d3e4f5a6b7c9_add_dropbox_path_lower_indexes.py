@@ -0,0 +1,44 @@
+"""case-insensitive dropbox_path prefix indexes
+
+Revision ID: d3e4f5a6b7c9
+Revises: c2d3e4f5a6b8
+Create Date: 2026-10-19 15:08:37.614290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3e4f5a6b7c9'
+down_revision = 'c2d3e4f5a6b8'
+branch_labels = None
+depends_on = None
+
+
+# filtro_prefijo_ruta compara lower(dropbox_path): rango en SQLite, LIKE en
+# PostgreSQL (varchar_pattern_ops para cualquier collation). Reemplaza a los
+# índices *_dropbox_path_prefix de d2e3f4a5b6c7, que solo servían a un LIKE
+# que distingue mayúsculas.
+INDICES = [
+    ('ix_archivo_dropbox_path_lower', 'archivo', 'ix_archivo_dropbox_path_prefix'),
+    ('ix_folder_dropbox_path_lower', 'folder', 'ix_folder_dropbox_path_prefix'),
+]
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    expresion = 'lower(dropbox_path) varchar_pattern_ops' if postgresql else 'lower(dropbox_path)'
+    for nombre, tabla, anterior in INDICES:
+        if postgresql:
+            op.drop_index(anterior, table_name=tabla)
+        op.create_index(nombre, tabla, [sa.text(expresion)], unique=False)
+
+
+def downgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    for nombre, tabla, anterior in reversed(INDICES):
+        op.drop_index(nombre, table_name=tabla)
+        if postgresql:
+            op.create_index(anterior, tabla, ['dropbox_path'], unique=False,
+                            postgresql_ops={'dropbox_path': 'varchar_pattern_ops'})
@@ -0,0 +1,49 @@
+"""add actividad_archivada and resumen_actividad
+
+Revision ID: d8e9f0a1b2c3
+Revises: c7d8e9f0a1b2
+Create Date: 2026-10-18 20:03:41.918274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8e9f0a1b2c3'
+down_revision = 'c7d8e9f0a1b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('actividad_archivada',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('mes', sa.String(length=7), nullable=False),
+    sa.Column('ruta', sa.String(length=255), nullable=False),
+    sa.Column('id_desde', sa.Integer(), nullable=False),
+    sa.Column('id_hasta', sa.Integer(), nullable=False),
+    sa.Column('filas', sa.Integer(), nullable=False),
+    sa.Column('fecha_desde', sa.DateTime(), nullable=True),
+    sa.Column('fecha_hasta', sa.DateTime(), nullable=True),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_actividad_archivada_mes', 'actividad_archivada', ['mes'], unique=False)
+
+    op.create_table('resumen_actividad',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('mes', sa.String(length=7), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id', 'mes')
+    )
+
+    # Para la selección por antigüedad del archivado
+    op.create_index('ix_user_activity_log_fecha', 'user_activity_log', ['fecha'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_activity_log_fecha', table_name='user_activity_log')
+    op.drop_table('resumen_actividad')
+    op.drop_index('ix_actividad_archivada_mes', table_name='actividad_archivada')
+    op.drop_table('actividad_archivada')
@@ -0,0 +1,50 @@
+"""add notificacion_saliente outbox table
+
+Revision ID: e3f4a5b6c7d8
+Revises: d2e3f4a5b6c7
+Create Date: 2026-10-18 16:20:43.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f4a5b6c7d8'
+down_revision = 'd2e3f4a5b6c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('notificacion_saliente',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('canal', sa.String(length=20), nullable=False),
+    sa.Column('proveedor', sa.String(length=20), nullable=False),
+    sa.Column('funcion', sa.String(length=50), nullable=False),
+    sa.Column('destinatario', sa.String(length=255), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('dedup_key', sa.String(length=64), nullable=False),
+    sa.Column('estado', sa.String(length=20), nullable=False),
+    sa.Column('intentos', sa.Integer(), nullable=False),
+    sa.Column('max_intentos', sa.Integer(), nullable=False),
+    sa.Column('proximo_intento', sa.DateTime(), nullable=False),
+    sa.Column('bloqueado_hasta', sa.DateTime(), nullable=True),
+    sa.Column('ultimo_error', sa.Text(), nullable=True),
+    sa.Column('usuario_id', sa.Integer(), nullable=True),
+    sa.Column('archivo_id', sa.Integer(), nullable=True),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=True),
+    sa.Column('fecha_envio', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['archivo_id'], ['archivo.id'], ),
+    sa.ForeignKeyConstraint(['usuario_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_notificacion_saliente_estado_proximo_intento', 'notificacion_saliente',
+                    ['estado', 'proximo_intento'], unique=False)
+    op.create_index('ix_notificacion_saliente_dedup_key', 'notificacion_saliente', ['dedup_key'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notificacion_saliente_dedup_key', table_name='notificacion_saliente')
+    op.drop_index('ix_notificacion_saliente_estado_proximo_intento', table_name='notificacion_saliente')
+    op.drop_table('notificacion_saliente')
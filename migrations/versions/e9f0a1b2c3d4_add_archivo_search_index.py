@@ -0,0 +1,63 @@
+"""add full-text search index on archivo
+
+Revision ID: e9f0a1b2c3d4
+Revises: d8e9f0a1b2c3
+Create Date: 2026-10-18 21:40:12.118350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9f0a1b2c3d4'
+down_revision = 'd8e9f0a1b2c3'
+branch_labels = None
+depends_on = None
+
+
+SQLITE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS archivo_fts USING fts5("
+    "nombre, descripcion, categoria, subcategoria, "
+    "content='archivo', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_ai AFTER INSERT ON archivo BEGIN "
+    "INSERT INTO archivo_fts(rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.subcategoria); END",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_ad AFTER DELETE ON archivo BEGIN "
+    "INSERT INTO archivo_fts(archivo_fts, rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.subcategoria); END",
+    "CREATE TRIGGER IF NOT EXISTS archivo_fts_au AFTER UPDATE OF nombre, descripcion, categoria, subcategoria "
+    "ON archivo BEGIN "
+    "INSERT INTO archivo_fts(archivo_fts, rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.subcategoria); "
+    "INSERT INTO archivo_fts(rowid, nombre, descripcion, categoria, subcategoria) "
+    "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.subcategoria); END",
+    "INSERT INTO archivo_fts(archivo_fts) VALUES ('rebuild')",
+)
+
+POSTGRESQL = (
+    "ALTER TABLE archivo ADD COLUMN IF NOT EXISTS busqueda tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace(coalesce(nombre, ''), '[^[:alnum:]]+', ' ', 'g')), 'A') || "
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace(coalesce(descripcion, ''), '[^[:alnum:]]+', ' ', 'g')), 'B') || "
+    "setweight(to_tsvector('simple'::regconfig, regexp_replace("
+    "coalesce(categoria, '') || ' ' || coalesce(subcategoria, ''), '[^[:alnum:]]+', ' ', 'g')), 'C')"
+    ") STORED",
+    "CREATE INDEX IF NOT EXISTS ix_archivo_busqueda ON archivo USING gin (busqueda)",
+)
+
+
+def upgrade():
+    dialecto = op.get_bind().dialect.name
+    for sentencia in SQLITE if dialecto == 'sqlite' else POSTGRESQL if dialecto == 'postgresql' else ():
+        op.execute(sentencia)
+
+
+def downgrade():
+    dialecto = op.get_bind().dialect.name
+    if dialecto == 'sqlite':
+        for trigger in ('archivo_fts_ai', 'archivo_fts_ad', 'archivo_fts_au'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS archivo_fts")
+    elif dialecto == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_archivo_busqueda")
+        op.execute("ALTER TABLE archivo DROP COLUMN IF EXISTS busqueda")
@@ -0,0 +1,42 @@
+"""add movimiento_lote background batch moves
+
+Revision ID: f0a1b2c3d4e5
+Revises: e9f0a1b2c3d4
+Create Date: 2026-10-18 22:31:47.506113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0a1b2c3d4e5'
+down_revision = 'e9f0a1b2c3d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movimiento_lote',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('usuario_id', sa.Integer(), nullable=True),
+    sa.Column('origen', sa.String(length=500), nullable=False),
+    sa.Column('destino', sa.String(length=500), nullable=False),
+    sa.Column('estado', sa.String(length=20), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('movidos', sa.Integer(), nullable=False),
+    sa.Column('fallidos', sa.Integer(), nullable=False),
+    sa.Column('errores', sa.Text(), nullable=True),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=True),
+    sa.Column('fecha_inicio', sa.DateTime(), nullable=True),
+    sa.Column('fecha_fin', sa.DateTime(), nullable=True),
+    sa.Column('latido', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['usuario_id'], ['user.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_movimiento_lote_estado', 'movimiento_lote', ['estado'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movimiento_lote_estado', table_name='movimiento_lote')
+    op.drop_table('movimiento_lote')
@@ -0,0 +1,31 @@
+"""add conteo_periodo rollup table
+
+Revision ID: f4a5b6c7d8e9
+Revises: e3f4a5b6c7d8
+Create Date: 2026-10-18 17:05:12.402771
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a5b6c7d8e9'
+down_revision = 'e3f4a5b6c7d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Se llena con `python manage.py rollups_backfill`
+    op.create_table('conteo_periodo',
+    sa.Column('metrica', sa.String(length=20), nullable=False),
+    sa.Column('granularidad', sa.String(length=10), nullable=False),
+    sa.Column('inicio', sa.DateTime(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('metrica', 'granularidad', 'inicio')
+    )
+
+
+def downgrade():
+    op.drop_table('conteo_periodo')
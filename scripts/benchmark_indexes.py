@@ -0,0 +1,300 @@
+"""Benchmark the hot lookup queries with and without the lookup indexes.
+
+This script:
+- Creates the app tables in a scratch database (a temporary SQLite file by
+  default, or --database-url for PostgreSQL/MySQL) and seeds synthetic data:
+  1M Archivo rows by default plus proportional users, folders,
+  notifications, activity log entries and comments.
+- Drops the indexes added by migration d2e3f4a5b6c7 and times each hot query
+  (p50/p99 over --runs executions with random parameters).
+- Recreates the indexes, runs ANALYZE and times the same queries again.
+
+Never point --database-url at a production database: the tables are created
+and dropped by this script.
+
+Usage:
+  venv/bin/python scripts/benchmark_indexes.py
+  venv/bin/python scripts/benchmark_indexes.py --archivos 200000 --runs 500 --explain
+  venv/bin/python scripts/benchmark_indexes.py \
+    --database-url postgresql://localhost/dropboxapp_bench
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import create_engine, desc, func, select, text
+
+# Ensure project root is on sys.path even when running from outside the repo cwd.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app import db
+from app.models import Archivo, Comentario, Folder, Notification, User, UserActivityLog
+from app.utils.query_utils import filtro_prefijo_ruta
+
+CATEGORIAS = ["Personal", "Laboral", "Migratorio", "Financiero", "Educativo", "Medico"]
+ESTADOS = ["en_revision", "validado", "validado", "validado", "rechazado"]
+BENCH_TABLES = [Archivo, Folder, Notification, UserActivityLog, Comentario]
+BATCH = 10_000
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def _insert_batches(conn, table, rows_iter) -> None:
+    batch = []
+    for row in rows_iter:
+        batch.append(row)
+        if len(batch) >= BATCH:
+            conn.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(table.insert(), batch)
+
+
+def seed(engine, n_archivos: int, n_users: int, rnd: random.Random) -> Dict[str, list]:
+    """Seed synthetic data; returns sample keys used as query parameters."""
+    now = datetime.utcnow()
+    n_notifs = max(1, n_archivos // 5)
+    n_logs = max(1, n_archivos // 3)
+    n_comments = max(1, n_archivos // 50)
+
+    user_ids = list(range(1, n_users + 1))
+    folder_paths: List[str] = []
+    file_paths: List[str] = []
+
+    with engine.begin() as conn:
+        _insert_batches(conn, User.__table__, (
+            {
+                "id": uid,
+                "email": f"user{uid}@bench.local",
+                "password_hash": "x",
+                "rol": "cliente",
+                "activo": True,
+                "es_beneficiario": False,
+                "fecha_registro": now,
+            }
+            for uid in user_ids
+        ))
+
+        def folders():
+            for uid in user_ids:
+                for cat in CATEGORIAS:
+                    path = f"/user{uid}@bench.local/{cat}"
+                    folder_paths.append(path)
+                    yield {"name": cat, "user_id": uid, "dropbox_path": path,
+                           "es_publica": True, "fecha_creacion": now}
+
+        _insert_batches(conn, Folder.__table__, folders())
+
+        def archivos():
+            for i in range(n_archivos):
+                uid = rnd.choice(user_ids)
+                cat = rnd.choice(CATEGORIAS)
+                path = f"/user{uid}@bench.local/{cat}/documento_{i}.pdf"
+                if i % 97 == 0:
+                    file_paths.append(path)
+                yield {
+                    "nombre": f"documento_{i}.pdf",
+                    "categoria": cat,
+                    "subcategoria": "",
+                    "dropbox_path": path,
+                    "fecha_subida": now - timedelta(minutes=rnd.randint(0, 60 * 24 * 730)),
+                    "tamano": rnd.randint(10_000, 5_000_000),
+                    "extension": "pdf",
+                    "estado": rnd.choice(ESTADOS),
+                    "es_publica": True,
+                    "usuario_id": uid,
+                }
+
+        _insert_batches(conn, Archivo.__table__, archivos())
+
+        _insert_batches(conn, Notification.__table__, (
+            {
+                "user_id": rnd.choice(user_ids),
+                "titulo": "Archivo subido",
+                "mensaje": "Se ha subido un archivo a tu carpeta.",
+                "tipo": "file_upload",
+                "leida": rnd.random() < 0.8,
+                "fecha_creacion": now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+            }
+            for _ in range(n_notifs)
+        ))
+
+        _insert_batches(conn, UserActivityLog.__table__, (
+            {
+                "user_id": rnd.choice(user_ids),
+                "accion": rnd.choice(["login", "logout", "file_uploaded", "profile_updated"]),
+                "descripcion": "bench",
+                "fecha": now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+            }
+            for _ in range(n_logs)
+        ))
+
+        _insert_batches(conn, Comentario.__table__, (
+            {
+                "user_id": rnd.choice(user_ids),
+                "dropbox_path": rnd.choice(file_paths),
+                "tipo": "archivo",
+                "contenido": "Revisar este documento",
+                "fecha_creacion": now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+            }
+            for _ in range(n_comments)
+        ))
+
+    return {"users": user_ids, "folders": folder_paths, "files": file_paths}
+
+
+def hot_queries(dialect: str) -> List[Tuple[str, Callable]]:
+    """(name, builder(rnd, samples) -> statement) mirroring the routes' lookups."""
+    a, f, n = Archivo.__table__, Folder.__table__, Notification.__table__
+    log, c = UserActivityLog.__table__, Comentario.__table__
+    return [
+        ("archivo_por_ruta (actualizar_estado_archivo)",
+         lambda r, s: select(a.c.id).where(a.c.dropbox_path == r.choice(s["files"]))
+         .order_by(a.c.id.desc()).limit(1)),
+        ("archivos_usuario_recientes (historial)",
+         lambda r, s: select(a.c.id, a.c.nombre).where(a.c.usuario_id == r.choice(s["users"]))
+         .order_by(desc(a.c.fecha_subida)).limit(50)),
+        ("conteo_archivos_usuario (dashboard)",
+         lambda r, s: select(func.count()).select_from(a).where(a.c.usuario_id == r.choice(s["users"]))),
+        ("pendientes_revision_json",
+         lambda r, s: select(a.c.id).where(a.c.estado == "en_revision")
+         .order_by(desc(a.c.fecha_subida)).limit(100)),
+        ("archivos_recientes (api_recent_files)",
+         lambda r, s: select(a.c.id).order_by(desc(a.c.fecha_subida)).limit(10)),
+        ("archivos_en_carpeta (toggle_visibilidad/eliminar_carpeta)",
+         lambda r, s: select(func.count()).select_from(a)
+         .where(filtro_prefijo_ruta(a.c.dropbox_path, r.choice(s["folders"]), dialect))),
+        ("carpeta_por_ruta",
+         lambda r, s: select(f.c.id).where(f.c.dropbox_path == r.choice(s["folders"])).limit(1)),
+        ("carpetas_usuario (carpetas_dropbox)",
+         lambda r, s: select(f.c.id, f.c.dropbox_path).where(f.c.user_id == r.choice(s["users"]))),
+        ("notificaciones_no_leidas",
+         lambda r, s: select(n.c.id).where(n.c.user_id == r.choice(s["users"]), n.c.leida.is_(False))
+         .order_by(desc(n.c.fecha_creacion)).limit(20)),
+        ("conteo_no_leidas (context processor)",
+         lambda r, s: select(func.count()).select_from(n)
+         .where(n.c.user_id == r.choice(s["users"]), n.c.leida.is_(False))),
+        ("actividad_usuario",
+         lambda r, s: select(log.c.id).where(log.c.user_id == r.choice(s["users"]))
+         .order_by(desc(log.c.fecha)).limit(5)),
+        ("comentarios_por_ruta",
+         lambda r, s: select(c.c.id).where(c.c.dropbox_path == r.choice(s["files"]))
+         .order_by(desc(c.c.fecha_creacion))),
+    ]
+
+
+def measure(engine, queries, samples, runs: int, seed_value: int) -> Dict[str, Tuple[float, float]]:
+    results = {}
+    with engine.connect() as conn:
+        for name, build in queries:
+            rnd = random.Random(seed_value)
+            timings = []
+            for _ in range(runs):
+                stmt = build(rnd, samples)
+                started = time.perf_counter()
+                conn.execute(stmt).fetchall()
+                timings.append((time.perf_counter() - started) * 1000.0)
+            results[name] = (_percentile(timings, 50), _percentile(timings, 99))
+    return results
+
+
+def explain(engine, queries, samples, dialect: str) -> None:
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    rnd = random.Random(0)
+    with engine.connect() as conn:
+        for name, build in queries:
+            stmt = build(rnd, samples).compile(engine, compile_kwargs={"literal_binds": True})
+            print(f"  {name}")
+            for row in conn.execute(text(prefix + str(stmt))):
+                print("    " + " | ".join(str(v) for v in row))
+
+
+def bench_indexes(engine):
+    return [index for model in BENCH_TABLES for index in model.__table__.indexes]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark hot queries before/after lookup indexes")
+    parser.add_argument("--database-url", help="Scratch database URL (default: temporary SQLite file)")
+    parser.add_argument("--archivos", type=int, default=1_000_000, help="Archivo rows to seed")
+    parser.add_argument("--users", type=int, default=2_000, help="User rows to seed")
+    parser.add_argument("--runs", type=int, default=200, help="Executions per query and phase")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--explain", action="store_true", help="Print query plans before and after")
+    args = parser.parse_args()
+
+    tmp_path = None
+    url = args.database_url
+    if not url:
+        fd, tmp_path = tempfile.mkstemp(prefix="bench_indexes_", suffix=".db")
+        os.close(fd)
+        url = f"sqlite:///{tmp_path}"
+
+    engine = create_engine(url)
+    dialect = engine.dialect.name
+    metadata = db.metadata
+    try:
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        indexes = bench_indexes(engine)
+        for index in indexes:
+            index.drop(engine)
+
+        print(f"Seeding {args.archivos:,} archivos / {args.users:,} users into {dialect} ...")
+        started = time.perf_counter()
+        samples = seed(engine, args.archivos, args.users, random.Random(args.seed))
+        print(f"  done in {time.perf_counter() - started:.1f}s")
+
+        queries = hot_queries(dialect)
+        if args.explain:
+            print("\nQuery plans WITHOUT indexes:")
+            explain(engine, queries, samples, dialect)
+        before = measure(engine, queries, samples, args.runs, args.seed)
+
+        print(f"\nCreating {len(indexes)} indexes ...")
+        started = time.perf_counter()
+        for index in indexes:
+            index.create(engine)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+        print(f"  done in {time.perf_counter() - started:.1f}s")
+
+        if args.explain:
+            print("\nQuery plans WITH indexes:")
+            explain(engine, queries, samples, dialect)
+        after = measure(engine, queries, samples, args.runs, args.seed)
+
+        width = max(len(name) for name, _ in queries)
+        print(f"\n{'query':<{width}}  {'p50 before':>11} {'p99 before':>11} {'p50 after':>10} {'p99 after':>10} {'p50 x':>7}")
+        for name, _ in queries:
+            b50, b99 = before[name]
+            a50, a99 = after[name]
+            speedup = (b50 / a50) if a50 else float("inf")
+            print(f"{name:<{width}}  {b50:>9.3f}ms {b99:>9.3f}ms {a50:>8.3f}ms {a99:>8.3f}ms {speedup:>6.1f}x")
+        return 0
+    finally:
+        metadata.drop_all(engine)
+        engine.dispose()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
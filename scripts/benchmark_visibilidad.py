@@ -0,0 +1,102 @@
+"""Microbenchmark for the single-pass visibility filter on synthetic trees.
+
+This script:
+- Builds synthetic Dropbox trees ({'_archivos': [...], '_subcarpetas': {...}})
+  of increasing size, with a share of private files and DB-registered folders.
+- Times VisibilidadUsuario.filtrar for each viewer type (admin, owner client)
+  and prints the time per node, which should stay flat as the tree grows
+  (linear scaling).
+- Prints how many queries the previous recursive filters issued for the same
+  tree (two per folder and filter) for comparison; the new filter issues at
+  most three per user regardless of the tree size.
+
+No database or Dropbox access is needed.
+
+Usage:
+  venv/bin/python scripts/benchmark_visibilidad.py
+  venv/bin/python scripts/benchmark_visibilidad.py --sizes 1000 10000 100000 --runs 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+from collections import deque
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Ensure project root is on sys.path even when running from outside the repo cwd.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.utils.visibilidad import VisibilidadUsuario
+
+BASE = "/cliente@example.com"
+
+
+def build_tree(target_nodes: int, rnd: random.Random) -> Tuple[Dict, List[str], List[str]]:
+    """Breadth-first synthetic tree with ~target_nodes files + folders."""
+    root = {"_archivos": [], "_subcarpetas": {}}
+    files: List[str] = []
+    folders: List[str] = []
+    queue = deque([(root, BASE)])
+    nodes = 0
+    while queue and nodes < target_nodes:
+        node, prefix = queue.popleft()
+        for i in range(rnd.randint(3, 8)):
+            name = f"documento_{i}.pdf"
+            node["_archivos"].append(name)
+            files.append(f"{prefix}/{name}")
+            nodes += 1
+        for i in range(rnd.randint(1, 4)):
+            name = f"carpeta_{i}"
+            child = {"_archivos": [], "_subcarpetas": {}}
+            node["_subcarpetas"][name] = child
+            path = f"{prefix}/{name}"
+            folders.append(path)
+            queue.append((child, path))
+            nodes += 1
+    return root, files, folders
+
+
+def time_filter(reglas: VisibilidadUsuario, tree: Dict, runs: int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        started = time.perf_counter()
+        reglas.filtrar(tree, BASE)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the single-pass visibility filter")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 500_000])
+    parser.add_argument("--runs", type=int, default=3, help="Runs per size (best time is reported)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>9} {'folders':>8} {'old queries':>12} {'viewer':>8} {'total ms':>10} {'us/node':>8}")
+    for size in args.sizes:
+        rnd = random.Random(args.seed)
+        tree, files, folders = build_tree(size, rnd)
+        nodes = len(files) + len(folders)
+        privados = [f for f in files if rnd.random() < 0.2]
+        carpetas_bd = [f for f in folders if rnd.random() < 0.3]
+        # Previous implementation: User.get + filter_by per folder, for each of the two filters
+        old_queries = 2 * 2 * (len(folders) + 1)
+
+        for viewer, reglas in (
+            ("admin", VisibilidadUsuario(BASE, (), carpetas_bd, rol_visor="admin")),
+            ("owner", VisibilidadUsuario(BASE, privados, carpetas_bd, rol_visor="cliente", es_duenio=True)),
+        ):
+            elapsed = time_filter(reglas, tree, args.runs)
+            print(f"{nodes:>9} {len(folders):>8} {old_queries:>12} {viewer:>8} "
+                  f"{elapsed * 1000:>10.2f} {elapsed * 1e6 / nodes:>8.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
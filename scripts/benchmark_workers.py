@@ -0,0 +1,311 @@
+"""Benchmark gunicorn sync vs gthread workers against a local fake Dropbox.
+
+This script:
+- Starts a fake Dropbox API on 127.0.0.1 (threaded http.server) that answers
+  users/get_current_account and files/list_folder after --latency-ms.
+- Runs gunicorn with gunicorn.conf.py once per worker class (-k sync, then
+  -k gthread --threads N) serving the real app plus a /_bench/listar route
+  that lists a folder through get_dbx() and runs a database query.
+- Drives each server with --concurrency keep-alive clients for --duration
+  seconds and prints requests/sec, p50, p99 and errors.
+
+The client pool, instrumented proxy and token manager are the real ones; only
+the HTTP transport of the Dropbox SDK is pointed at the fake server. The
+rate-limit scheduler is disabled so it does not cap the measurement. Each run
+uses a scratch directory (SQLite database, metrics, logs), so no .env or
+token file from the project is read.
+
+Usage:
+  venv/bin/python scripts/benchmark_workers.py
+  venv/bin/python scripts/benchmark_workers.py --workers 2 --threads 8 \
+    --concurrency 32 --latency-ms 300 --duration 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+# Ensure project root is on sys.path even when running from outside the repo cwd.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+BENCH_PATH = "/_bench/listar"
+ENTRIES = 50
+
+ACCOUNT = {
+    "account_id": "dbid:AAH4f99T0taONIb-OurWxbNQ6ywGRopQngc",
+    "name": {
+        "given_name": "Bench",
+        "surname": "Worker",
+        "familiar_name": "Bench",
+        "display_name": "Bench Worker",
+        "abbreviated_name": "BW",
+    },
+    "email": "bench@example.com",
+    "email_verified": True,
+    "disabled": False,
+    "locale": "es",
+    "referral_link": "https://db.tt/bench",
+    "is_paired": False,
+    "account_type": {".tag": "basic"},
+    "root_info": {".tag": "user", "root_namespace_id": "3235641", "home_namespace_id": "3235641"},
+}
+
+
+def _listing(path: str) -> dict:
+    entries = [
+        {
+            ".tag": "file",
+            "name": f"doc{i}.pdf",
+            "id": f"id:bench{i:08d}",
+            "client_modified": "2026-01-01T00:00:00Z",
+            "server_modified": "2026-01-01T00:00:00Z",
+            "rev": f"{i + 1:015x}",
+            "size": 1024 * (i + 1),
+            "path_lower": f"{path.lower()}/doc{i}.pdf",
+            "path_display": f"{path}/doc{i}.pdf",
+        }
+        for i in range(ENTRIES)
+    ]
+    return {"entries": entries, "cursor": "bench-cursor", "has_more": False}
+
+
+# ---------------------------------------------------------------------------
+# Fake Dropbox API
+# ---------------------------------------------------------------------------
+
+def start_fake_dropbox(latency: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):  # keep the benchmark output readable
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            time.sleep(latency)
+            if self.path == "/2/users/get_current_account":
+                status, payload = 200, ACCOUNT
+            elif self.path == "/2/files/list_folder":
+                arg = json.loads(body or b"{}")
+                status, payload = 200, _listing(arg.get("path") or "")
+            else:
+                status, payload = 409, {"error_summary": "not_found/", "error": {".tag": "other"}}
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------------------------------------------------------------------
+# App served by gunicorn
+# ---------------------------------------------------------------------------
+
+def create_bench_app():
+    """App factory for gunicorn: the real app, Dropbox SDK pointed at the fake API."""
+    import dropbox.dropbox_client
+    from flask import jsonify
+    from requests.adapters import HTTPAdapter
+
+    from app import create_app, db
+    from app.dropbox_utils import get_dbx, with_base_folder
+    from app.models import User
+
+    base = os.environ["BENCH_FAKE_DROPBOX_URL"]
+    original_create_session = dropbox.dropbox_client.create_session
+
+    class FakeDropboxAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            request.url = base + urlsplit(request.url).path
+            return super().send(request, **kwargs)
+
+    def create_session(max_connections=8, proxies=None, ca_certs=None):
+        session = original_create_session(max_connections=max_connections, proxies=proxies, ca_certs=ca_certs)
+        session.mount("https://", FakeDropboxAdapter(pool_maxsize=max_connections))
+        return session
+
+    dropbox.dropbox_client.create_session = create_session
+
+    app = create_app("production")
+    with app.app_context():
+        db.create_all()
+
+    @app.route(BENCH_PATH)
+    def bench_listar():
+        dbx = get_dbx()
+        if dbx is None:
+            return jsonify({"error": "sin cliente de Dropbox"}), 503
+        listing = dbx.files_list_folder(with_base_folder("/"))
+        return jsonify({"entries": len(listing.entries), "usuarios": User.query.count()})
+
+    return app
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            conn.request("GET", BENCH_PATH)
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"gunicorn did not answer {BENCH_PATH} on port {port}")
+
+
+def drive(port: int, concurrency: int, duration: float) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        mine: List[float] = []
+        failed = 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", BENCH_PATH)
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    mine.append(time.perf_counter() - start)
+                else:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000.0,
+        "p99_ms": _percentile(latencies, 99) * 1000.0,
+    }
+
+
+def run(worker_class: str, args, fake_url: str) -> Dict[str, float]:
+    scratch = Path(tempfile.mkdtemp(prefix=f"bench_{worker_class}_"))
+    port = _free_port()
+    env = dict(
+        os.environ,
+        BENCH_FAKE_DROPBOX_URL=fake_url,
+        DATABASE_URL=f"sqlite:///{scratch / 'bench.db'}",
+        PROMETHEUS_MULTIPROC_DIR=str(scratch / "metrics"),
+        STRUCTURE_CACHE_SQLITE_PATH=str(scratch / "structure_cache.sqlite3"),
+        DROPBOX_RATE_LIMIT_ENABLED="false",
+        DROPBOX_ACCESS_TOKEN="bench-token",
+        DROPBOX_REFRESH_TOKEN="",
+        DROPBOX_APP_KEY="",
+        DROPBOX_APP_SECRET="",
+        DROPBOX_BASE_SHARED_LINK="",
+        DROPBOX_BASE_FOLDER="/bench",
+        NOTIFICATION_OUTBOX_WORKER="external",
+    )
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "-c", str(PROJECT_ROOT / "gunicorn.conf.py"),
+        "--chdir", str(scratch),
+        "--pythonpath", str(PROJECT_ROOT),
+        "-b", f"127.0.0.1:{port}",
+        "-w", str(args.workers),
+        "-k", worker_class,
+        "--threads", str(args.threads if worker_class == "gthread" else 1),
+        "scripts.benchmark_workers:create_bench_app()",
+    ]
+    with open(scratch / "gunicorn.log", "w") as log:
+        server = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            _wait_ready(port, timeout=60)
+            return drive(port, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker in gthread mode")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent keep-alive clients")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds of load per configuration")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="fake Dropbox latency per call")
+    args = parser.parse_args(argv)
+
+    fake = start_fake_dropbox(args.latency_ms / 1000.0)
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    print(
+        f"{args.workers} workers, {args.concurrency} clients, {args.duration:.0f}s each, "
+        f"fake Dropbox latency {args.latency_ms:.0f} ms"
+    )
+    print(f"{'worker class':<22}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'requests':>10}{'errors':>8}")
+    for worker_class in ("sync", "gthread"):
+        label = worker_class if worker_class == "sync" else f"gthread x{args.threads}"
+        result = run(worker_class, args, fake_url)
+        print(
+            f"{label:<22}{result['rps']:>9.1f}{result['p50_ms']:>10.0f}{result['p99_ms']:>10.0f}"
+            f"{result['requests']:>10}{result['errors']:>8}"
+        )
+    fake.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,351 @@
+"""Exercise the shared Dropbox rate limiter against a fake API that answers 429.
+
+This script:
+- Starts a fake Dropbox API on 127.0.0.1 (threaded http.server) that answers
+  files/list_folder and, when armed, opens a throttle window: every request
+  that arrives inside it gets 429 with Retry-After set to the seconds left.
+  The server logs the arrival time, calling pid and status of each request.
+- Points real dropbox.Dropbox clients (max_retries_on_rate_limit=0, as in
+  the app's pool) at it and calls them through the real instrumented proxy
+  (app/dropbox_metrics.py) and scheduler (app/dropbox_rate_limit.py) backed
+  by a scratch SQLite bucket. Worker processes are forked, as gunicorn does
+  with preload_app, and share that bucket.
+- Checks:
+  * backoff: after a 429 with Retry-After the call is retried, and not
+    before Retry-After has elapsed;
+  * penalty: a 429 seen by one process blocks every process sharing the
+    bucket until the window closes, then all of them resume;
+  * reserve: background callers stop at the interactive token and
+    concurrency reserves while interactive calls still go through at once;
+  * dead pids: turns held by a live process are respected, and the turns of
+    a process that died without releasing them are reclaimed.
+
+The priority the app derives from the request context (prioridad_actual) is
+passed explicitly here. No .env, token file or real Dropbox call is used.
+
+Prints one line per check and exits non-zero if any fails.
+
+Usage:
+  venv/bin/python scripts/check_dropbox_rate_limit.py
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Tuple
+from urllib.parse import urlsplit
+
+# Ensure project root is on sys.path even when running from outside the repo cwd.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import dropbox
+from requests.adapters import HTTPAdapter
+
+from app import dropbox_rate_limit as rate_limit
+from app.dropbox_metrics import DropboxInstrumentado
+
+# Seconds a request may still arrive after the window opens (calls already in flight)
+GRACE = 0.3
+LISTING = {"entries": [], "cursor": "check-cursor", "has_more": False}
+
+
+# ---------------------------------------------------------------------------
+# Fake Dropbox API
+# ---------------------------------------------------------------------------
+
+class FakeDropbox:
+    """Threaded fake API that logs every request and can open a 429 window."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log: List[Tuple[float, int, int]] = []
+        self.latency = 0.0
+        self.armed = 0
+        self.window_start = 0.0
+        self.window_end = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):  # keep the check output readable
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                status, retry_after = fake.arrive(int(self.headers.get("X-Check-Pid") or 0))
+                if status == 200:
+                    with fake.lock:
+                        fake.in_flight += 1
+                        fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                    time.sleep(fake.latency)
+                    with fake.lock:
+                        fake.in_flight -= 1
+                    data = json.dumps(LISTING).encode()
+                else:
+                    data = b"too_many_requests"
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json" if status == 200 else "text/plain")
+                if retry_after:
+                    self.send_header("Retry-After", str(retry_after))
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def arrive(self, pid: int) -> Tuple[int, int]:
+        now = time.time()
+        with self.lock:
+            if self.armed and now >= self.window_end:
+                self.window_start, self.window_end = now, now + self.armed
+                self.armed = 0
+            if now < self.window_end:
+                status, retry_after = 429, max(1, math.ceil(self.window_end - now))
+            else:
+                status, retry_after = 200, 0
+            self.log.append((now, pid, status))
+        return status, retry_after
+
+    def throttle(self, seconds: int) -> None:
+        """The next request opens a window of ``seconds`` answered with 429."""
+        with self.lock:
+            self.armed = seconds
+
+    def reset(self, latency: float = 0.0) -> None:
+        with self.lock:
+            self.log = []
+            self.latency = latency
+            self.armed = 0
+            self.window_start = self.window_end = 0.0
+            self.max_in_flight = 0
+
+    def requests(self) -> List[Tuple[float, int, int]]:
+        with self.lock:
+            return list(self.log)
+
+
+def make_client(fake_url: str) -> dropbox.Dropbox:
+    """SDK client like the app's pool, its HTTPS transport pointed at the fake API."""
+
+    class FakeDropboxAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            request.url = fake_url + urlsplit(request.url).path
+            return super().send(request, **kwargs)
+
+    session = dropbox.create_session(max_connections=16)
+    session.mount("https://", FakeDropboxAdapter(pool_maxsize=16))
+    return dropbox.Dropbox(
+        oauth2_access_token="check-token",
+        max_retries_on_rate_limit=0,
+        session=session,
+        headers={"X-Check-Pid": str(os.getpid())},
+    )
+
+
+def use_scheduler(scratch: Path, name: str, espera_interactiva: float = 10.0,
+                  espera_segundo_plano: float = 30.0, **bucket) -> rate_limit.SQLiteBucket:
+    """Install a scheduler over a fresh bucket as the process-wide one (as get_planificador does)."""
+    cubeta = rate_limit.SQLiteBucket(str(scratch / f"{name}.sqlite3"), **bucket)
+    rate_limit.planificador = rate_limit.Planificador(
+        cubeta, espera_interactiva=espera_interactiva, espera_segundo_plano=espera_segundo_plano,
+    )
+    return cubeta
+
+
+def listar(fake_url: str, prioridad: str) -> None:
+    DropboxInstrumentado(make_client(fake_url), None, prioridad).files_list_folder("/check")
+
+
+# ---------------------------------------------------------------------------
+# Worker processes (forked, sharing the bucket file)
+# ---------------------------------------------------------------------------
+
+def keep_calling(fake_url: str, seconds: float) -> None:
+    dbx = DropboxInstrumentado(make_client(fake_url), None, rate_limit.SEGUNDO_PLANO)
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        dbx.files_list_folder("/check")
+        time.sleep(0.02)
+
+
+def hold_turns(cubeta: rate_limit.SQLiteBucket, turns: int, ready, release) -> None:
+    for _ in range(turns):
+        cubeta.intentar(rate_limit.SEGUNDO_PLANO)
+    ready.set()
+    release.wait(30)
+    # Dies without liberar(), as a worker killed mid-call would
+    os._exit(0)
+
+
+# ---------------------------------------------------------------------------
+# Checks
+# ---------------------------------------------------------------------------
+
+def check_backoff(fake: FakeDropbox, scratch: Path, check) -> None:
+    fake.reset()
+    use_scheduler(scratch, "backoff", tasa=50.0, capacidad=10.0, reserva=0.0)
+    fake.throttle(2)
+    started = time.time()
+    error = None
+    try:
+        listar(fake.url, rate_limit.SEGUNDO_PLANO)
+    except Exception as e:  # reported in the check line
+        error = e
+    log = fake.requests()
+    statuses = [status for _, _, status in log]
+    gap = log[1][0] - log[0][0] if len(log) > 1 else 0.0
+    check("backoff: call is retried once Retry-After has elapsed",
+          error is None and statuses == [429, 200] and gap >= 2.0 - 0.05,
+          f"error={error!r} statuses={statuses} gap={gap:.2f}s total={time.time() - started:.2f}s")
+
+
+def check_penalty(fake: FakeDropbox, scratch: Path, check, ctx) -> None:
+    fake.reset()
+    use_scheduler(scratch, "penalty", tasa=50.0, capacidad=10.0, reserva=0.0, concurrencia=8,
+                  reserva_concurrencia=0)
+    workers = [ctx.Process(target=keep_calling, args=(fake.url, 5.0)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    time.sleep(1.5)
+    fake.throttle(2)
+    for w in workers:
+        w.join(30)
+    log = fake.requests()
+    pids = {w.pid for w in workers}
+    start, end = fake.window_start, fake.window_end
+    before = {pid for t, pid, _ in log if t < start}
+    during = [(t - start, pid) for t, pid, _ in log if start + GRACE <= t < end]
+    after = {pid for t, pid, status in log if t >= end and status == 200}
+    throttled = sum(1 for _, _, status in log if status == 429)
+    check("penalty: a 429 in one process blocks every process",
+          start > 0 and before == pids and not during and after == pids
+          and all(w.exitcode == 0 for w in workers),
+          f"window={end - start:.1f}s calls inside={len(during)} 429s={throttled} "
+          f"active before={len(before & pids)}/3 after={len(after & pids)}/3 "
+          f"exit codes={[w.exitcode for w in workers]}")
+
+
+def check_reserve(fake: FakeDropbox, scratch: Path, check) -> None:
+    # Tokens: capacity 6, reserve 4 -> background gets 2 calls, then waits for the refill
+    fake.reset()
+    cubeta = use_scheduler(scratch, "reserve_tokens", tasa=0.2, capacidad=6.0, reserva=4.0,
+                           concurrencia=0, espera_segundo_plano=2.0)
+    background = {"ok": 0, "limited": 0}
+    lock = threading.Lock()
+
+    def background_call():
+        try:
+            listar(fake.url, rate_limit.SEGUNDO_PLANO)
+            outcome = "ok"
+        except dropbox.exceptions.RateLimitError:
+            outcome = "limited"
+        with lock:
+            background[outcome] += 1
+
+    threads = [threading.Thread(target=background_call) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    waits = []
+    for _ in range(3):
+        started = time.monotonic()
+        listar(fake.url, rate_limit.INTERACTIVA)
+        waits.append(time.monotonic() - started)
+    for t in threads:
+        t.join()
+    check("reserve: background stops at the interactive token reserve",
+          background == {"ok": 2, "limited": 2} and max(waits) < 0.25,
+          f"background={background} interactive waits={[round(w, 2) for w in waits]} "
+          f"tokens={cubeta.estado()['tokens']}")
+
+    # Concurrency: 3 slots, 1 reserved -> background keeps at most 2 calls in flight
+    fake.reset(latency=1.0)
+    use_scheduler(scratch, "reserve_slots", tasa=100.0, capacidad=100.0, reserva=0.0,
+                  concurrencia=3, reserva_concurrencia=1)
+    threads = [threading.Thread(target=listar, args=(fake.url, rate_limit.SEGUNDO_PLANO)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.3)
+    started = time.monotonic()
+    listar(fake.url, rate_limit.INTERACTIVA)
+    interactive = time.monotonic() - started
+    for t in threads:
+        t.join()
+    check("reserve: background stops at the interactive concurrency reserve",
+          fake.max_in_flight == 3 and interactive < 1.3,
+          f"max in flight={fake.max_in_flight} interactive={interactive:.2f}s")
+    fake.reset()
+
+
+def check_dead_pids(fake: FakeDropbox, scratch: Path, check, ctx) -> None:
+    fake.reset()
+    cubeta = use_scheduler(scratch, "dead_pids", tasa=100.0, capacidad=100.0, reserva=0.0,
+                           concurrencia=2, reserva_concurrencia=0, espera_segundo_plano=1.0)
+    ready, release = ctx.Event(), ctx.Event()
+    holder = ctx.Process(target=hold_turns, args=(cubeta, 2, ready, release))
+    holder.start()
+    ready.wait(10)
+    try:
+        listar(fake.url, rate_limit.SEGUNDO_PLANO)
+        blocked = False
+    except dropbox.exceptions.RateLimitError:
+        blocked = True
+    release.set()
+    holder.join(10)
+    held = sum(cubeta.estado()["en_curso"].values())
+    started = time.monotonic()
+    error = None
+    try:
+        listar(fake.url, rate_limit.SEGUNDO_PLANO)
+    except Exception as e:  # reported in the check line
+        error = e
+    waited = time.monotonic() - started
+    left = sum(cubeta.estado()["en_curso"].values())
+    check("dead pids: live holders are respected, dead ones are reclaimed",
+          blocked and held == 2 and error is None and waited < 0.5 and left == 0,
+          f"blocked while alive={blocked} held after exit={held} error={error!r} "
+          f"wait={waited:.2f}s left={left}")
+
+
+def main() -> int:
+    scratch = Path(tempfile.mkdtemp(prefix="rate_limit_check_"))
+    ctx = multiprocessing.get_context("fork")
+    fake = FakeDropbox()
+    results = []
+
+    def check(name: str, ok: bool, detail: str = "") -> None:
+        results.append(ok)
+        print(f"{'PASS' if ok else 'FAIL'}  {name}  ({detail})")
+
+    check_backoff(fake, scratch, check)
+    check_penalty(fake, scratch, check, ctx)
+    check_reserve(fake, scratch, check)
+    check_dead_pids(fake, scratch, check, ctx)
+    fake.server.shutdown()
+
+    failed = results.count(False)
+    print(f"\n{len(results) - failed}/{len(results)} checks passed (scratch: {scratch})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,231 @@
+"""Exercise the notification outbox (claim, retry, dedup) with local providers.
+
+This script:
+- Creates the app tables in a scratch SQLite database and seeds a user and a
+  document.
+- Replaces the email/SMS/WhatsApp senders (external_notifications.ENVIADORES)
+  with local stand-ins that record every call and can fail on demand, and
+  reports every channel as configured. No SMTP, SendGrid or Twilio call is
+  made.
+- Runs the real enqueue helper, claim, processing and OutboxWorker code and
+  checks:
+  * claim: two workers draining the same rows concurrently send each row
+    exactly once, and a row whose lease expired is picked up again;
+  * retry: a provider that fails twice is retried until it succeeds, and one
+    that always fails stops at max_intentos;
+  * dedup: the same send is not enqueued twice within
+    NOTIFICATION_OUTBOX_DEDUP_SECONDS, a concurrent duplicate row is marked
+    duplicada instead of sent, and the same send enqueued after the window is
+    delivered again.
+
+Prints one line per check and exits non-zero if any fails.
+
+Usage:
+  venv/bin/python scripts/check_notification_outbox.py
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+# Ensure project root is on sys.path even when running from outside the repo cwd.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import config
+from app import create_app, db
+from app import notification_outbox as outbox
+from app.models import Archivo, NotificacionSaliente, User
+from app.utils import external_notifications
+
+DEDUP_SECONDS = 600
+
+
+class LocalProviders:
+    """Stand-ins for the senders: record calls, fail the first N per recipient."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def sender(self, funcion: str) -> Callable[..., bool]:
+        def send(**kwargs) -> bool:
+            destinatario = kwargs.get("destinatario") or kwargs.get("telefono")
+            with self._lock:
+                self.calls[(funcion, destinatario)] += 1
+                pending = self.failures.get(destinatario, 0)
+                if pending:
+                    self.failures[destinatario] = pending - 1
+                    raise ConnectionError(f"{funcion}: provider unavailable")
+            return True
+
+        return send
+
+    def install(self):
+        for funcion in list(external_notifications.ENVIADORES):
+            external_notifications.ENVIADORES[funcion] = self.sender(funcion)
+        external_notifications.canal_configurado = lambda canal: True
+
+
+def make_app(scratch: Path):
+    config.TestingConfig.SQLALCHEMY_DATABASE_URI = f"sqlite:///{scratch / 'outbox.db'}"
+    config.TestingConfig.NOTIFICATION_OUTBOX_BACKOFF_SECONDS = 0
+    config.TestingConfig.NOTIFICATION_OUTBOX_MAX_ATTEMPTS = 3
+    config.TestingConfig.NOTIFICATION_OUTBOX_DEDUP_SECONDS = DEDUP_SECONDS
+    app = create_app("testing")
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed_user(email: str, telefono: str | None = None) -> Tuple[int, int]:
+    user = User(email=email, nombre="Outbox", apellido="Check", rol="cliente",
+                password_hash="x", telefono=telefono)
+    db.session.add(user)
+    db.session.flush()
+    archivo = Archivo(nombre=f"{email}.pdf", categoria="Personal", subcategoria="Pasaportes",
+                      dropbox_path=f"/{email}/{email}.pdf", usuario_id=user.id)
+    db.session.add(archivo)
+    db.session.commit()
+    return user.id, archivo.id
+
+
+def enqueue(user_id: int, archivo_id: int, estado: str, comentario: str | None = None) -> List[int]:
+    usuario = db.session.get(User, user_id)
+    archivo = db.session.get(Archivo, archivo_id)
+    filas = outbox.encolar_notificaciones_documento(usuario, archivo, estado, comentario)
+    db.session.commit()
+    return [f.id for f in filas]
+
+
+def states(ids: List[int]) -> List[str]:
+    db.session.expire_all()
+    return [db.session.get(NotificacionSaliente, i).estado for i in ids]
+
+
+def drain(app, workers: int = 1) -> None:
+    pool = [outbox.OutboxWorker(app, limites={"smtp": 2, "sendgrid": 2, "twilio": 2}, poll_seconds=0.05)
+            for _ in range(workers)]
+    threads = [threading.Thread(target=w.drenar) for w in pool]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for w in pool:
+        w.detener()
+
+
+def main() -> int:
+    scratch = Path(tempfile.mkdtemp(prefix="outbox_check_"))
+    app = make_app(scratch)
+    providers = LocalProviders()
+    providers.install()
+    results = []
+
+    def check(name: str, ok: bool, detail: str = "") -> None:
+        results.append(ok)
+        print(f"{'PASS' if ok else 'FAIL'}  {name}{f'  ({detail})' if detail and not ok else ''}")
+
+    with app.app_context():
+        # --- claim: two workers, each row sent once
+        ids = []
+        for i in range(20):
+            user_id, archivo_id = seed_user(f"claim{i}@example.com", telefono=f"+1555000{i:04d}")
+            ids += enqueue(user_id, archivo_id, "rechazado", "Documento ilegible")
+        db.session.remove()
+        drain(app, workers=2)
+        sent = [c for (funcion, dest), c in providers.calls.items() if dest.startswith(("claim", "+1555"))]
+        check("claim: two workers send every row exactly once",
+              len(sent) == len(ids) and set(sent) == {1} and set(states(ids)) == {outbox.ENVIADA},
+              f"{len(sent)} recipients, counts {sorted(set(sent))}, states {Counter(states(ids))}")
+
+        # --- claim: expired lease is reclaimed, a live one is not
+        user_id, archivo_id = seed_user("lease@example.com")
+        (fila_id,) = enqueue(user_id, archivo_id, "validado")
+        fila = db.session.get(NotificacionSaliente, fila_id)
+        fila.estado = outbox.ENVIANDO
+        fila.bloqueado_hasta = datetime.utcnow() + timedelta(minutes=5)
+        db.session.commit()
+        live = outbox.reclamar(fila_id)
+        fila = db.session.get(NotificacionSaliente, fila_id)
+        fila.bloqueado_hasta = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        expired = outbox.reclamar(fila_id)
+        outbox.procesar(fila_id)
+        check("claim: live lease is skipped, expired lease is reclaimed",
+              not live and expired and states([fila_id]) == [outbox.ENVIADA],
+              f"live={live} expired={expired} state={states([fila_id])}")
+
+        # --- retry: two failures then success; permanent failure stops at max_intentos
+        user_id, archivo_id = seed_user("flaky@example.com")
+        (flaky,) = enqueue(user_id, archivo_id, "validado")
+        providers.failures["flaky@example.com"] = 2
+        user_id, archivo_id = seed_user("down@example.com")
+        (down,) = enqueue(user_id, archivo_id, "validado")
+        providers.failures["down@example.com"] = 10 ** 6
+        db.session.remove()
+        drain(app)
+        f1 = db.session.get(NotificacionSaliente, flaky)
+        f2 = db.session.get(NotificacionSaliente, down)
+        check("retry: transient failures are retried until sent",
+              f1.estado == outbox.ENVIADA and f1.intentos == 3,
+              f"state={f1.estado} intentos={f1.intentos}")
+        check("retry: permanent failure stops at max_intentos",
+              f2.estado == outbox.FALLIDA and f2.intentos == f2.max_intentos and f2.ultimo_error,
+              f"state={f2.estado} intentos={f2.intentos}/{f2.max_intentos}")
+
+        # --- dedup: same send within the window is not enqueued again
+        user_id, archivo_id = seed_user("dedup@example.com")
+        first = enqueue(user_id, archivo_id, "validado", "ok")
+        again = enqueue(user_id, archivo_id, "validado", "ok")
+        check("dedup: same send is not enqueued twice within the window",
+              len(first) == 1 and again == [], f"first={first} again={again}")
+
+        # --- dedup: a concurrent duplicate row is marked duplicada, not sent
+        original = db.session.get(NotificacionSaliente, first[0])
+        twin = NotificacionSaliente(
+            canal=original.canal, proveedor=original.proveedor, funcion=original.funcion,
+            destinatario=original.destinatario, payload=original.payload, dedup_key=original.dedup_key,
+            estado=outbox.PENDIENTE, intentos=0, max_intentos=3, proximo_intento=datetime.utcnow(),
+            usuario_id=user_id, archivo_id=archivo_id, fecha_creacion=original.fecha_creacion,
+        )
+        db.session.add(twin)
+        db.session.commit()
+        twin_id = twin.id
+        db.session.remove()
+        drain(app)
+        calls = providers.calls[("email_validado", "dedup@example.com")]
+        check("dedup: concurrent duplicate is marked duplicada",
+              sorted(states([first[0], twin_id])) == sorted([outbox.ENVIADA, outbox.DUPLICADA]) and calls == 1,
+              f"states={states([first[0], twin_id])} calls={calls}")
+
+        # --- dedup: the same send after the window is delivered again
+        old = db.session.get(NotificacionSaliente, first[0])
+        old.fecha_creacion = datetime.utcnow() - timedelta(seconds=DEDUP_SECONDS * 3)
+        old_twin = db.session.get(NotificacionSaliente, twin_id)
+        old_twin.fecha_creacion = old.fecha_creacion
+        db.session.commit()
+        later = enqueue(user_id, archivo_id, "validado", "ok")
+        db.session.remove()
+        drain(app)
+        calls = providers.calls[("email_validado", "dedup@example.com")]
+        check("dedup: the same send after the window is delivered",
+              len(later) == 1 and states(later) == [outbox.ENVIADA] and calls == 2,
+              f"later={later} states={states(later) if later else []} calls={calls}")
+
+    failed = results.count(False)
+    print(f"\n{len(results) - failed}/{len(results)} checks passed (scratch: {scratch})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())